@@ -0,0 +1,244 @@
+"""
+Сверка runtime AmneziaWG на eu1 с БД (desired state → план → пакет).
+
+Желаемое состояние считается одним запросом (db_peers_desired_state): peer
+должен быть в runtime своего шарда, если слот active=1 и доступ не истёк
+больше GRACE_PERIOD_HOURS назад (как enforce_expired); peer'ы тёплого пула —
+тоже. Runtime — один SSH на ноду: `awg show <iface> dump` всех шардов.
+
+План минимальный:
+  add    — missing (нет в runtime), allowed_ips (другой адрес), misplaced
+           (peer в чужом шарде: добавить в свой…)
+  remove — revoked (active=0), expired (active=1, но доступ истёк),
+           misplaced (…и убрать из чужого)
+Применяется пакетом (AwgPeerBatch: один SSH, save-conf раз на шард).
+
+Чего сверка НЕ делает:
+  - не трогает peer'ы, которых нет ни в peers, ни в пуле (legacy/owner/admin —
+    инцидент 2026-05-29), только считает их в отчёте (unknown);
+  - не трогает шарды, чей dump не получен, и слоты шардов, которых нет в
+    AMNEZIAWG_EU1_SHARDS;
+  - не пишет в БД: active=False/уведомления — дело enforce_expired.
+
+Лимиты на прогон: max_adds / max_removes (остальное — deferred, доедет на
+следующем прогоне); удаления блокируются целиком, если план снимает больше
+_MAX_REMOVE_FRACTION runtime-peer'ов шарда (пустая/чужая БД, сбой запроса).
+
+Запуск по cron — scripts/awg_reconcile.py (по умолчанию dry-run).
+"""
+
+import logging
+import shlex
+import time
+from typing import Dict, List, Optional, Tuple
+
+from .awg_shards import get_awg_shards, resolve_shard
+from .database import db_peers_desired_state, db_warm_pool_list
+from .wg_errors import UnknownAwgShardError
+
+logger = logging.getLogger(__name__)
+
+_NODE = "eu1"
+GRACE_PERIOD_HOURS = 12          # = scripts/enforce_expired.GRACE_PERIOD_HOURS
+DEFAULT_MAX_ADDS = 50
+DEFAULT_MAX_REMOVES = 20
+_MAX_REMOVE_FRACTION = 0.2
+_MIN_REMOVES_GUARDED = 5         # до стольких удалений guard по доле не срабатывает
+_DUMP_MARK = "AWG_DUMP"
+
+
+def fetch_awg_runtime(env: Optional[dict] = None) -> Tuple[Dict[str, Dict[str, str]], List[str]]:
+    """
+    `awg show <iface> dump` всех шардов eu1 одним SSH.
+    Возвращает ({shard: {public_key: allowed_ips}}, failed) — failed: шарды,
+    чей dump не получен (их peer'ы в runtime неизвестны).
+    """
+    from .wireguard_peers import _load_env, execute_server_command
+
+    if env is None:
+        env = _load_env()
+    shards = get_awg_shards(env)
+    script = "\n".join(
+        f"echo {shlex.quote(f'{_DUMP_MARK}:{s.name}')}; "
+        f"docker exec {shlex.quote(s.container)} awg show {shlex.quote(s.interface)} dump "
+        f"|| echo {shlex.quote(f'{_DUMP_MARK}:FAIL')}"
+        for s in shards
+    )
+    stdout, _stderr = execute_server_command(_NODE, script, timeout=20)
+
+    runtime: Dict[str, Dict[str, str]] = {}
+    current: Optional[str] = None
+    for line in (stdout or "").splitlines():
+        if line.startswith(f"{_DUMP_MARK}:"):
+            name = line.split(":", 1)[1]
+            if name == "FAIL":
+                if current is not None:
+                    runtime.pop(current, None)
+                current = None
+            else:
+                current = name
+            continue
+        if current is None:
+            continue
+        if current not in runtime:    # первая строка — интерфейс: шард ответил
+            runtime[current] = {}
+            continue
+        parts = line.split("\t")
+        if len(parts) >= 8:
+            runtime[current][parts[0].strip()] = parts[3].strip()
+    failed = [s.name for s in shards if s.name not in runtime]
+    return runtime, failed
+
+
+def _host_ip(wg_ip: str) -> str:
+    return f"{(wg_ip or '').split('/')[0].strip()}/32"
+
+
+def plan_awg_reconcile(
+    desired_rows: List[Dict],
+    pool_rows: List[Dict],
+    runtime: Dict[str, Dict[str, str]],
+    failed_shards: List[str],
+    env: Optional[dict] = None,
+) -> Dict:
+    """
+    Чистая функция: строки db_peers_desired_state + пул + runtime → план.
+    Возвращает {"add": [...], "remove": [...], "unknown": {shard: [pk]},
+    "unknown_shard": [...], "runtime": {shard: n}, "desired": {shard: n}}.
+    """
+    configured = {s.name for s in get_awg_shards(env)}
+    wanted: Dict[str, Dict] = {}      # pk → {shard, allowed_ips, telegram_id}
+    unwanted: Dict[str, Dict] = {}    # pk → {telegram_id, reason}
+    unknown_shard: List[Dict] = []
+
+    for row in desired_rows:
+        pk = (row.get("public_key") or "").strip()
+        if not pk:
+            continue
+        try:
+            shard = resolve_shard(row.get("shard"), env).name
+        except UnknownAwgShardError:
+            unknown_shard.append({"public_key": pk, "shard": row.get("shard"),
+                                  "telegram_id": row.get("telegram_id")})
+            continue
+        if row.get("wanted"):
+            wanted[pk] = {"shard": shard, "allowed_ips": _host_ip(row.get("wg_ip")),
+                          "wg_ip": row.get("wg_ip"), "telegram_id": row.get("telegram_id")}
+        elif pk not in unwanted:
+            unwanted[pk] = {"telegram_id": row.get("telegram_id"),
+                            "reason": "revoked" if not row.get("active") else "expired"}
+    for row in pool_rows:
+        if row["shard"] in configured:
+            wanted[row["public_key"]] = {"shard": row["shard"], "allowed_ips": _host_ip(row["wg_ip"]),
+                                         "wg_ip": row["wg_ip"], "telegram_id": None}
+    for pk in wanted:
+        unwanted.pop(pk, None)        # ключ в нескольких слотах: хоть один wanted — оставляем
+
+    located = {pk for peers in runtime.values() for pk in peers}
+
+    add: List[Dict] = []
+    remove: List[Dict] = []
+    unknown: Dict[str, List[str]] = {}
+    for pk, want in wanted.items():
+        if want["shard"] in failed_shards:
+            continue
+        here = runtime.get(want["shard"], {}).get(pk)
+        if here is None:
+            reason = "misplaced" if pk in located else "missing"
+        elif here != want["allowed_ips"]:
+            reason = "allowed_ips"
+        else:
+            continue
+        add.append({"public_key": pk, "shard": want["shard"], "wg_ip": want["wg_ip"],
+                    "telegram_id": want["telegram_id"], "reason": reason})
+    for shard, peers in runtime.items():
+        for pk in peers:
+            if pk in wanted:
+                if wanted[pk]["shard"] != shard:
+                    remove.append({"public_key": pk, "shard": shard,
+                                   "telegram_id": wanted[pk]["telegram_id"], "reason": "misplaced"})
+            elif pk in unwanted:
+                remove.append({"public_key": pk, "shard": shard, **unwanted[pk]})
+            else:
+                unknown.setdefault(shard, []).append(pk)
+
+    desired_count: Dict[str, int] = {}
+    for want in wanted.values():
+        desired_count[want["shard"]] = desired_count.get(want["shard"], 0) + 1
+    return {
+        "add": add,
+        "remove": remove,
+        "unknown": unknown,
+        "unknown_shard": unknown_shard,
+        "runtime": {shard: len(peers) for shard, peers in runtime.items()},
+        "desired": desired_count,
+    }
+
+
+def reconcile_awg(
+    apply: bool = False,
+    max_adds: int = DEFAULT_MAX_ADDS,
+    max_removes: int = DEFAULT_MAX_REMOVES,
+    env: Optional[dict] = None,
+) -> Dict:
+    """
+    Сверка eu1: dump → план → (apply) пакет. Возвращает отчёт (JSON-сериализуемый):
+    node, dry_run, failed_shards, план (add/remove с reason), deferred,
+    removes_blocked, unknown (число на шард), applied, apply_failed_shards, ms.
+    """
+    from .wireguard_peers import AwgPeerBatch, _load_env
+
+    t0 = time.perf_counter()
+    if env is None:
+        env = _load_env()
+    runtime, failed = fetch_awg_runtime(env)
+    plan = plan_awg_reconcile(
+        db_peers_desired_state([_NODE], GRACE_PERIOD_HOURS),
+        db_warm_pool_list(_NODE),
+        runtime, failed, env,
+    )
+
+    removes_blocked: List[str] = []
+    for shard, n_runtime in plan["runtime"].items():
+        n_remove = sum(1 for r in plan["remove"] if r["shard"] == shard)
+        if n_remove > _MIN_REMOVES_GUARDED and n_remove > n_runtime * _MAX_REMOVE_FRACTION:
+            removes_blocked.append(shard)
+    if removes_blocked:
+        logger.warning("awg reconcile: удаления заблокированы на шардах %s (слишком много за прогон)",
+                       ", ".join(removes_blocked))
+    removable = [r for r in plan["remove"] if r["shard"] not in removes_blocked]
+
+    adds = plan["add"][:max(0, max_adds)]
+    # misplaced убираем из чужого шарда, только если в этом прогоне он добавлен в свой
+    added = {a["public_key"] for a in adds}
+    removable = [r for r in removable if r["reason"] != "misplaced" or r["public_key"] in added]
+    removes = removable[:max(0, max_removes)]
+    report = {
+        "node": _NODE,
+        "dry_run": not apply,
+        "failed_shards": failed,
+        "runtime": plan["runtime"],
+        "desired": plan["desired"],
+        "add": plan["add"],
+        "remove": plan["remove"],
+        "unknown": {shard: len(pks) for shard, pks in plan["unknown"].items()},
+        "unknown_shard": plan["unknown_shard"],
+        "removes_blocked": removes_blocked,
+        "deferred": {"add": len(plan["add"]) - len(adds), "remove": len(removable) - len(removes)},
+        "applied": {"add": 0, "remove": 0},
+        "apply_failed_shards": [],
+    }
+    if apply and (adds or removes):
+        batch = AwgPeerBatch(env)
+        for r in removes:
+            batch.remove(r["public_key"], r["shard"])
+        for a in adds:
+            batch.restore(a["public_key"], a["wg_ip"], a["shard"])
+        bad = batch.apply()
+        report["apply_failed_shards"] = bad
+        report["applied"] = {"add": sum(1 for a in adds if a["shard"] not in bad),
+                             "remove": sum(1 for r in removes if r["shard"] not in bad)}
+        logger.info("awg reconcile: +%d −%d (шарды с ошибкой: %s)",
+                    report["applied"]["add"], report["applied"]["remove"], bad or "нет")
+    report["ms"] = round((time.perf_counter() - t0) * 1000, 1)
+    return report
@@ -0,0 +1,144 @@
+"""
+Шарды AmneziaWG на eu1: несколько интерфейсов/контейнеров на одном хосте.
+
+Один awg0 в /24 — это ~250 peer'ов на ноду. Шард = (контейнер, интерфейс,
+подсеть); каждый новый peer получает адрес в первом шарде, где он есть, и имя
+шарда записывается в peers.shard. Всё, что работает с runtime AWG (revoke /
+restore / remove, учёт трафика, панель, сверки), адресует нужный шард.
+
+Конфиг (env_vars.txt):
+    AMNEZIAWG_EU1_SHARDS=awg0=amnezia-awg2:awg0:10.8.1.0/24, awg1=amnezia-awg3:awg0:10.8.4.0/22:48101
+    (name=container:interface:cidr[:endpoint_port] через запятую; порядок =
+    порядок заполнения; порт — UDP-порт контейнера для клиентов, если не дефолтный).
+Без AMNEZIAWG_EU1_SHARDS — один шард из старых переменных
+AMNEZIAWG_EU1_CONTAINER / _INTERFACE / _NETWORK_CIDR (поведение как раньше).
+
+Слоты с peers.shard = NULL (созданные до шардирования) живут в ПЕРВОМ шарде —
+поэтому первым в списке должен стоять существующий контейнер. Без
+AMNEZIAWG_EU1_SHARDS новые слоты пишут shard = имя интерфейса
+(AMNEZIAWG_EU1_INTERFACE), поэтому при переходе на список первый шард должен
+называться так же, иначе эти слоты не найдут шард (UnknownAwgShardError).
+"""
+
+import logging
+import pathlib
+import shlex
+import subprocess
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+from .config import _parse_env_file
+from .wg_errors import UnknownAwgShardError
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONTAINER = "amnezia-awg2"
+DEFAULT_INTERFACE = "awg0"
+DEFAULT_NETWORK_CIDR = "10.1.0.0/24"
+
+
+@dataclass(frozen=True)
+class AwgShard:
+    name: str
+    container: str
+    interface: str
+    network_cidr: str
+    endpoint_port: str = ""
+
+
+def _load_env() -> dict:
+    base_dir = pathlib.Path(__file__).resolve().parent.parent
+    return _parse_env_file(base_dir / "env_vars.txt")
+
+
+def get_awg_shards(env: Optional[dict] = None) -> List[AwgShard]:
+    """Шарды eu1 в порядке заполнения (минимум один)."""
+    if env is None:
+        env = _load_env()
+    raw = env.get("AMNEZIAWG_EU1_SHARDS", "").strip()
+    if not raw:
+        interface = env.get("AMNEZIAWG_EU1_INTERFACE", "").strip() or DEFAULT_INTERFACE
+        return [AwgShard(
+            name=interface,
+            container=env.get("AMNEZIAWG_EU1_CONTAINER", "").strip() or DEFAULT_CONTAINER,
+            interface=interface,
+            network_cidr=env.get("AMNEZIAWG_EU1_NETWORK_CIDR", "").strip() or DEFAULT_NETWORK_CIDR,
+        )]
+    shards: List[AwgShard] = []
+    for item in raw.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        try:
+            name, spec = item.split("=", 1)
+            container, interface, cidr, *port = spec.split(":")
+            if len(port) > 1:
+                raise ValueError
+        except ValueError:
+            raise ValueError(
+                f"AMNEZIAWG_EU1_SHARDS: ожидается name=container:interface:cidr[:port], получено {item!r}"
+            )
+        shards.append(AwgShard(name.strip(), container.strip(), interface.strip(), cidr.strip(),
+                               port[0].strip() if port else ""))
+    if len({s.name for s in shards}) != len(shards):
+        raise ValueError("AMNEZIAWG_EU1_SHARDS: имена шардов должны быть уникальны")
+    return shards
+
+
+def resolve_shard(name: Optional[str], env: Optional[dict] = None) -> AwgShard:
+    """Шард по имени из peers.shard; NULL/пусто — первый (legacy-слоты).
+    Неизвестное имя (шард убран из конфига) — UnknownAwgShardError
+    (WireGuardError: вызывающие, терпящие ошибки удаления, её ловят)."""
+    shards = get_awg_shards(env)
+    if not name:
+        return shards[0]
+    for shard in shards:
+        if shard.name == name:
+            return shard
+    raise UnknownAwgShardError(f"AWG-шард {name!r} не найден в AMNEZIAWG_EU1_SHARDS")
+
+
+def shard_env_prefix(shard: AwgShard) -> str:
+    """Переменные для add/remove/save-скриптов на хосте eu1 (см. docs/scripts)."""
+    prefix = (
+        f"AWG_DOCKER_CONTAINER={shlex.quote(shard.container)} "
+        f"AWG_INTERFACE={shlex.quote(shard.interface)} "
+        f"AWG_NETWORK_CIDR={shlex.quote(shard.network_cidr)} "
+    )
+    if shard.endpoint_port:
+        prefix += f"ENDPOINT_PORT={shlex.quote(shard.endpoint_port)} "
+    return prefix
+
+
+def awg_dump_all(timeout: int = 10, docker: str = "docker") -> Tuple[str, List[str]]:
+    """
+    `awg show <iface> dump` всех шардов (локально, docker exec на хосте eu1).
+
+    Возвращает (dump, failed): dump — строка интерфейса первого ответившего
+    шарда + peer-строки ВСЕХ шардов (формат как у одного dump — парсеры,
+    пропускающие первую строку, работают без правок); failed — имена шардов,
+    чей dump получить не удалось.
+    """
+    header: Optional[str] = None
+    lines: List[str] = []
+    failed: List[str] = []
+    for shard in get_awg_shards():
+        try:
+            out = subprocess.run(
+                [docker, "exec", shard.container, "awg", "show", shard.interface, "dump"],
+                capture_output=True, text=True, timeout=timeout,
+            )
+        except (OSError, subprocess.TimeoutExpired) as exc:
+            logger.warning("awg dump %s: %s", shard.name, exc)
+            failed.append(shard.name)
+            continue
+        if out.returncode != 0 or not out.stdout.strip():
+            failed.append(shard.name)
+            continue
+        shard_lines = out.stdout.strip().split("\n")
+        if header is None:
+            header = shard_lines[0]
+        lines.extend(shard_lines[1:])
+    if header is None:
+        return "", failed
+    return "\n".join([header, *lines]) + "\n", failed
@@ -0,0 +1,207 @@
+"""
+Тёплый пул AmneziaWG peer'ов на eu1: готовые peer'ы без владельца.
+
+Создание peer'а — SSH на eu1 + add-скрипт (секунды). Фоновый филлер заранее
+держит AMNEZIAWG_EU1_WARM_POOL готовых peer'ов: IP из аллокатора (аренда за
+WARM_POOL_TELEGRAM_ID, шарды по порядку заполнения), peer в runtime шарда,
+client_config — в таблице awg_warm_pool. create_amneziawg_peer_and_config_for_user
+для нового слота забирает peer из пула одной транзакцией (storage.claim_warm_peer)
+без SSH; пул пуст — обычный путь через скрипт.
+
+Peer из пула в runtime, но трафик по нему невозможен, пока конфиг не выдан:
+handshake требует приватный ключ, а он есть только в client_config в БД бота.
+
+Пополняет пул только процесс бота (warm_pool_start); выдача из ЛК тоже
+берёт из пула — бот догоняет не позже _REFILL_INTERVAL_S. Пополнение
+последовательное (один SSH за раз), чтобы не занимать слоты SSH-сессий выдачи.
+
+env_vars.txt:
+    AMNEZIAWG_EU1_WARM_POOL=0   — сколько готовых peer'ов держать (0 — пул выключен)
+"""
+
+import logging
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+from .awg_shards import get_awg_shards
+from .database import (
+    WARM_POOL_TELEGRAM_ID,
+    db_warm_pool_add,
+    db_warm_pool_depth,
+    db_warm_pool_list,
+    db_warm_pool_remove,
+)
+
+logger = logging.getLogger(__name__)
+
+_NODE = "eu1"
+_REFILL_INTERVAL_S = 60
+_ERROR_BACKOFF_S = 300
+
+_fill_lock = threading.Lock()
+_wake = threading.Event()
+_stop = threading.Event()
+_thread: Optional[threading.Thread] = None
+_stats = {
+    "claimed": 0, "misses": 0, "filled": 0, "fill_errors": 0, "pruned": 0,
+    "fill_ms_total": 0.0, "last_error": "",
+}
+
+
+def _reset_after_fork() -> None:
+    global _fill_lock, _wake, _stop, _thread
+    _fill_lock = threading.Lock()
+    _wake = threading.Event()
+    _stop = threading.Event()
+    _thread = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def warm_pool_target(env: Optional[dict] = None) -> int:
+    """AMNEZIAWG_EU1_WARM_POOL из env_vars.txt (0 — выключен)."""
+    if env is None:
+        from .wireguard_peers import _load_env
+
+        env = _load_env()
+    try:
+        return max(0, int((env.get("AMNEZIAWG_EU1_WARM_POOL") or "0").strip()))
+    except ValueError:
+        return 0
+
+
+def note_warm_pool_claim(hit: bool) -> None:
+    """Учёт выдачи (create_amneziawg_peer_and_config_for_user): попадание
+    будит филлер, промах при непустой цели — метрика «пул не успевает»."""
+    if hit:
+        _stats["claimed"] += 1
+        _wake.set()
+    elif warm_pool_target() > 0:
+        _stats["misses"] += 1
+
+
+def prune_warm_pool(env: Optional[dict] = None) -> int:
+    """Убирает из пула peer'ы шардов, которых больше нет в конфиге: аренда IP
+    отдаётся; runtime не трогаем — адрес контейнера шарда уже неизвестен
+    (выведенный шард уходит вместе со своими peer'ами)."""
+    known = {s.name for s in get_awg_shards(env)}
+    pruned = 0
+    for row in db_warm_pool_list(_NODE):
+        if row["shard"] in known:
+            continue
+        db_warm_pool_remove(row["id"])
+        pruned += 1
+    if pruned:
+        logger.warning("warm pool: убрано %d peer(ов) шардов, которых нет в AMNEZIAWG_EU1_SHARDS", pruned)
+    _stats["pruned"] += pruned
+    return pruned
+
+
+def fill_warm_pool(target: Optional[int] = None) -> int:
+    """
+    Доводит пул до target (по умолчанию AMNEZIAWG_EU1_WARM_POOL) готовых
+    peer'ов. Возвращает число созданных; на первой ошибке SSH/скрипта
+    останавливается (IP возвращается в пул) — следующая попытка на новом цикле.
+    """
+    from .wireguard_peers import (
+        _allocate_awg_slot,
+        _load_env,
+        _release_ip,
+        _run_amneziawg_add_script,
+        is_amneziawg_eu1_configured,
+    )
+
+    env = _load_env()
+    if target is None:
+        target = warm_pool_target(env)
+    if target <= 0 or not is_amneziawg_eu1_configured(env):
+        return 0
+    added = 0
+    with _fill_lock:
+        while sum(db_warm_pool_depth(_NODE).values()) < target:
+            t0 = time.perf_counter()
+            try:
+                awg, wg_ip = _allocate_awg_slot(WARM_POOL_TELEGRAM_ID, env)
+            except Exception as exc:  # noqa: BLE001 — все шарды заполнены
+                _stats["fill_errors"] += 1
+                _stats["last_error"] = str(exc)[:300]
+                logger.warning("warm pool: нет свободных адресов: %s", exc)
+                break
+            try:
+                public_key, client_config = _run_amneziawg_add_script(env, awg, wg_ip)
+                db_warm_pool_add(_NODE, awg.name, wg_ip, public_key, client_config)
+            except Exception as exc:  # noqa: BLE001
+                _release_ip(WARM_POOL_TELEGRAM_ID, wg_ip)
+                _stats["fill_errors"] += 1
+                _stats["last_error"] = str(exc)[:300]
+                logger.warning("warm pool: не удалось создать peer (%s, %s): %s", awg.name, wg_ip, exc)
+                break
+            added += 1
+            _stats["filled"] += 1
+            _stats["fill_ms_total"] += (time.perf_counter() - t0) * 1000
+    if added:
+        logger.info("warm pool: +%d peer(ов), в пуле %s", added, db_warm_pool_depth(_NODE))
+    return added
+
+
+def _filler() -> None:
+    try:
+        prune_warm_pool()
+    except Exception:  # noqa: BLE001
+        logger.exception("warm pool: prune упал")
+    while not _stop.is_set():
+        errors_before = _stats["fill_errors"]
+        try:
+            fill_warm_pool()
+        except Exception:  # noqa: BLE001
+            logger.exception("warm pool: цикл пополнения упал")
+            _stats["fill_errors"] += 1
+        wait = _ERROR_BACKOFF_S if _stats["fill_errors"] > errors_before else _REFILL_INTERVAL_S
+        _wake.wait(wait)
+        _wake.clear()
+
+
+def warm_pool_start() -> bool:
+    """Запускает фоновое пополнение (идемпотентно). False — пул выключен
+    (AMNEZIAWG_EU1_WARM_POOL=0) или AWG на eu1 не настроен."""
+    global _thread
+    from .wireguard_peers import _load_env, is_amneziawg_eu1_configured
+
+    env = _load_env()
+    if warm_pool_target(env) <= 0 or not is_amneziawg_eu1_configured(env):
+        return False
+    if _thread is not None and _thread.is_alive():
+        return True
+    _stop.clear()
+    _thread = threading.Thread(target=_filler, name="awg-warm-pool", daemon=True)
+    _thread.start()
+    logger.info("warm pool: пополнение запущено, цель %d", warm_pool_target(env))
+    return True
+
+
+def warm_pool_stop(timeout: float = 5.0) -> None:
+    global _thread
+    _stop.set()
+    _wake.set()
+    if _thread is not None:
+        _thread.join(timeout)
+    _thread = None
+
+
+def warm_pool_stats() -> Dict:
+    """Глубина пула по шардам + claimed/misses/filled/fill_errors/pruned,
+    среднее время создания peer'а филлером."""
+    depth = db_warm_pool_depth(_NODE)
+    stats = dict(_stats)
+    stats["fill_ms_avg"] = stats["fill_ms_total"] / stats["filled"] if stats["filled"] else 0.0
+    return {
+        "target": warm_pool_target(),
+        "depth": sum(depth.values()),
+        "depth_by_shard": depth,
+        "filler_running": _thread is not None and _thread.is_alive(),
+        **stats,
+    }
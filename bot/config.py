@@ -1,7 +1,7 @@
 import os
 import pathlib
 from dataclasses import dataclass
-from typing import Dict
+from typing import Dict, Tuple
 
 
 @dataclass
@@ -46,6 +46,13 @@ class BotConfig:
     # ENFORCEMENT_ENABLED: гейт «Получить VPN» по db_is_access_active (резать доступ просрочкам).
     onboarding_enabled: bool = False
     enforcement_enabled: bool = False
+    # DB_WRITE_QUEUE: некритичные частые записи (hit'ы /sub, выдачи ссылок) пишутся
+    # пачками фоновым потоком (bot/database.py, db_write_queue_start).
+    db_write_queue: bool = False
+    # PROVISION_QUEUE: выдача AWG-конфигов (SSH на eu1) — фоновой очередью
+    # (bot/provision_queue.py): хендлер отвечает сразу, конфиг приходит отдельно.
+    provision_queue: bool = False
+    provision_workers_per_node: int = 2
 
 
 def _parse_env_file(path: pathlib.Path) -> Dict[str, str]:
@@ -151,6 +158,12 @@ def load_config(env_path: str = "env_vars.txt") -> BotConfig:
 
     onboarding_enabled = _bool_flag("ONBOARDING_ENABLED")
     enforcement_enabled = _bool_flag("ENFORCEMENT_ENABLED")
+    db_write_queue = _bool_flag("DB_WRITE_QUEUE")
+    provision_queue = _bool_flag("PROVISION_QUEUE")
+    try:
+        provision_workers_per_node = max(1, int((data.get("PROVISION_WORKERS_PER_NODE") or "2").strip()))
+    except ValueError:
+        provision_workers_per_node = 2
 
     return BotConfig(
         bot_token=token,
@@ -174,9 +187,40 @@ def load_config(env_path: str = "env_vars.txt") -> BotConfig:
         vless_eu1_sni=vless_eu1_sni,
         onboarding_enabled=onboarding_enabled,
         enforcement_enabled=enforcement_enabled,
+        db_write_queue=db_write_queue,
+        provision_queue=provision_queue,
+        provision_workers_per_node=provision_workers_per_node,
     )
 
 
+_config_cache: Dict[str, Tuple[Tuple[int, int], BotConfig]] = {}
+
+
+def config_version(env_path: str = "env_vars.txt") -> Tuple[int, int]:
+    """(mtime_ns, size) env-файла — меняется при любой его правке; (0, 0), если файла нет."""
+    env_file = pathlib.Path(__file__).resolve().parent.parent / env_path
+    try:
+        st = env_file.stat()
+    except OSError:
+        return (0, 0)
+    return (st.st_mtime_ns, st.st_size)
+
+
+def load_config_cached(env_path: str = "env_vars.txt") -> BotConfig:
+    """
+    load_config(), но env_vars.txt перечитывается только при смене
+    config_version() (один stat вместо разбора файла) — для горячих путей
+    вроде /sub/<token>. Возвращаемый объект общий: не мутировать.
+    """
+    version = config_version(env_path)
+    cached = _config_cache.get(env_path)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    cfg = load_config(env_path)
+    _config_cache[env_path] = (version, cfg)
+    return cfg
+
+
 def environment_for_mtproxy_rotate(base_dir: pathlib.Path) -> Dict[str, str]:
     """
     Окружение для subprocess скрипта ротации: копия os.environ плюс переменные MTPROXY_*
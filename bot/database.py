@@ -5,14 +5,19 @@ SQLite слой для VPN-сервиса.
 Автоматически мигрирует данные из users.json при первом запуске.
 """
 
+import atexit
+import ipaddress
 import json
 import logging
+import os
 import pathlib
 import secrets
 import sqlite3
+import threading
+import time
 from contextlib import contextmanager
-from datetime import datetime, timedelta
-from typing import Dict, Generator, List, Optional
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, Generator, List, Optional, Tuple
 
 logger = logging.getLogger(__name__)
 
@@ -25,24 +30,451 @@ PEERS_JSON_PATH = DATA_DIR / "peers.json"
 _db_initialized = False
 
 
-@contextmanager
-def _conn() -> Generator[sqlite3.Connection, None, None]:
+# ─── Connection pool ──────────────────────────────────────────────────────────
+# Раньше каждый db_* хелпер открывал свежий sqlite3.connect + 3 PRAGMA и закрывал
+# его; /start или /api/account/info дёргают 5–10 хелперов → connect×10. Теперь
+# соединения переиспользуются: _conn() берёт соединение из общего пула на входе
+# в ВНЕШНИЙ `with` и возвращает на выходе. Вложенные _conn() в том же потоке
+# (хелпер внутри хелпера) получают то же соединение — commit/rollback делает
+# только внешний уровень (раньше вложенный writer ждал busy_timeout на
+# собственной блокировке).
+#
+# - Пул ограничен _POOL_MAX_IDLE простаивающими соединениями; лишние закрываются.
+#   Одновременно занятых — сколько потоков (telebot workers / Flask requests).
+# - Health-check: соединение, простоявшее > _POOL_HEALTHCHECK_IDLE_S, проверяется
+#   `SELECT 1`; битое выбрасывается, взамен открывается новое.
+# - Fork-safety: cron-скрипты форкаются (subprocess не в счёт, но multiprocessing/
+#   gunicorn — да). Соединения родителя в ребёнке НЕ используем и НЕ закрываем
+#   (SQLite запрещает переносить их через fork) — просто забываем пул.
+# - Пул привязан к DB_PATH: тесты подменяют DB_PATH на временный — старые
+#   соединения к другому файлу выбрасываются.
+# _POOL_ENABLED=False возвращает старое поведение (connect/close на каждый вызов).
+
+_POOL_ENABLED = True
+_POOL_MAX_IDLE = 8
+_POOL_HEALTHCHECK_IDLE_S = 60.0
+
+_pool_lock = threading.Lock()
+_pool_idle: List[tuple] = []          # [(con, db_path, last_used_monotonic), ...]
+_pool_pid = os.getpid()
+_pool_local = threading.local()       # .con / .path / .depth — текущая аренда потока
+_pool_stats = {"opened": 0, "reused": 0, "discarded": 0}
+
+
+def _open_connection(path: str) -> sqlite3.Connection:
     DATA_DIR.mkdir(parents=True, exist_ok=True)
-    con = sqlite3.connect(str(DB_PATH))
+    # check_same_thread=False: соединение переходит между потоками через пул,
+    # но в каждый момент им владеет ровно один поток (аренда в _conn()).
+    con = sqlite3.connect(path, check_same_thread=not _POOL_ENABLED)
     con.row_factory = sqlite3.Row
     con.execute("PRAGMA journal_mode=WAL")
     con.execute("PRAGMA foreign_keys=ON")
     # Несколько писателей одновременно (bot + web + cron-скрипты) — ждём
     # освобождения блокировки до 5 с вместо мгновенного "database is locked".
     con.execute("PRAGMA busy_timeout=5000")
+    _pool_stats["opened"] += 1
+    return con
+
+
+def _pool_reset_after_fork() -> None:
+    """В дочернем процессе — забыть соединения родителя (не закрывая их)."""
+    global _pool_idle, _pool_lock, _pool_local, _pool_pid
+    _pool_idle = []
+    _pool_lock = threading.Lock()
+    _pool_local = threading.local()
+    _pool_pid = os.getpid()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_pool_reset_after_fork)
+
+
+def _pool_checkout(path: str) -> sqlite3.Connection:
+    if os.getpid() != _pool_pid:  # fork без register_at_fork (или до импорта)
+        _pool_reset_after_fork()
+    now = time.monotonic()
+    while True:
+        with _pool_lock:
+            if not _pool_idle:
+                break
+            con, con_path, last_used = _pool_idle.pop()
+        if con_path != path:
+            _pool_discard(con)
+            continue
+        if now - last_used > _POOL_HEALTHCHECK_IDLE_S:
+            try:
+                con.execute("SELECT 1").fetchone()
+            except sqlite3.Error:
+                _pool_discard(con)
+                continue
+        _pool_stats["reused"] += 1
+        return con
+    return _open_connection(path)
+
+
+def _pool_checkin(con: sqlite3.Connection, path: str) -> None:
+    if con.in_transaction:  # не смогли ни commit, ни rollback — не отдаём дальше
+        _pool_discard(con)
+        return
+    with _pool_lock:
+        if path == str(DB_PATH) and len(_pool_idle) < _POOL_MAX_IDLE:
+            _pool_idle.append((con, path, time.monotonic()))
+            return
+    _pool_discard(con)
+
+
+def _pool_discard(con: sqlite3.Connection) -> None:
+    _pool_stats["discarded"] += 1
+    try:
+        con.close()
+    except sqlite3.Error:
+        pass
+
+
+def db_pool_close_all() -> None:
+    """Закрывает простаивающие соединения пула (shutdown / тесты)."""
+    with _pool_lock:
+        idle = list(_pool_idle)
+        _pool_idle.clear()
+    for con, _path, _ts in idle:
+        _pool_discard(con)
+
+
+def db_pool_stats() -> Dict[str, int]:
+    """Счётчики пула: opened / reused / discarded / idle."""
+    with _pool_lock:
+        idle = len(_pool_idle)
+    return {**_pool_stats, "idle": idle}
+
+
+@contextmanager
+def _conn() -> Generator[sqlite3.Connection, None, None]:
+    path = str(DB_PATH)
+    if not _POOL_ENABLED:
+        con = _open_connection(path)
+        try:
+            yield con
+            con.commit()
+        except Exception:
+            con.rollback()
+            raise
+        finally:
+            con.close()
+        return
+
+    local = _pool_local
+    depth = getattr(local, "depth", 0)
+    if depth and local.path == path:
+        # Вложенный вызов в том же потоке — та же транзакция, commit делает внешний.
+        local.depth = depth + 1
+        try:
+            yield local.con
+        finally:
+            local.depth = depth
+        return
+
+    con = _pool_checkout(path)
+    outer = (getattr(local, "con", None), getattr(local, "path", None), depth)
+    local.con, local.path, local.depth = con, path, 1
     try:
         yield con
         con.commit()
     except Exception:
-        con.rollback()
+        try:
+            con.rollback()
+        except sqlite3.Error:
+            pass
         raise
     finally:
-        con.close()
+        local.con, local.path, local.depth = outer
+        _pool_checkin(con, path)
+
+
+# ─── Write-behind queue ───────────────────────────────────────────────────────
+# bot, web и ~8 cron-скриптов пишут в один vpn.db и сериализуются через
+# busy_timeout: длинный writer (cron) держит /sub и /start секундами. Частые
+# НЕкритичные записи долгоживущих процессов (отметки «последний hit» из /sub,
+# выдачи ссылок) можно не писать синхронно: _write_behind кладёт их в очередь,
+# фоновый поток сбрасывает её одной транзакцией раз в _WQ_FLUSH_INTERVAL_S
+# (executemany по одинаковым SQL). Запись с тем же ключом до flush заменяет
+# предыдущую (coalescing: 10 hit'ов /sub одного юзера → 1 UPDATE).
+#
+# - Очередь ВЫКЛЮЧЕНА по умолчанию: пока не вызван db_write_queue_start()
+#   (bot/web при DB_WRITE_QUEUE=1), _write_behind пишет синхронно как раньше.
+#   cron-скрипты её не включают — у них и так одна транзакция на прогон.
+# - Биллинг/подписки/peers сюда НЕ идут — только то, что можно потерять при
+#   kill -9 (не более _WQ_FLUSH_INTERVAL_S) и прочитать с задержкой.
+# - Ошибка flush (например, locked дольше busy_timeout) — пачка возвращается в
+#   очередь (ключи, перезаписанные за это время, не откатываются).
+# - atexit и db_write_queue_stop() сбрасывают остаток; в fork-ребёнке очередь
+#   родителя забывается (её допишет родитель).
+
+_WQ_FLUSH_INTERVAL_S = 0.5
+_WQ_MAX_PENDING = 5000                # при таком размере flush не ждёт интервала
+
+_wq_cond = threading.Condition()
+_wq_flush_lock = threading.Lock()     # flush из потока-сбрасывателя и из stop/тестов
+_wq_pending: Dict[tuple, tuple] = {}  # key → (sql, params), порядок вставки
+_wq_thread: Optional[threading.Thread] = None
+_wq_stopping = False
+_wq_seq = 0                           # ключи для записей без coalescing
+_wq_stats = {
+    "enqueued": 0, "coalesced": 0, "written": 0, "flushes": 0, "errors": 0,
+    "max_depth": 0, "last_flush_ms": 0.0, "max_flush_ms": 0.0, "total_flush_ms": 0.0,
+}
+
+
+def _wq_reset_after_fork() -> None:
+    global _wq_cond, _wq_flush_lock, _wq_pending, _wq_thread, _wq_stopping
+    _wq_cond = threading.Condition()
+    _wq_flush_lock = threading.Lock()
+    _wq_pending = {}
+    _wq_thread = None
+    _wq_stopping = False
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_wq_reset_after_fork)
+
+
+def _write_behind(key: Optional[tuple], sql: str, params: tuple) -> None:
+    """
+    Некритичная запись: в очередь, если она запущена, иначе — сразу.
+    key — ключ coalescing (None: без слияния, каждая запись сохраняется).
+    """
+    global _wq_seq
+    with _wq_cond:
+        if _wq_thread is not None:
+            if key is None:
+                _wq_seq += 1
+                key = ("_seq", _wq_seq)
+            elif key in _wq_pending:
+                _wq_stats["coalesced"] += 1
+            _wq_pending[key] = (sql, params)
+            _wq_stats["enqueued"] += 1
+            depth = len(_wq_pending)
+            if depth > _wq_stats["max_depth"]:
+                _wq_stats["max_depth"] = depth
+            if depth >= _WQ_MAX_PENDING:
+                _wq_cond.notify()
+            return
+    with _conn() as con:
+        con.execute(sql, params)
+
+
+def _wq_flush() -> int:
+    """Сбрасывает очередь одной транзакцией. Возвращает число записей."""
+    with _wq_flush_lock:
+        with _wq_cond:
+            batch = _wq_pending.copy()
+            _wq_pending.clear()
+        if not batch:
+            return 0
+        by_sql: Dict[str, List[tuple]] = {}
+        for sql, params in batch.values():
+            by_sql.setdefault(sql, []).append(params)
+        t0 = time.perf_counter()
+        try:
+            with _conn() as con:
+                for sql, rows in by_sql.items():
+                    con.executemany(sql, rows)
+        except sqlite3.Error as e:
+            _wq_stats["errors"] += 1
+            logger.warning("write queue: flush %d записей не удался, вернул в очередь: %s",
+                           len(batch), e)
+            with _wq_cond:
+                for key, item in batch.items():
+                    _wq_pending.setdefault(key, item)
+            return 0
+        ms = (time.perf_counter() - t0) * 1000
+        _wq_stats["written"] += len(batch)
+        _wq_stats["flushes"] += 1
+        _wq_stats["last_flush_ms"] = ms
+        _wq_stats["total_flush_ms"] += ms
+        if ms > _wq_stats["max_flush_ms"]:
+            _wq_stats["max_flush_ms"] = ms
+        return len(batch)
+
+
+def _wq_loop() -> None:
+    while True:
+        with _wq_cond:
+            if not _wq_stopping and len(_wq_pending) < _WQ_MAX_PENDING:
+                _wq_cond.wait(_WQ_FLUSH_INTERVAL_S)
+            stopping = _wq_stopping
+        try:
+            _wq_flush()
+        except Exception:
+            logger.exception("write queue: flush упал")
+        if stopping:
+            return
+
+
+def db_write_queue_start() -> None:
+    """Включает write-behind очередь в этом процессе (идемпотентно)."""
+    global _wq_thread, _wq_stopping
+    with _wq_cond:
+        if _wq_thread is not None:
+            return
+        _wq_stopping = False
+        _wq_thread = threading.Thread(target=_wq_loop, name="db-write-queue", daemon=True)
+        _wq_thread.start()
+    atexit.register(db_write_queue_stop)
+    logger.info("write queue: включена, flush каждые %.1f с", _WQ_FLUSH_INTERVAL_S)
+
+
+def db_write_queue_stop(timeout: float = 5.0) -> None:
+    """Сбрасывает остаток очереди и останавливает поток; дальше — синхронные записи."""
+    global _wq_thread, _wq_stopping
+    with _wq_cond:
+        thread = _wq_thread
+        if thread is None:
+            return
+        _wq_stopping = True
+        _wq_cond.notify()
+    thread.join(timeout)
+    with _wq_cond:
+        _wq_thread = None
+        _wq_stopping = False
+    _wq_flush()  # хвост после последнего flush потока (или если поток не успел)
+
+
+def db_write_queue_flush() -> int:
+    """Принудительный flush (тесты/админка). Возвращает число записей."""
+    return _wq_flush()
+
+
+def db_write_queue_stats() -> Dict:
+    """Метрики очереди: depth (сейчас в очереди), enqueued / coalesced / written,
+    flushes / errors, max_depth и латентность flush (last/max/avg, мс)."""
+    with _wq_cond:
+        depth = len(_wq_pending)
+        running = _wq_thread is not None
+    stats = dict(_wq_stats)
+    stats["avg_flush_ms"] = stats["total_flush_ms"] / stats["flushes"] if stats["flushes"] else 0.0
+    return {"running": running, "depth": depth, **stats}
+
+
+# ─── Read cache ───────────────────────────────────────────────────────────────
+# web (/admin, /api/stats, /api/traffic, CSV) на каждый refresh материализует
+# users и peers целиком — get_all_peers() + get_all_users() + db_get_all_users(),
+# а на 50k слотов один get_all_peers() — сотни мс. db_read_cached держит
+# результат в памяти процесса, пока его таблицы не менялись.
+#
+# Инвалидация (из любого процесса: bot, web, cron, ручной sqlite3):
+# - `PRAGMA data_version` на отдельном соединении _rc_con, которое само ничего
+#   не пишет: значение меняется после commit'а ЛЮБОГО другого соединения.
+#   Не поменялось → кеш валиден целиком, проверка — один PRAGMA.
+# - Поменялось → читаем table_versions (счётчики, которые триггеры на
+#   users/peers увеличивают на каждую изменённую строку, см.
+#   _migrate_add_table_versions). Запись кеша сбрасывается, только если
+#   сдвинулась версия её таблиц: трафик/очередь /sub-hit'ов не трогают peers.
+# - Внутри собственной незакоммиченной транзакции потока кеш не используется
+#   (свои изменения ещё не видны другим соединениям).
+#
+# Возвращаемые объекты общие для всех вызывающих — их нельзя мутировать
+# (сами списки — копии). _READ_CACHE_ENABLED=False — читать всегда из БД.
+
+_READ_CACHE_ENABLED = True
+
+_rc_lock = threading.Lock()
+_rc_con: Optional[sqlite3.Connection] = None
+_rc_path: Optional[str] = None
+_rc_data_version: Optional[int] = None
+_rc_versions: Dict[str, int] = {}     # table → версия из table_versions
+_rc_entries: Dict[str, tuple] = {}    # key → (версии таблиц, значение)
+_rc_stats = {"hits": 0, "misses": 0, "bypassed": 0, "checks": 0, "refreshes": 0}
+_rc_key_stats: Dict[str, Dict[str, int]] = {}
+
+
+def _rc_reset_after_fork() -> None:
+    global _rc_lock, _rc_con, _rc_path, _rc_data_version, _rc_versions, _rc_entries
+    _rc_lock = threading.Lock()
+    _rc_con = None                    # соединение родителя не трогаем (как в пуле)
+    _rc_path = None
+    _rc_data_version = None
+    _rc_versions = {}
+    _rc_entries = {}
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_rc_reset_after_fork)
+
+
+def _rc_current_versions(path: str) -> Dict[str, int]:
+    """Актуальные версии таблиц; вызывать под _rc_lock."""
+    global _rc_con, _rc_path, _rc_data_version, _rc_versions
+    if _rc_con is None or _rc_path != path:
+        if _rc_con is not None:
+            try:
+                _rc_con.close()
+            except sqlite3.Error:
+                pass
+        _rc_con = None
+        _rc_entries.clear()
+        con = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        con.execute("PRAGMA busy_timeout=5000")
+        _rc_con, _rc_path, _rc_data_version = con, path, None
+    _rc_stats["checks"] += 1
+    dv = _rc_con.execute("PRAGMA data_version").fetchone()[0]
+    if dv != _rc_data_version:
+        _rc_versions = dict(_rc_con.execute("SELECT tbl, version FROM table_versions").fetchall())
+        _rc_data_version = dv
+        _rc_stats["refreshes"] += 1
+    return _rc_versions
+
+
+def db_read_cached(key: str, tables: tuple, loader):
+    """
+    Результат loader() из кеша процесса, пока таблицы tables не менялись
+    (см. «Read cache»). key — имя записи кеша; loader читает только tables.
+    """
+    _ensure_init()
+    local = _pool_local
+    in_tx = getattr(local, "depth", 0) and local.con.in_transaction
+    stats = _rc_key_stats.setdefault(key, {"hits": 0, "misses": 0})
+    if not _READ_CACHE_ENABLED or in_tx:
+        _rc_stats["bypassed"] += 1
+        return loader()
+    path = str(DB_PATH)
+    try:
+        with _rc_lock:
+            current = _rc_current_versions(path)
+            stamp = tuple(current.get(t, 0) for t in tables)
+            entry = _rc_entries.get(key)
+            if entry is not None and entry[0] == stamp:
+                _rc_stats["hits"] += 1
+                stats["hits"] += 1
+                return entry[1]
+    except sqlite3.Error as e:
+        logger.warning("read cache: проверка версий не удалась, читаю из БД: %s", e)
+        _rc_stats["bypassed"] += 1
+        return loader()
+    # Версии сняты ДО чтения: запись, закоммиченная во время loader(), сдвинет
+    # версию, и следующий вызов перечитает (лишний промах, но не устаревшие данные).
+    value = loader()
+    _rc_stats["misses"] += 1
+    stats["misses"] += 1
+    with _rc_lock:
+        if _rc_path == path:
+            _rc_entries[key] = (stamp, value)
+    return value
+
+
+def db_read_cache_clear() -> None:
+    """Сбрасывает все записи кеша (тесты / ручное вмешательство)."""
+    with _rc_lock:
+        _rc_entries.clear()
+
+
+def db_read_cache_stats() -> Dict:
+    """Счётчики кеша: hits / misses / bypassed (в транзакции или выключен),
+    checks (проверок data_version) / refreshes (перечитываний table_versions),
+    entries и разбивка hits/misses по ключам."""
+    with _rc_lock:
+        entries = len(_rc_entries)
+    return {**_rc_stats, "entries": entries,
+            "keys": {k: dict(v) for k, v in _rc_key_stats.items()}}
 
 
 # ─── Schema ───────────────────────────────────────────────────────────────────
@@ -206,38 +638,48 @@ CREATE INDEX IF NOT EXISTS idx_ip_usage_tid_seen ON ip_usage (telegram_id, last_
 
 def init_db(whitelist_seed: Optional[List[int]] = None) -> None:
     """
-    Создаёт таблицы и мигрирует users.json → SQLite (идемпотентно).
+    Создаёт таблицы и прогоняет миграции (идемпотентно).
     whitelist_seed — список telegram_id из env (TELEGRAM_ID_WHITELIST),
     которые добавляются в whitelist при первой инициализации.
+
+    Fast path: версия схемы хранится в `PRAGMA user_version`. Если БД уже на
+    _SCHEMA_VERSION — ни _SCHEMA, ни миграции не выполняются (cron-скрипты
+    каждые 5–15 мин больше не платят ~20 PRAGMA table_info/ALTER на старте).
+    Иначе выполняются только миграции с номером > user_version, каждая с
+    замером времени в лог, и user_version поднимается после каждой. На fast
+    path сверяются только индексы _LOOKUP_INDEXES (один SELECT по sqlite_master).
     """
     global _db_initialized
     with _conn() as con:
-        con.executescript(_SCHEMA)
-    _migrate_from_json()
-    _migrate_peers_json_to_sqlite()
-    _migrate_add_vless_columns()
-    _migrate_add_servers_table()
-    _migrate_add_proxy_column()
-    _migrate_add_vless_column()
-    _migrate_add_vless_server_traffic_table()
-    _migrate_add_traffic_snapshots_table()
-    _migrate_add_per_user_vless_uuids()
-    _migrate_add_vless_user_traffic_table()
-    _migrate_add_subscription_columns()
-    _migrate_add_password_column()
-    _migrate_add_sub_token_column()
-    _migrate_add_referral_bonus_paid_column()
-    _migrate_add_expiry_notif_columns()
-    _migrate_add_migrated_at_column()
-    _migrate_add_claim_device_limit()
-    # B (Фаза 2): peers platform→device_id + devices. ПОСЛЕДНЕЙ — после того как
-    # все peer-данные (json→sqlite и пр.) уже в старом формате, конвертируем 1:1.
-    _migrate_peers_platform_to_device()
+        version = con.execute("PRAGMA user_version").fetchone()[0]
+    if version < _SCHEMA_VERSION:
+        _run_migrations(version)
+    else:
+        _ensure_lookup_indexes()
     if whitelist_seed:
         _seed_whitelist(whitelist_seed)
     _db_initialized = True
 
 
+def _run_migrations(from_version: int) -> None:
+    """Выполняет миграции реестра _MIGRATIONS с номером > from_version."""
+    t0 = time.perf_counter()
+    with _conn() as con:
+        con.executescript(_SCHEMA)
+    logger.info("Migration: schema v%d → v%d, base schema %.1f ms",
+                from_version, _SCHEMA_VERSION, (time.perf_counter() - t0) * 1000)
+    for version, fn in enumerate(_MIGRATIONS, start=1):
+        if version <= from_version:
+            continue
+        t0 = time.perf_counter()
+        fn()
+        # PRAGMA не параметризуется; version — int из реестра, не ввод.
+        with _conn() as con:
+            con.execute(f"PRAGMA user_version = {version}")
+        logger.info("Migration %d %s: %.1f ms",
+                    version, fn.__name__, (time.perf_counter() - t0) * 1000)
+
+
 def _migrate_add_servers_table() -> None:
     """
     Идемпотентная миграция: создаёт таблицу servers (если нет) и засевает
@@ -432,9 +874,8 @@ def _migrate_add_traffic_snapshots_table() -> None:
     VLESS использует общие UUIDs — per-user всё равно невозможно;
     per-server VLESS-history можно достать из journalctl `vless-summary`.
 
-    Rolling-delete: >14 дней удаляется автоматически при каждой записи
-    (см. db_record_traffic_snapshot). Объём: ~16 peers × 12 snapshots/час
-    × 24 ч × 14 дней ≈ 65k строк (мизер для SQLite).
+    Rolling-delete: сырые снимки старше _TRAFFIC_RAW_KEEP_DAYS удаляются после
+    свёртки в часовые/дневные бакеты traffic_rollup (см. db_rollup_traffic).
     """
     with _conn() as con:
         con.execute(
@@ -454,6 +895,55 @@ def _migrate_add_traffic_snapshots_table() -> None:
         )
 
 
+def _migrate_add_traffic_snapshots_pk_ts_index() -> None:
+    """
+    Индекс (public_key, ts) для window-запроса db_query_traffic_delta:
+    PARTITION BY public_key ORDER BY ts можно читать по индексу без сортировки.
+    PK (ts, public_key) для этого не подходит (ведущая колонка — ts).
+    """
+    with _conn() as con:
+        con.execute(
+            "CREATE INDEX IF NOT EXISTS idx_traffic_snapshots_pk_ts "
+            "ON traffic_snapshots(public_key, ts)"
+        )
+
+
+def _migrate_add_traffic_rollup_tables() -> None:
+    """
+    Многоуровневое хранилище истории AWG-трафика (см. db_rollup_traffic):
+    traffic_rollup — reset-aware дельты per peer в часовых ('h') и дневных
+    ('d') бакетах; traffic_rollup_state — водяной знак свёртки по уровню.
+    Сырые traffic_snapshots после этого хранятся лишь несколько дней.
+    """
+    with _conn() as con:
+        con.execute(
+            """
+            CREATE TABLE IF NOT EXISTS traffic_rollup (
+                resolution  TEXT NOT NULL,              -- 'h' | 'd'
+                bucket      TEXT NOT NULL,              -- начало бакета, UTC
+                public_key  TEXT NOT NULL,
+                telegram_id INTEGER,
+                rx          INTEGER NOT NULL DEFAULT 0, -- дельта за бакет
+                tx          INTEGER NOT NULL DEFAULT 0,
+                samples     INTEGER NOT NULL DEFAULT 0, -- сколько 5-мин снимков
+                PRIMARY KEY (resolution, bucket, public_key)
+            )
+            """
+        )
+        con.execute(
+            "CREATE INDEX IF NOT EXISTS idx_traffic_rollup_tid "
+            "ON traffic_rollup(resolution, telegram_id, bucket)"
+        )
+        con.execute(
+            """
+            CREATE TABLE IF NOT EXISTS traffic_rollup_state (
+                resolution    TEXT PRIMARY KEY,
+                folded_until  TEXT NOT NULL
+            )
+            """
+        )
+
+
 def _migrate_add_vless_server_traffic_table() -> None:
     """
     Создаёт таблицу vless_server_traffic для per-server summary VLESS-трафика
@@ -555,6 +1045,306 @@ def _migrate_add_subscription_columns() -> None:
                     logger.info("Migration: skip %s (%s)", name, e)
 
 
+def _migrate_add_expires_epoch_column() -> None:
+    """
+    Нормализованный срок доступа: users.expires_epoch = expires_at в unix-секундах
+    (UTC) + индекс. Все «доступ активен / истёк / в grace» запросы сравнивают
+    expires_epoch с константой → index range scan вместо datetime(expires_at)
+    по всей таблице.
+
+    expires_at пишется в разных форматах (isoformat с 'T' и микросекундами,
+    datetime('now') с пробелом) и не только из этого модуля (main.py,
+    enforce_expired.py, ручные правки sqlite3), поэтому колонку держат в
+    синхроне триггеры на INSERT/UPDATE OF expires_at — тем же парсером SQLite,
+    что и прежний datetime(expires_at). Нераспознанная строка → NULL (как и
+    раньше: datetime() = NULL, доступ не активен).
+    """
+    with _conn() as con:
+        existing = {row[1] for row in con.execute("PRAGMA table_info(users)").fetchall()}
+        if "expires_epoch" not in existing:
+            con.execute("ALTER TABLE users ADD COLUMN expires_epoch INTEGER")
+            logger.info("Migration: added expires_epoch column to users")
+        for name, event in (("ins", "INSERT"), ("upd", "UPDATE OF expires_at")):
+            con.execute(
+                f"CREATE TRIGGER IF NOT EXISTS trg_users_expires_epoch_{name} "
+                f"AFTER {event} ON users BEGIN "
+                f"UPDATE users SET expires_epoch = CAST(strftime('%s', NEW.expires_at) AS INTEGER) "
+                f"WHERE rowid = NEW.rowid; END"
+            )
+        n = con.execute(
+            "UPDATE users SET expires_epoch = CAST(strftime('%s', expires_at) AS INTEGER) "
+            "WHERE expires_epoch IS NOT CAST(strftime('%s', expires_at) AS INTEGER)"
+        ).rowcount
+        con.execute("CREATE INDEX IF NOT EXISTS idx_users_expires_epoch ON users(expires_epoch)")
+    if n:
+        logger.info("Migration: backfilled expires_epoch for %d users", n)
+
+
+# Вторичные индексы под point-lookup'ы горячих эндпоинтов: (имя, таблица,
+# колонки, WHERE частичного индекса). /sub/<token> дёргается каждым клиентом
+# ~раз в 12 ч на устройство, реферальные/платёжные/OTP-поиски — на каждом
+# /start, вебхуке и входе в ЛК. Частичные (IS NOT NULL): у большинства юзеров
+# колонка пуста, а `col = ?` планировщик SQLite сам сводит к `col IS NOT NULL`.
+# Не UNIQUE: дубли в исторических данных не должны ронять миграцию.
+_LOOKUP_INDEXES = (
+    ("idx_users_sub_token", "users", "sub_token", "sub_token IS NOT NULL"),
+    ("idx_users_referral_code", "users", "referral_code", "referral_code IS NOT NULL"),
+    ("idx_users_referred_by", "users", "referred_by", "referred_by IS NOT NULL"),
+    ("idx_payments_external_id", "payments", "external_id", "external_id IS NOT NULL"),
+    ("idx_otp_codes_email", "otp_codes", "email, used", None),
+    # storage: поиск слотов по устройству и выборка по серверу (вместо get_all_peers).
+    ("idx_peers_device_id", "peers", "device_id", None),
+    ("idx_peers_server_active", "peers", "server_id, active", None),
+    # IP-аллокатор: «адрес уже занят peer'ом?» без прохода по всем слотам.
+    ("idx_peers_wg_ip", "peers", "wg_ip", None),
+)
+
+
+def _ensure_lookup_indexes() -> List[str]:
+    """
+    Создаёт отсутствующие индексы из _LOOKUP_INDEXES, возвращает их имена.
+    Вызывается миграцией и на fast path init_db — индекс, снесённый руками
+    или потерянный при восстановлении из дампа, пересоздастся при старте.
+    """
+    with _conn() as con:
+        existing = {r[0] for r in con.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'"
+        ).fetchall()}
+        created = []
+        for name, table, cols, where in _LOOKUP_INDEXES:
+            if name in existing:
+                continue
+            partial = f" WHERE {where}" if where else ""
+            con.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({cols}){partial}")
+            created.append(name)
+    for name in created:
+        logger.info("Migration: created index %s", name)
+    return created
+
+
+def _migrate_add_lookup_indexes() -> None:
+    """Индексы по sub_token / referral_code / referred_by / external_id / OTP email."""
+    _ensure_lookup_indexes()
+
+
+def _migrate_add_peer_lookup_indexes() -> None:
+    """Индексы peers по device_id и (server_id, active) для точечных запросов storage."""
+    _ensure_lookup_indexes()
+
+
+# Таблицы, за изменениями которых следит read cache (db_read_cached).
+_VERSIONED_TABLES = ("users", "peers")
+
+
+def _migrate_add_table_versions() -> None:
+    """
+    Счётчики изменений таблиц для read cache: table_versions(tbl, version),
+    триггеры AFTER INSERT/UPDATE/DELETE на _VERSIONED_TABLES увеличивают
+    version. Триггеры, а не инкремент в db_upsert_*: users/peers пишут и
+    мимо этого модуля (main.py, cron-скрипты, ручные правки).
+    """
+    with _conn() as con:
+        con.execute(
+            "CREATE TABLE IF NOT EXISTS table_versions ("
+            "tbl TEXT PRIMARY KEY, version INTEGER NOT NULL DEFAULT 0)"
+        )
+        for tbl in _VERSIONED_TABLES:
+            con.execute("INSERT OR IGNORE INTO table_versions (tbl) VALUES (?)", (tbl,))
+            for event in ("INSERT", "UPDATE", "DELETE"):
+                con.execute(
+                    f"CREATE TRIGGER IF NOT EXISTS trg_{tbl}_version_{event.lower()} "
+                    f"AFTER {event} ON {tbl} BEGIN "
+                    f"UPDATE table_versions SET version = version + 1 WHERE tbl = '{tbl}'; END"
+                )
+
+
+# Хост из peers.wg_ip ('10.1.0.5/32' → '10.1.0.5') для SQL триггеров.
+def _sql_wg_host(col: str) -> str:
+    return f"(CASE WHEN instr({col}, '/') > 0 THEN substr({col}, 1, instr({col}, '/') - 1) ELSE {col} END)"
+
+
+def _ip_release_sql(tid: str, host: str) -> List[str]:
+    """Возврат аренды (telegram_id, host) в free-list всех пулов её пространства,
+    где адрес уже ниже курсора next_ip (выше курсора он свободен неявно)."""
+    return [
+        "INSERT OR IGNORE INTO ip_pool_free (space, pool, ip) "
+        "SELECT p.space, p.pool, l.ip FROM ip_leases l JOIN ip_pools p ON p.space = l.space "
+        f"WHERE l.telegram_id = {tid} AND l.host = {host} "
+        "AND l.ip BETWEEN p.lo AND p.hi AND l.ip < p.next_ip "
+        "AND (p.ex_lo IS NULL OR l.ip NOT BETWEEN p.ex_lo AND p.ex_hi)",
+        f"DELETE FROM ip_leases WHERE telegram_id = {tid} AND host = {host}",
+    ]
+
+
+def _migrate_add_ip_allocator() -> None:
+    """
+    Состояние IP-аллокатора WG/AmneziaWG (см. db_ip_allocate):
+    ip_spaces — адресные пространства (нода + подсеть), засеянные из peers;
+    ip_leases — занятые адреса (смещение от адреса сети); ip_pools — пулы
+    внутри пространства (диапазон, исключение, курсор next_ip); ip_pool_free —
+    освобождённые адреса ниже курсора.
+
+    Освобождение — триггерами на peers (DELETE и смена wg_ip): слоты удаляют
+    и db_delete_peer, и db_delete_device, и ручные правки. Soft-revoke
+    (active=0) адрес НЕ освобождает — restore возвращает peer с тем же IP.
+    """
+    with _conn() as con:
+        con.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS ip_spaces (
+                space      TEXT PRIMARY KEY,              -- '{нода}:{cidr}'
+                cidr       TEXT NOT NULL,
+                seeded_at  TEXT NOT NULL DEFAULT (datetime('now'))
+            );
+            CREATE TABLE IF NOT EXISTS ip_leases (
+                space       TEXT NOT NULL,
+                ip          INTEGER NOT NULL,             -- смещение от адреса сети
+                host        TEXT NOT NULL,                -- '10.1.0.5'
+                telegram_id INTEGER,
+                pool        TEXT,
+                leased_at   TEXT NOT NULL DEFAULT (datetime('now')),
+                PRIMARY KEY (space, ip)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS idx_ip_leases_owner ON ip_leases (telegram_id, host);
+            CREATE TABLE IF NOT EXISTS ip_pools (
+                space    TEXT NOT NULL,
+                pool     TEXT NOT NULL,
+                lo       INTEGER NOT NULL,
+                hi       INTEGER NOT NULL,
+                ex_lo    INTEGER,
+                ex_hi    INTEGER,
+                next_ip  INTEGER NOT NULL,                -- выше — ни разу не выданные
+                PRIMARY KEY (space, pool)
+            );
+            CREATE TABLE IF NOT EXISTS ip_pool_free (
+                space  TEXT NOT NULL,
+                pool   TEXT NOT NULL,
+                ip     INTEGER NOT NULL,
+                PRIMARY KEY (space, pool, ip)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS idx_ip_pool_free_ip ON ip_pool_free (space, ip);
+            """
+        )
+        same_host = (
+            "NOT EXISTS (SELECT 1 FROM peers WHERE telegram_id = OLD.telegram_id "
+            f"AND {_sql_wg_host('wg_ip')} = {_sql_wg_host('OLD.wg_ip')})"
+        )
+        body = "; ".join(_ip_release_sql("OLD.telegram_id", _sql_wg_host("OLD.wg_ip")))
+        con.execute(
+            f"CREATE TRIGGER IF NOT EXISTS trg_peers_ip_release_del AFTER DELETE ON peers "
+            f"WHEN {same_host} BEGIN {body}; END"
+        )
+        con.execute(
+            f"CREATE TRIGGER IF NOT EXISTS trg_peers_ip_release_upd AFTER UPDATE OF wg_ip ON peers "
+            f"WHEN OLD.wg_ip IS NOT NEW.wg_ip AND {same_host} BEGIN {body}; END"
+        )
+    _ensure_lookup_indexes()
+
+
+def _migrate_add_peer_shard_column() -> None:
+    """
+    peers.shard — имя AWG-шарда eu1 (контейнер + интерфейс + подсеть, см.
+    bot/awg_shards.py), в котором живёт peer. NULL — слоты до шардирования:
+    они в первом шарде AMNEZIAWG_EU1_SHARDS. Для не-AWG слотов всегда NULL.
+    """
+    with _conn() as con:
+        existing = {row[1] for row in con.execute("PRAGMA table_info(peers)").fetchall()}
+        if "shard" not in existing:
+            try:
+                con.execute("ALTER TABLE peers ADD COLUMN shard TEXT")
+                logger.info("Migration: added shard column to peers")
+            except sqlite3.OperationalError as e:
+                logger.info("Migration: skip peers.shard (%s)", e)
+
+
+def _migrate_add_provision_jobs() -> None:
+    """
+    provision_jobs — очередь выдачи конфигов (bot/provision_queue.py): хендлеры
+    бота/ЛК ставят задачу и сразу отвечают, воркеры по нодам выполняют SSH.
+    idem_key UNIQUE — повторный тап/запрос возвращает ту же задачу, пока она
+    queued/running (по завершении ключ освобождается); owner —
+    процесс, который доставит результат ('bot' / 'web'). result хранит конфиг
+    (с приватным ключом) только до доставки.
+    """
+    with _conn() as con:
+        con.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS provision_jobs (
+                id           INTEGER PRIMARY KEY AUTOINCREMENT,
+                idem_key     TEXT UNIQUE,
+                kind         TEXT NOT NULL,
+                node         TEXT NOT NULL,
+                owner        TEXT NOT NULL,
+                telegram_id  INTEGER,
+                params       TEXT NOT NULL DEFAULT '{}',
+                status       TEXT NOT NULL DEFAULT 'queued', -- queued|running|done|failed
+                attempts     INTEGER NOT NULL DEFAULT 0,
+                max_attempts INTEGER NOT NULL DEFAULT 3,
+                run_after    TEXT NOT NULL DEFAULT (datetime('now')),
+                result       TEXT,
+                error        TEXT,
+                created_at   TEXT NOT NULL DEFAULT (datetime('now')),
+                started_at   TEXT,
+                finished_at  TEXT,
+                delivered_at TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_provision_jobs_claim
+                ON provision_jobs (status, owner, node, run_after);
+            """
+        )
+
+
+def _migrate_add_awg_warm_pool() -> None:
+    """
+    awg_warm_pool — заранее созданные AmneziaWG peer'ы без владельца
+    (bot/awg_warm_pool.py). Peer уже в runtime шарда, IP арендован за
+    WARM_POOL_TELEGRAM_ID; выдача забирает строку, пишет слот в peers и
+    переносит аренду на юзера одной транзакцией (db_warm_pool_claim).
+    client_config (с приватным ключом) живёт здесь только до выдачи.
+    """
+    with _conn() as con:
+        con.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS awg_warm_pool (
+                id            INTEGER PRIMARY KEY AUTOINCREMENT,
+                node          TEXT NOT NULL,
+                shard         TEXT NOT NULL,
+                wg_ip         TEXT NOT NULL,
+                host          TEXT NOT NULL UNIQUE,
+                public_key    TEXT NOT NULL,
+                client_config TEXT NOT NULL,
+                created_at    TEXT NOT NULL DEFAULT (datetime('now'))
+            );
+            CREATE INDEX IF NOT EXISTS idx_awg_warm_pool_node ON awg_warm_pool (node, id);
+            """
+        )
+
+
+def _migrate_add_xray_sync_state() -> None:
+    """
+    xray_sync_state — отложенный sync clients[] Xray по нодам (bot/xray_sync.py).
+    requested_gen растёт на каждый запрос (новый per-user UUID), synced_gen —
+    сколько запросов покрыл последний успешный sync: нода «грязная», пока
+    requested_gen > synced_gen. Флаг в БД переживает падение процесса — sync
+    догоняется после рестарта. dirty_since (unix-время) — первый непокрытый
+    запрос, для метрики задержки.
+    """
+    with _conn() as con:
+        con.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS xray_sync_state (
+                server_id     TEXT PRIMARY KEY,
+                requested_gen INTEGER NOT NULL DEFAULT 0,
+                synced_gen    INTEGER NOT NULL DEFAULT 0,
+                dirty_since   REAL,
+                failures      INTEGER NOT NULL DEFAULT 0,
+                last_error    TEXT,
+                synced_at     TEXT
+            );
+            """
+        )
+
+
 def _migrate_add_claim_device_limit() -> None:
     """Добавляет device_limit в payment_claims (идемпотентно).
 
@@ -792,6 +1582,58 @@ def _seed_whitelist(ids: List[int]) -> None:
             )
 
 
+def _migrate_release_finished_job_keys() -> None:
+    """idem_key держит только незавершённые задачи: у done/failed, созданных до
+    этого, ключ снимается — иначе тот же тап навсегда «занят» старой задачей."""
+    with _conn() as con:
+        con.execute(
+            "UPDATE provision_jobs SET idem_key = NULL "
+            "WHERE idem_key IS NOT NULL AND status IN ('done', 'failed')"
+        )
+
+
+# Реестр миграций: номер = позиция (с 1), сохраняется в PRAGMA user_version.
+# ТОЛЬКО ДОПИСЫВАТЬ В КОНЕЦ — не переставлять и не удалять (номера уже записаны
+# в прод-БД). Каждая миграция обязана быть идемпотентной: старая БД с
+# user_version=0 (до реестра) прогонит их все, и две службы могут стартовать
+# одновременно.
+_MIGRATIONS = [
+    _migrate_from_json,
+    _migrate_peers_json_to_sqlite,
+    _migrate_add_vless_columns,
+    _migrate_add_servers_table,
+    _migrate_add_proxy_column,
+    _migrate_add_vless_column,
+    _migrate_add_vless_server_traffic_table,
+    _migrate_add_traffic_snapshots_table,
+    _migrate_add_per_user_vless_uuids,
+    _migrate_add_vless_user_traffic_table,
+    _migrate_add_subscription_columns,
+    _migrate_add_password_column,
+    _migrate_add_sub_token_column,
+    _migrate_add_referral_bonus_paid_column,
+    _migrate_add_expiry_notif_columns,
+    _migrate_add_migrated_at_column,
+    _migrate_add_claim_device_limit,
+    # B (Фаза 2): peers platform→device_id + devices. ПОСЛЕ всех peer-миграций
+    # старого формата (json→sqlite и пр.) — конвертируем 1:1.
+    _migrate_peers_platform_to_device,
+    _migrate_add_traffic_snapshots_pk_ts_index,
+    _migrate_add_traffic_rollup_tables,
+    _migrate_add_expires_epoch_column,
+    _migrate_add_lookup_indexes,
+    _migrate_add_peer_lookup_indexes,
+    _migrate_add_table_versions,
+    _migrate_add_ip_allocator,
+    _migrate_add_peer_shard_column,
+    _migrate_add_provision_jobs,
+    _migrate_add_awg_warm_pool,
+    _migrate_add_xray_sync_state,
+    _migrate_release_finished_job_keys,
+]
+_SCHEMA_VERSION = len(_MIGRATIONS)
+
+
 # ─── Helpers ──────────────────────────────────────────────────────────────────
 
 def _now_iso() -> str:
@@ -913,19 +1755,26 @@ def db_upsert_user(data: Dict) -> int:
         return row["id"] if row else 0
 
 
-def db_get_all_users() -> List[Dict]:
-    _ensure_init()
+def _load_all_users() -> List[Dict]:
     with _conn() as con:
         rows = con.execute("SELECT * FROM users ORDER BY id").fetchall()
         return [dict(r) for r in rows]
 
 
+def db_get_all_users() -> List[Dict]:
+    """Все строки users (через read cache — dict'ы не мутировать)."""
+    _ensure_init()
+    return list(db_read_cached("db.users", ("users",), _load_all_users))
+
+
 # Сегменты для рассылок (broadcast). active=1 — аккаунт включён (не cruft/бан).
 # «доступ активен» = expires_at в будущем (реальных grandfather=NULL у нас нет —
-# NULL это незавершённый онбординг/placeholder, в active НЕ попадает).
+# NULL это незавершённый онбординг/placeholder, в active НЕ попадает). Сравнение
+# идёт по индексированному expires_epoch (см. _migrate_add_expires_epoch_column).
 # «онбординг завершён» = migrated + верифицированный НЕ синтетический email.
 _SEG_BASE = "telegram_id IS NOT NULL AND telegram_id > 0 AND active = 1"
-_SEG_ACTIVE = "(expires_at IS NOT NULL AND datetime(expires_at) > datetime('now'))"
+_NOW_EPOCH = "CAST(strftime('%s', 'now') AS INTEGER)"
+_SEG_ACTIVE = f"(expires_epoch IS NOT NULL AND expires_epoch > {_NOW_EPOCH})"
 _SEG_ONBOARDED = (
     "(migrated_at IS NOT NULL AND email_verified = 1 "
     "AND email IS NOT NULL AND email NOT LIKE '%@kronos.internal')"
@@ -977,19 +1826,20 @@ def db_users_due_for_churn_survey() -> List[Dict]:
             f"SELECT telegram_id, email, expires_at FROM users "
             f"WHERE {_SEG_BASE} AND NOT {_SEG_ACTIVE} AND {_SEG_ONBOARDED} "
             f"AND churn_asked_at IS NULL "
-            f"AND expires_at IS NOT NULL AND date(expires_at) = date('now', '-1 day')"
+            f"AND expires_epoch >= CAST(strftime('%s', 'now', 'start of day', '-1 day') AS INTEGER) "
+            f"AND expires_epoch < CAST(strftime('%s', 'now', 'start of day') AS INTEGER)"
         ).fetchall()
     return [dict(r) for r in rows]
 
 
 def db_update_proxy_requested_at(telegram_id: int) -> None:
-    """Записывает время последнего запроса MTProxy-ссылки пользователем."""
+    """Записывает время последнего запроса MTProxy-ссылки пользователем (write-behind)."""
     _ensure_init()
-    with _conn() as con:
-        con.execute(
-            "UPDATE users SET proxy_requested_at = datetime('now') WHERE telegram_id = ?",
-            (telegram_id,),
-        )
+    _write_behind(
+        ("proxy_requested_at", telegram_id),
+        "UPDATE users SET proxy_requested_at = ? WHERE telegram_id = ?",
+        (datetime.utcnow().strftime(_TS_FMT), telegram_id),
+    )
 
 
 def db_update_vless_requested_at(telegram_id: int) -> None:
@@ -1000,13 +1850,16 @@ def db_update_vless_requested_at(telegram_id: int) -> None:
     (включая авто-refresh HAPP/Streisand-клиентами). Используется в админ-панели
     как `vless_last_seen` сигнал — компенсирует отсутствие AWG-handshake для
     VLESS-юзеров до тех пор пока не сделаем per-user UUID + Xray stats API.
+
+    Самая частая запись в БД (каждый /sub каждого клиента) — идёт через
+    write-behind очередь; время фиксируется в момент hit'а, не flush'а.
     """
     _ensure_init()
-    with _conn() as con:
-        con.execute(
-            "UPDATE users SET vless_requested_at = datetime('now') WHERE telegram_id = ?",
-            (telegram_id,),
-        )
+    _write_behind(
+        ("vless_requested_at", telegram_id),
+        "UPDATE users SET vless_requested_at = ? WHERE telegram_id = ?",
+        (datetime.utcnow().strftime(_TS_FMT), telegram_id),
+    )
 
 
 def db_get_effective_telegram_id(user_row: Dict) -> int:
@@ -1025,9 +1878,10 @@ def db_get_effective_telegram_id(user_row: Dict) -> int:
 def db_get_user_total_bytes(telegram_id: int) -> int:
     """Суммарный трафик юзера (AWG + VLESS, lifetime rx+tx) в байтах.
     Для лимита триала (7д/20ГБ): traffic_accounting (AWG per-peer) +
-    vless_user_traffic (VLESS per-server). Триал-юзер новый → lifetime ≈ объём
-    триала, baseline не нужен. NB: eu1-direct VLESS per-user не трекается
-    отдельно → кэп чуть щедрый (в пользу юзера)."""
+    vless_user_traffic (VLESS per-server: main и eu1 — per-user UUID, см.
+    scripts/vless_summary_accounting.py). Триал-юзер новый → lifetime ≈ объём
+    триала, baseline не нужен. Трафик на общем (не per-user) UUID юзеру не
+    приписывается → кэп чуть щедрый (в пользу юзера)."""
     _ensure_init()
     with _conn() as con:
         awg = con.execute(
@@ -1089,26 +1943,106 @@ def db_get_all_peers() -> List[Dict]:
         return [dict(r) for r in rows]
 
 
+_PEERS_ORDER = " ORDER BY telegram_id, server_id, device_id"
+
+
+def db_get_peers_by_telegram_id(telegram_id: int) -> List[Dict]:
+    """Слоты одного юзера (по префиксу PK (telegram_id, server_id, device_id))."""
+    _ensure_init()
+    with _conn() as con:
+        rows = con.execute(
+            "SELECT * FROM peers WHERE telegram_id = ?" + _PEERS_ORDER, (int(telegram_id),)
+        ).fetchall()
+        return [dict(r) for r in rows]
+
+
+def db_get_peers_by_device_id(device_id: str) -> List[Dict]:
+    """Слоты устройства на всех серверах (idx_peers_device_id)."""
+    _ensure_init()
+    with _conn() as con:
+        rows = con.execute(
+            "SELECT * FROM peers WHERE device_id = ?" + _PEERS_ORDER, (device_id,)
+        ).fetchall()
+        return [dict(r) for r in rows]
+
+
+def db_get_peers_by_public_key(public_key: str) -> List[Dict]:
+    """Слоты с данным public_key (idx_peers_public_key); в норме — один."""
+    _ensure_init()
+    with _conn() as con:
+        rows = con.execute(
+            "SELECT * FROM peers WHERE public_key = ?" + _PEERS_ORDER, (public_key,)
+        ).fetchall()
+        return [dict(r) for r in rows]
+
+
+def db_get_peers_by_server(server_ids: List[str], active_only: bool = False) -> List[Dict]:
+    """Слоты на серверах server_ids (сырые значения колонки, без нормализации —
+    её делает storage.get_peers_by_server). idx_peers_server_active; без
+    ORDER BY — иначе планировщик предпочитает обход PK ради сортировки."""
+    _ensure_init()
+    if not server_ids:
+        return []
+    marks = ", ".join("?" * len(server_ids))
+    active = " AND active = 1" if active_only else ""
+    with _conn() as con:
+        rows = con.execute(
+            f"SELECT * FROM peers WHERE server_id IN ({marks}){active}",
+            list(server_ids),
+        ).fetchall()
+        return [dict(r) for r in rows]
+
+
+def db_peers_desired_state(server_ids: List[str], grace_hours: int) -> List[Dict]:
+    """
+    Слоты серверов server_ids + признак wanted: peer должен быть в runtime
+    (active=1 и доступ не истёк больше grace_hours назад; expires_at NULL /
+    юзера нет в users — не отзываем, как enforce_expired). Один запрос для
+    сверки runtime (bot/awg_reconcile.py).
+    """
+    _ensure_init()
+    if not server_ids:
+        return []
+    marks = ", ".join("?" * len(server_ids))
+    with _conn() as con:
+        rows = con.execute(
+            f"""
+            SELECT p.telegram_id, p.server_id, p.device_id, p.public_key, p.wg_ip, p.shard, p.active,
+                   CASE WHEN p.active = 1 AND (u.expires_epoch IS NULL OR u.expires_epoch >=
+                        CAST(strftime('%s', 'now') AS INTEGER) - ?) THEN 1 ELSE 0 END AS wanted
+            FROM peers p
+            LEFT JOIN users u ON u.telegram_id = p.telegram_id
+            WHERE p.server_id IN ({marks})
+            """,
+            [int(grace_hours) * 3600, *server_ids],
+        ).fetchall()
+        return [dict(r) for r in rows]
+
+
 def db_upsert_peer(data: Dict) -> None:
     """
     Вставляет/обновляет peer-слот по ключу (telegram_id, server_id, device_id).
     Ожидает device_id + os (см. storage.upsert_peer). created_at трогает только
-    INSERT (сохраняется при обновлении).
+    INSERT (сохраняется при обновлении). shard=None при обновлении не затирает
+    уже записанный шард (Peer, собранный без него, не «переносит» слот в первый).
     """
     _ensure_init()
     with _conn() as con:
         con.execute(
             """
             INSERT INTO peers
-                (telegram_id, server_id, device_id, os, wg_ip, public_key, active, profile_type, updated_at)
+                (telegram_id, server_id, device_id, os, wg_ip, public_key, active, profile_type,
+                 shard, updated_at)
             VALUES
-                (:telegram_id, :server_id, :device_id, :os, :wg_ip, :public_key, :active, :profile_type, datetime('now'))
+                (:telegram_id, :server_id, :device_id, :os, :wg_ip, :public_key, :active, :profile_type,
+                 :shard, datetime('now'))
             ON CONFLICT(telegram_id, server_id, device_id) DO UPDATE SET
                 os           = :os,
                 wg_ip        = :wg_ip,
                 public_key   = :public_key,
                 active       = :active,
                 profile_type = :profile_type,
+                shard        = COALESCE(:shard, shard),
                 updated_at   = datetime('now')
             """,
             {
@@ -1120,6 +2054,7 @@ def db_upsert_peer(data: Dict) -> None:
                 "public_key": data["public_key"],
                 "active": 1 if data.get("active", True) else 0,
                 "profile_type": data.get("profile_type"),
+                "shard": data.get("shard"),
             },
         )
 
@@ -1154,10 +2089,10 @@ def db_get_device(device_id: str) -> Optional[Dict]:
         return dict(r) if r else None
 
 
-def db_add_device(telegram_id: int, name: str, os: str = "pc") -> str:
-    """Создаёт устройство, возвращает новый device_id (hex8)."""
+def db_add_device(telegram_id: int, name: str, os: str = "pc", device_id: Optional[str] = None) -> str:
+    """Создаёт устройство, возвращает device_id (новый hex8, если не передан)."""
     _ensure_init()
-    device_id = secrets.token_hex(4)
+    device_id = device_id or secrets.token_hex(4)
     with _conn() as con:
         con.execute(
             "INSERT INTO devices (device_id, telegram_id, name, os) VALUES (?, ?, ?, ?)",
@@ -1202,31 +2137,595 @@ def db_device_autoname(telegram_id: int, os: str) -> str:
     return f"{base} {len(same) + 1}"
 
 
-# ─── OTP ──────────────────────────────────────────────────────────────────────
+# ─── IP allocator ─────────────────────────────────────────────────────────────
+# Раньше каждый новый peer: get_all_peers() → set занятых IP → линейный проход
+# net.hosts(); два потока бота могли выбрать один и тот же адрес. Теперь
+# состояние аллокатора лежит в SQLite (_migrate_add_ip_allocator), выдача —
+# одна транзакция BEGIN IMMEDIATE (сериализует потоки и процессы):
+#   1. наименьший адрес из free-list пула (освобождённые ниже курсора), иначе
+#   2. курсор next_ip (адреса выше него ни разу не выдавались этим пулом);
+#      занятые другим пулом того же пространства пропускаются навсегда —
+#      при освобождении они попадут во free-list — так что амортизированно O(1).
+# Пространство (нода + подсеть) засевается арендами из peers один раз, при
+# первой выдаче; дальше peers не читаются целиком. Адрес, занятый слотом,
+# который в аллокатор не попал (ручная вставка, восстановление бэкапа),
+# проверяется по idx_peers_wg_ip и «усыновляется» арендой.
+# Аренда, так и не ставшая слотом (упал SSH), отдаётся db_ip_release; забытые —
+# подбираются при исчерпании пула спустя _IP_LEASE_GRACE_MIN минут.
+
+_IP_LEASE_GRACE_MIN = 10
+
+
+def _ip_taken_by_peer(con: sqlite3.Connection, host: str, server_ids: tuple) -> Optional[int]:
+    """telegram_id слота на этих серверах с адресом host (или None).
+    Фильтр по server_id — в Python: иначе планировщик берёт idx_peers_server_active
+    и проходит все слоты ноды."""
+    for r in con.execute(
+        "SELECT telegram_id, server_id FROM peers WHERE wg_ip = ? OR (wg_ip >= ? AND wg_ip < ?)",
+        (host, host + "/", host + "0"),
+    ).fetchall():
+        if r["server_id"] in server_ids:
+            return r["telegram_id"]
+    return None
 
-def db_create_otp(email: str, code: str, ttl_minutes: int = 10) -> None:
-    """Сохраняет OTP-код. Аннулирует предыдущие неиспользованные коды для этого email."""
+
+def _ip_seed_space(con: sqlite3.Connection, space: str, net, server_ids: tuple) -> None:
+    """Аренды для уже существующих слотов пространства (один раз)."""
+    marks = ", ".join("?" * len(server_ids))
+    base = int(net.network_address)
+    leases = {}
+    for r in con.execute(
+        f"SELECT telegram_id, wg_ip FROM peers WHERE server_id IN ({marks})", server_ids
+    ).fetchall():
+        try:
+            ip = ipaddress.ip_interface((r["wg_ip"] or "").strip()).ip
+        except ValueError:
+            continue
+        if ip in net:
+            leases.setdefault(int(ip) - base, (str(ip), r["telegram_id"]))
+    con.executemany(
+        "INSERT OR IGNORE INTO ip_leases (space, ip, host, telegram_id, pool) "
+        "VALUES (?, ?, ?, ?, 'seed')",
+        [(space, off, host, tid) for off, (host, tid) in leases.items()],
+    )
+    con.execute("INSERT INTO ip_spaces (space, cidr) VALUES (?, ?)", (space, str(net)))
+
+
+def _ip_register_pool(con: sqlite3.Connection, space: str, pool: str, lo: int, hi: int,
+                      exclude: Optional[tuple]) -> None:
+    """(Пере)создаёт пул: free-list = свободные адреса до максимальной аренды
+    в диапазоне, курсор — сразу за ней."""
+    ex_lo, ex_hi = exclude if exclude else (None, None)
+    leased = {r[0] for r in con.execute(
+        "SELECT ip FROM ip_leases WHERE space = ? AND ip BETWEEN ? AND ?", (space, lo, hi)
+    ).fetchall()}
+    top = max(leased) if leased else lo - 1
+    con.execute("DELETE FROM ip_pool_free WHERE space = ? AND pool = ?", (space, pool))
+    con.executemany(
+        "INSERT INTO ip_pool_free (space, pool, ip) VALUES (?, ?, ?)",
+        [(space, pool, ip) for ip in range(lo, top + 1)
+         if ip not in leased and not (exclude and ex_lo <= ip <= ex_hi)],
+    )
+    con.execute(
+        "INSERT OR REPLACE INTO ip_pools (space, pool, lo, hi, ex_lo, ex_hi, next_ip) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (space, pool, lo, hi, ex_lo, ex_hi, top + 1),
+    )
+
+
+def _ip_reclaim_stale(con: sqlite3.Connection, space: str) -> int:
+    """Аренды старше _IP_LEASE_GRACE_MIN без слота (и не в тёплом пуле) → обратно в пулы."""
+    rows = con.execute(
+        "SELECT telegram_id, host FROM ip_leases l WHERE space = ? "
+        "AND leased_at < datetime('now', ?) AND NOT EXISTS ("
+        "  SELECT 1 FROM peers p WHERE p.telegram_id IS l.telegram_id "
+        "  AND (p.wg_ip = l.host OR (p.wg_ip >= l.host || '/' AND p.wg_ip < l.host || '0'))) "
+        "AND NOT EXISTS (SELECT 1 FROM awg_warm_pool w WHERE w.host = l.host)",
+        (space, f"-{_IP_LEASE_GRACE_MIN} minutes"),
+    ).fetchall()
+    for r in rows:
+        for sql in _ip_release_sql(":tid", ":host"):
+            con.execute(sql, {"tid": r["telegram_id"], "host": r["host"]})
+    return len(rows)
+
+
+def _ip_take(con: sqlite3.Connection, space: str, pool: str, hi: int,
+             ex_lo: Optional[int], ex_hi: Optional[int], next_ip: int) -> Optional[int]:
+    row = con.execute(
+        "SELECT ip FROM ip_pool_free WHERE space = ? AND pool = ? ORDER BY ip LIMIT 1",
+        (space, pool),
+    ).fetchone()
+    if row is not None:
+        return row[0]
+    ip = next_ip
+    while ip <= hi:
+        if ex_lo is not None and ex_lo <= ip <= ex_hi:
+            ip = ex_hi + 1
+            continue
+        if con.execute("SELECT 1 FROM ip_leases WHERE space = ? AND ip = ?", (space, ip)).fetchone() is None:
+            break
+        ip += 1
+    con.execute("UPDATE ip_pools SET next_ip = ? WHERE space = ? AND pool = ?",
+                (min(ip, hi) + 1, space, pool))
+    return ip if ip <= hi else None
+
+
+def db_ip_allocate(
+    space: str,
+    network_cidr: str,
+    server_ids: tuple,
+    pool: str,
+    lo: int,
+    hi: int,
+    telegram_id: int,
+    exclude: Optional[tuple] = None,
+) -> Optional[str]:
+    """
+    Выдаёт наименьший свободный адрес пула и сразу арендует его за telegram_id.
+
+    space — ключ пространства ('{нода}:{cidr}'); server_ids — server_id слотов
+    peers, живущих на этой ноде (засев и проверка занятости); lo/hi/exclude —
+    смещения от адреса сети. Возвращает хост ('10.1.0.5') или None, если пул
+    исчерпан.
+    """
     _ensure_init()
-    email = email.lower().strip()
-    expires = _expire_iso(ttl_minutes)
+    net = ipaddress.ip_network(network_cidr, strict=False)
+    base = net.network_address
+    server_ids = tuple(server_ids)
     with _conn() as con:
-        con.execute(
-            "UPDATE otp_codes SET used = 1 WHERE email = ? AND used = 0", (email,)
-        )
-        con.execute(
-            "INSERT INTO otp_codes (email, code, expires_at) VALUES (?, ?, ?)",
-            (email, code, expires),
-        )
+        if not con.in_transaction:
+            con.execute("BEGIN IMMEDIATE")  # выдача атомарна между потоками и процессами
+        if con.execute("SELECT 1 FROM ip_spaces WHERE space = ?", (space,)).fetchone() is None:
+            _ip_seed_space(con, space, net, server_ids)
+        ex_lo, ex_hi = exclude if exclude else (None, None)
+        row = con.execute("SELECT * FROM ip_pools WHERE space = ? AND pool = ?", (space, pool)).fetchone()
+        if row is None or (row["lo"], row["hi"], row["ex_lo"], row["ex_hi"]) != (lo, hi, ex_lo, ex_hi):
+            _ip_register_pool(con, space, pool, lo, hi, exclude)
+        reclaimed = False
+        while True:
+            next_ip = con.execute(
+                "SELECT next_ip FROM ip_pools WHERE space = ? AND pool = ?", (space, pool)
+            ).fetchone()[0]
+            ip = _ip_take(con, space, pool, hi, ex_lo, ex_hi, next_ip)
+            if ip is None:
+                if reclaimed or not _ip_reclaim_stale(con, space):
+                    return None
+                reclaimed = True
+                continue
+            host = str(base + ip)
+            con.execute("DELETE FROM ip_pool_free WHERE space = ? AND ip = ?", (space, ip))
+            owner = _ip_taken_by_peer(con, host, server_ids)
+            if owner is not None:
+                # Слот мимо аллокатора — усыновляем адрес и берём следующий.
+                con.execute(
+                    "INSERT OR IGNORE INTO ip_leases (space, ip, host, telegram_id, pool) "
+                    "VALUES (?, ?, ?, ?, 'adopted')", (space, ip, host, owner),
+                )
+                continue
+            con.execute(
+                "INSERT INTO ip_leases (space, ip, host, telegram_id, pool) VALUES (?, ?, ?, ?, ?)",
+                (space, ip, host, int(telegram_id), pool),
+            )
+            return host
 
 
-def db_verify_otp(email: str, code: str) -> bool:
-    """Проверяет OTP. Возвращает True если валиден и не просрочен. Помечает как использованный."""
+def db_ip_release(telegram_id: int, host: str) -> None:
+    """Отдаёт аренду (telegram_id, host), если слота с этим адресом у юзера нет
+    (выдача не дошла до upsert_peer). Удаление слота освобождает сам триггер."""
     _ensure_init()
-    email = email.lower().strip()
-    now = _now_iso()
+    host = host.split("/")[0].strip()
     with _conn() as con:
-        row = con.execute(
-            """
+        taken = con.execute(
+            "SELECT 1 FROM peers WHERE telegram_id = ? AND (wg_ip = ? OR (wg_ip >= ? AND wg_ip < ?))",
+            (int(telegram_id), host, host + "/", host + "0"),
+        ).fetchone()
+        if taken is None:
+            for sql in _ip_release_sql(":tid", ":host"):
+                con.execute(sql, {"tid": int(telegram_id), "host": host})
+
+
+def db_ip_pool_stats(space: str) -> Dict[str, Dict[str, int]]:
+    """{pool: {"leased", "free", "next_ip", "hi"}} пространства (админка/тесты)."""
+    _ensure_init()
+    with _conn() as con:
+        leased = con.execute("SELECT COUNT(*) FROM ip_leases WHERE space = ?", (space,)).fetchone()[0]
+        out: Dict[str, Dict[str, int]] = {}
+        for r in con.execute("SELECT * FROM ip_pools WHERE space = ?", (space,)).fetchall():
+            free = con.execute(
+                "SELECT COUNT(*) FROM ip_pool_free WHERE space = ? AND pool = ?", (space, r["pool"])
+            ).fetchone()[0]
+            out[r["pool"]] = {"leased": leased, "free": free, "next_ip": r["next_ip"], "hi": r["hi"]}
+        return out
+
+
+# ─── Provisioning jobs ────────────────────────────────────────────────────────
+# Хранилище очереди bot/provision_queue.py. Захват задачи — BEGIN IMMEDIATE:
+# лимит одновременных задач на ноду общий для всех процессов (бот + ЛК).
+# Задача, «зависшая» в running (процесс убит посреди SSH), возвращается в
+# очередь db_job_requeue_stale. idem_key дедуплицирует только queued/running:
+# done/failed его освобождают, повтор того же действия — новая задача.
+
+def db_job_submit(
+    kind: str,
+    node: str,
+    owner: str,
+    telegram_id: Optional[int],
+    params: Dict,
+    idem_key: Optional[str] = None,
+    max_attempts: int = 3,
+) -> Tuple[int, bool]:
+    """Ставит задачу. Возвращает (id, created); при повторе idem_key ещё
+    не завершённой задачи — её id и created=False."""
+    _ensure_init()
+    with _conn() as con:
+        cur = con.execute(
+            """
+            INSERT OR IGNORE INTO provision_jobs
+                (idem_key, kind, node, owner, telegram_id, params, max_attempts)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            """,
+            (idem_key, kind, node, owner, telegram_id, json.dumps(params, ensure_ascii=False),
+             max(1, int(max_attempts))),
+        )
+        if cur.rowcount:
+            return int(cur.lastrowid), True
+        row = con.execute("SELECT id FROM provision_jobs WHERE idem_key = ?", (idem_key,)).fetchone()
+        return int(row["id"]), False
+
+
+def _job_row(row: Optional[sqlite3.Row]) -> Optional[Dict]:
+    if row is None:
+        return None
+    job = dict(row)
+    job["params"] = json.loads(job["params"] or "{}")
+    job["result"] = json.loads(job["result"]) if job["result"] else None
+    return job
+
+
+def db_job_claim(
+    owner: str,
+    node: str,
+    kinds: List[str],
+    max_running: int,
+    job_id: Optional[int] = None,
+) -> Optional[Dict]:
+    """
+    Берёт следующую готовую задачу owner/node (status=queued, run_after наступил)
+    и переводит в running, если на ноде сейчас меньше max_running задач.
+    job_id — взять конкретную задачу (синхронное выполнение без воркеров).
+    """
+    _ensure_init()
+    if not kinds:
+        return None
+    marks = ", ".join("?" * len(kinds))
+    with _conn() as con:
+        if not con.in_transaction:
+            con.execute("BEGIN IMMEDIATE")
+        running = con.execute(
+            "SELECT COUNT(*) FROM provision_jobs WHERE status = 'running' AND node = ?", (node,)
+        ).fetchone()[0]
+        if running >= max_running:
+            return None
+        if job_id is not None:
+            row = con.execute(
+                "SELECT id FROM provision_jobs WHERE id = ? AND status = 'queued'", (int(job_id),)
+            ).fetchone()
+        else:
+            row = con.execute(
+                f"""
+                SELECT id FROM provision_jobs
+                WHERE status = 'queued' AND owner = ? AND node = ? AND kind IN ({marks})
+                  AND run_after <= datetime('now')
+                ORDER BY run_after, id LIMIT 1
+                """,
+                (owner, node, *kinds),
+            ).fetchone()
+        if row is None:
+            return None
+        con.execute(
+            """
+            UPDATE provision_jobs
+            SET status = 'running', attempts = attempts + 1, started_at = datetime('now')
+            WHERE id = ?
+            """,
+            (row["id"],),
+        )
+        return _job_row(con.execute("SELECT * FROM provision_jobs WHERE id = ?", (row["id"],)).fetchone())
+
+
+def db_job_complete(job_id: int, result: Dict) -> None:
+    _ensure_init()
+    with _conn() as con:
+        con.execute(
+            """
+            UPDATE provision_jobs
+            SET status = 'done', result = ?, error = NULL, finished_at = datetime('now'),
+                idem_key = NULL
+            WHERE id = ?
+            """,
+            (json.dumps(result, ensure_ascii=False), int(job_id)),
+        )
+
+
+def db_job_fail(job_id: int, error: str, retry_in_s: int, retry: Optional[bool] = None) -> str:
+    """Ошибка попытки: снова в очередь через retry_in_s, если попытки остались,
+    иначе failed. retry=True/False — решение вызывающего вместо attempts <
+    max_attempts. Возвращает новый статус."""
+    _ensure_init()
+    with _conn() as con:
+        con.execute(
+            """
+            UPDATE provision_jobs
+            SET status = CASE WHEN COALESCE(?1, attempts < max_attempts) THEN 'queued' ELSE 'failed' END,
+                run_after = datetime('now', ?2),
+                error = ?3,
+                finished_at = CASE WHEN COALESCE(?1, attempts < max_attempts) THEN NULL ELSE datetime('now') END,
+                idem_key = CASE WHEN COALESCE(?1, attempts < max_attempts) THEN idem_key END
+            WHERE id = ?4
+            """,
+            (None if retry is None else int(retry), f"+{int(retry_in_s)} seconds", error[:1000], int(job_id)),
+        )
+        row = con.execute("SELECT status FROM provision_jobs WHERE id = ?", (int(job_id),)).fetchone()
+        return row["status"] if row else "failed"
+
+
+def db_job_get(job_id: int) -> Optional[Dict]:
+    _ensure_init()
+    with _conn() as con:
+        return _job_row(con.execute("SELECT * FROM provision_jobs WHERE id = ?", (int(job_id),)).fetchone())
+
+
+def db_job_mark_delivered(job_id: int) -> None:
+    """Результат доставлен: конфиг (приватный ключ) из БД стирается."""
+    _ensure_init()
+    with _conn() as con:
+        con.execute(
+            "UPDATE provision_jobs SET result = NULL, delivered_at = datetime('now') WHERE id = ?",
+            (int(job_id),),
+        )
+
+
+def db_job_requeue_stale(older_than_s: int) -> Tuple[int, List[Dict]]:
+    """running дольше older_than_s (процесс-исполнитель умер) → снова queued
+    (или failed, если попытки кончились). Возвращает (сколько вернули в
+    очередь, задачи, ставшие failed) — по вторым надо вызвать listener."""
+    _ensure_init()
+    with _conn() as con:
+        if not con.in_transaction:
+            con.execute("BEGIN IMMEDIATE")
+        rows = con.execute(
+            """
+            SELECT id, attempts < max_attempts AS retry FROM provision_jobs
+            WHERE status = 'running' AND started_at < datetime('now', ?)
+            """,
+            (f"-{int(older_than_s)} seconds",),
+        ).fetchall()
+        if not rows:
+            return 0, []
+        ids = [r["id"] for r in rows]
+        marks = ", ".join("?" * len(ids))
+        con.execute(
+            f"""
+            UPDATE provision_jobs
+            SET status = CASE WHEN attempts < max_attempts THEN 'queued' ELSE 'failed' END,
+                run_after = datetime('now'),
+                error = COALESCE(error, 'stale: исполнитель не завершил задачу'),
+                finished_at = CASE WHEN attempts < max_attempts THEN NULL ELSE datetime('now') END,
+                idem_key = CASE WHEN attempts < max_attempts THEN idem_key END
+            WHERE id IN ({marks})
+            """,
+            ids,
+        )
+        failed = [r["id"] for r in rows if not r["retry"]]
+        jobs = [_job_row(con.execute("SELECT * FROM provision_jobs WHERE id = ?", (i,)).fetchone())
+                for i in failed]
+        return len(ids) - len(failed), jobs
+
+
+def db_job_stats() -> Dict[str, Dict[str, int]]:
+    """{node: {status: count}} за последние сутки + всё незавершённое."""
+    _ensure_init()
+    with _conn() as con:
+        out: Dict[str, Dict[str, int]] = {}
+        for r in con.execute(
+            """
+            SELECT node, status, COUNT(*) AS n FROM provision_jobs
+            WHERE status IN ('queued', 'running') OR created_at >= datetime('now', '-1 day')
+            GROUP BY node, status
+            """
+        ).fetchall():
+            out.setdefault(r["node"], {})[r["status"]] = r["n"]
+        return out
+
+
+# ─── AmneziaWG warm pool ──────────────────────────────────────────────────────
+# Готовые peer'ы без владельца (bot/awg_warm_pool.py). Аренда IP пула записана
+# за WARM_POOL_TELEGRAM_ID; _ip_reclaim_stale её не трогает.
+
+WARM_POOL_TELEGRAM_ID = 0
+
+
+def db_warm_pool_add(node: str, shard: str, wg_ip: str, public_key: str, client_config: str) -> int:
+    _ensure_init()
+    with _conn() as con:
+        cur = con.execute(
+            """
+            INSERT INTO awg_warm_pool (node, shard, wg_ip, host, public_key, client_config)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            (node, shard, wg_ip, wg_ip.split("/")[0].strip(), public_key, client_config),
+        )
+        return int(cur.lastrowid)
+
+
+def db_warm_pool_claim(
+    node: str, slot: Dict, resolve_device: Optional[Callable[[], str]] = None,
+) -> Optional[Dict]:
+    """
+    Забирает самый старый готовый peer ноды и в той же транзакции делает его
+    слотом: slot — поля db_upsert_peer без wg_ip/public_key/shard (берутся из
+    пула); аренда IP переходит на slot['telegram_id']. Без slot['device_id']
+    устройство даёт resolve_device() — только если пул не пуст. None — пул пуст.
+    Возвращает строку пула (wg_ip, shard, public_key, client_config) + device_id.
+    """
+    _ensure_init()
+    with _conn() as con:
+        if not con.in_transaction:
+            con.execute("BEGIN IMMEDIATE")  # одна строка пула — одному юзеру
+        row = con.execute(
+            "SELECT * FROM awg_warm_pool WHERE node = ? ORDER BY id LIMIT 1", (node,)
+        ).fetchone()
+        if row is None:
+            return None
+        if not slot.get("device_id"):
+            slot = {**slot, "device_id": resolve_device()}
+        con.execute("DELETE FROM awg_warm_pool WHERE id = ?", (row["id"],))
+        con.execute(
+            "UPDATE ip_leases SET telegram_id = ?, leased_at = datetime('now') "
+            "WHERE host = ? AND telegram_id = ?",
+            (int(slot["telegram_id"]), row["host"], WARM_POOL_TELEGRAM_ID),
+        )
+        db_upsert_peer({**slot, "wg_ip": row["wg_ip"], "public_key": row["public_key"],
+                        "shard": row["shard"], "active": True})
+        return {**dict(row), "device_id": slot["device_id"]}
+
+
+def db_warm_pool_remove(pool_id: int) -> Optional[Dict]:
+    """Убирает строку пула (шард выведен из конфига и т.п.); аренду IP отдаёт.
+    Возвращает удалённую строку — runtime-peer вызывающий удаляет сам."""
+    _ensure_init()
+    with _conn() as con:
+        row = con.execute("SELECT * FROM awg_warm_pool WHERE id = ?", (int(pool_id),)).fetchone()
+        if row is None:
+            return None
+        con.execute("DELETE FROM awg_warm_pool WHERE id = ?", (int(pool_id),))
+        for sql in _ip_release_sql(":tid", ":host"):
+            con.execute(sql, {"tid": WARM_POOL_TELEGRAM_ID, "host": row["host"]})
+        return dict(row)
+
+
+def db_warm_pool_list(node: str) -> List[Dict]:
+    """Строки пула ноды без client_config (метрики, сверки с runtime)."""
+    _ensure_init()
+    with _conn() as con:
+        return [dict(r) for r in con.execute(
+            "SELECT id, node, shard, wg_ip, host, public_key, created_at FROM awg_warm_pool "
+            "WHERE node = ? ORDER BY id",
+            (node,),
+        ).fetchall()]
+
+
+def db_warm_pool_depth(node: str) -> Dict[str, int]:
+    """{shard: готовых peer'ов} ноды."""
+    _ensure_init()
+    with _conn() as con:
+        return {r["shard"]: r["n"] for r in con.execute(
+            "SELECT shard, COUNT(*) AS n FROM awg_warm_pool WHERE node = ? GROUP BY shard", (node,)
+        ).fetchall()}
+
+
+# ─── Xray sync ────────────────────────────────────────────────────────────────
+# Грязные ноды Xray (bot/xray_sync.py): запросы sync копятся в счётчике,
+# один прогон покрывает все накопленные.
+
+def db_xray_sync_request(server_id: str, now: Optional[float] = None) -> int:
+    """+1 запрос sync ноды; возвращает новый requested_gen. dirty_since
+    ставится, только если нода была чистой."""
+    _ensure_init()
+    now = time.time() if now is None else now
+    with _conn() as con:
+        con.execute(
+            """
+            INSERT INTO xray_sync_state (server_id, requested_gen, dirty_since) VALUES (?, 1, ?)
+            ON CONFLICT(server_id) DO UPDATE SET
+                dirty_since = CASE WHEN requested_gen <= synced_gen
+                                   THEN excluded.dirty_since ELSE dirty_since END,
+                requested_gen = requested_gen + 1
+            """,
+            (server_id, now),
+        )
+        row = con.execute(
+            "SELECT requested_gen FROM xray_sync_state WHERE server_id = ?", (server_id,)
+        ).fetchone()
+        return int(row["requested_gen"])
+
+
+def db_xray_sync_get(server_id: str) -> Optional[Dict]:
+    _ensure_init()
+    with _conn() as con:
+        row = con.execute("SELECT * FROM xray_sync_state WHERE server_id = ?", (server_id,)).fetchone()
+        return dict(row) if row else None
+
+
+def db_xray_sync_dirty() -> List[Dict]:
+    """Ноды с непокрытыми запросами (requested_gen > synced_gen)."""
+    _ensure_init()
+    with _conn() as con:
+        return [dict(r) for r in con.execute(
+            "SELECT * FROM xray_sync_state WHERE requested_gen > synced_gen ORDER BY server_id"
+        ).fetchall()]
+
+
+def db_xray_sync_done(server_id: str, gen: int, started: float, error: Optional[str] = None) -> None:
+    """
+    Итог прогона, начатого при requested_gen = gen. Успех: synced_gen = gen,
+    счётчик неудач сброшен; если за время прогона пришли новые запросы, нода
+    остаётся грязной с dirty_since = started (они не старше начала прогона).
+    Ошибка: нода остаётся грязной, failures + 1.
+    """
+    _ensure_init()
+    with _conn() as con:
+        if error is None:
+            con.execute(
+                """
+                UPDATE xray_sync_state SET
+                    synced_gen = MAX(synced_gen, :gen),
+                    dirty_since = CASE WHEN requested_gen > :gen THEN :started ELSE NULL END,
+                    failures = 0, last_error = NULL, synced_at = datetime('now')
+                WHERE server_id = :sid
+                """,
+                {"gen": int(gen), "started": started, "sid": server_id},
+            )
+        else:
+            con.execute(
+                "UPDATE xray_sync_state SET failures = failures + 1, last_error = ? WHERE server_id = ?",
+                (error[:500], server_id),
+            )
+
+
+def db_xray_sync_states() -> List[Dict]:
+    _ensure_init()
+    with _conn() as con:
+        return [dict(r) for r in con.execute(
+            "SELECT * FROM xray_sync_state ORDER BY server_id"
+        ).fetchall()]
+
+
+# ─── OTP ──────────────────────────────────────────────────────────────────────
+
+def db_create_otp(email: str, code: str, ttl_minutes: int = 10) -> None:
+    """Сохраняет OTP-код. Аннулирует предыдущие неиспользованные коды для этого email."""
+    _ensure_init()
+    email = email.lower().strip()
+    expires = _expire_iso(ttl_minutes)
+    with _conn() as con:
+        con.execute(
+            "UPDATE otp_codes SET used = 1 WHERE email = ? AND used = 0", (email,)
+        )
+        con.execute(
+            "INSERT INTO otp_codes (email, code, expires_at) VALUES (?, ?, ?)",
+            (email, code, expires),
+        )
+
+
+def db_verify_otp(email: str, code: str) -> bool:
+    """Проверяет OTP. Возвращает True если валиден и не просрочен. Помечает как использованный."""
+    _ensure_init()
+    email = email.lower().strip()
+    now = _now_iso()
+    with _conn() as con:
+        row = con.execute(
+            """
             SELECT id FROM otp_codes
             WHERE email = ? AND code = ? AND used = 0 AND expires_at > ?
             ORDER BY created_at DESC LIMIT 1
@@ -1444,44 +2943,35 @@ def db_accumulate_vless_user_traffic(server_id: str, samples: List[Dict]) -> Non
       current ≥ last → приращение = current - last
 
     last_seen обновляется при любом current > 0 (юзер реально подключался).
+
+    Один executemany UPSERT на весь батч (reset-aware CASE в ON CONFLICT),
+    без SELECT+INSERT/UPDATE на каждого юзера.
     """
     _ensure_init()
     if not samples or not server_id:
         return
+    rows = [
+        (int(s["telegram_id"]), server_id, int(s.get("rx") or 0), int(s.get("tx") or 0))
+        for s in samples
+        if s.get("telegram_id")
+    ]
+    if not rows:
+        return
     with _conn() as con:
-        for s in samples:
-            tid = s.get("telegram_id")
-            if not tid:
-                continue
-            rx = int(s.get("rx") or 0)
-            tx = int(s.get("tx") or 0)
-            row = con.execute(
-                "SELECT lifetime_rx, lifetime_tx, last_rx, last_tx "
-                "FROM vless_user_traffic "
-                "WHERE telegram_id = ? AND server_id = ?",
-                (int(tid), server_id),
-            ).fetchone()
-            seen_clause = "datetime('now')" if (rx > 0 or tx > 0) else "last_seen"
-            if row is None:
-                con.execute(
-                    "INSERT INTO vless_user_traffic "
-                    f"(telegram_id, server_id, lifetime_rx, lifetime_tx, "
-                    f" last_rx, last_tx, last_seen) "
-                    f"VALUES (?, ?, ?, ?, ?, ?, {seen_clause})",
-                    (int(tid), server_id, rx, tx, rx, tx),
-                )
-                continue
-            d_rx = rx - row["last_rx"] if rx >= row["last_rx"] else rx
-            d_tx = tx - row["last_tx"] if tx >= row["last_tx"] else tx
-            con.execute(
-                f"UPDATE vless_user_traffic "
-                f"SET lifetime_rx = lifetime_rx + ?, "
-                f"    lifetime_tx = lifetime_tx + ?, "
-                f"    last_rx = ?, last_tx = ?, "
-                f"    last_seen = {seen_clause} "
-                f"WHERE telegram_id = ? AND server_id = ?",
-                (d_rx, d_tx, rx, tx, int(tid), server_id),
-            )
+        con.executemany(
+            """
+            INSERT INTO vless_user_traffic
+                (telegram_id, server_id, lifetime_rx, lifetime_tx,
+                 last_rx, last_tx, last_seen)
+            VALUES (?1, ?2, ?3, ?4, ?3, ?4,
+                    CASE WHEN ?3 > 0 OR ?4 > 0 THEN datetime('now') END)
+            ON CONFLICT(telegram_id, server_id) DO UPDATE SET
+            """ + _RESET_AWARE_SET + """,
+                last_seen = CASE WHEN excluded.last_rx > 0 OR excluded.last_tx > 0
+                                 THEN datetime('now') ELSE last_seen END
+            """,
+            rows,
+        )
 
 
 def db_get_vless_user_last_seen() -> Dict[int, str]:
@@ -1565,12 +3055,77 @@ def db_get_active_servers(protocol: Optional[str] = None) -> List[Dict]:
         return [dict(r) for r in rows]
 
 
+# Взвешивание нагрузки при выборе сервера: юзер, активный за последние
+# _PICK_ACTIVE_WINDOW_H часов, весит 1 + _PICK_ACTIVE_WEIGHT «спящих».
+_PICK_ACTIVE_WINDOW_H = 24
+_PICK_ACTIVE_WEIGHT = 2.0
+
+
+def db_server_load(
+    protocol: str = "vless", servers: Optional[List[Dict]] = None,
+) -> Dict[str, Dict[str, int]]:
+    """
+    Нагрузка активных серверов протокола: {server_id: {"users": n, "active": n}}.
+
+    users  — назначенные юзеры (active=1). VLESS: с per-user UUID для сервера
+             (_VLESS_UUID_COLUMNS), для серверов без своей колонки — legacy
+             общий vless_uuid. AWG: preferred_server_id = server.id.
+    active — реальная утилизация за _PICK_ACTIVE_WINDOW_H: VLESS — юзеры с
+             last_seen в vless_user_traffic; AWG — peer'ы с ненулевым трафиком
+             в часовых бакетах traffic_rollup (прокси handshake-активности).
+
+    Каждая метрика — один агрегирующий запрос на все серверы сразу.
+    servers — уже загруженный db_get_active_servers(protocol) (не перечитываем).
+    """
+    _ensure_init()
+    if servers is None:
+        servers = db_get_active_servers(protocol=protocol)
+    sids = [s["id"] for s in servers]
+    load = {sid: {"users": 0, "active": 0} for sid in sids}
+    if not sids:
+        return load
+    since = (datetime.utcnow() - timedelta(hours=_PICK_ACTIVE_WINDOW_H)).strftime(_TS_FMT)
+    with _conn() as con:
+        if protocol == "vless":
+            cols = [_VLESS_UUID_COLUMNS.get(sid, "vless_uuid") for sid in sids]
+            row = con.execute(
+                "SELECT " + ", ".join(f"SUM({c} IS NOT NULL)" for c in cols)
+                + " FROM users WHERE active = 1"
+            ).fetchone()
+            for sid, n in zip(sids, row):
+                load[sid]["users"] = n or 0
+            active = con.execute(
+                "SELECT server_id, COUNT(*) FROM vless_user_traffic "
+                "WHERE last_seen >= ? GROUP BY server_id", (since,),
+            ).fetchall()
+        else:
+            users = con.execute(
+                "SELECT preferred_server_id, COUNT(*) FROM users "
+                "WHERE active = 1 GROUP BY preferred_server_id"
+            ).fetchall()
+            for sid, n in users:
+                if sid in load:
+                    load[sid]["users"] = n
+            active = con.execute(
+                "SELECT p.server_id, COUNT(DISTINCT r.public_key) FROM traffic_rollup r "
+                "JOIN peers p ON p.public_key = r.public_key "
+                "WHERE r.resolution = 'h' AND r.bucket >= ? AND r.rx + r.tx > 0 "
+                "GROUP BY p.server_id", (since,),
+            ).fetchall()
+        for sid, n in active:
+            if sid in load:
+                load[sid]["active"] = n
+    return load
+
+
 def db_pick_server(protocol: str = "vless") -> str:
     """
     Выбирает наименее загруженный активный сервер для протокола.
 
-    Для protocol='vless'  нагрузка = кол-во пользователей с vless_uuid IS NOT NULL.
-    Для protocol='awg'    нагрузка = кол-во пользователей с preferred_server_id = server.id.
+    Нагрузка (см. db_server_load) = (users + _PICK_ACTIVE_WEIGHT × active) / capacity:
+    назначенные юзеры, где реально активные за последние сутки весят больше
+    спящих. Для protocol='vless' считаются per-user UUID сервера, для 'awg' —
+    preferred_server_id.
 
     Возвращает server_id (str). Если активных серверов нет — возвращает 'eu1' как fallback.
     """
@@ -1583,30 +3138,17 @@ def db_pick_server(protocol: str = "vless") -> str:
     if len(servers) == 1:
         return servers[0]["id"]
 
-    # Считаем нагрузку для каждого сервера
-    with _conn() as con:
-        load: Dict[str, int] = {}
-        for srv in servers:
-            sid = srv["id"]
-            if protocol == "vless":
-                # VLESS: пользователи с vless_uuid != NULL
-                # Все VLESS-пользователи пока на eu1, поэтому считаем общий счётчик
-                cnt = con.execute(
-                    "SELECT COUNT(*) FROM users WHERE vless_uuid IS NOT NULL AND active = 1"
-                ).fetchone()[0]
-            else:
-                # AWG / WG: пользователи с preferred_server_id = sid
-                cnt = con.execute(
-                    "SELECT COUNT(*) FROM users WHERE preferred_server_id = ? AND active = 1",
-                    (sid,),
-                ).fetchone()[0]
-            load[sid] = cnt
-
-    # Выбираем сервер с наибольшим остатком: capacity - load
-    best = min(servers, key=lambda s: load.get(s["id"], 0) / max(s["capacity"], 1))
+    load = db_server_load(protocol, servers)
+
+    def score(srv: Dict) -> float:
+        lo = load.get(srv["id"], {"users": 0, "active": 0})
+        return (lo["users"] + _PICK_ACTIVE_WEIGHT * lo["active"]) / max(srv["capacity"], 1)
+
+    best = min(servers, key=score)
+    lo = load.get(best["id"], {"users": 0, "active": 0})
     logger.info(
-        "db_pick_server(protocol=%s): выбран %s (load=%d/%d)",
-        protocol, best["id"], load.get(best["id"], 0), best["capacity"],
+        "db_pick_server(protocol=%s): выбран %s (users=%d active=%d /%d)",
+        protocol, best["id"], lo["users"], lo["active"], best["capacity"],
     )
     return best["id"]
 
@@ -1631,6 +3173,20 @@ def db_upsert_server(server_id: str, name: str, protocol: str, capacity: int, ac
 
 # ─── Traffic accounting ─────────────────────────────────────────────────────────
 
+# Общий reset-aware фрагмент для UPSERT-накопителей (traffic_accounting,
+# vless_server_traffic, vless_user_traffic). excluded.last_* = текущий счётчик:
+# current ≥ last → приращение = current − last; current < last (рестарт
+# интерфейса/Xray) → приращение = current. В SET справа — значения СТАРОЙ строки.
+_RESET_AWARE_SET = """
+                lifetime_rx = lifetime_rx + CASE WHEN excluded.last_rx >= last_rx
+                                                 THEN excluded.last_rx - last_rx
+                                                 ELSE excluded.last_rx END,
+                lifetime_tx = lifetime_tx + CASE WHEN excluded.last_tx >= last_tx
+                                                 THEN excluded.last_tx - last_tx
+                                                 ELSE excluded.last_tx END,
+                last_rx     = excluded.last_rx,
+                last_tx     = excluded.last_tx"""
+
 def db_accumulate_traffic(samples: List[Dict]) -> None:
     """
     Накопительный учёт трафика по счётчикам AmneziaWG (reset-aware).
@@ -1643,49 +3199,34 @@ def db_accumulate_traffic(samples: List[Dict]) -> None:
 
     Важно: вызывать только для peer'ов, реально присутствующих в dump (иначе
     нулевые сэмплы исказят last_* и приведут к двойному учёту).
+
+    Весь батч — один executemany UPSERT (reset-aware CASE в ON CONFLICT):
+    число обращений к SQLite из Python не растёт с числом peer'ов.
     """
     _ensure_init()
     if not samples:
         return
+    rows = []
+    for s in samples:
+        pk = (s.get("public_key") or "").strip()
+        if pk:
+            rows.append((pk, s.get("telegram_id"), int(s.get("rx") or 0), int(s.get("tx") or 0)))
+    if not rows:
+        return
     with _conn() as con:
-        for s in samples:
-            pk = (s.get("public_key") or "").strip()
-            if not pk:
-                continue
-            rx = int(s.get("rx") or 0)
-            tx = int(s.get("tx") or 0)
-            tid = s.get("telegram_id")
-            row = con.execute(
-                "SELECT lifetime_rx, lifetime_tx, last_rx, last_tx "
-                "FROM traffic_accounting WHERE public_key = ?",
-                (pk,),
-            ).fetchone()
-            if row is None:
-                con.execute(
-                    """
-                    INSERT INTO traffic_accounting
-                        (public_key, telegram_id, lifetime_rx, lifetime_tx,
-                         last_rx, last_tx, updated_at)
-                    VALUES (?, ?, ?, ?, ?, ?, datetime('now'))
-                    """,
-                    (pk, tid, rx, tx, rx, tx),
-                )
-                continue
-            d_rx = rx - row["last_rx"] if rx >= row["last_rx"] else rx
-            d_tx = tx - row["last_tx"] if tx >= row["last_tx"] else tx
-            con.execute(
-                """
-                UPDATE traffic_accounting
-                SET lifetime_rx = lifetime_rx + ?,
-                    lifetime_tx = lifetime_tx + ?,
-                    last_rx     = ?,
-                    last_tx     = ?,
-                    telegram_id = COALESCE(?, telegram_id),
-                    updated_at  = datetime('now')
-                WHERE public_key = ?
-                """,
-                (d_rx, d_tx, rx, tx, tid, pk),
-            )
+        con.executemany(
+            """
+            INSERT INTO traffic_accounting
+                (public_key, telegram_id, lifetime_rx, lifetime_tx,
+                 last_rx, last_tx, updated_at)
+            VALUES (?1, ?2, ?3, ?4, ?3, ?4, datetime('now'))
+            ON CONFLICT(public_key) DO UPDATE SET
+            """ + _RESET_AWARE_SET + """,
+                telegram_id = COALESCE(excluded.telegram_id, telegram_id),
+                updated_at  = datetime('now')
+            """,
+            rows,
+        )
 
 
 def db_accumulate_vless_server_traffic(server_id: str, samples: List[Dict]) -> None:
@@ -1700,43 +3241,94 @@ def db_accumulate_vless_server_traffic(server_id: str, samples: List[Dict]) -> N
     _ensure_init()
     if not samples or not server_id:
         return
+    rows = []
+    for s in samples:
+        tag = (s.get("inbound_tag") or "").strip()
+        if tag:
+            rows.append((server_id, tag, int(s.get("rx") or 0), int(s.get("tx") or 0)))
+    if not rows:
+        return
     with _conn() as con:
-        for s in samples:
-            tag = (s.get("inbound_tag") or "").strip()
-            if not tag:
-                continue
-            rx = int(s.get("rx") or 0)
-            tx = int(s.get("tx") or 0)
-            row = con.execute(
-                "SELECT lifetime_rx, lifetime_tx, last_rx, last_tx "
-                "FROM vless_server_traffic WHERE server_id = ? AND inbound_tag = ?",
-                (server_id, tag),
-            ).fetchone()
-            if row is None:
-                con.execute(
-                    """
-                    INSERT INTO vless_server_traffic
-                        (server_id, inbound_tag, lifetime_rx, lifetime_tx,
-                         last_rx, last_tx, updated_at)
-                    VALUES (?, ?, ?, ?, ?, ?, datetime('now'))
-                    """,
-                    (server_id, tag, rx, tx, rx, tx),
-                )
-                continue
-            d_rx = rx - row["last_rx"] if rx >= row["last_rx"] else rx
-            d_tx = tx - row["last_tx"] if tx >= row["last_tx"] else tx
-            con.execute(
-                """
-                UPDATE vless_server_traffic
-                SET lifetime_rx = lifetime_rx + ?,
-                    lifetime_tx = lifetime_tx + ?,
-                    last_rx     = ?,
-                    last_tx     = ?,
-                    updated_at  = datetime('now')
-                WHERE server_id = ? AND inbound_tag = ?
-                """,
-                (d_rx, d_tx, rx, tx, server_id, tag),
-            )
+        con.executemany(
+            """
+            INSERT INTO vless_server_traffic
+                (server_id, inbound_tag, lifetime_rx, lifetime_tx,
+                 last_rx, last_tx, updated_at)
+            VALUES (?1, ?2, ?3, ?4, ?3, ?4, datetime('now'))
+            ON CONFLICT(server_id, inbound_tag) DO UPDATE SET
+            """ + _RESET_AWARE_SET + """,
+                updated_at  = datetime('now')
+            """,
+            rows,
+        )
+
+
+def db_add_vless_traffic_deltas(
+    server_id: str, inbound_deltas: List[Dict], user_deltas: List[Dict],
+) -> None:
+    """
+    Дельты VLESS-трафика сервера (statsquery -reset: каждый опрос отдаёт
+    приращение с прошлого опроса) — прибавляются к lifetime обеих таблиц одной
+    транзакцией.
+
+    inbound_deltas: [{"inbound_tag": str, "rx": int, "tx": int}, ...]
+    user_deltas:    [{"telegram_id": int, "rx": int, "tx": int}, ...]
+
+    Переход со снимков: первый -reset отдаёт весь счётчик с запуска Xray, а
+    его часть до last_* уже в lifetime. Пока last_* > 0, значение считается
+    снимком (reset-aware, как db_accumulate_vless_*): + (value − last), а если
+    value < last (Xray перезапускался) — + value. Потом last_* = 0 и дальше
+    дельты прибавляются целиком; reset-aware накопители поверх таких строк
+    тоже считают верно. last_seen — только при ненулевой дельте.
+    """
+    _ensure_init()
+    if not server_id:
+        return
+    inbound_rows = [
+        (server_id, (d.get("inbound_tag") or "").strip(), int(d.get("rx") or 0), int(d.get("tx") or 0))
+        for d in inbound_deltas
+        if (d.get("inbound_tag") or "").strip()
+    ]
+    user_rows = [
+        (int(d["telegram_id"]), server_id, int(d.get("rx") or 0), int(d.get("tx") or 0))
+        for d in user_deltas
+        if d.get("telegram_id")
+    ]
+    if not inbound_rows and not user_rows:
+        return
+    with _conn() as con:
+        con.executemany(
+            """
+            INSERT INTO vless_server_traffic
+                (server_id, inbound_tag, lifetime_rx, lifetime_tx, last_rx, last_tx, updated_at)
+            VALUES (?1, ?2, ?3, ?4, 0, 0, datetime('now'))
+            ON CONFLICT(server_id, inbound_tag) DO UPDATE SET
+                lifetime_rx = lifetime_rx + CASE WHEN excluded.lifetime_rx >= last_rx
+                    THEN excluded.lifetime_rx - last_rx ELSE excluded.lifetime_rx END,
+                lifetime_tx = lifetime_tx + CASE WHEN excluded.lifetime_tx >= last_tx
+                    THEN excluded.lifetime_tx - last_tx ELSE excluded.lifetime_tx END,
+                last_rx = 0, last_tx = 0,
+                updated_at = datetime('now')
+            """,
+            inbound_rows,
+        )
+        con.executemany(
+            """
+            INSERT INTO vless_user_traffic
+                (telegram_id, server_id, lifetime_rx, lifetime_tx, last_rx, last_tx, last_seen)
+            VALUES (?1, ?2, ?3, ?4, 0, 0,
+                    CASE WHEN ?3 > 0 OR ?4 > 0 THEN datetime('now') END)
+            ON CONFLICT(telegram_id, server_id) DO UPDATE SET
+                lifetime_rx = lifetime_rx + CASE WHEN excluded.lifetime_rx >= last_rx
+                    THEN excluded.lifetime_rx - last_rx ELSE excluded.lifetime_rx END,
+                lifetime_tx = lifetime_tx + CASE WHEN excluded.lifetime_tx >= last_tx
+                    THEN excluded.lifetime_tx - last_tx ELSE excluded.lifetime_tx END,
+                last_rx = 0, last_tx = 0,
+                last_seen = CASE WHEN excluded.lifetime_rx > 0 OR excluded.lifetime_tx > 0
+                                 THEN datetime('now') ELSE last_seen END
+            """,
+            user_rows,
+        )
 
 
 def db_get_vless_server_lifetime() -> Dict[str, Dict]:
@@ -1772,90 +3364,358 @@ def db_record_traffic_snapshot(samples: List[Dict]) -> None:
     samples — тот же формат что и в db_accumulate_traffic:
     [{"public_key": str, "telegram_id": int|None, "rx": int, "tx": int}, ...].
 
-    Auto-cleanup: удаляет записи старше 14 дней при каждом вызове (cheap WHERE
-    по индексу idx_traffic_snapshots_ts). 65k строк за 14 дней — SQLite это
-    не нагружает.
+    После записи сворачивает состарившиеся снимки в часовые/дневные бакеты
+    (db_rollup_traffic) — сырые 5-мин точки живут _TRAFFIC_RAW_KEEP_DAYS.
     """
     _ensure_init()
     if not samples:
         return
     # timezone-aware UTC (Python 3.12+ deprecates utcnow); храним как
     # naive string в SQLite-формате, как и весь остальной datetime в БД.
-    from datetime import timezone as _tz
-    ts = datetime.now(_tz.utc).strftime("%Y-%m-%d %H:%M:%S")
+    ts = datetime.now(timezone.utc).strftime(_TS_FMT)
+    rows = []
+    for s in samples:
+        pk = (s.get("public_key") or "").strip()
+        if pk:
+            rows.append((ts, pk, s.get("telegram_id"), int(s.get("rx") or 0), int(s.get("tx") or 0)))
     with _conn() as con:
-        for s in samples:
-            pk = (s.get("public_key") or "").strip()
-            if not pk:
-                continue
-            con.execute(
+        con.executemany(
+            """
+            INSERT OR REPLACE INTO traffic_snapshots
+                (ts, public_key, telegram_id, rx, tx)
+            VALUES (?, ?, ?, ?, ?)
+            """,
+            rows,
+        )
+    db_rollup_traffic()
+
+
+# ─── Traffic rollups (5m → 1h → 1d) ───────────────────────────────────────────
+# traffic_snapshots (сырые 5-мин счётчики) → traffic_rollup: reset-aware ДЕЛЬТЫ
+# per peer в бакетах resolution='h' (час) и 'd' (сутки). Дельта снимка
+# относится к бакету, в который попал сам снимок (приращение от предыдущего).
+# Per-user — GROUP BY telegram_id поверх тех же бакетов. Водяные знаки в
+# traffic_rollup_state: всё с ts < folded_until уже свёрнуто в этот уровень.
+# Объём ограничен: raw ~3 дня, часы ~90 дней, сутки ~3 года на peer.
+
+_TS_FMT = "%Y-%m-%d %H:%M:%S"
+_TRAFFIC_RAW_KEEP_DAYS = 3
+_TRAFFIC_HOURLY_KEEP_DAYS = 90
+_TRAFFIC_DAILY_KEEP_DAYS = 1100
+# Самое длинное окно, на которое есть история (дневные rollup'ы) — предел
+# для внешних запросов окна (/api/traffic?window=).
+TRAFFIC_WINDOW_MAX_DAYS = _TRAFFIC_DAILY_KEEP_DAYS
+_ROLLUP_BUCKET = {"d": timedelta(days=1), "h": timedelta(hours=1)}
+
+
+def _floor_ts(dt: datetime, res: str) -> datetime:
+    if res == "d":
+        return dt.replace(hour=0, minute=0, second=0, microsecond=0)
+    return dt.replace(minute=0, second=0, microsecond=0)
+
+
+def _ceil_ts(dt: datetime, res: str) -> datetime:
+    fl = _floor_ts(dt, res)
+    return fl if fl == dt else fl + _ROLLUP_BUCKET[res]
+
+
+def _parse_ts(ts: str) -> datetime:
+    return datetime.strptime(ts[:19].replace("T", " "), _TS_FMT)
+
+
+def db_rollup_traffic(now: Optional[datetime] = None) -> Dict[str, int]:
+    """
+    Сворачивает законченные часы traffic_snapshots → 'h', законченные сутки
+    'h' → 'd', затем чистит уровни по retention. Идемпотентна (водяные знаки),
+    дешёвая когда сворачивать нечего. Возвращает {"h": строк, "d": строк}.
+    now — naive UTC (для тестов), по умолчанию текущее время.
+    """
+    _ensure_init()
+    now = now or datetime.now(timezone.utc).replace(tzinfo=None)
+    hour_start = _floor_ts(now, "h")
+    day_start = _floor_ts(now, "d")
+    folded = {"h": 0, "d": 0}
+    with _conn() as con:
+        if not con.in_transaction:
+            con.execute("BEGIN IMMEDIATE")  # водяной знак + fold — атомарно
+        marks = {
+            r["resolution"]: r["folded_until"]
+            for r in con.execute("SELECT resolution, folded_until FROM traffic_rollup_state")
+        }
+
+        # raw → час
+        since = marks.get("h")
+        if since is None:
+            first = con.execute("SELECT MIN(ts) FROM traffic_snapshots").fetchone()[0]
+            since = _floor_ts(_parse_ts(first), "h").strftime(_TS_FMT) if first else None
+        until = hour_start.strftime(_TS_FMT)
+        if since is not None and since < until:
+            folded["h"] = con.execute(
                 """
-                INSERT OR REPLACE INTO traffic_snapshots
-                    (ts, public_key, telegram_id, rx, tx)
-                VALUES (?, ?, ?, ?, ?)
+                INSERT INTO traffic_rollup
+                    (resolution, bucket, public_key, telegram_id, rx, tx, samples)
+                SELECT 'h', strftime('%Y-%m-%d %H:00:00', ts), public_key,
+                       MAX(telegram_id), SUM(d_rx), SUM(d_tx), COUNT(*)
+                FROM (
+                    SELECT ts, public_key, telegram_id,
+                           CASE WHEN prev_rx IS NULL THEN 0
+                                WHEN rx >= prev_rx THEN rx - prev_rx ELSE rx END AS d_rx,
+                           CASE WHEN prev_tx IS NULL THEN 0
+                                WHEN tx >= prev_tx THEN tx - prev_tx ELSE tx END AS d_tx
+                    FROM (
+                        SELECT ts, public_key, telegram_id, rx, tx,
+                               LAG(rx) OVER win AS prev_rx, LAG(tx) OVER win AS prev_tx
+                        FROM traffic_snapshots
+                        WHERE ts >= datetime(:since, '-1 day') AND ts < :until
+                        WINDOW win AS (PARTITION BY public_key ORDER BY ts)
+                    )
+                )
+                WHERE ts >= :since
+                GROUP BY 2, 3
+                ON CONFLICT(resolution, bucket, public_key) DO UPDATE SET
+                    rx = rx + excluded.rx, tx = tx + excluded.tx,
+                    samples = samples + excluded.samples,
+                    telegram_id = COALESCE(excluded.telegram_id, telegram_id)
                 """,
-                (ts, pk, s.get("telegram_id"), int(s.get("rx") or 0), int(s.get("tx") or 0)),
-            )
+                {"since": since, "until": until},
+            ).rowcount
         con.execute(
-            "DELETE FROM traffic_snapshots WHERE ts < datetime('now', '-14 days')"
+            "INSERT OR REPLACE INTO traffic_rollup_state (resolution, folded_until) VALUES ('h', ?)",
+            (max(until, since or until),),
         )
 
+        # час → сутки (только часы, уже свёрнутые из raw)
+        since = marks.get("d")
+        if since is None:
+            first = con.execute(
+                "SELECT MIN(bucket) FROM traffic_rollup WHERE resolution = 'h'"
+            ).fetchone()[0]
+            since = _floor_ts(_parse_ts(first), "d").strftime(_TS_FMT) if first else None
+        until = day_start.strftime(_TS_FMT)
+        if since is not None and since < until:
+            folded["d"] = con.execute(
+                """
+                INSERT INTO traffic_rollup
+                    (resolution, bucket, public_key, telegram_id, rx, tx, samples)
+                SELECT 'd', date(bucket) || ' 00:00:00', public_key,
+                       MAX(telegram_id), SUM(rx), SUM(tx), SUM(samples)
+                FROM traffic_rollup
+                WHERE resolution = 'h' AND bucket >= :since AND bucket < :until
+                GROUP BY 2, 3
+                ON CONFLICT(resolution, bucket, public_key) DO UPDATE SET
+                    rx = rx + excluded.rx, tx = tx + excluded.tx,
+                    samples = samples + excluded.samples,
+                    telegram_id = COALESCE(excluded.telegram_id, telegram_id)
+                """,
+                {"since": since, "until": until},
+            ).rowcount
+        con.execute(
+            "INSERT OR REPLACE INTO traffic_rollup_state (resolution, folded_until) VALUES ('d', ?)",
+            (max(until, since or until),),
+        )
+
+        # retention: каждый уровень чистится только за пределами следующего
+        con.execute(
+            "DELETE FROM traffic_snapshots WHERE ts < ?",
+            ((now - timedelta(days=_TRAFFIC_RAW_KEEP_DAYS)).strftime(_TS_FMT),),
+        )
+        con.execute(
+            "DELETE FROM traffic_rollup WHERE resolution = 'h' AND bucket < ?",
+            ((now - timedelta(days=_TRAFFIC_HOURLY_KEEP_DAYS)).strftime(_TS_FMT),),
+        )
+        con.execute(
+            "DELETE FROM traffic_rollup WHERE resolution = 'd' AND bucket < ?",
+            ((now - timedelta(days=_TRAFFIC_DAILY_KEEP_DAYS)).strftime(_TS_FMT),),
+        )
+    if folded["h"] or folded["d"]:
+        logger.info("traffic rollup: +%d hourly, +%d daily buckets", folded["h"], folded["d"])
+    return folded
+
+
+def db_traffic_window_plan(
+    start_ts: str, end_ts: str, now: Optional[datetime] = None
+) -> List[tuple]:
+    """
+    Разбивает окно [start_ts, end_ts) на сегменты самого грубого доступного
+    разрешения: [(res, lo, hi), ...], res ∈ {'d', 'h', 'raw'}. Сутки берутся
+    там, где окно покрывает целые свёрнутые сутки, края — часами, хвост
+    (ещё не свёрнутый текущий час) и края часов — сырыми снимками. Если более
+    мелкий уровень на краю уже вычищен retention'ом — край округляется наружу
+    до целого бакета грубого уровня (небольшая переоценка вместо потери).
+    """
+    _ensure_init()
+    now = now or datetime.now(timezone.utc).replace(tzinfo=None)
+    with _conn() as con:
+        marks = {
+            r["resolution"]: _parse_ts(r["folded_until"])
+            for r in con.execute("SELECT resolution, folded_until FROM traffic_rollup_state")
+        }
+    kept_from = {
+        "h": now - timedelta(days=_TRAFFIC_HOURLY_KEEP_DAYS),
+        "raw": now - timedelta(days=_TRAFFIC_RAW_KEEP_DAYS),
+    }
+    chain = ["d", "h", "raw"]
+
+    def plan(lo: datetime, hi: datetime, level: int) -> List[tuple]:
+        if lo >= hi:
+            return []
+        res = chain[level]
+        if res == "raw":
+            return [("raw", lo, hi)]
+        if res not in marks:
+            return plan(lo, hi, level + 1)
+        finer = chain[level + 1]
+        c_lo = _floor_ts(lo, res) if lo < kept_from[finer] else _ceil_ts(lo, res)
+        c_hi = _floor_ts(min(hi, marks[res]), res)
+        if c_lo >= c_hi:
+            return plan(lo, hi, level + 1)
+        return plan(lo, c_lo, level + 1) + [(res, c_lo, c_hi)] + plan(c_hi, hi, level + 1)
+
+    start, end = _parse_ts(start_ts), _parse_ts(end_ts)
+    return [
+        (res, lo.strftime(_TS_FMT), hi.strftime(_TS_FMT))
+        for res, lo, hi in plan(start, end, 0)
+    ]
+
+
+def db_query_traffic_window(
+    start_ts: str, end_ts: str, by: str = "peer", now: Optional[datetime] = None
+) -> List[Dict]:
+    """
+    Delta-трафик за окно [start_ts, end_ts) по плану db_traffic_window_plan:
+    целые сутки/часы читаются из traffic_rollup, остаток — reset-aware LAG по
+    сырым снимкам (с заглядыванием назад за предыдущим снимком, как при
+    свёртке — стыки сегментов не теряют и не дублируют приращения).
+
+    by='peer' — строки как у db_query_traffic_delta (+ 'resolutions');
+    by='user' — агрегат per telegram_id (+ 'peers'). Сортировка по delta_total desc.
+    """
+    plan = db_traffic_window_plan(start_ts, end_ts, now=now)
+    acc: Dict[str, Dict] = {}
+    with _conn() as con:
+        for res, lo, hi in plan:
+            if res == "raw":
+                rows = con.execute(
+                    """
+                    SELECT public_key, MAX(telegram_id) AS telegram_id,
+                           MIN(ts) AS first_ts, MAX(ts) AS last_ts, COUNT(*) AS samples,
+                           SUM(CASE WHEN prev_rx IS NULL THEN 0
+                                    WHEN rx >= prev_rx THEN rx - prev_rx ELSE rx END) AS rx,
+                           SUM(CASE WHEN prev_tx IS NULL THEN 0
+                                    WHEN tx >= prev_tx THEN tx - prev_tx ELSE tx END) AS tx
+                    FROM (
+                        SELECT ts, public_key, telegram_id, rx, tx,
+                               LAG(rx) OVER win AS prev_rx, LAG(tx) OVER win AS prev_tx
+                        FROM traffic_snapshots
+                        WHERE ts >= datetime(:lo, '-1 day') AND ts < :hi
+                        WINDOW win AS (PARTITION BY public_key ORDER BY ts)
+                    )
+                    WHERE ts >= :lo
+                    GROUP BY public_key
+                    """,
+                    {"lo": lo, "hi": hi},
+                ).fetchall()
+            else:
+                rows = con.execute(
+                    """
+                    SELECT public_key, MAX(telegram_id) AS telegram_id,
+                           MIN(bucket) AS first_ts, MAX(bucket) AS last_ts,
+                           SUM(samples) AS samples, SUM(rx) AS rx, SUM(tx) AS tx
+                    FROM traffic_rollup
+                    WHERE resolution = ? AND bucket >= ? AND bucket < ?
+                    GROUP BY public_key
+                    """,
+                    (res, lo, hi),
+                ).fetchall()
+            for r in rows:
+                cur = acc.setdefault(r["public_key"], {
+                    "public_key": r["public_key"], "telegram_id": None, "samples": 0,
+                    "first_ts": r["first_ts"], "last_ts": r["last_ts"],
+                    "delta_rx": 0, "delta_tx": 0, "resolutions": [],
+                })
+                cur["telegram_id"] = cur["telegram_id"] or r["telegram_id"]
+                cur["samples"] += r["samples"] or 0
+                cur["first_ts"] = min(cur["first_ts"], r["first_ts"])
+                cur["last_ts"] = max(cur["last_ts"], r["last_ts"])
+                cur["delta_rx"] += r["rx"] or 0
+                cur["delta_tx"] += r["tx"] or 0
+                if res not in cur["resolutions"]:
+                    cur["resolutions"].append(res)
+
+    out = list(acc.values())
+    for r in out:
+        r["delta_total"] = r["delta_rx"] + r["delta_tx"]
+    if by == "user":
+        users: Dict = {}
+        for r in out:
+            key = r["telegram_id"] if r["telegram_id"] is not None else f"pk:{r['public_key']}"
+            u = users.setdefault(key, {
+                "telegram_id": r["telegram_id"], "peers": 0,
+                "delta_rx": 0, "delta_tx": 0, "delta_total": 0,
+            })
+            u["peers"] += 1
+            u["delta_rx"] += r["delta_rx"]
+            u["delta_tx"] += r["delta_tx"]
+            u["delta_total"] += r["delta_total"]
+        out = list(users.values())
+    out.sort(key=lambda x: x["delta_total"], reverse=True)
+    return out
+
 
 def db_query_traffic_delta(start_ts: str, end_ts: str) -> List[Dict]:
     """
     Возвращает delta-трафик per public_key за окно [start_ts, end_ts].
-    delta = rx/tx в последней записи окна минус первая запись окна, per pubkey.
 
-    Отрицательные значения = был reset (рестарт контейнера/перегенерация peer'а)
-    — в этом случае возвращаем последнюю запись как нижнюю оценку прироста.
+    delta — сумма приращений между СОСЕДНИМИ снимками окна (LAG по
+    (public_key, ts)), каждое reset-aware: rx ≥ prev → rx − prev, иначе
+    (рестарт контейнера/перегенерация peer'а) → rx. Так сброс счётчика в
+    середине окна больше не съедает трафик до него (раньше — только
+    первый-vs-последний снимок). Один запрос вместо 2 точечных SELECT на
+    каждый peer; для широких окон планировщик может читать партиции прямо из
+    idx_traffic_snapshots_pk_ts без сортировки, для узких — по idx_traffic_snapshots_ts.
 
     Возвращает list of dict, отсортированный по убыванию (delta_rx + delta_tx).
     Полезно для «кто качал в окне X-Y».
     """
     _ensure_init()
     with _conn() as con:
-        # Получаем для каждого peer'а первое и последнее значения в окне.
         rows = con.execute(
             """
-            SELECT public_key, telegram_id,
+            WITH w AS (
+                SELECT public_key, telegram_id, ts, rx, tx,
+                       LAG(rx) OVER win AS prev_rx,
+                       LAG(tx) OVER win AS prev_tx
+                FROM traffic_snapshots
+                WHERE ts >= ? AND ts <= ?
+                WINDOW win AS (PARTITION BY public_key ORDER BY ts)
+            )
+            SELECT public_key,
+                   MAX(telegram_id) AS telegram_id,
                    MIN(ts) AS first_ts, MAX(ts) AS last_ts,
-                   COUNT(*) AS samples
-            FROM traffic_snapshots
-            WHERE ts >= ? AND ts <= ?
+                   COUNT(*) AS samples,
+                   SUM(CASE WHEN prev_rx IS NULL THEN 0
+                            WHEN rx >= prev_rx THEN rx - prev_rx ELSE rx END) AS delta_rx,
+                   SUM(CASE WHEN prev_tx IS NULL THEN 0
+                            WHEN tx >= prev_tx THEN tx - prev_tx ELSE tx END) AS delta_tx
+            FROM w
             GROUP BY public_key
+            ORDER BY delta_rx + delta_tx DESC
             """,
             (start_ts, end_ts),
         ).fetchall()
-
-        results = []
-        for r in rows:
-            first = con.execute(
-                "SELECT rx, tx FROM traffic_snapshots WHERE ts = ? AND public_key = ?",
-                (r["first_ts"], r["public_key"]),
-            ).fetchone()
-            last = con.execute(
-                "SELECT rx, tx FROM traffic_snapshots WHERE ts = ? AND public_key = ?",
-                (r["last_ts"], r["public_key"]),
-            ).fetchone()
-            if not first or not last:
-                continue
-            # reset-aware: если last < first, считаем что был reset и
-            # delta = last (что прокачано после reset'а).
-            delta_rx = last["rx"] - first["rx"] if last["rx"] >= first["rx"] else last["rx"]
-            delta_tx = last["tx"] - first["tx"] if last["tx"] >= first["tx"] else last["tx"]
-            results.append({
-                "public_key": r["public_key"],
-                "telegram_id": r["telegram_id"],
-                "samples": r["samples"],
-                "first_ts": r["first_ts"],
-                "last_ts": r["last_ts"],
-                "delta_rx": delta_rx,
-                "delta_tx": delta_tx,
-                "delta_total": delta_rx + delta_tx,
-            })
-
-        results.sort(key=lambda x: x["delta_total"], reverse=True)
-        return results
+    return [
+        {
+            "public_key": r["public_key"],
+            "telegram_id": r["telegram_id"],
+            "samples": r["samples"],
+            "first_ts": r["first_ts"],
+            "last_ts": r["last_ts"],
+            "delta_rx": r["delta_rx"],
+            "delta_tx": r["delta_tx"],
+            "delta_total": r["delta_rx"] + r["delta_tx"],
+        }
+        for r in rows
+    ]
 
 
 def db_get_lifetime_by_user() -> Dict[int, Dict]:
@@ -1913,7 +3773,12 @@ def db_is_access_active(telegram_id: int) -> bool:
         ).fetchone()
     if not row:
         return False
-    exp = row["expires_at"]
+    return db_is_access_active_row(row)
+
+
+def db_is_access_active_row(user_row) -> bool:
+    """db_is_access_active по уже прочитанной строке users (без запроса)."""
+    exp = user_row["expires_at"]
     if not exp:
         return True  # grandfathered
     try:
@@ -1933,7 +3798,8 @@ def db_extend_subscription(
     Продлевает доступ на N дней от max(now, текущий expires_at).
     Возвращает новый expires_at (ISO). Используется и для оплаты, и для бонусов (реферал).
     `device_limit` (если задан) проставляет лимит устройств по тарифу; None —
-    не трогаем (бонусы/реферал не меняют тариф).
+    не трогаем (бонусы/реферал не меняют тариф). expires_epoch пересчитывает
+    триггер на UPDATE OF expires_at (см. _migrate_add_expires_epoch_column).
     """
     _ensure_init()
     now = datetime.utcnow()
@@ -1971,14 +3837,22 @@ def db_count_active_users() -> int:
     _ensure_init()
     with _conn() as con:
         row = con.execute(
-            "SELECT COUNT(*) AS n FROM users "
-            "WHERE telegram_id IS NOT NULL AND active = 1 "
-            "AND expires_at IS NOT NULL "
-            "AND datetime(expires_at) > datetime('now')"
+            f"SELECT COUNT(*) AS n FROM users "
+            f"WHERE telegram_id IS NOT NULL AND active = 1 AND {_SEG_ACTIVE}"
         ).fetchone()
     return int(row["n"] or 0) if row else 0
 
 
+def _sql_iso_add_days(value: Optional[str], days: int) -> Optional[str]:
+    """SQL-функция для db_bulk_extend_active: expires_at + N дней в том же виде,
+    что и раньше в Python (fromisoformat → isoformat, зона/микросекунды
+    сохраняются). Нераспознанная строка → NULL (строку не трогаем)."""
+    try:
+        return (datetime.fromisoformat(value) + timedelta(days=days)).isoformat()
+    except (ValueError, TypeError):
+        return None
+
+
 def db_bulk_extend_active(days: int) -> int:
     """
     Массовое продление доступа на N дней ВСЕМ юзерам с активным доступом
@@ -1987,32 +3861,24 @@ def db_bulk_extend_active(days: int) -> int:
     НЕ меняет status/plan/device_limit — триал остаётся триалом, тариф цел.
     Грандфазеры (expires_at NULL) пропускаются — доступ и так бессрочный.
     Возвращает число затронутых строк.
+
+    Один UPDATE по индексу expires_epoch (а не SELECT + UPDATE на юзера из
+    Python): write-lock держится одну короткую инструкцию, бот/веб/cron не
+    стоят в busy_timeout на всю базу. Арифметика дат — _sql_iso_add_days.
     """
     if days <= 0:
         return 0
     _ensure_init()
-    delta = timedelta(days=int(days))
-    affected = 0
     with _conn() as con:
-        rows = con.execute(
-            "SELECT telegram_id, expires_at FROM users "
-            "WHERE telegram_id IS NOT NULL AND active = 1 "
-            "AND expires_at IS NOT NULL "
-            "AND datetime(expires_at) > datetime('now')"
-        ).fetchall()
-        for r in rows:
-            try:
-                new_exp = (datetime.fromisoformat(r["expires_at"]) + delta).isoformat()
-            except (ValueError, TypeError):
-                continue
-            con.execute(
-                "UPDATE users SET expires_at = ?, "
-                "notif_7d_sent = 0, notif_3d_sent = 0, notif_0d_sent = 0 "
-                "WHERE telegram_id = ?",
-                (new_exp, r["telegram_id"]),
-            )
-            affected += 1
-    return affected
+        con.create_function("iso_add_days", 2, _sql_iso_add_days, deterministic=True)
+        cur = con.execute(
+            f"UPDATE users SET expires_at = iso_add_days(expires_at, :days), "
+            f"notif_7d_sent = 0, notif_3d_sent = 0, notif_0d_sent = 0 "
+            f"WHERE telegram_id IS NOT NULL AND active = 1 AND {_SEG_ACTIVE} "
+            f"AND iso_add_days(expires_at, :days) IS NOT NULL",
+            {"days": int(days)},
+        )
+        return cur.rowcount
 
 
 def db_get_device_limit(telegram_id: int) -> int:
@@ -2114,8 +3980,9 @@ def db_users_due_for_daily_reminder() -> List[Dict]:
     with _conn() as con:
         rows = con.execute(
             "SELECT telegram_id, email, expires_at, subscription_status "
-            "FROM users WHERE expires_at IS NOT NULL AND telegram_id IS NOT NULL AND active = 1 "
-            "AND date(expires_at) >= date('now') AND date(expires_at) <= date('now', '+7 days') "
+            "FROM users WHERE telegram_id IS NOT NULL AND active = 1 "
+            "AND expires_epoch >= CAST(strftime('%s', 'now', 'start of day') AS INTEGER) "
+            "AND expires_epoch < CAST(strftime('%s', 'now', 'start of day', '+8 days') AS INTEGER) "
             "AND (last_reminder_date IS NULL OR last_reminder_date != ?)",
             (today,),
         ).fetchall()
@@ -2408,18 +4275,17 @@ def db_count_subscription_split() -> Dict[str, int]:
     _ensure_init()
     with _conn() as con:
         active_paid = con.execute(
-            "SELECT COUNT(*) AS n FROM users u WHERE u.expires_at > datetime('now') "
+            f"SELECT COUNT(*) AS n FROM users u WHERE u.expires_epoch > {_NOW_EPOCH} "
             "AND EXISTS (SELECT 1 FROM payments p "
             "WHERE p.telegram_id = u.telegram_id AND p.status = 'succeeded')"
         ).fetchone()["n"]
         active_trial = con.execute(
-            "SELECT COUNT(*) AS n FROM users u WHERE u.expires_at > datetime('now') "
+            f"SELECT COUNT(*) AS n FROM users u WHERE u.expires_epoch > {_NOW_EPOCH} "
             "AND NOT EXISTS (SELECT 1 FROM payments p "
             "WHERE p.telegram_id = u.telegram_id AND p.status = 'succeeded')"
         ).fetchone()["n"]
         expired = con.execute(
-            "SELECT COUNT(*) AS n FROM users "
-            "WHERE expires_at IS NOT NULL AND expires_at <= datetime('now')"
+            f"SELECT COUNT(*) AS n FROM users WHERE expires_epoch <= {_NOW_EPOCH}"
         ).fetchone()["n"]
     return {"active_paid": active_paid, "active_trial": active_trial, "expired": expired}
 
@@ -2558,15 +4424,13 @@ def db_users_due_for_expiry_notif(days_until: int) -> List[Dict]:
     with _conn() as con:
         rows = con.execute(
             f"SELECT telegram_id, email, expires_at FROM users "
-            f"WHERE expires_at IS NOT NULL "
-            f"AND date(expires_at) = date(?) "
+            f"WHERE expires_epoch >= CAST(strftime('%s', ?) AS INTEGER) "
+            f"AND expires_epoch < CAST(strftime('%s', ?) AS INTEGER) "
             f"AND {flag_col} = 0 "
             f"AND telegram_id IS NOT NULL "
             f"AND active = 1",
-            (target,),
+            (target, next_day),
         ).fetchall()
-        # next_day помогает быть строгим к дате (на случай зон), но date(expires_at) уже округлит.
-        _ = next_day
         return [dict(r) for r in rows]
 
 
@@ -23,6 +23,7 @@ main() как вложенные функции/хендлеры (замыкан
 
 import io
 import logging
+import secrets
 import subprocess
 import time
 from pathlib import Path
@@ -43,8 +44,8 @@ from .formatting import format_subscription_status
 from .database import (
     db_list_devices,
     db_get_device,
-    db_add_device,
     db_delete_device,
+    db_job_get,
     db_count_devices,
     db_device_autoname,
     db_get_device_limit,
@@ -98,7 +99,10 @@ from .database import (
     db_get_ticket_messages,
     db_get_open_tickets,
     init_db,
+    db_write_queue_start,
 )
+from .awg_warm_pool import warm_pool_start
+from .provision_queue import provision_queue_running, provision_queue_start, set_job_listener, submit_job
 from .vless_peers import (
     create_vless_client_for_user,
     regenerate_vless_client_for_user,
@@ -232,6 +236,9 @@ def main() -> None:
     config = load_config()
     # Инициализируем SQLite DB и мигрируем users.json
     init_db(whitelist_seed=config.telegram_id_whitelist or [])
+    if config.db_write_queue:
+        db_write_queue_start()
+    warm_pool_start()  # AMNEZIAWG_EU1_WARM_POOL=0 — выключен
 
     bot = telebot.TeleBot(config.bot_token, parse_mode="HTML")
     admin_id = config.admin_id
@@ -1129,7 +1136,16 @@ def main() -> None:
         android → vpn:// deep link + текст-инструкция.
         success_text=None → используем стандартный _awg_success_text(platform).
         """
-        chat_id = message.chat.id
+        _deliver_config_to_chat(message.chat.id, config_text, filename, platform, success_text)
+
+    def _deliver_config_to_chat(
+        chat_id: int,
+        config_text: str,
+        filename: str,
+        platform: str,
+        success_text: str | None = None,
+    ) -> None:
+        """_deliver_config по chat_id — для доставки из очереди выдачи (нет исходного message)."""
         text = success_text if success_text is not None else _awg_success_text(platform)
         if platform == "android":
             vpn_link = generate_vpn_url(config_text)
@@ -1147,6 +1163,97 @@ def main() -> None:
         bot.send_message(chat_id, f"<code>{vless_link}</code>", parse_mode="HTML",
                          reply_markup=_not_working_kb())
 
+    # Выдача AWG (SSH на eu1) — через очередь bot/provision_queue.py: хендлер
+    # ставит задачу и сразу отвечает, конфиг доставляет _on_awg_job. Без
+    # PROVISION_QUEUE задача выполняется тут же (как раньше), доставка та же.
+    _AWG_JOB_FAIL_TEXT = {
+        "get_config": "Не удалось получить конфиг. Попробуй позже или напиши владельцу.",
+        "regen": "Не удалось обновить VPN‑доступ. Попробуй позже или напиши владельцу.",
+        "device_add": "Не удалось создать конфиг устройства. Попробуй позже.",
+        "device_regen": "Не удалось обновить конфиг. Попробуй позже.",
+    }
+
+    def _submit_awg_job(
+        message: types.Message,
+        kind: str,
+        reply: str,
+        telegram_id: int,
+        platform: str,
+        android_safe: bool,
+        device_id: str | None = None,
+        device_name: str | None = None,
+        create_device: bool = False,
+    ) -> bool:
+        """Ставит задачу выдачи. Ключ идемпотентности — (действие, сообщение с
+        кнопкой, платформа[, устройство]): повторный тап, пока задача не
+        завершена, не создаёт второй peer. create_device — устройство device_id
+        создаёт сама задача (в ключ оно не входит). False — такая задача уже идёт."""
+        chat_id = message.chat.id
+        params = {
+            "telegram_id": telegram_id, "platform": platform, "android_safe": android_safe,
+            "device_id": device_id, "device_name": device_name, "create_device": create_device,
+            "chat_id": chat_id, "reply": reply,
+        }
+        key_device = "" if create_device else (device_id or "")
+        idem_key = f"{reply}:{telegram_id}:{chat_id}:{message.message_id}:{platform}:{key_device}"
+        try:
+            job_id, created = submit_job(kind, "eu1", telegram_id, params, idem_key=idem_key)
+        except Exception:  # noqa: BLE001
+            logger.exception("provision submit %s for %s", kind, telegram_id)
+            safe_reply(message, _AWG_JOB_FAIL_TEXT[reply])
+            return False
+        if created:
+            if provision_queue_running():
+                bot.send_message(chat_id, "⏳ Готовлю конфиг — пришлю, как только будет готов (обычно до минуты).")
+            return True
+        # Повторный тап: отвечаем по фактическому статусу первой задачи.
+        job = db_job_get(job_id)
+        status = job["status"] if job else "failed"
+        if status in ("queued", "running"):
+            bot.send_message(chat_id, "⏳ Конфиг уже готовится — пришлю, как только будет готов.")
+        elif status == "done":
+            bot.send_message(chat_id, "Конфиг уже отправлен — смотри сообщение выше.")
+        # failed — отказ уже отправил _on_awg_job
+        return False
+
+    def _on_awg_job(job: dict) -> bool:
+        """Доставка результата задачи выдачи (listener provision_queue)."""
+        p = job["params"]
+        chat_id, reply = p.get("chat_id"), p.get("reply")
+        if job["status"] != "done" and reply == "device_add" and p.get("device_id"):
+            # Откат записи устройства, раз peer не создан (и для задач ЛК, если
+            # зависшую задачу провалил sweeper этого процесса).
+            db_delete_device(p["device_id"])
+        if not chat_id or reply not in _AWG_JOB_FAIL_TEXT:
+            return False
+        platform = p.get("platform") or "pc"
+        if job["status"] != "done":
+            logger.warning("provision job %s (%s) для %s: %s", job["id"], reply, p.get("telegram_id"), job["error"])
+            bot.send_message(chat_id, _AWG_JOB_FAIL_TEXT[reply])
+            return False
+        cfg = job["result"]["config"]
+        if reply == "get_config":
+            _deliver_config_to_chat(chat_id, cfg, "awg_eu1.conf", platform)
+        elif reply == "regen":
+            # Предупреждение, что старый отвалится — отдельной строкой перед стандартной инструкцией.
+            warn = "⚠️ Старый конфиг больше не работает — импортируй новый.\n\n"
+            _deliver_config_to_chat(chat_id, cfg, "awg_eu1.conf", platform, warn + _awg_success_text(platform))
+        elif reply == "device_add":
+            _deliver_config_to_chat(
+                chat_id, cfg, f"awg_eu1_{platform}.conf", platform,
+                f"✅ Добавлено устройство «{p.get('device_name')}». Импортируй конфиг в AmneziaWG/AmneziaVPN.")
+            _render_device_list(chat_id, int(p["telegram_id"]))
+        else:
+            _deliver_config_to_chat(
+                chat_id, cfg, f"awg_eu1_{platform}.conf", platform,
+                f"🔄 Конфиг «{p.get('device_name')}» пересоздан. Импортируй заново.")
+        return True
+
+    set_job_listener("awg_create", _on_awg_job)
+    set_job_listener("awg_regen", _on_awg_job)
+    if config.provision_queue:
+        provision_queue_start("bot", workers_per_node=config.provision_workers_per_node)
+
     def _show_platform_keyboard(chat_id: int, action: str) -> None:
         """Отправляет клавиатуру выбора платформы перед выдачей конфига."""
         label = "получения" if action == "get_config" else "обновления"
@@ -1245,21 +1352,7 @@ def main() -> None:
                 server_name = servers_info.get(preferred_server_id, {}).get("name", preferred_server_id)
                 platform_label = {"pc": "ПК", "ios": "iOS", "android": "Android"}.get(platform, platform)
                 if preferred_server_id == "eu1":
-                    try:
-                        peer, client_config = regenerate_amneziawg_peer_and_config_for_user(
-                            telegram_id,
-                            android_safe=android_safe,
-                            server_id="eu1",
-                            platform=platform,
-                        )
-                        filename = f"awg_{peer.server_id}.conf"
-                        _deliver_config(message, client_config, filename, platform)
-                    except WireGuardError as exc:
-                        logger.exception("AmneziaWG regen for %s: %s", telegram_id, exc)
-                        safe_reply(
-                            message,
-                            "Не удалось получить конфиг. Попробуй позже или напиши владельцу.",
-                        )
+                    _submit_awg_job(message, "awg_regen", "get_config", telegram_id, platform, android_safe)
                 else:
                     safe_reply(
                         message,
@@ -1283,21 +1376,7 @@ def main() -> None:
 
             # Европа (eu1): AmneziaWG (Резервный VPN — отдельный .conf для AmneziaWG/AmneziaVPN).
             if preferred_server_id == "eu1":
-                try:
-                    peer, client_config = create_amneziawg_peer_and_config_for_user(
-                        telegram_id,
-                        android_safe=android_safe,
-                        server_id="eu1",
-                        platform=platform,
-                    )
-                    filename = f"awg_{peer.server_id}.conf"
-                    _deliver_config(message, client_config, filename, platform)
-                except WireGuardError as exc:
-                    logger.exception("Ошибка AmneziaWG для %s: %s", telegram_id, exc)
-                    safe_reply(
-                        message,
-                        "Не удалось создать VPN‑доступ. Попробуй позже или напиши владельцу.",
-                    )
+                _submit_awg_job(message, "awg_create", "get_config", telegram_id, platform, android_safe)
                 return
 
             # WireGuard: rus1/rus2 (eu1/eu2 обработаны выше как AmneziaWG)
@@ -1370,27 +1449,7 @@ def main() -> None:
 
             # Европа (eu1): регенерация AmneziaWG peer (новые ключи, тот же IP).
             if preferred_server_id == "eu1":
-                try:
-                    peer, client_config = regenerate_amneziawg_peer_and_config_for_user(
-                        telegram_id,
-                        android_safe=android_safe,
-                        server_id="eu1",
-                        platform=platform,
-                    )
-                    filename = f"awg_{peer.server_id}.conf"
-                    # Предупреждение, что старый отвалится — отдельной строкой перед стандартной инструкцией.
-                    warn = "⚠️ Старый конфиг больше не работает — импортируй новый.\n\n"
-                    _deliver_config(
-                        message, client_config, filename, platform,
-                        warn + _awg_success_text(platform),
-                    )
-                except WireGuardError as exc:
-                    logger.exception("Ошибка регенерации AmneziaWG для %s: %s", telegram_id, exc)
-                    safe_reply(
-                        message,
-                        f"Не удалось обновить VPN‑доступ: {exc}\n"
-                        "Попробуй позже или напиши владельцу.",
-                    )
+                _submit_awg_job(message, "awg_regen", "regen", telegram_id, platform, android_safe)
                 return
 
             preferred_pt = getattr(user, "preferred_profile_type", None) if preferred_server_id == "eu1" else None
@@ -1640,18 +1699,10 @@ def main() -> None:
                 + (" или оформи тариф на 5 устройств." if cap < 5 else "."))
             return
         name = db_device_autoname(uid, os_)
-        device_id = db_add_device(uid, name, os_)
-        try:
-            _, cfg = create_amneziawg_peer_and_config_for_user(
-                uid, android_safe=(os_ == "android"), server_id="eu1", platform=os_, device_id=device_id)
-        except WireGuardError as exc:
-            logger.exception("dev add %s os=%s: %s", uid, os_, exc)
-            db_delete_device(device_id)  # откат записи устройства, раз peer не создан
-            bot.send_message(message.chat.id, "Не удалось создать конфиг устройства. Попробуй позже.")
-            return
-        _deliver_config(message, cfg, f"awg_eu1_{os_}.conf", os_,
-                        f"✅ Добавлено устройство «{name}». Импортируй конфиг в AmneziaWG/AmneziaVPN.")
-        _render_device_list(message.chat.id, uid)
+        # Запись устройства создаёт задача (create_device): повторный тап по той же
+        # кнопке попадает в уже идущую задачу и второго устройства не появляется.
+        _submit_awg_job(message, "awg_create", "device_add", uid, os_, os_ == "android",
+                        device_id=secrets.token_hex(4), device_name=name, create_device=True)
 
     def _regen_device(message: types.Message, uid: int, did: str) -> None:
         dev = db_get_device(did)
@@ -1659,15 +1710,8 @@ def main() -> None:
             bot.send_message(message.chat.id, "Устройство не найдено.")
             return
         os_ = dev["os"]
-        try:
-            _, cfg = regenerate_amneziawg_peer_and_config_for_user(
-                uid, android_safe=(os_ == "android"), server_id="eu1", device_id=did)
-        except WireGuardError as exc:
-            logger.exception("dev regen %s did=%s: %s", uid, did[:8], exc)
-            bot.send_message(message.chat.id, "Не удалось обновить конфиг. Попробуй позже.")
-            return
-        _deliver_config(message, cfg, f"awg_eu1_{os_}.conf", os_,
-                        f"🔄 Конфиг «{dev['name']}» пересоздан. Импортируй заново.")
+        _submit_awg_job(message, "awg_regen", "device_regen", uid, os_, os_ == "android",
+                        device_id=did, device_name=dev["name"])
 
     @bot.callback_query_handler(func=lambda c: c.data in ("dev_list", "dev_add", "dev_noop")
                                 or c.data.startswith(("devadd_", "devregen_", "devdel_", "devdelyes_")))
@@ -3012,7 +3056,7 @@ def main() -> None:
             for peer in user_peers:
                 try:
                     if peer.public_key:
-                        _remove_amneziawg_peer(peer.public_key)
+                        _remove_amneziawg_peer(peer.public_key, peer.shard)
                     delete_peer(tid, peer.server_id, peer.platform or "pc")
                     reset_summary["awg_removed"] += 1
                 except Exception as e:
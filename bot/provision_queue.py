@@ -0,0 +1,357 @@
+"""
+Очередь выдачи конфигов: хендлеры бота и ЛК не держат поток на SSH.
+
+create/regenerate AmneziaWG-peer'а — это add-скрипт на eu1 по SSH с таймаутом
+60 с. Раньше он выполнялся прямо в потоке telebot/Flask: после рассылки волна
+«Получить конфиг» занимала все воркеры, и бот переставал отвечать всем.
+
+Теперь хендлер ставит задачу (provision_jobs в SQLite, см. db_job_submit) и
+сразу отвечает «готовлю»; воркеры этого процесса (PROVISION_WORKERS_PER_NODE
+на ноду, лимит общий для бота и ЛК) выполняют её и вызывают listener вида
+задачи — он доставляет конфиг (бот — сообщением; ЛК забирает результат
+опросом /api/recovery/job).
+
+- Идемпотентность: idem_key (тап по той же кнопке, повтор POST) → та же задача,
+  пока она не завершена; после done/failed тот же ключ ставит новую.
+- Повторы: ошибка → снова в очередь через _RETRY_DELAYS_S, до max_attempts;
+  после последней listener получает status='failed'. Неидемпотентные виды
+  (register_job_kind(..., retry_only=...): AWG add-скрипт создаёт новую пару
+  ключей и runtime-peer на каждый запуск) — одна попытка; повторяются только
+  ошибки типов retry_only (гарантированно до побочных эффектов), зависшая
+  задача такого вида — сразу failed.
+- Задачи переживают рестарт: running дольше _STALE_AFTER_S (процесс убит
+  посреди SSH) возвращаются в очередь; queued подхватывают воркеры после старта.
+  Если попытки кончились — failed, и listener получает её как обычный отказ.
+- Очередь не запущена (PROVISION_QUEUE=0, cron, тесты) — submit_job выполняет
+  задачу тут же, синхронно, одной попыткой, с тем же listener'ом.
+"""
+
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .database import (
+    db_job_claim,
+    db_job_complete,
+    db_job_fail,
+    db_job_get,
+    db_job_mark_delivered,
+    db_job_requeue_stale,
+    db_job_stats,
+    db_job_submit,
+)
+
+logger = logging.getLogger(__name__)
+
+_RETRY_DELAYS_S = (5, 20, 60)
+_POLL_INTERVAL_S = 0.5
+_STALE_AFTER_S = 300                 # > таймаута add-скрипта (60 с) с запасом
+_STALE_CHECK_INTERVAL_S = 60
+_DEFAULT_WORKERS_PER_NODE = 2
+_INLINE_OWNER = "inline"
+
+Runner = Callable[[Dict], Dict]
+Listener = Callable[[Dict], bool]
+
+_runners: Dict[str, Runner] = {}
+_retry_only: Dict[str, Tuple[type, ...]] = {}
+_listeners: Dict[str, Listener] = {}
+
+_cond = threading.Condition()
+_threads: List[threading.Thread] = []
+_stopping = False
+_owner: Optional[str] = None
+_last_stale_check = 0.0
+_nodes: Tuple[str, ...] = ()
+_workers_per_node = _DEFAULT_WORKERS_PER_NODE
+_stats = {
+    "executed": 0, "succeeded": 0, "retried": 0, "failed": 0, "inline": 0,
+    "total_run_ms": 0.0, "max_run_ms": 0.0,
+}
+
+
+def _reset_after_fork() -> None:
+    global _cond, _threads, _stopping, _owner
+    _cond = threading.Condition()
+    _threads = []
+    _stopping = False
+    _owner = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def register_job_kind(kind: str, runner: Runner, retry_only: Optional[Tuple[type, ...]] = None) -> None:
+    """runner(params) → result (JSON-сериализуемый dict); исключение = неудачная попытка.
+    retry_only — runner неидемпотентен: задача ставится с max_attempts=1, повтор
+    (до len(_RETRY_DELAYS_S) попыток) — только для исключений этих типов."""
+    _runners[kind] = runner
+    if retry_only:
+        _retry_only[kind] = tuple(retry_only)
+    else:
+        _retry_only.pop(kind, None)
+
+
+def set_job_listener(kind: str, listener: Listener) -> None:
+    """listener(job) после завершения задачи (status 'done' с result или 'failed' с error).
+    Вызывается в процессе, выполнившем задачу. Вернул True — результат доставлен
+    и стирается из БД; иначе его заберут опросом (take_job_result)."""
+    _listeners[kind] = listener
+
+
+def provision_queue_running() -> bool:
+    with _cond:
+        return bool(_threads)
+
+
+def submit_job(
+    kind: str,
+    node: str,
+    telegram_id: Optional[int],
+    params: Dict,
+    idem_key: Optional[str] = None,
+    max_attempts: int = len(_RETRY_DELAYS_S),
+) -> Tuple[int, bool]:
+    """
+    Ставит задачу (или выполняет сразу, если очередь в процессе не запущена).
+    Возвращает (job_id, created): created=False — задача с этим idem_key уже
+    выполняется (её статус — db_job_get(job_id)).
+    """
+    if kind not in _runners:
+        raise ValueError(f"Неизвестный вид задачи: {kind}")
+    if kind in _retry_only:
+        max_attempts = 1   # зависшая → failed (db_job_requeue_stale), не повтор
+    with _cond:
+        owner = _owner if _threads else None
+    if owner is None:
+        _maybe_sweep_stale()   # без очереди некому, кроме submit
+        job_id, created = db_job_submit(kind, node, _INLINE_OWNER, telegram_id, params, idem_key, 1)
+        if created:
+            job = db_job_claim(_INLINE_OWNER, node, [kind], max_running=1 << 30, job_id=job_id)
+            if job is not None:
+                _stats["inline"] += 1
+                _execute(job)
+        return job_id, created
+    job_id, created = db_job_submit(kind, node, owner, telegram_id, params, idem_key, max_attempts)
+    if created:
+        with _cond:
+            _cond.notify_all()
+    return job_id, created
+
+
+def _execute(job: Dict) -> None:
+    job_id = job["id"]
+    t0 = time.perf_counter()
+    try:
+        result = _runners[job["kind"]](job["params"])
+    except Exception as exc:  # noqa: BLE001 — любая ошибка попытки → повтор/failed
+        delay = _RETRY_DELAYS_S[min(job["attempts"], len(_RETRY_DELAYS_S)) - 1]
+        retry = None   # по attempts < max_attempts
+        if job["kind"] in _retry_only:
+            retry = (isinstance(exc, _retry_only[job["kind"]]) and job["owner"] != _INLINE_OWNER
+                     and job["attempts"] < len(_RETRY_DELAYS_S))
+        status = db_job_fail(job_id, f"{type(exc).__name__}: {exc}", delay, retry=retry)
+        _record(t0)
+        if status == "failed":
+            _stats["failed"] += 1
+            logger.warning("provision job %s (%s) не выполнена: %s", job_id, job["kind"], exc)
+            _notify(db_job_get(job_id))
+        else:
+            _stats["retried"] += 1
+            logger.info("provision job %s: попытка %s не удалась, повтор через %s с: %s",
+                        job_id, job["attempts"], delay, exc)
+        return
+    db_job_complete(job_id, result)
+    _record(t0)
+    _stats["succeeded"] += 1
+    _notify(db_job_get(job_id))
+
+
+def _record(t0: float) -> None:
+    ms = (time.perf_counter() - t0) * 1000
+    _stats["executed"] += 1
+    _stats["total_run_ms"] += ms
+    if ms > _stats["max_run_ms"]:
+        _stats["max_run_ms"] = ms
+
+
+def _notify(job: Optional[Dict]) -> None:
+    if job is None:
+        return
+    listener = _listeners.get(job["kind"])
+    if listener is None:
+        return  # результат заберут опросом (take_job_result)
+    try:
+        delivered = listener(job)
+    except Exception:  # noqa: BLE001
+        logger.exception("provision job %s: listener упал", job["id"])
+        return
+    if delivered and job["status"] == "done":
+        db_job_mark_delivered(job["id"])
+
+
+def take_job_result(job_id: int) -> Optional[Dict]:
+    """Задача для опроса (ЛК): при status='done' результат отдаётся один раз
+    и стирается из БД."""
+    job = db_job_get(job_id)
+    if job is not None and job["status"] == "done" and job["result"] is not None:
+        db_job_mark_delivered(job_id)
+    return job
+
+
+def _worker(node: str) -> None:
+    while True:
+        with _cond:
+            if _stopping:
+                return
+            owner = _owner
+        try:
+            job = db_job_claim(owner, node, list(_runners), _workers_per_node)
+        except Exception:  # noqa: BLE001
+            logger.exception("provision queue: claim на %s упал", node)
+            job = None
+        if job is None:
+            with _cond:
+                if not _stopping:
+                    _cond.wait(_POLL_INTERVAL_S)
+            continue
+        _execute(job)
+
+
+def _sweep_stale() -> None:
+    global _last_stale_check
+    _last_stale_check = time.monotonic()
+    try:
+        n, failed = db_job_requeue_stale(_STALE_AFTER_S)
+    except Exception:  # noqa: BLE001
+        logger.exception("provision queue: requeue_stale упал")
+        return
+    if n:
+        logger.warning("provision queue: %d зависших задач возвращено в очередь", n)
+    for job in failed:
+        _stats["failed"] += 1
+        logger.warning("provision job %s (%s) зависла, попыток больше нет", job["id"], job["kind"])
+        _notify(job)
+
+
+def _maybe_sweep_stale() -> None:
+    if time.monotonic() - _last_stale_check >= _STALE_CHECK_INTERVAL_S:
+        _sweep_stale()
+
+
+def _stale_sweeper() -> None:
+    while True:
+        _sweep_stale()
+        with _cond:
+            if not _stopping:
+                _cond.wait(_STALE_CHECK_INTERVAL_S)
+            if _stopping:
+                return
+
+
+def provision_queue_start(
+    owner: str,
+    nodes: Tuple[str, ...] = ("eu1",),
+    workers_per_node: int = _DEFAULT_WORKERS_PER_NODE,
+) -> None:
+    """Запускает воркеры очереди в этом процессе (идемпотентно). owner — кто
+    доставляет результат ('bot' / 'web'): воркеры берут только свои задачи."""
+    global _owner, _nodes, _workers_per_node, _stopping
+    with _cond:
+        if _threads:
+            return
+        _owner, _nodes, _stopping = owner, tuple(nodes), False
+        _workers_per_node = max(1, int(workers_per_node))
+        for node in _nodes:
+            for i in range(_workers_per_node):
+                _threads.append(threading.Thread(
+                    target=_worker, args=(node,), name=f"provision-{node}-{i}", daemon=True))
+        _threads.append(threading.Thread(target=_stale_sweeper, name="provision-stale", daemon=True))
+        for t in _threads:
+            t.start()
+    logger.info("provision queue: %s, ноды %s, воркеров на ноду %d", owner, ", ".join(_nodes), _workers_per_node)
+
+
+def provision_queue_stop(timeout: float = 10.0) -> None:
+    """Останавливает воркеры (текущие задачи дорабатывают; неначатые остаются в БД)."""
+    global _stopping, _threads
+    with _cond:
+        threads = list(_threads)
+        _stopping = True
+        _cond.notify_all()
+    for t in threads:
+        t.join(timeout)
+    with _cond:
+        _threads = []
+        _stopping = False
+
+
+def provision_queue_stats() -> Dict:
+    """Метрики процесса (executed/succeeded/retried/failed/inline, время задач)
+    + задачи в БД по нодам и статусам."""
+    with _cond:
+        running = bool(_threads)
+        owner = _owner
+    stats = dict(_stats)
+    stats["avg_run_ms"] = stats["total_run_ms"] / stats["executed"] if stats["executed"] else 0.0
+    return {"running": running, "owner": owner, "workers_per_node": _workers_per_node,
+            **stats, "jobs": db_job_stats()}
+
+
+# ─── Виды задач ───────────────────────────────────────────────────────────────
+
+def _awg_result(peer, client_config: str) -> Dict:
+    return {
+        "server_id": peer.server_id,
+        "wg_ip": peer.wg_ip,
+        "public_key": peer.public_key,
+        "device_id": peer.device_id,
+        "os": peer.os,
+        "config": client_config,
+    }
+
+
+def _awg_retry_only() -> Tuple[type, ...]:
+    from .wireguard_peers import AwgNotProvisionedError
+
+    return (AwgNotProvisionedError,)
+
+
+def _run_awg_create(params: Dict) -> Dict:
+    from .database import db_add_device, db_get_device
+    from .wireguard_peers import create_amneziawg_peer_and_config_for_user
+
+    if params.get("create_device") and not db_get_device(params["device_id"]):
+        # Устройство создаёт сама задача: дубль тапа (created=False) его не плодит.
+        db_add_device(int(params["telegram_id"]), params.get("device_name") or "",
+                      params.get("platform") or "pc", device_id=params["device_id"])
+    peer, cfg = create_amneziawg_peer_and_config_for_user(
+        int(params["telegram_id"]),
+        android_safe=bool(params.get("android_safe")),
+        server_id="eu1",
+        platform=params.get("platform") or "pc",
+        device_id=params.get("device_id"),
+    )
+    return _awg_result(peer, cfg)
+
+
+def _run_awg_regen(params: Dict) -> Dict:
+    from .wireguard_peers import regenerate_amneziawg_peer_and_config_for_user
+
+    peer, cfg = regenerate_amneziawg_peer_and_config_for_user(
+        int(params["telegram_id"]),
+        android_safe=bool(params.get("android_safe")),
+        server_id="eu1",
+        platform=params.get("platform") or "pc",
+        device_id=params.get("device_id"),
+    )
+    return _awg_result(peer, cfg)
+
+
+# add-скрипт неидемпотентен: повтор после его вызова — лишний runtime-peer
+# (и чужой ключ на переиспользованном IP). Повторяем только ошибки до скрипта.
+register_job_kind("awg_create", _run_awg_create, retry_only=_awg_retry_only())
+register_job_kind("awg_regen", _run_awg_regen, retry_only=_awg_retry_only())
@@ -0,0 +1,290 @@
+"""
+Постоянные SSH-сессии к нодам (OpenSSH ControlMaster/ControlPersist).
+
+Раньше каждая операция с peer'ом (execute_server_command, wg set на main,
+add-ss-redirect, VLESS add/remove) запускала отдельный `ssh` с полным TCP +
+key-exchange. Провайдеры режут 5–6 подряд идущих коннектов (см.
+scripts/health_check.py, _run_remote_resilient), а handshake дороже самой
+команды.
+
+Здесь на каждый хост держится один master-коннект (сокет в _CONTROL_DIR,
+живёт _CONTROL_PERSIST_S после последней команды), команды идут каналами
+внутри него. Сокет общий для всех процессов (бот, панель, cron) — коннект
+переиспользуют все. Через сокет уходят root-команды на ноды, поэтому
+каталог — в data/ бота, и если он не наш или доступен другим (не 0700),
+multiplexing выключается. Одновременных команд на хост — не больше
+SSH_MAX_SESSIONS_PER_HOST в процессе (sshd по умолчанию MaxSessions=10).
+
+Сбой уровня ssh (код 255: master умер, сеть моргнула) → master закрывается,
+следующая команда поднимает коннект заново. Повтор самой команды — только
+с retry=True: 255 бывает и когда связь оборвалась ПОСЛЕ выполнения на ноде,
+так что повторять можно лишь идемпотентное (wg set peer … allowed-ips /
+remove). AWG add-скрипт (новая пара ключей на каждый запуск), statsquery
+-reset (съест интервал дельт) и т.п. вызываются без повтора.
+
+env_vars.txt:
+    SSH_MULTIPLEX=0                  — выключить (каждая команда — свой ssh, как раньше)
+    SSH_MAX_SESSIONS_PER_HOST=4      — лимит параллельных команд на хост
+
+Латентность handshake (подъём master) и команд считается раздельно —
+ssh_session_stats().
+"""
+
+import logging
+import os
+import pathlib
+import stat
+import subprocess
+import threading
+import time
+from typing import Dict, List, Optional
+
+from .config import _parse_env_file
+
+logger = logging.getLogger(__name__)
+
+_CONTROL_DIR = pathlib.Path(__file__).resolve().parent.parent / "data" / "ssh"
+# sun_path сокета ограничен ~104 байтами; %C — 40 hex-символов.
+_MAX_CONTROL_DIR_LEN = 60
+_CONTROL_PERSIST_S = 600
+# Master считаем живым, если последняя команда была не раньше этого (с запасом
+# до ControlPersist) — иначе перед командой делаем дешёвый `true` через него.
+_MASTER_FRESH_S = _CONTROL_PERSIST_S - 60
+_DEFAULT_MAX_SESSIONS = 4
+_SSH_CONNECTION_ERROR = 255
+
+_lock = threading.Lock()
+_semaphores: Dict[str, threading.BoundedSemaphore] = {}
+_last_used: Dict[str, float] = {}
+_stats: Dict[str, Dict[str, float]] = {}
+_settings: Optional[Dict[str, object]] = None
+_control_dir_warned = False
+
+
+def _load_settings() -> Dict[str, object]:
+    global _settings
+    if _settings is None:
+        base_dir = pathlib.Path(__file__).resolve().parent.parent
+        try:
+            env = _parse_env_file(base_dir / "env_vars.txt")
+        except Exception:  # noqa: BLE001
+            env = {}
+        try:
+            max_sessions = max(1, int(env.get("SSH_MAX_SESSIONS_PER_HOST", "") or _DEFAULT_MAX_SESSIONS))
+        except ValueError:
+            max_sessions = _DEFAULT_MAX_SESSIONS
+        _settings = {
+            "multiplex": env.get("SSH_MULTIPLEX", "1").strip().lower() not in ("0", "false", "no"),
+            "max_sessions": max_sessions,
+        }
+    return _settings
+
+
+def _host_stats(target: str) -> Dict[str, float]:
+    st = _stats.get(target)
+    if st is None:
+        st = _stats[target] = {
+            "handshakes": 0, "handshake_ms_total": 0.0, "handshake_ms_last": 0.0,
+            "commands": 0, "command_ms_total": 0.0, "command_ms_last": 0.0,
+            "reconnects": 0, "errors": 0, "in_flight": 0, "waited": 0,
+        }
+    return st
+
+
+def _semaphore(target: str) -> threading.BoundedSemaphore:
+    with _lock:
+        sem = _semaphores.get(target)
+        if sem is None:
+            sem = _semaphores[target] = threading.BoundedSemaphore(int(_load_settings()["max_sessions"]))
+        return sem
+
+
+def _base_cmd(
+    target: str, key_path: Optional[str], connect_timeout: Optional[int], mux: bool, master: str = "no",
+) -> List[str]:
+    """
+    master="auto" — только для _handshake (поднимает master, stdio в /dev/null:
+    фоновый master держал бы пайпы capture_output). Команды идут с "no": через
+    живой сокет, а если его нет — обычным отдельным коннектом, без нового master.
+    """
+    cmd = ["ssh"]
+    if key_path:
+        cmd.extend(["-i", key_path])
+    cmd.extend(["-o", "StrictHostKeyChecking=no", "-o", "BatchMode=yes"])
+    if connect_timeout:
+        cmd.extend(["-o", f"ConnectTimeout={connect_timeout}"])
+    if mux:
+        cmd.extend([
+            "-o", f"ControlMaster={master}",
+            "-o", f"ControlPath={_CONTROL_DIR}/%C",
+            "-o", f"ControlPersist={_CONTROL_PERSIST_S}",
+            "-o", "ServerAliveInterval=30",
+        ])
+    cmd.append(target)
+    return cmd
+
+
+def _control_dir_ok() -> bool:
+    """Создаёт каталог сокетов и проверяет, что он наш и закрыт (0700, не
+    symlink). Иначе — False: multiplexing выключен, сокету чужого каталога
+    команды не отдаём."""
+    global _control_dir_warned
+    try:
+        _CONTROL_DIR.mkdir(mode=0o700, parents=True, exist_ok=True)
+        st = os.lstat(_CONTROL_DIR)
+        problem = None
+        if len(str(_CONTROL_DIR)) > _MAX_CONTROL_DIR_LEN:
+            problem = "слишком длинный путь для unix-сокета"
+        elif not stat.S_ISDIR(st.st_mode):
+            problem = "не каталог (symlink?)"
+        elif st.st_uid != os.geteuid():
+            problem = f"владелец uid={st.st_uid}, не мы"
+        elif stat.S_IMODE(st.st_mode) & 0o077:
+            problem = f"права {stat.S_IMODE(st.st_mode):o}, нужно 700"
+    except OSError as exc:
+        problem = str(exc)
+    if problem is None:
+        return True
+    if not _control_dir_warned:
+        _control_dir_warned = True
+        logger.warning("SSH multiplexing выключен: %s — %s", _CONTROL_DIR, problem)
+    return False
+
+
+def _close_master(base: List[str]) -> None:
+    """`ssh -O exit` — закрыть (возможно, зависший) master; ошибки не важны."""
+    try:
+        subprocess.run(base[:-1] + ["-O", "exit", base[-1]], capture_output=True, timeout=5)
+    except (OSError, subprocess.TimeoutExpired):
+        pass
+
+
+def _handshake(target: str, master_base: List[str], timeout: int) -> bool:
+    """Поднимает master (или проверяет живой) тривиальной командой; время — в handshake-метрики."""
+    t0 = time.perf_counter()
+    try:
+        r = subprocess.run(
+            master_base + ["true"], stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL, timeout=timeout,
+        )
+    except subprocess.TimeoutExpired:
+        return False
+    ms = (time.perf_counter() - t0) * 1000
+    with _lock:
+        st = _host_stats(target)
+        st["handshakes"] += 1
+        st["handshake_ms_total"] += ms
+        st["handshake_ms_last"] = ms
+    return r.returncode == 0
+
+
+def run_ssh(
+    host: str,
+    remote_cmd: str,
+    user: Optional[str] = None,
+    key_path: Optional[str] = None,
+    input: Optional[str] = None,
+    timeout: int = 30,
+    connect_timeout: Optional[int] = None,
+    check: bool = False,
+    retry: bool = False,
+) -> subprocess.CompletedProcess:
+    """
+    Выполняет remote_cmd на host через постоянную SSH-сессию.
+
+    retry=True — при коде 255 переподключиться и выполнить команду ещё раз;
+    только для идемпотентных команд (см. docstring модуля).
+
+    Возвращает CompletedProcess (stdout/stderr — text). Как subprocess.run:
+    TimeoutExpired при таймауте, CalledProcessError при check=True и ненулевом коде.
+    """
+    target = f"{user}@{host}" if user else host
+    mux = bool(_load_settings()["multiplex"]) and _control_dir_ok()
+    base = _base_cmd(target, key_path, connect_timeout, mux)
+    master_base = _base_cmd(target, key_path, connect_timeout, mux, master="auto")
+    sem = _semaphore(target)
+    if not sem.acquire(blocking=False):
+        with _lock:
+            _host_stats(target)["waited"] += 1
+        sem.acquire()
+    with _lock:
+        _host_stats(target)["in_flight"] += 1
+    try:
+        if mux:
+            fresh = time.monotonic() - _last_used.get(target, float("-inf")) < _MASTER_FRESH_S
+            if not fresh:
+                _handshake(target, master_base, timeout)
+        result = _run_once(target, base, remote_cmd, input, timeout)
+        if mux and result.returncode == _SSH_CONNECTION_ERROR:
+            logger.warning("SSH %s: код 255, %s (%s)", target,
+                           "переподключаюсь и повторяю" if retry else "закрываю master, без повтора",
+                           (result.stderr or "").strip()[:200])
+            _close_master(base)
+            if retry:
+                with _lock:
+                    _host_stats(target)["reconnects"] += 1
+                _handshake(target, master_base, timeout)
+                result = _run_once(target, base, remote_cmd, input, timeout)
+        if result.returncode == _SSH_CONNECTION_ERROR:
+            with _lock:
+                _host_stats(target)["errors"] += 1
+            _last_used.pop(target, None)
+        else:
+            _last_used[target] = time.monotonic()
+    finally:
+        with _lock:
+            _host_stats(target)["in_flight"] -= 1
+        sem.release()
+    if check and result.returncode != 0:
+        raise subprocess.CalledProcessError(result.returncode, result.args, result.stdout, result.stderr)
+    return result
+
+
+def _run_once(
+    target: str, base: List[str], remote_cmd: str, input: Optional[str], timeout: int,
+) -> subprocess.CompletedProcess:
+    t0 = time.perf_counter()
+    try:
+        result = subprocess.run(base + [remote_cmd], input=input, capture_output=True, text=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        with _lock:
+            _host_stats(target)["errors"] += 1
+        raise
+    ms = (time.perf_counter() - t0) * 1000
+    with _lock:
+        st = _host_stats(target)
+        st["commands"] += 1
+        st["command_ms_total"] += ms
+        st["command_ms_last"] = ms
+    return result
+
+
+def ssh_session_stats() -> Dict[str, Dict[str, float]]:
+    """Метрики по хостам: handshakes/commands (+ средняя латентность), reconnects, errors."""
+    with _lock:
+        out = {}
+        for target, st in _stats.items():
+            row = dict(st)
+            row["handshake_ms_avg"] = st["handshake_ms_total"] / st["handshakes"] if st["handshakes"] else 0.0
+            row["command_ms_avg"] = st["command_ms_total"] / st["commands"] if st["commands"] else 0.0
+            out[target] = row
+        return out
+
+
+def ssh_close_all() -> None:
+    """Закрыть все master-коннекты этого процесса (при остановке; иначе закроются по ControlPersist)."""
+    for target in list(_last_used):
+        _close_master(_base_cmd(target, None, None, True))
+        _last_used.pop(target, None)
+
+
+def _reset_after_fork() -> None:
+    global _lock
+    _lock = threading.Lock()
+    _semaphores.clear()
+    for st in _stats.values():
+        st["in_flight"] = 0
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -1,7 +1,7 @@
 import json
 import pathlib
 from dataclasses import dataclass, asdict
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 
 DATA_DIR = pathlib.Path(__file__).resolve().parent / "data"
 USERS_FILE = DATA_DIR / "users.json"
@@ -125,6 +125,7 @@ class Peer:
     device_id: Optional[str] = None
     os: Optional[str] = None
     platform: Optional[str] = None  # legacy-алиас os
+    shard: Optional[str] = None  # AWG-шард eu1 (bot/awg_shards.py); None — первый
 
     def __post_init__(self) -> None:
         # os приоритетнее; если не задан — берём из platform (legacy). Держим
@@ -152,6 +153,21 @@ def _save_raw(path: pathlib.Path, data: Dict[str, dict]) -> None:
     path.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
 
 
+def _payload_from_row(r: dict) -> dict:
+    """Строка таблицы peers → нормализованный payload (server_id, os)."""
+    return {
+        "telegram_id": int(r["telegram_id"]),
+        "wg_ip": r["wg_ip"],
+        "public_key": r["public_key"],
+        "server_id": normalize_peer_server_id(r.get("server_id")),
+        "active": bool(r["active"]),
+        "profile_type": r.get("profile_type"),
+        "device_id": r.get("device_id") or "",
+        "os": _normalize_platform(r.get("os")),
+        "shard": r.get("shard"),
+    }
+
+
 def _load_peers_data() -> Dict[str, dict]:
     """
     {storage_key: payload} из таблицы peers (источник правды — SQLite).
@@ -162,18 +178,8 @@ def _load_peers_data() -> Dict[str, dict]:
 
     out: Dict[str, dict] = {}
     for r in db_get_all_peers():
-        sid = normalize_peer_server_id(r.get("server_id"))
-        did = r.get("device_id") or ""
-        out[f'{r["telegram_id"]}:{sid}:{did}'] = {
-            "telegram_id": int(r["telegram_id"]),
-            "wg_ip": r["wg_ip"],
-            "public_key": r["public_key"],
-            "server_id": sid,
-            "active": bool(r["active"]),
-            "profile_type": r.get("profile_type"),
-            "device_id": did,
-            "os": _normalize_platform(r.get("os")),
-        }
+        payload = _payload_from_row(r)
+        out[f'{payload["telegram_id"]}:{payload["server_id"]}:{payload["device_id"]}'] = payload
     return out
 
 
@@ -210,11 +216,10 @@ def _user_from_db_row(row: dict) -> User:
     )
 
 
-def get_all_users() -> List[User]:
+def _build_all_users() -> List[User]:
     from .database import db_get_all_users
-    rows = db_get_all_users()
     users: List[User] = []
-    for row in rows:
+    for row in db_get_all_users():
         try:
             users.append(_user_from_db_row(row))
         except (ValueError, KeyError):
@@ -222,6 +227,13 @@ def get_all_users() -> List[User]:
     return users
 
 
+def get_all_users() -> List[User]:
+    """Все пользователи (read cache database.db_read_cached: пока users не
+    менялась — без обращения к БД; объекты User общие, не мутировать)."""
+    from .database import db_read_cached
+    return list(db_read_cached("storage.users", ("users",), _build_all_users))
+
+
 def find_user(telegram_id: int) -> Optional[User]:
     from .database import db_find_user_by_telegram_id
     row = db_find_user_by_telegram_id(telegram_id)
@@ -265,6 +277,7 @@ def _peer_from_payload(payload: dict) -> Peer:
         profile_type=payload.get("profile_type"),
         device_id=payload.get("device_id"),
         os=_normalize_platform(payload.get("os") or payload.get("platform")),
+        shard=payload.get("shard"),
     )
 
 
@@ -275,7 +288,7 @@ def _pick_active(cands: List[Peer]) -> Optional[Peer]:
     return cands[0] if cands else None
 
 
-def get_all_peers() -> List[Peer]:
+def _build_all_peers() -> List[Peer]:
     peers: List[Peer] = []
     for payload in _load_peers_data().values():
         try:
@@ -285,6 +298,63 @@ def get_all_peers() -> List[Peer]:
     return peers
 
 
+def get_all_peers() -> List[Peer]:
+    """Все слоты (read cache, как get_all_users; объекты Peer не мутировать)."""
+    from .database import db_read_cached
+    return list(db_read_cached("storage.peers", ("peers",), _build_all_peers))
+
+
+# Точечные выборки: WHERE по индексам таблицы peers вместо get_all_peers() +
+# фильтра в Python (тот растёт линейно от числа слотов всех юзеров).
+
+def _peers_from_rows(rows: List[dict]) -> List[Peer]:
+    peers: List[Peer] = []
+    for r in rows:
+        try:
+            peers.append(_peer_from_payload(_payload_from_row(r)))
+        except (ValueError, KeyError):
+            continue
+    return peers
+
+
+def _raw_server_ids(server_id: str) -> List[str]:
+    """Сырые значения server_id в таблице, которые нормализуются в server_id."""
+    sid = normalize_peer_server_id(server_id)
+    return [sid, "main", ""] if sid == "rus1" else [sid]
+
+
+def get_peers_by_telegram_id(telegram_id: int, server_id: Optional[str] = None) -> List[Peer]:
+    """Слоты пользователя (опционально — на одном сервере)."""
+    from .database import db_get_peers_by_telegram_id
+
+    peers = _peers_from_rows(db_get_peers_by_telegram_id(int(telegram_id)))
+    if server_id is not None:
+        sid = normalize_peer_server_id(server_id)
+        peers = [p for p in peers if p.server_id == sid]
+    return peers
+
+
+def get_peers_by_device_id(device_id: str) -> List[Peer]:
+    """Слоты устройства на всех серверах."""
+    from .database import db_get_peers_by_device_id
+    return _peers_from_rows(db_get_peers_by_device_id(device_id))
+
+
+def find_peer_by_public_key(public_key: str) -> Optional[Peer]:
+    """Слот по public_key (активный приоритетнее)."""
+    from .database import db_get_peers_by_public_key
+    pk = (public_key or "").strip()
+    if not pk:
+        return None
+    return _pick_active(_peers_from_rows(db_get_peers_by_public_key(pk)))
+
+
+def get_peers_by_server(server_id: str, active_only: bool = False) -> List[Peer]:
+    """Слоты на сервере (main → rus1, как в get_all_peers)."""
+    from .database import db_get_peers_by_server
+    return _peers_from_rows(db_get_peers_by_server(_raw_server_ids(server_id), active_only))
+
+
 def find_peer_by_telegram_id(
     telegram_id: int,
     server_id: Optional[str] = None,
@@ -301,9 +371,7 @@ def find_peer_by_telegram_id(
     main в server_id → rus1.
     """
     sid = normalize_peer_server_id(server_id) if server_id is not None else None
-    mine = [p for p in get_all_peers() if p.telegram_id == int(telegram_id)]
-    if sid is not None:
-        mine = [p for p in mine if p.server_id == sid]
+    mine = get_peers_by_telegram_id(telegram_id, server_id=sid)
 
     if device_id is not None:
         return _pick_active([p for p in mine if p.device_id == device_id])
@@ -331,15 +399,11 @@ def upsert_peer(peer: Peer) -> None:
     этом сервере с тем же os; иначе создаём новое устройство (db_add_device).
     Так бот/ЛК работают без правок до B3-UX.
     """
-    from .database import db_upsert_peer, db_add_device
+    from .database import db_upsert_peer
 
     sid = normalize_peer_server_id(peer.server_id)
     os_ = _normalize_platform(peer.os or peer.platform)
-    device_id = peer.device_id
-    if not device_id:
-        existing = find_peer_by_telegram_id(peer.telegram_id, server_id=sid, platform=os_)
-        device_id = existing.device_id if (existing and existing.device_id) \
-            else db_add_device(peer.telegram_id, _device_label(os_), os_)
+    device_id = peer.device_id or resolve_device_id(peer.telegram_id, sid, os_)
 
     db_upsert_peer({
         "telegram_id": peer.telegram_id,
@@ -350,9 +414,56 @@ def upsert_peer(peer: Peer) -> None:
         "public_key": peer.public_key,
         "active": peer.active,
         "profile_type": peer.profile_type,
+        "shard": peer.shard,
     })
 
 
+def resolve_device_id(telegram_id: int, server_id: str, platform: Optional[str]) -> str:
+    """device_id для слота без явного устройства (legacy-shim upsert_peer):
+    устройство существующего слота с тем же os, иначе новое."""
+    from .database import db_add_device
+
+    sid = normalize_peer_server_id(server_id)
+    os_ = _normalize_platform(platform)
+    existing = find_peer_by_telegram_id(telegram_id, server_id=sid, platform=os_)
+    if existing and existing.device_id:
+        return existing.device_id
+    return db_add_device(telegram_id, _device_label(os_), os_)
+
+
+def claim_warm_peer(peer: Peer, node: str) -> Optional[Tuple[Peer, str]]:
+    """
+    Слот peer (telegram_id/server_id/device_id/os; wg_ip и ключ не нужны)
+    из тёплого пула ноды одной транзакцией; без device_id — как upsert_peer. Возвращает (peer с wg_ip,
+    public_key, shard; client_config из пула) или None — пул пуст.
+    """
+    from .database import db_warm_pool_claim
+
+    sid = normalize_peer_server_id(peer.server_id)
+    os_ = _normalize_platform(peer.os or peer.platform)
+    row = db_warm_pool_claim(node, {
+        "telegram_id": peer.telegram_id,
+        "server_id": sid,
+        "device_id": peer.device_id,
+        "os": os_,
+        "profile_type": peer.profile_type,
+    }, resolve_device=lambda: resolve_device_id(peer.telegram_id, sid, os_))
+    if row is None:
+        return None
+    claimed = Peer(
+        telegram_id=peer.telegram_id,
+        wg_ip=row["wg_ip"],
+        public_key=row["public_key"],
+        server_id=sid,
+        active=True,
+        profile_type=peer.profile_type,
+        device_id=row["device_id"],
+        os=os_,
+        shard=row["shard"],
+    )
+    return claimed, row["client_config"]
+
+
 def delete_peer(telegram_id: int, server_id: str, platform: Optional[str] = "pc",
                 device_id: Optional[str] = None) -> None:
     """
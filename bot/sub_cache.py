@@ -0,0 +1,116 @@
+"""
+Кеш отрисованных подписок /sub/<token> + ETag/304.
+
+/sub/<token> дёргает каждый VPN-клиент (HAPP/Streisand/V2Box) по
+Profile-Update-Interval, а раньше каждый hit заново разбирал env_vars.txt,
+ходил в БД за per-user UUID каждого сервера (по 2 запроса на сервер),
+собирал ссылки и кодировал base64 — при том что подписка юзера меняется
+редко.
+
+Здесь на токен хранится готовое тело и его ETag, пока не сдвинулся штамп:
+всё, от чего зависит подписка, — per-user UUID, active, expires_at юзера и
+версия env_vars.txt (config_version). Штамп берётся из той же строки users,
+что и так читается по токену, поэтому инвалидация бесплатна: выдали/сбросили
+UUID, продлили/отозвали, поправили env — следующий hit перерисует.
+
+ETag — sha256 тела и Subscription-Userinfo (strong: одинаковый ETag =
+байт-в-байт одинаковый ответ). Клиент, приславший If-None-Match с ним,
+получает 304 без тела. Неполная отрисовка (per-user UUID не подставился,
+в теле общая ссылка) не кешируется и идёт без ETag — следующий hit
+попробует снова. Кеш — в памяти процесса (LRU на _MAX_ENTRIES
+токенов); в каждом воркере свой, промах = одна перерисовка.
+"""
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Tuple
+
+from .database import db_is_access_active_row
+
+_MAX_ENTRIES = 50000
+
+# Колонки users, от которых зависит тело подписки (см. _build_subscription_links).
+_STAMP_COLUMNS = ("telegram_id", "active", "expires_at", "vless_uuid_eu1", "vless_uuid_main")
+
+Render = Callable[[], Tuple[str, Optional[str], bool]]
+
+_lock = threading.Lock()
+_entries: "OrderedDict[str, Tuple[tuple, str, Optional[str], str]]" = OrderedDict()
+_stats = {"hits": 0, "misses": 0, "not_modified": 0, "evicted": 0, "degraded": 0}
+
+
+def _reset_after_fork() -> None:
+    global _lock
+    _lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def sub_stamp(user: Dict, config_version: Tuple[int, int]) -> tuple:
+    """Всё, от чего зависит подписка юзера; включает доступ на сейчас
+    (истёк срок — штамп меняется без записи в БД)."""
+    return (config_version, db_is_access_active_row(user)) + tuple(user.get(c) for c in _STAMP_COLUMNS)
+
+
+def sub_etag(body: str, userinfo: Optional[str]) -> str:
+    digest = hashlib.sha256(f"{body}\n{userinfo or ''}".encode("utf-8")).hexdigest()
+    return f'"{digest[:32]}"'
+
+
+def sub_render_cached(token: str, stamp: tuple, render: Render) -> Tuple[str, Optional[str], Optional[str]]:
+    """
+    (тело, Subscription-Userinfo, ETag) подписки токена: из кеша, если штамп
+    не сдвинулся, иначе render() → (тело, userinfo, полная ли) и запись в кеш.
+    Неполная отрисовка в кеш не попадает, ETag — None.
+    """
+    with _lock:
+        entry = _entries.get(token)
+        if entry is not None and entry[0] == stamp:
+            _entries.move_to_end(token)
+            _stats["hits"] += 1
+            return entry[1], entry[2], entry[3]
+    body, userinfo, complete = render()
+    if not complete:
+        with _lock:
+            _stats["misses"] += 1
+            _stats["degraded"] += 1
+            _entries.pop(token, None)
+        return body, userinfo, None
+    etag = sub_etag(body, userinfo)
+    with _lock:
+        _stats["misses"] += 1
+        _entries[token] = (stamp, body, userinfo, etag)
+        _entries.move_to_end(token)
+        while len(_entries) > _MAX_ENTRIES:
+            _entries.popitem(last=False)
+            _stats["evicted"] += 1
+    return body, userinfo, etag
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """If-None-Match (RFC 9110: `*` или список, слабое сравнение — W/ игнорируется)
+    содержит etag → ответ 304."""
+    if not if_none_match:
+        return False
+    candidates = [c.strip() for c in if_none_match.split(",")]
+    matched = any(c == "*" or (c[2:] if c.startswith("W/") else c) == etag for c in candidates)
+    if matched:
+        _stats["not_modified"] += 1
+    return matched
+
+
+def sub_cache_clear() -> None:
+    with _lock:
+        _entries.clear()
+
+
+def sub_cache_stats() -> Dict:
+    """hits / misses (перерисовки) / not_modified (ответы 304) / evicted /
+    degraded (неполные отрисовки, не кешированы), entries."""
+    with _lock:
+        entries = len(_entries)
+    return {**_stats, "entries": entries}
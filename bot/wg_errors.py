@@ -0,0 +1,15 @@
+"""
+Ошибки выдачи WireGuard/AmneziaWG — отдельно от bot/wireguard_peers.py, чтобы
+их могли бросать модули, которые wireguard_peers сам импортирует
+(bot/awg_shards.py), без цикла импортов. Снаружи по-прежнему
+`from .wireguard_peers import WireGuardError`.
+"""
+
+
+class WireGuardError(RuntimeError):
+    """Ошибка при работе с WireGuard или генерации конфига."""
+
+
+class UnknownAwgShardError(WireGuardError, ValueError):
+    """peers.shard ссылается на шард, которого нет в AMNEZIAWG_EU1_SHARDS
+    (переименован / убран из конфига)."""
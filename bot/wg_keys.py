@@ -0,0 +1,89 @@
+"""
+Ключи WireGuard (X25519) в процессе бота — вместо `wg genkey` + `wg pubkey`.
+
+Формат тот же, что у wireguard-tools: приватный ключ — 32 случайных байта
+с clamping (RFC 7748), публичный — X25519(priv, 9); оба в base64. Вывод
+байт-в-байт совпадает с `wg pubkey` (см. scripts/test_wg_keys.py).
+
+Если установлен `cryptography` — скалярное умножение через него (OpenSSL,
+constant-time); без него — чистый Python по RFC 7748 (~2 мс на ключ), так
+что выдача работает и без wireguard-tools, и без cryptography на хосте бота.
+"""
+
+import base64
+import os
+from typing import List, Tuple
+
+try:
+    from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+    from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+except ImportError:  # pragma: no cover — зависит от окружения
+    X25519PrivateKey = None
+
+_P = 2 ** 255 - 19
+_A24 = 121665
+_BASEPOINT_U = 9
+
+
+def _clamp(raw: bytes) -> bytes:
+    """Clamping секрета, как в `wg genkey` (curve25519_clamp_secret)."""
+    b = bytearray(raw)
+    b[0] &= 248
+    b[31] = (b[31] & 127) | 64
+    return bytes(b)
+
+
+def _x25519_base_py(scalar: bytes) -> bytes:
+    """X25519(scalar, 9): лестница Монтгомери из RFC 7748, раздел 5."""
+    k = int.from_bytes(_clamp(scalar), "little")
+    x1 = _BASEPOINT_U
+    x2, z2, x3, z3 = 1, 0, x1, 1
+    swap = 0
+    for t in range(254, -1, -1):
+        k_t = (k >> t) & 1
+        if swap ^ k_t:
+            x2, x3, z2, z3 = x3, x2, z3, z2
+        swap = k_t
+        a = x2 + z2
+        aa = a * a % _P
+        b = x2 - z2
+        bb = b * b % _P
+        e = aa - bb
+        c = x3 + z3
+        d = x3 - z3
+        da = d * a % _P
+        cb = c * b % _P
+        x3 = (da + cb) ** 2 % _P
+        z3 = x1 * (da - cb) ** 2 % _P
+        x2 = aa * bb % _P
+        z2 = e * (aa + _A24 * e) % _P
+    if swap:
+        x2, z2 = x3, z3
+    return (x2 * pow(z2, _P - 2, _P) % _P).to_bytes(32, "little")
+
+
+def _x25519_base(scalar: bytes) -> bytes:
+    if X25519PrivateKey is not None:
+        return X25519PrivateKey.from_private_bytes(scalar).public_key().public_bytes(
+            Encoding.Raw, PublicFormat.Raw
+        )
+    return _x25519_base_py(scalar)
+
+
+def public_key_from_private(private_key: str) -> str:
+    """Аналог `echo <priv> | wg pubkey`. ValueError — не 32 байта в base64."""
+    raw = base64.b64decode(private_key.strip(), validate=True)
+    if len(raw) != 32:
+        raise ValueError("Ключ WireGuard должен быть 32 байта в base64.")
+    return base64.b64encode(_x25519_base(raw)).decode("ascii")
+
+
+def generate_keypair() -> Tuple[str, str]:
+    """Аналог `wg genkey | tee priv | wg pubkey`. Возвращает (private_key, public_key)."""
+    raw = _clamp(os.urandom(32))
+    return base64.b64encode(raw).decode("ascii"), base64.b64encode(_x25519_base(raw)).decode("ascii")
+
+
+def generate_keypairs(count: int) -> List[Tuple[str, str]]:
+    """Пачка пар ключей для массовой выдачи (один вызов вместо 2×count процессов wg)."""
+    return [generate_keypair() for _ in range(count)]
@@ -4,10 +4,14 @@ import pathlib
 import re
 import shlex
 import subprocess
-from typing import Dict, Optional, Tuple
+from typing import Dict, List, Optional, Tuple
 
+from .awg_shards import AwgShard, get_awg_shards, resolve_shard, shard_env_prefix
 from .config import _parse_env_file
-from .storage import Peer, get_all_peers, upsert_peer, find_peer_by_telegram_id
+from .ssh_sessions import run_ssh
+from .storage import Peer, claim_warm_peer, find_peer_by_telegram_id, upsert_peer
+from .wg_errors import UnknownAwgShardError, WireGuardError  # noqa: F401 — реэкспорт
+from .wg_keys import generate_keypair
 
 
 def canonical_env_server_id(logical: str) -> str:
@@ -27,8 +31,10 @@ def canonical_env_server_id(logical: str) -> str:
 logger = logging.getLogger(__name__)
 
 
-class WireGuardError(RuntimeError):
-    """Ошибка при работе с WireGuard или генерации конфига."""
+class AwgNotProvisionedError(WireGuardError):
+    """Выдача AmneziaWG упала ДО вызова add-скрипта на eu1: на ноде ничего не
+    создано, повтор безопасен. После вызова скрипта (новая пара ключей и
+    runtime-peer на каждый запуск) ошибки — обычные WireGuardError."""
 
 
 def _load_env() -> dict:
@@ -111,77 +117,82 @@ def _get_server_config(server_id: str, env: dict) -> Dict[str, str]:
     return config
 
 
-def _allocate_ip(network_cidr: str, server_id: str) -> str:
-    """
-    Находит свободный IP в заданной сети с учётом уже занятых IP в peers.json для указанного сервера.
+def _node_server_ids(canonical: str) -> Tuple[str, ...]:
+    """server_id слотов peers, живущих на физической ноде canonical (сырые
+    значения колонки: rus1/rus2/legacy main → main; eu1/eu2 → eu1)."""
+    if canonical == "main":
+        return ("rus1", "rus2", "main", "")
+    if canonical == "eu1":
+        return ("eu1", "eu2")
+    return (canonical,)
 
-    На текущем этапе:
-    - предполагаем, что сервер использует первый адрес (например, 10.0.0.1);
-    - client1 (владелец) занимает второй адрес (например, 10.0.0.2) только на сервере "main";
-    - для новых пользователей начинаем с последующих адресов.
-    - каждая нода имеет свою подсеть, поэтому IP выделяются независимо для каждой ноды.
+
+def _lease_ip(
+    network_cidr: str,
+    canonical: str,
+    pool: str,
+    lo: int,
+    hi: int,
+    telegram_id: int,
+    exclude: Optional[Tuple[int, int]] = None,
+) -> Optional[str]:
+    """
+    Арендует адрес в подсети ноды через аллокатор в SQLite (db_ip_allocate):
+    одна транзакция, без чтения всех peers. lo/hi/exclude — смещения от адреса
+    сети. Одна подсеть на ноде = одно пространство: пулы (обычный, VPN+GPT,
+    Unified) не выдают адрес, занятый другим пулом.
     """
+    from .database import db_ip_allocate
+
     net = ipaddress.ip_network(network_cidr, strict=False)
+    return db_ip_allocate(
+        f"{canonical}:{net}", str(net), _node_server_ids(canonical),
+        pool, lo, hi, telegram_id, exclude=exclude,
+    )
 
-    # Занятые IP: все peers на той же физической WG-ноде (rus1+rus2 → main; eu1+eu2 для EU classic)
-    canonical = canonical_env_server_id(server_id)
-    used_ips = set()
-    for peer in get_all_peers():
-        if canonical_env_server_id(peer.server_id) != canonical:
-            continue
-        try:
-            iface = ipaddress.ip_interface(peer.wg_ip)
-            used_ips.add(iface.ip)
-        except ValueError:
-            continue
 
-    # Резервируем network, broadcast, первый адрес (сервер)
-    reserved = {
-        net.network_address,
-        net.broadcast_address,
-    }
+def _release_ip(telegram_id: int, wg_ip: str) -> None:
+    """Отдаёт аренду, если peer так и не был сохранён (ошибка после выдачи IP)."""
+    from .database import db_ip_release
+
     try:
-        reserved.add(net.network_address + 1)  # сервер, например 10.0.0.1
-        # client1 (владелец) резервируем только на main
-        if canonical == "main":
-            reserved.add(net.network_address + 2)  # первый peer (client1) на main
-    except Exception:  # noqa: BLE001
-        # На случай экзотической сети просто игнорируем дополнительные резервы.
-        pass
-
-    used_ips |= reserved
-
-    for host in net.hosts():
-        if host not in used_ips:
-            return f"{host}/{net.prefixlen}"
-
-    raise WireGuardError(
-        f"Не удалось подобрать свободный IP для нового peer в сети WireGuard на ноде {canonical}."
-    )
+        db_ip_release(telegram_id, wg_ip)
+    except Exception as exc:  # noqa: BLE001
+        logger.warning("Не удалось вернуть IP %s в пул: %s", wg_ip, exc)
 
 
-def _allocate_ip_amnezia_eu(network_cidr: str) -> str:
-    """Свободный IP в подсети AmneziaWG (eu1)."""
+def _allocate_ip(network_cidr: str, server_id: str, telegram_id: int) -> str:
+    """
+    Выделяет свободный IP в сети ноды (rus1+rus2 → main; eu1+eu2 для EU classic).
+
+    - сервер использует первый адрес (например, 10.0.0.1);
+    - client1 (владелец) занимает второй адрес (например, 10.0.0.2) только на ноде "main";
+    - network/broadcast не выдаются;
+    - каждая нода имеет свою подсеть, поэтому IP выделяются независимо для каждой ноды.
+    """
     net = ipaddress.ip_network(network_cidr, strict=False)
-    used_ips: set = set()
-    for peer in get_all_peers():
-        if peer.server_id != "eu1":
-            continue
-        try:
-            iface = ipaddress.ip_interface(peer.wg_ip)
-            used_ips.add(iface.ip)
-        except ValueError:
-            continue
-    reserved = {net.network_address, net.broadcast_address}
-    try:
-        reserved.add(net.network_address + 1)
-    except Exception:  # noqa: BLE001
-        pass
-    used_ips |= reserved
-    for host in net.hosts():
-        if host not in used_ips:
-            return f"{host}/{net.prefixlen}"
-    raise WireGuardError("Не удалось подобрать свободный IP для AmneziaWG (eu1).")
+    canonical = canonical_env_server_id(server_id)
+    lo = 3 if canonical == "main" else 2
+    host = _lease_ip(network_cidr, canonical, "hosts", lo, net.num_addresses - 2, telegram_id)
+    if host is None:
+        raise WireGuardError(
+            f"Не удалось подобрать свободный IP для нового peer в сети WireGuard на ноде {canonical}."
+        )
+    return f"{host}/{net.prefixlen}"
+
+
+def _allocate_awg_slot(telegram_id: int, env: dict) -> Tuple[AwgShard, str]:
+    """
+    Шард + IP для нового AmneziaWG peer: шарды заполняются по порядку
+    (AMNEZIAWG_EU1_SHARDS), следующий берётся, только когда в предыдущем нет
+    свободных адресов. У каждого шарда своя подсеть — своё пространство аллокатора.
+    """
+    for shard in get_awg_shards(env):
+        net = ipaddress.ip_network(shard.network_cidr, strict=False)
+        host = _lease_ip(shard.network_cidr, "eu1", "hosts", 2, net.num_addresses - 2, telegram_id)
+        if host is not None:
+            return shard, f"{host}/{net.prefixlen}"
+    raise WireGuardError("Не удалось подобрать свободный IP для AmneziaWG (eu1): все шарды заполнены.")
 
 
 def _allocate_ip_in_pool(
@@ -189,51 +200,42 @@ def _allocate_ip_in_pool(
     server_id: str,
     last_octet_start: int,
     last_octet_end: int,
+    telegram_id: int,
     profile_type_filter: str = "vpn_gpt",
     exclude_octet_start: Optional[int] = None,
     exclude_octet_end: Optional[int] = None,
 ) -> str:
     """
-    Выделяет свободный IP из пула last_octet_start..last_octet_end в последнем октете (для 10.1.0.0/24).
+    Выделяет свободный IP из пула last_octet_start..last_octet_end — смещений от
+    адреса сети (для /24 это последний октет 10.1.0.X; в подсетях шире /24 пул
+    может выходить за 255).
     Для VPN+GPT на eu1: пул 8–254 с исключением 20–50 (резерв под Unified).
-    Учитываются только peer'ы с server_id и profile_type=profile_type_filter.
+    profile_type_filter — имя пула; занятость общая для всей подсети ноды.
     """
     net = ipaddress.ip_network(network_cidr, strict=False)
-    if net.prefixlen != 24:
-        raise WireGuardError("Пул поддерживается только для подсети /24.")
-    used_ips = set()
-    for peer in get_all_peers():
-        if peer.server_id != server_id or getattr(peer, "profile_type", None) != profile_type_filter:
-            continue
-        try:
-            iface = ipaddress.ip_interface(peer.wg_ip)
-            used_ips.add(iface.ip.packed[-1])
-        except (ValueError, IndexError):
-            continue
-    for last in range(last_octet_start, min(last_octet_end + 1, 255)):
-        if exclude_octet_start is not None and exclude_octet_end is not None:
-            if exclude_octet_start <= last <= exclude_octet_end:
-                continue
-        if last in used_ips:
-            continue
-        parts = list(net.network_address.packed)
-        parts[-1] = last
-        host = ipaddress.IPv4Address(bytes(parts))
-        if host in (net.network_address, net.broadcast_address):
-            continue
-        return f"{host}/32"
-    raise WireGuardError(
-        f"Нет свободных IP в пуле (10.1.0.{last_octet_start}–10.1.0.{last_octet_end}) на сервере {server_id}."
+    if net.prefixlen > 24:
+        raise WireGuardError("Пул поддерживается только для подсетей /24 и шире.")
+    exclude = None
+    if exclude_octet_start is not None and exclude_octet_end is not None:
+        exclude = (exclude_octet_start, exclude_octet_end)
+    host = _lease_ip(
+        network_cidr, canonical_env_server_id(server_id), profile_type_filter,
+        max(last_octet_start, 1), min(last_octet_end, net.num_addresses - 2), telegram_id, exclude=exclude,
     )
+    if host is None:
+        raise WireGuardError(
+            f"Нет свободных IP в пуле ({net.network_address + last_octet_start}–"
+            f"{net.network_address + last_octet_end}) на сервере {server_id}."
+        )
+    return f"{host}/32"
 
 
-def _allocate_ip_unified_pool(network_cidr: str, server_id: str) -> str:
+def _allocate_ip_unified_pool(network_cidr: str, server_id: str, telegram_id: int) -> str:
     """
     Выделяет свободный IP из пула Unified на eu1: 10.1.0.20–10.1.0.50.
-    Учитываются только peer'ы с server_id и profile_type=unified.
     """
     return _allocate_ip_in_pool(
-        network_cidr, server_id, 20, 50, profile_type_filter="unified"
+        network_cidr, server_id, 20, 50, telegram_id, profile_type_filter="unified"
     )
 
 
@@ -248,18 +250,11 @@ def _run_add_ss_redirect(
     Выполняет на удалённом сервере (eu1) скрипт add-ss-redirect.sh <client_ip>.
     client_ip — IP без маски, например 10.1.0.8.
     """
-    ssh_target = f"{ssh_user}@{ssh_host}" if ssh_user else ssh_host
     remote_cmd = f"sudo {script_path} {client_ip}"
-    ssh_cmd = ["ssh"]
-    if ssh_key_path:
-        ssh_cmd.extend(["-i", ssh_key_path])
-    ssh_cmd.extend(["-o", "StrictHostKeyChecking=no", "-o", "BatchMode=yes"])
-    ssh_cmd.append(ssh_target)
-    ssh_cmd.append(remote_cmd)
     logger.info("Запуск add-ss-redirect на %s: %s", ssh_host, remote_cmd)
     try:
-        subprocess.run(ssh_cmd, check=True)
-    except subprocess.CalledProcessError as exc:
+        run_ssh(ssh_host, remote_cmd, user=ssh_user, key_path=ssh_key_path, check=True)
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as exc:
         logger.exception("Ошибка при вызове add-ss-redirect.sh на %s: %s", ssh_host, exc)
         raise WireGuardError(f"Не удалось добавить редирект Shadowsocks на сервере {ssh_host}. Обратись к владельцу.") from exc
 
@@ -270,7 +265,8 @@ def execute_server_command(
     timeout: int = 30,
 ) -> Tuple[str, str]:
     """
-    Выполняет команду на указанном сервере через SSH.
+    Выполняет команду на указанном сервере через SSH (постоянная сессия к
+    ноде, см. bot/ssh_sessions.py).
     
     Args:
         server_id: Идентификатор сервера ("main", "eu1" и т.п.)
@@ -293,28 +289,22 @@ def execute_server_command(
     if not ssh_host:
         raise WireGuardError(f"SSH_HOST не настроен для сервера {server_id}")
     
-    ssh_target = f"{ssh_user}@{ssh_host}" if ssh_user else ssh_host
-    ssh_cmd = ["ssh"]
-    if ssh_key_path:
-        ssh_cmd.extend(["-i", ssh_key_path])
-    ssh_cmd.extend(["-o", "StrictHostKeyChecking=no", "-o", "BatchMode=yes", "-o", f"ConnectTimeout={timeout}"])
-    ssh_cmd.append(ssh_target)
     # Используем bash для выполнения команды с правильным PATH
     # Передаём команду через stdin для избежания проблем с экранированием
     # Устанавливаем полный PATH для non-interactive shell
     full_command = f"export PATH=/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin:$PATH\n{command}\n"
-    ssh_cmd.append("bash")
     
     logger.info("Выполнение команды на %s (%s): %s", server_id, ssh_host, command)
     try:
-        result = subprocess.run(
-            ssh_cmd,
+        result = run_ssh(
+            ssh_host,
+            "bash",
+            user=ssh_user,
+            key_path=ssh_key_path,
             input=full_command,
-            capture_output=True,
-            text=True,
             timeout=timeout,
-            check=False,  # Не бросаем исключение при ненулевом коде возврата
-        )
+            connect_timeout=timeout,
+        )  # ненулевой код возврата — не исключение
         return result.stdout, result.stderr
     except subprocess.TimeoutExpired:
         raise WireGuardError(f"Команда на сервере {server_id} превысила таймаут ({timeout} сек)")
@@ -325,31 +315,12 @@ def execute_server_command(
 
 def _generate_keypair() -> Tuple[str, str]:
     """
-    Генерирует ключи для нового peer через утилиты wg/wg pubkey.
+    Генерирует ключи для нового peer в процессе (X25519, см. bot/wg_keys.py) —
+    без `wg genkey`/`wg pubkey` и без wireguard-tools на хосте бота.
 
     Возвращает (private_key, public_key).
     """
-    try:
-        private_key = subprocess.check_output(["wg", "genkey"], text=True).strip()
-        result = subprocess.run(
-            ["wg", "pubkey"],
-            input=f"{private_key}\n",
-            capture_output=True,
-            text=True,
-            check=True,
-        )
-        public_key = result.stdout.strip()
-        return private_key, public_key
-    except FileNotFoundError as exc:
-        logger.exception("Утилита wg не найдена на хосте бота: %s", exc)
-        raise WireGuardError(
-            "На сервере бота не установлен пакет wireguard-tools (нет команды wg). "
-            "Для выдачи конфигов России (rus1/rus2) бот локально вызывает wg genkey/wg pubkey. "
-            "Установи: apt install -y wireguard-tools и перезапусти vpn-bot."
-        ) from exc
-    except subprocess.CalledProcessError as exc:
-        logger.exception("Ошибка при генерации ключей WireGuard: %s", exc)
-        raise WireGuardError("Не удалось сгенерировать ключи WireGuard.") from exc
+    return generate_keypair()
 
 
 def _add_peer_to_wireguard(interface: str, public_key: str, wg_ip: str, ssh_host: Optional[str] = None, ssh_user: Optional[str] = None, ssh_key_path: Optional[str] = None) -> None:
@@ -371,23 +342,14 @@ def _add_peer_to_wireguard(interface: str, public_key: str, wg_ip: str, ssh_host
             # Удалённая нода через SSH
             # Формируем команду для выполнения на удалённом сервере
             remote_cmd = " ".join(cmd)
-            ssh_target = f"{ssh_user}@{ssh_host}" if ssh_user else ssh_host
-            
-            ssh_cmd = ["ssh"]
-            if ssh_key_path:
-                ssh_cmd.extend(["-i", ssh_key_path])
-            # Добавляем опции для неинтерактивного режима
-            ssh_cmd.extend(["-o", "StrictHostKeyChecking=no", "-o", "BatchMode=yes"])
-            ssh_cmd.append(ssh_target)
-            ssh_cmd.append(remote_cmd)
-            
             logger.info("Добавляю peer на удалённую ноду %s через SSH: %s", ssh_host, remote_cmd)
-            subprocess.run(ssh_cmd, check=True)
+            # wg set … allowed-ips идемпотентен — повтор после обрыва безопасен
+            run_ssh(ssh_host, remote_cmd, user=ssh_user, key_path=ssh_key_path, check=True, retry=True)
         else:
             # Локальная нода
             logger.info("Добавляю peer на локальную ноду: %s", " ".join(cmd))
             subprocess.run(cmd, check=True)
-    except subprocess.CalledProcessError as exc:
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as exc:
         logger.exception("Ошибка при добавлении peer в WireGuard: %s", exc)
         raise WireGuardError(f"Не удалось добавить peer в WireGuard на сервере {ssh_host or 'local'}.") from exc
 
@@ -408,22 +370,13 @@ def _remove_peer_from_wireguard(interface: str, public_key: str, ssh_host: Optio
         if ssh_host:
             # Удалённая нода через SSH
             remote_cmd = " ".join(cmd)
-            ssh_target = f"{ssh_user}@{ssh_host}" if ssh_user else ssh_host
-            
-            ssh_cmd = ["ssh"]
-            if ssh_key_path:
-                ssh_cmd.extend(["-i", ssh_key_path])
-            ssh_cmd.extend(["-o", "StrictHostKeyChecking=no", "-o", "BatchMode=yes"])
-            ssh_cmd.append(ssh_target)
-            ssh_cmd.append(remote_cmd)
-            
             logger.info("Удаляю peer с удалённой ноды %s через SSH: %s", ssh_host, remote_cmd)
-            subprocess.run(ssh_cmd, check=True)
+            run_ssh(ssh_host, remote_cmd, user=ssh_user, key_path=ssh_key_path, check=True, retry=True)
         else:
             # Локальная нода
             logger.info("Удаляю peer с локальной ноды: %s", " ".join(cmd))
             subprocess.run(cmd, check=True)
-    except subprocess.CalledProcessError as exc:
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as exc:
         logger.exception("Ошибка при удалении peer из WireGuard: %s", exc)
         # Не бросаем исключение, если peer уже не существует (это нормально при регенерации)
         # Просто логируем предупреждение
@@ -563,21 +516,41 @@ def create_peer_and_config_for_user(
     use_gpt_pool = server_id == "eu1" and profile_type == "vpn_gpt"
     use_unified_pool = server_id == "eu1" and profile_type == "unified"
     if use_unified_pool:
-        wg_ip = _allocate_ip_unified_pool(server_config["network_cidr"], server_id)
+        wg_ip = _allocate_ip_unified_pool(server_config["network_cidr"], server_id, telegram_id)
     elif use_gpt_pool:
         # Пул 8–254 с исключением 20–50 (резерв под Unified)
         wg_ip = _allocate_ip_in_pool(
-            server_config["network_cidr"], server_id, 8, 254,
+            server_config["network_cidr"], server_id, 8, 254, telegram_id,
             exclude_octet_start=20, exclude_octet_end=50,
         )
     else:
-        wg_ip = _allocate_ip(server_config["network_cidr"], server_id)
+        wg_ip = _allocate_ip(server_config["network_cidr"], server_id, telegram_id)
 
     logger.info(
         "Создаю peer для telegram_id=%s на ноде server_id=%s, profile_type=%s, wg_ip=%s",
         telegram_id, server_id, profile_type, wg_ip,
     )
+    try:
+        return _provision_wireguard_peer(
+            telegram_id, server_id, server_config, wg_ip,
+            use_gpt_pool, use_unified_pool, android_safe, platform,
+        )
+    except Exception:
+        _release_ip(telegram_id, wg_ip)
+        raise
+
 
+def _provision_wireguard_peer(
+    telegram_id: int,
+    server_id: str,
+    server_config: Dict[str, str],
+    wg_ip: str,
+    use_gpt_pool: bool,
+    use_unified_pool: bool,
+    android_safe: bool,
+    platform: str,
+) -> Tuple[Peer, str]:
+    """Ключи + wg set + (для VPN+GPT) редирект + сохранение peer для уже выданного wg_ip."""
     private_key, public_key = _generate_keypair()
 
     # Применяем изменения к WireGuard (локально или через SSH)
@@ -807,24 +780,24 @@ def is_amneziawg_eu1_configured(env: Optional[dict] = None) -> bool:
     return bool(env.get("AMNEZIAWG_EU1_ADD_CLIENT_SCRIPT", "").strip())
 
 
-def _remove_amneziawg_peer(public_key: str) -> None:
+def _remove_amneziawg_peer(public_key: str, shard: Optional[str] = None) -> None:
     """
     Удаляет peer AmneziaWG на eu1 по публичному ключу (для регенерации).
     Вызывает скрипт AMNEZIAWG_EU1_REMOVE_CLIENT_SCRIPT или команду awg/wg set <interface> peer <key> remove.
-    Передаёт AWG_INTERFACE на eu1, чтобы скрипт использовал нужный интерфейс (например wg0).
+    Передаёт AWG_DOCKER_CONTAINER/AWG_INTERFACE шарда peer'а (peers.shard; None — первый шард).
     """
     env = _load_env()
     remove_script = env.get("AMNEZIAWG_EU1_REMOVE_CLIENT_SCRIPT", "").strip()
-    interface = env.get("AMNEZIAWG_EU1_INTERFACE", "").strip() or "awg0"
+    awg = resolve_shard(shard, env)
 
     if remove_script:
-        remote_cmd = f"AWG_INTERFACE={shlex.quote(interface)} {remove_script} {shlex.quote(public_key)}"
+        remote_cmd = f"{shard_env_prefix(awg)}{remove_script} {shlex.quote(public_key)}"
     else:
-        remote_cmd = f"awg set {shlex.quote(interface)} peer {shlex.quote(public_key)} remove 2>/dev/null || true"
+        remote_cmd = f"awg set {shlex.quote(awg.interface)} peer {shlex.quote(public_key)} remove 2>/dev/null || true"
     execute_server_command("eu1", remote_cmd, timeout=15)
 
 
-def revoke_amneziawg_peer_soft(public_key: str) -> None:
+def revoke_amneziawg_peer_soft(public_key: str, shard: Optional[str] = None) -> None:
     """
     Soft-revoke: удаляет AmneziaWG peer только из runtime (`awg set peer remove`).
     Peer-credentials (pubkey, privkey, ip) НЕ затрагиваются в peers.json — для
@@ -833,50 +806,137 @@ def revoke_amneziawg_peer_soft(public_key: str) -> None:
     Вызывает существующий AMNEZIAWG_EU1_REMOVE_CLIENT_SCRIPT, который делает
     `awg set ... remove` + `/opt/amnezia-save-conf.sh` (persist).
 
-    Используется в `scripts/enforce_expired.py --apply`.
+    Одиночный отзыв; массовый (`scripts/enforce_expired.py --apply`) — через
+    AwgPeerBatch.
     """
-    _remove_amneziawg_peer(public_key)
+    _remove_amneziawg_peer(public_key, shard)
+
+
+_AWG_PSK_PATH = "/opt/amnezia/awg/wireguard_psk.key"
+_AWG_BATCH_CHUNK = 200      # peer-клауз в одном `awg set` (длина командной строки)
+_AWG_BATCH_MARK = "AWG_BATCH"
 
 
-def restore_amneziawg_peer_runtime(public_key: str, wg_ip: str) -> None:
+class AwgPeerBatch:
+    """
+    Пакет изменений runtime AmneziaWG на eu1: remove()/restore() только копят
+    операции, apply() применяет их ОДНИМ SSH-вызовом на ноду.
+
+    На каждый шард — один multi-peer `docker exec <c> awg set <iface>
+    peer A remove peer B preshared-key … allowed-ips …/32` (одна установка
+    конфигурации интерфейса: применяется целиком или никак; больше
+    _AWG_BATCH_CHUNK peer'ов — несколько вызовов) и один
+    `/opt/amnezia-save-conf.sh` в конце. `awg syncconf` не подходит: в runtime
+    есть peer'ы, которых бот не знает (legacy, владелец), syncconf их бы снёс.
+
+    Повторная операция над тем же ключом в шарде заменяет предыдущую.
+    Remove отсутствующего peer'а — не ошибка (как `awg set … remove`).
+
+    AMNEZIAWG_EU1_REMOVE_CLIENT_SCRIPT пакет сознательно НЕ вызывает: скрипт —
+    это `awg set … remove` + save-conf на каждый peer, т.е. ровно то, что пакет
+    схлопывает. Если remove-скрипт на ноде делает что-то сверх этого, массовый
+    отзыв (enforce_expired) это пропустит — такое нужно переносить в
+    /opt/amnezia-save-conf.sh. Одиночный отзыв (revoke_amneziawg_peer_soft)
+    по-прежнему идёт через скрипт.
+    """
+
+    def __init__(self, env: Optional[dict] = None) -> None:
+        self._env = env if env is not None else _load_env()
+        self._ops: Dict[Tuple[AwgShard, str], Optional[str]] = {}  # → allowed-ips; None — remove
+        self.failed_shards: List[str] = []
+
+    def __len__(self) -> int:
+        return len(self._ops)
+
+    def remove(self, public_key: str, shard: Optional[str] = None) -> None:
+        """Soft-revoke: убрать peer из runtime (credentials в БД не трогаются)."""
+        if not public_key:
+            raise WireGuardError("AwgPeerBatch.remove: пустой pubkey")
+        self._ops[(resolve_shard(shard, self._env), public_key)] = None
+
+    def restore(self, public_key: str, wg_ip: str, shard: Optional[str] = None) -> None:
+        """Вернуть peer в runtime с теми же pubkey/ip. PSK у AmneziaWG общий для
+        всех peers интерфейса (хранится в контейнере)."""
+        if not public_key or not wg_ip:
+            raise WireGuardError(f"AwgPeerBatch.restore: пустой pubkey или ip ({public_key!r}, {wg_ip!r})")
+        # IP может прийти как "10.8.1.5/24" или "10.8.1.5" — нормализуем в /32
+        allowed_ips = f"{wg_ip.split('/')[0].strip()}/32"
+        self._ops[(resolve_shard(shard, self._env), public_key)] = allowed_ips
+
+    def applied(self, shard: Optional[str] = None) -> bool:
+        """Применён ли шард peer'а после apply() (peers.shard; None — первый)."""
+        return resolve_shard(shard, self._env).name not in self.failed_shards
+
+    def _shard_script(self, awg: AwgShard, clauses: List[str]) -> str:
+        sets = [
+            f"docker exec {shlex.quote(awg.container)} awg set {shlex.quote(awg.interface)} "
+            + " ".join(clauses[i:i + _AWG_BATCH_CHUNK])
+            for i in range(0, len(clauses), _AWG_BATCH_CHUNK)
+        ]
+        # Persist через хостовый скрипт (вне контейнера) — для контейнера шарда.
+        save = f"{shard_env_prefix(awg)}/opt/amnezia-save-conf.sh"
+        ok = shlex.quote(f"{_AWG_BATCH_MARK}:OK:{awg.name}")
+        fail = shlex.quote(f"{_AWG_BATCH_MARK}:FAIL:{awg.name}")
+        return f"{{ {' && '.join(sets)} && {save}; }} && echo {ok} || echo {fail}"
+
+    def apply(self) -> List[str]:
+        """
+        Применяет накопленное и очищает пакет. Возвращает имена шардов, которые
+        НЕ применились (остальные применены и сохранены); они же — в
+        failed_shards. SSH недоступен — WireGuardError, не применено ничего.
+        """
+        self.failed_shards = []
+        if not self._ops:
+            return []
+        by_shard: Dict[AwgShard, List[str]] = {}
+        for (awg, public_key), allowed_ips in self._ops.items():
+            if allowed_ips is None:
+                clause = f"peer {shlex.quote(public_key)} remove"
+            else:
+                clause = (
+                    f"peer {shlex.quote(public_key)} "
+                    f"preshared-key {shlex.quote(_AWG_PSK_PATH)} "
+                    f"allowed-ips {shlex.quote(allowed_ips)}"
+                )
+            by_shard.setdefault(awg, []).append(clause)
+        n_ops = len(self._ops)
+        self._ops = {}
+
+        script = "\n".join(self._shard_script(awg, clauses) for awg, clauses in by_shard.items())
+        stdout, stderr = execute_server_command("eu1", script, timeout=20 + n_ops // 20)
+        done = {
+            line.split(":", 2)[2]
+            for line in (stdout or "").splitlines()
+            if line.startswith(f"{_AWG_BATCH_MARK}:OK:")
+        }
+        self.failed_shards = [awg.name for awg in by_shard if awg.name not in done]
+        if self.failed_shards:
+            logger.warning(
+                "AwgPeerBatch: не применено на шардах %s. stderr=%s",
+                ", ".join(self.failed_shards), (stderr or "")[:300],
+            )
+        logger.info(
+            "AwgPeerBatch: %d операций, шардов %d (ошибок %d)",
+            n_ops, len(by_shard), len(self.failed_shards),
+        )
+        return list(self.failed_shards)
+
+
+def restore_amneziawg_peer_runtime(public_key: str, wg_ip: str, shard: Optional[str] = None) -> None:
     """
     Возвращает AmneziaWG peer в runtime с теми же pubkey/ip (после soft-revoke).
-    Команда: `awg set awg0 peer <pk> preshared-key /opt/amnezia/awg/wireguard_psk.key allowed-ips <ip>/32`
-    PSK у AmneziaWG общий для всех peers интерфейса (хранится в контейнере).
-    После — `/opt/amnezia-save-conf.sh` для persist (иначе при рестарте контейнера peer пропадёт).
+    Пакет из одной операции (AwgPeerBatch): `awg set awg0 peer <pk>
+    preshared-key … allowed-ips <ip>/32` + `/opt/amnezia-save-conf.sh` для
+    persist (иначе при рестарте контейнера peer пропадёт).
 
     Используется в `extend_subscription_and_restore` (hook после оплаты).
 
     Raises WireGuardError при сбое.
     """
-    if not public_key or not wg_ip:
-        raise WireGuardError(f"restore_amneziawg_peer_runtime: пустой pubkey или ip ({public_key!r}, {wg_ip!r})")
-    env = _load_env()
-    interface = env.get("AMNEZIAWG_EU1_INTERFACE", "").strip() or "awg0"
-    container = env.get("AMNEZIAWG_EU1_CONTAINER", "").strip() or "amnezia-awg2"
-    psk_path = "/opt/amnezia/awg/wireguard_psk.key"
-    # IP может прийти как "10.8.1.5/24" или "10.8.1.5" — нормализуем в /32
-    ip_clean = wg_ip.split("/")[0].strip()
-    allowed_ips = f"{ip_clean}/32"
-
-    # 1. Вернуть peer в runtime (awg внутри контейнера).
-    awg_cmd = (
-        f"docker exec {shlex.quote(container)} awg set {shlex.quote(interface)} "
-        f"peer {shlex.quote(public_key)} "
-        f"preshared-key {shlex.quote(psk_path)} "
-        f"allowed-ips {shlex.quote(allowed_ips)}"
-    )
-    # 2. Persist через хостовый скрипт (вне контейнера).
-    save_cmd = "/opt/amnezia-save-conf.sh"
-    combined = f"{awg_cmd} && {save_cmd}"
-
-    stdout, stderr = execute_server_command("eu1", combined, timeout=20)
-    if stderr and "error" in stderr.lower():
-        # save-script может писать info в stderr, поэтому проверяем явно на "error"
-        logger.warning(
-            "restore_amneziawg_peer_runtime: возможна ошибка. pubkey=%s ip=%s stderr=%s",
-            public_key[:20], wg_ip, stderr[:300],
-        )
+    batch = AwgPeerBatch()
+    batch.restore(public_key, wg_ip, shard)
+    if batch.apply():
+        raise WireGuardError(f"Не удалось вернуть AmneziaWG peer {public_key[:20]}... в runtime")
     logger.info(
         "Восстановлен AmneziaWG peer в runtime: pubkey=%s..., ip=%s",
         public_key[:20], wg_ip,
@@ -892,32 +952,51 @@ def restore_user_revoked_peers(telegram_id: int) -> list:
     Безопасно вызывать после любого db_extend_subscription — даже когда юзер
     никогда не был отозван.
 
+    Все peer'ы юзера возвращаются одним пакетом (AwgPeerBatch: один SSH,
+    save-conf раз на шард).
+
     Возвращает список Peer'ов которые были успешно восстановлены.
     Используется как hook после оплаты — старый .conf на устройстве юзера
     снова работает без необходимости заново импортировать.
     """
-    from .storage import get_all_peers, upsert_peer
+    from .storage import get_peers_by_telegram_id, upsert_peer
+
+    revoked = [p for p in get_peers_by_telegram_id(telegram_id, server_id="eu1") if not p.active]
+    if not revoked:
+        return []
+    batch = AwgPeerBatch()
+    queued = []
+    for peer in revoked:
+        try:
+            batch.restore(peer.public_key, peer.wg_ip, peer.shard)
+            queued.append(peer)
+        except Exception as e:
+            logger.exception(
+                "restore_user_revoked_peers: failed for tid=%s pk=%s: %s",
+                telegram_id, (peer.public_key or "")[:20], e,
+            )
+    try:
+        batch.apply()
+    except Exception as e:
+        logger.exception("restore_user_revoked_peers: failed for tid=%s: %s", telegram_id, e)
+        return []
 
     restored = []
-    for peer in get_all_peers():
-        if peer.telegram_id != telegram_id:
-            continue
-        if peer.server_id != "eu1":
+    for peer in queued:
+        if not batch.applied(peer.shard):
             continue
-        if peer.active:
-            continue  # уже активен — нечего восстанавливать
-        # Этот peer был soft-revoked — возвращаем в runtime
+        new_peer = Peer(
+            telegram_id=peer.telegram_id,
+            wg_ip=peer.wg_ip,
+            public_key=peer.public_key,
+            server_id=peer.server_id,
+            active=True,
+            profile_type=peer.profile_type,
+            platform=peer.platform,
+            device_id=peer.device_id,
+            shard=peer.shard,
+        )
         try:
-            restore_amneziawg_peer_runtime(peer.public_key, peer.wg_ip)
-            new_peer = Peer(
-                telegram_id=peer.telegram_id,
-                wg_ip=peer.wg_ip,
-                public_key=peer.public_key,
-                server_id=peer.server_id,
-                active=True,
-                profile_type=peer.profile_type,
-                platform=peer.platform,
-            )
             upsert_peer(new_peer)
             restored.append(new_peer)
         except Exception as e:
@@ -931,7 +1010,6 @@ def restore_user_revoked_peers(telegram_id: int) -> list:
             len(restored), telegram_id,
         )
     return restored
-    logger.info("Удалён AmneziaWG peer с eu1 (public_key: %s...)", public_key[:20] if len(public_key) > 20 else public_key)
 
 
 def create_amneziawg_peer_and_config_for_user(
@@ -941,32 +1019,82 @@ def create_amneziawg_peer_and_config_for_user(
     server_id: str = "eu1",
     platform: str = "pc",
     device_id: Optional[str] = None,
+    shard: Optional[str] = None,
 ) -> Tuple[Peer, str]:
     """Создаёт peer AmneziaWG на eu1 через скрипт по SSH.
     device_id (Фаза 2 B): явный слот именованного устройства. Если None —
-    storage-shim переиспользует/создаёт устройство по os=platform (legacy-путь)."""
-    if server_id != "eu1":
-        raise WireGuardError("AmneziaWG выдаётся только для server_id eu1.")
-    env = _load_env()
-    script_path = env.get("AMNEZIAWG_EU1_ADD_CLIENT_SCRIPT", "").strip()
-    if not script_path:
-        raise WireGuardError("AMNEZIAWG_EU1_ADD_CLIENT_SCRIPT не задан в env_vars.txt.")
+    storage-shim переиспользует/создаёт устройство по os=platform (legacy-путь).
+    shard — шард reuse_ip (регенерация); новый IP берётся в первом шарде со
+    свободными адресами (см. bot/awg_shards.py)."""
+    try:
+        if server_id != "eu1":
+            raise WireGuardError("AmneziaWG выдаётся только для server_id eu1.")
+        env = _load_env()
+        script_path = env.get("AMNEZIAWG_EU1_ADD_CLIENT_SCRIPT", "").strip()
+        if not script_path:
+            raise WireGuardError("AMNEZIAWG_EU1_ADD_CLIENT_SCRIPT не задан в env_vars.txt.")
+
+        server_config = _get_server_config(server_id, env)
+        ssh_host = server_config.get("ssh_host")
+        if not ssh_host:
+            raise WireGuardError("SSH_HOST не настроен для eu1 (WG_EU1_SSH_HOST или WG_EU1_ENDPOINT_HOST).")
+
+        if reuse_ip:
+            awg = resolve_shard(shard, env)
+            wg_ip = reuse_ip if "/" in reuse_ip else f"{reuse_ip}/32"
+        else:
+            # Новый слот — сначала тёплый пул (bot/awg_warm_pool.py): без SSH.
+            warm = _claim_warm_amneziawg_peer(telegram_id, server_config, android_safe, platform, device_id)
+            if warm is not None:
+                return warm
+            awg, wg_ip = _allocate_awg_slot(telegram_id, env)
+    except AwgNotProvisionedError:
+        raise
+    except Exception as exc:
+        raise AwgNotProvisionedError(str(exc)) from exc
+    # Дальше add-скрипт: при ошибке runtime-peer на eu1 мог остаться с этим IP,
+    # поэтому аренда не отдаётся (забытую подберёт аллокатор, см. _IP_LEASE_GRACE_MIN).
+    return _provision_amneziawg_peer(
+        telegram_id, env, server_id, server_config, wg_ip, android_safe, platform, device_id, awg,
+    )
 
-    network_cidr = env.get("AMNEZIAWG_EU1_NETWORK_CIDR", "").strip() or "10.1.0.0/24"
-    server_config = _get_server_config(server_id, env)
-    ssh_host = server_config.get("ssh_host")
-    if not ssh_host:
-        raise WireGuardError("SSH_HOST не настроен для eu1 (WG_EU1_SSH_HOST или WG_EU1_ENDPOINT_HOST).")
 
-    if reuse_ip:
-        wg_ip = reuse_ip if "/" in reuse_ip else f"{reuse_ip}/32"
-    else:
-        wg_ip = _allocate_ip_amnezia_eu(network_cidr)
+def _claim_warm_amneziawg_peer(
+    telegram_id: int,
+    server_config: Dict[str, str],
+    android_safe: bool,
+    platform: str,
+    device_id: Optional[str],
+) -> Optional[Tuple[Peer, str]]:
+    """Готовый peer из тёплого пула eu1 (или None — пул пуст)."""
+    from .awg_warm_pool import note_warm_pool_claim
+
+    claimed = claim_warm_peer(
+        Peer(telegram_id=telegram_id, wg_ip="", public_key="", server_id="eu1", device_id=device_id, os=platform),
+        "eu1",
+    )
+    note_warm_pool_claim(claimed is not None)
+    if claimed is None:
+        return None
+    peer, client_config = claimed
+    if android_safe:
+        client_config = _make_amneziawg_config_android_safe(
+            client_config, endpoint_ip=server_config.get("endpoint_host") if server_config else None,
+        )
+    logger.info(
+        "Выдан AmneziaWG peer из тёплого пула: telegram_id=%s, wg_ip=%s, os=%s, device_id=%s, shard=%s",
+        telegram_id, peer.wg_ip, peer.os, (peer.device_id or "")[:8], peer.shard,
+    )
+    return peer, client_config
+
+
+def _run_amneziawg_add_script(env: dict, awg: AwgShard, wg_ip: str) -> Tuple[str, str]:
+    """add-client скрипт на eu1 для wg_ip в шарде awg → (public_key, client_config)."""
+    script_path = env.get("AMNEZIAWG_EU1_ADD_CLIENT_SCRIPT", "").strip()
     client_ip = wg_ip.split("/")[0].strip()
 
-    # Интерфейс на eu1 (wg0 или awg0) — передаём в скрипт, иначе скрипт по умолчанию использует awg0
-    interface = env.get("AMNEZIAWG_EU1_INTERFACE", "").strip() or "awg0"
-    remote_cmd = f"AWG_INTERFACE={shlex.quote(interface)} {script_path} {shlex.quote(client_ip)}"
+    # Контейнер/интерфейс шарда — передаём в скрипт, иначе скрипт по умолчанию использует amnezia-awg2/awg0
+    remote_cmd = f"{shard_env_prefix(awg)}{script_path} {shlex.quote(client_ip)}"
     stdout, stderr = execute_server_command("eu1", remote_cmd, timeout=60)
 
     # Ошибка SSH (ключ не найден или доступ запрещён) — подсказка по настройке на хосте, где запущен бот
@@ -994,7 +1122,8 @@ def create_amneziawg_peer_and_config_for_user(
         logger.error("Скрипт AmneziaWG вернул ошибку. first_line=%s stderr=%s", first_line, stderr)
         raise WireGuardError(
             "Скрипт AmneziaWG на eu1 вернул ошибку. На eu1 должен быть интерфейс "
-            f"({interface}), в env — AMNEZIAWG_EU1_INTERFACE. Детали: {err_detail}"
+            f"({awg.interface} в контейнере {awg.container}, шард {awg.name}), в env — "
+            f"AMNEZIAWG_EU1_SHARDS / AMNEZIAWG_EU1_INTERFACE. Детали: {err_detail}"
         )
 
     public_key = first_line.split("=", 1)[1].strip()
@@ -1002,6 +1131,22 @@ def create_amneziawg_peer_and_config_for_user(
 
     if not client_config:
         raise WireGuardError("Скрипт AmneziaWG не вернул содержимое конфига.")
+    return public_key, client_config
+
+
+def _provision_amneziawg_peer(
+    telegram_id: int,
+    env: dict,
+    server_id: str,
+    server_config: Dict[str, str],
+    wg_ip: str,
+    android_safe: bool,
+    platform: str,
+    device_id: Optional[str],
+    awg: AwgShard,
+) -> Tuple[Peer, str]:
+    """add-client скрипт на eu1 + сохранение peer для уже выданного wg_ip."""
+    public_key, client_config = _run_amneziawg_add_script(env, awg, wg_ip)
 
     if android_safe:
         endpoint_ip = server_config.get("endpoint_host") if server_config else None
@@ -1016,11 +1161,12 @@ def create_amneziawg_peer_and_config_for_user(
         profile_type=None,
         device_id=device_id,
         os=platform,
+        shard=awg.name,
     )
     upsert_peer(peer)
     logger.info(
-        "Создан AmneziaWG peer для telegram_id=%s на %s, wg_ip=%s, os=%s, device_id=%s",
-        telegram_id, server_id, wg_ip, platform, (device_id or "")[:8],
+        "Создан AmneziaWG peer для telegram_id=%s на %s, wg_ip=%s, os=%s, device_id=%s, shard=%s",
+        telegram_id, server_id, wg_ip, platform, (device_id or "")[:8], awg.name,
     )
     return peer, client_config
 
@@ -1035,18 +1181,18 @@ def regenerate_amneziawg_peer_and_config_for_user(
     """Регенерирует AmneziaWG peer для eu1 (тот же IP, новые ключи).
     device_id (Фаза 2 B): регенерит КОНКРЕТНОЕ устройство; если None — по os=platform."""
     if server_id != "eu1":
-        raise WireGuardError("Регенерация AmneziaWG только для eu1.")
+        raise AwgNotProvisionedError("Регенерация AmneziaWG только для eu1.")
     existing_peer = find_peer_by_telegram_id(
         telegram_id, server_id=server_id, platform=platform, device_id=device_id
     )
     if not existing_peer or not existing_peer.active:
-        raise WireGuardError(
+        raise AwgNotProvisionedError(
             f"Не найден активный peer для Европы ({server_id}, платформа: {platform}). "
             "Сначала используй /get_config для этого слота."
         )
 
     try:
-        _remove_amneziawg_peer(existing_peer.public_key)
+        _remove_amneziawg_peer(existing_peer.public_key, existing_peer.shard)
     except WireGuardError as exc:
         logger.warning("Не удалось удалить старый AmneziaWG peer (продолжаем): %s", exc)
 
@@ -1057,6 +1203,7 @@ def regenerate_amneziawg_peer_and_config_for_user(
         server_id=server_id,
         platform=existing_peer.os,
         device_id=existing_peer.device_id,
+        shard=existing_peer.shard,
     )
     logger.info(
         "Регенерирован AmneziaWG peer для telegram_id=%s на %s, platform=%s",
@@ -1071,7 +1218,7 @@ def delete_amneziawg_device(telegram_id: int, device_id: str) -> None:
     existing_peer = find_peer_by_telegram_id(telegram_id, server_id="eu1", device_id=device_id)
     if existing_peer and existing_peer.public_key:
         try:
-            _remove_amneziawg_peer(existing_peer.public_key)
+            _remove_amneziawg_peer(existing_peer.public_key, existing_peer.shard)
         except WireGuardError as exc:
             logger.warning("delete device %s: AWG peer не убран (продолжаем): %s", device_id[:8], exc)
     from .database import db_delete_device
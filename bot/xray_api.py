@@ -0,0 +1,162 @@
+"""
+Живое управление юзерами Xray через HandlerService (API 127.0.0.1:10085).
+
+Раньше любое изменение clients[] = правка config.json + `systemctl restart
+xray` (~5 с обрыва ВСЕМ подключённым на ноде ради одного нового UUID). Теперь
+sync-скрипты (sync_xray_users / sync_eu1_vless) считают разницу clients[] и
+применяют её вживую:
+  - `xray api rmu -tag=<inbound> <email>…` — снять юзеров (по email);
+  - `xray api adu <file.json>` — добавить (AlterInbound AddUserOperation);
+существующие соединения не рвутся. config.json после этого пишется как
+checkpoint — validate + атомарная замена БЕЗ рестарта (Xray читает файл
+только при старте; файл нужен, чтобы рестарт/ребут не потерял юзеров).
+
+Требует HandlerService в api.services (scripts/patch_xray_stats.py — раньше
+там был только StatsService, поэтому `adu/rmu` молча ничего не делали).
+Живой путь невозможен (клиент без email, смена policy) или API ответил не
+тем числом юзеров — XrayApiError, вызывающий откатывается на config+restart.
+
+Команды выполняет run(cmd) → CompletedProcess: локально (eu1) или по SSH.
+"""
+
+import base64
+import json
+import logging
+import re
+import shlex
+import subprocess
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+XRAY_API_ADDR = "127.0.0.1:10085"
+
+Runner = Callable[[str], subprocess.CompletedProcess]
+
+
+class XrayApiError(RuntimeError):
+    pass
+
+
+def local_runner(timeout: int = 30) -> Runner:
+    """Команды на этом хосте (eu1: скрипты гоняются на самой ноде)."""
+    def run(cmd: str) -> subprocess.CompletedProcess:
+        return subprocess.run(["bash", "-c", cmd], capture_output=True, text=True, timeout=timeout)
+    return run
+
+
+def ssh_runner(ssh_args: List[str], timeout: int = 30) -> Runner:
+    """Команды по SSH (ssh_args — как SERVERS[...]["ssh"] в sync_xray_users)."""
+    def run(cmd: str) -> subprocess.CompletedProcess:
+        return subprocess.run(ssh_args + [cmd], capture_output=True, text=True, timeout=timeout)
+    return run
+
+
+def _client_key(client: Dict) -> str:
+    return json.dumps(client, sort_keys=True, ensure_ascii=False)
+
+
+def plan_client_changes(old: List[Dict], new: List[Dict]) -> Tuple[List[Dict], List[str]]:
+    """
+    Разница clients[] одного inbound для живого применения: (добавить, снять
+    email'ы). Изменённый клиент (тот же email, другой id/flow) — снять и
+    добавить. XrayApiError, если разница задевает клиента без email (rmu
+    снимает только по email) или email'ы не уникальны.
+    """
+    old_emails = [c["email"] for c in old if c.get("email")]
+    if len(set(old_emails)) != len(old_emails):
+        raise XrayApiError("email'ы в текущем clients[] не уникальны")
+    new_keys = {_client_key(c) for c in new}
+    old_keys = {_client_key(c) for c in old}
+
+    removes: List[str] = []
+    for c in old:
+        if _client_key(c) in new_keys:
+            continue
+        if not c.get("email"):
+            raise XrayApiError(f"клиент без email ({str(c.get('id'))[:8]}…) снимается только рестартом")
+        removes.append(c["email"])
+    adds: List[Dict] = []
+    seen: set = set()
+    for c in new:
+        if _client_key(c) in old_keys:
+            continue
+        email = c.get("email")
+        if not email:
+            raise XrayApiError(f"клиент без email ({str(c.get('id'))[:8]}…) добавляется только рестартом")
+        if email in seen:
+            raise XrayApiError(f"email {email} дважды в новом clients[]")
+        seen.add(email)
+        adds.append(c)
+    return adds, removes
+
+
+def _count(pattern: str, output: str) -> Optional[int]:
+    m = re.search(pattern, output or "")
+    return int(m.group(1)) if m else None
+
+
+def xray_remove_users(run: Runner, tag: str, emails: List[str]) -> int:
+    """`xray api rmu`: снимает юзеров inbound'а по email. Соединения остальных не трогаются."""
+    if not emails:
+        return 0
+    cmd = (f"xray api rmu --server={XRAY_API_ADDR} -tag={shlex.quote(tag)} "
+           + " ".join(shlex.quote(e) for e in emails))
+    r = run(cmd)
+    removed = _count(r"Removed\s+(\d+)\s+user", r.stdout + r.stderr)
+    if r.returncode != 0 or removed != len(emails):
+        raise XrayApiError(
+            f"rmu {tag}: снято {removed} из {len(emails)} (rc={r.returncode}): {(r.stderr or r.stdout).strip()[:200]}"
+        )
+    return removed
+
+
+def xray_add_users(run: Runner, tag: str, protocol: str, clients: List[Dict]) -> int:
+    """`xray api adu`: добавляет clients в inbound tag (файл-описание inbound'а
+    передаётся через base64 во временный файл ноды)."""
+    if not clients:
+        return 0
+    payload = {"inbounds": [{"tag": tag, "protocol": protocol,
+                             "settings": {"clients": clients, "decryption": "none"}}]}
+    b64 = base64.b64encode(json.dumps(payload, ensure_ascii=False).encode("utf-8")).decode("ascii")
+    cmd = (
+        "f=$(mktemp /tmp/xray-adu.XXXXXX) && "
+        f"echo {b64} | base64 -d > \"$f\" && "
+        f"xray api adu --server={XRAY_API_ADDR} \"$f\"; rc=$?; rm -f \"$f\"; exit $rc"
+    )
+    r = run(cmd)
+    added = _count(r"Added\s+(\d+)\s+user", r.stdout + r.stderr)
+    if r.returncode != 0 or added != len(clients):
+        raise XrayApiError(
+            f"adu {tag}: добавлено {added} из {len(clients)} (rc={r.returncode}): {(r.stderr or r.stdout).strip()[:200]}"
+        )
+    return added
+
+
+def apply_client_changes(run: Runner, tag: str, protocol: str, adds: List[Dict], removes: List[str]) -> None:
+    """Сначала снять (в т.ч. изменённых), потом добавить — email в inbound уникален."""
+    xray_remove_users(run, tag, removes)
+    xray_add_users(run, tag, protocol, adds)
+    if adds or removes:
+        logger.info("xray %s: вживую +%d −%d", tag, len(adds), len(removes))
+
+
+def write_config_checkpoint(run: Runner, config_path: str, config_text: str, sudo: str = "") -> None:
+    """
+    config.json = текущее runtime-состояние, БЕЗ рестарта: backup → tmp →
+    `xray run -test` → атомарный mv. XrayApiError, если validate не прошёл
+    (старый файл остаётся; runtime уже применён — следующий sync повторит).
+    """
+    b64 = base64.b64encode(config_text.encode("utf-8")).decode("ascii")
+    path = shlex.quote(config_path)
+    cmd = (
+        "t=$(mktemp /tmp/xray-checkpoint.XXXXXX) && "
+        f"echo {b64} | base64 -d > \"$t\" && "
+        f"chmod --reference={path} \"$t\" && "
+        f"{sudo}xray run -test -format=json -c \"$t\" >/dev/null && "
+        f"{sudo}cp {path} {path}.bak.checkpoint && "
+        f"{sudo}mv \"$t\" {path}"
+    )
+    r = run(cmd)
+    if r.returncode != 0:
+        raise XrayApiError(f"checkpoint {config_path}: rc={r.returncode}: {r.stderr.strip()[:300]}")
@@ -0,0 +1,260 @@
+"""
+Отложенный sync Xray по нодам: один прогон на пачку новых per-user UUID.
+
+Раньше ЛК на каждый свежесозданный UUID (_personalize_vless_url) делал Popen
+полного sync_xray_users.py / sync_eu1_vless.py: волна из 50 запросов /sub —
+50 параллельных sync'ов, гоняющихся за одним config.json.
+
+Теперь request_xray_sync(server_id) только отмечает ноду грязной
+(xray_sync_state в SQLite, db_xray_sync_request) и будит воркер ноды:
+  - debounce: прогон стартует через _DEBOUNCE_S после первого запроса;
+    всё, что пришло за окно и во время прогона, покрывается одним прогоном;
+  - на ноду один прогон одновременно — один поток на ноду в процессе и
+    flock на data/xray_sync.<нода>.lock между процессами (бот, воркеры ЛК);
+    дождавшийся лока перечитывает состояние: ноду уже синхронизировали —
+    запуск не нужен;
+  - флаг в БД переживает падение: sweeper раз в _RECHECK_INTERVAL_S (и сразу
+    при старте) подхватывает грязные ноды; ошибка прогона — повтор через
+    _RETRY_DELAYS_S, флаг остаётся.
+Метрики: сколько запросов слилось в чужой прогон (coalesced), время прогона
+и задержка «первый запрос → нода синхронизирована» (lag).
+"""
+
+import fcntl
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, Optional
+
+from . import database
+from .database import (
+    db_xray_sync_done,
+    db_xray_sync_dirty,
+    db_xray_sync_get,
+    db_xray_sync_request,
+    db_xray_sync_states,
+)
+
+logger = logging.getLogger(__name__)
+
+_DEBOUNCE_S = 3.0
+_RETRY_DELAYS_S = (10, 30, 120)
+_RECHECK_INTERVAL_S = 60
+_SYNC_TIMEOUT_S = 180
+
+_SCRIPTS_DIR = Path(__file__).resolve().parent.parent / "scripts"
+
+Runner = Callable[[str], None]
+
+_cond = threading.Condition()
+_workers: Dict[str, threading.Thread] = {}
+_sweeper: Optional[threading.Thread] = None
+_due: Dict[str, float] = {}          # нода → monotonic-время прогона
+_stopping = False
+_stats = {
+    "requested": 0, "coalesced": 0, "runs": 0, "succeeded": 0, "failed": 0, "skipped": 0,
+    "total_run_ms": 0.0, "max_run_ms": 0.0, "total_lag_ms": 0.0, "max_lag_ms": 0.0,
+}
+
+
+def _reset_after_fork() -> None:
+    global _cond, _workers, _sweeper, _due, _stopping
+    _cond = threading.Condition()
+    _workers = {}
+    _sweeper = None
+    _due = {}
+    _stopping = False
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def sync_command(server_id: str) -> list:
+    """eu1 — отдельный скрипт (локальный, 3 inbound, grace); main/yc — sync_xray_users."""
+    if server_id == "eu1":
+        return [sys.executable, str(_SCRIPTS_DIR / "sync_eu1_vless.py")]
+    return [sys.executable, str(_SCRIPTS_DIR / "sync_xray_users.py"), "--server", server_id]
+
+
+def _run_sync_script(server_id: str) -> None:
+    r = subprocess.run(sync_command(server_id), capture_output=True, text=True, timeout=_SYNC_TIMEOUT_S)
+    if r.returncode != 0:
+        tail = (r.stderr.strip() or r.stdout.strip())[-300:]
+        raise RuntimeError(f"rc={r.returncode}: {tail}")
+
+
+_runner: Runner = _run_sync_script
+
+
+def set_sync_runner(runner: Runner) -> None:
+    """runner(server_id) выполняет sync ноды; исключение = неудачный прогон."""
+    global _runner
+    _runner = runner
+
+
+def request_xray_sync(server_id: str) -> None:
+    """Нода нуждается в sync (новый per-user UUID). Не блокирует: флаг в БД +
+    пробуждение воркера; планировщик не запущен — запускается здесь."""
+    db_xray_sync_request(server_id)
+    _stats["requested"] += 1
+    if not xray_sync_running():
+        xray_sync_start()
+    _schedule(server_id, _DEBOUNCE_S)
+
+
+def _schedule(server_id: str, delay: float) -> None:
+    """Прогон ноды через delay; уже назначенный раньше — не сдвигается
+    (окно debounce считается от первого запроса)."""
+    with _cond:
+        if _stopping or _sweeper is None:
+            return
+        due = time.monotonic() + delay
+        if server_id not in _due or _due[server_id] > due:
+            _due[server_id] = due
+        if server_id not in _workers:
+            t = threading.Thread(target=_worker, args=(server_id,), name=f"xray-sync-{server_id}", daemon=True)
+            _workers[server_id] = t
+            t.start()
+        _cond.notify_all()
+
+
+def _lock_path(server_id: str) -> Path:
+    return Path(database.DATA_DIR) / f"xray_sync.{server_id}.lock"
+
+
+def _sync_once(server_id: str) -> bool:
+    """Один прогон под межпроцессным локом ноды. False — ошибка (флаг остаётся)."""
+    path = _lock_path(server_id)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "a") as lock_fp:
+        fcntl.flock(lock_fp.fileno(), fcntl.LOCK_EX)
+        try:
+            state = db_xray_sync_get(server_id)
+            if not state or state["requested_gen"] <= state["synced_gen"]:
+                _stats["skipped"] += 1   # пока ждали лок, ноду синхронизировал другой процесс
+                return True
+            gen = state["requested_gen"]
+            started = time.time()
+            t0 = time.perf_counter()
+            _stats["runs"] += 1
+            try:
+                _runner(server_id)
+            except Exception as exc:  # noqa: BLE001 — любая ошибка = повтор позже
+                db_xray_sync_done(server_id, gen, started, error=f"{type(exc).__name__}: {exc}")
+                _stats["failed"] += 1
+                logger.warning("xray sync %s не удался: %s", server_id, exc)
+                return False
+            db_xray_sync_done(server_id, gen, started)
+        finally:
+            fcntl.flock(lock_fp.fileno(), fcntl.LOCK_UN)
+
+    run_ms = (time.perf_counter() - t0) * 1000
+    lag_ms = max(0.0, (time.time() - (state["dirty_since"] or started)) * 1000)
+    covered = gen - state["synced_gen"]
+    _stats["succeeded"] += 1
+    _stats["coalesced"] += max(0, covered - 1)
+    _stats["total_run_ms"] += run_ms
+    _stats["max_run_ms"] = max(_stats["max_run_ms"], run_ms)
+    _stats["total_lag_ms"] += lag_ms
+    _stats["max_lag_ms"] = max(_stats["max_lag_ms"], lag_ms)
+    logger.info("xray sync %s: %d запрос(ов) одним прогоном, %.0f мс (lag %.0f мс)",
+                server_id, covered, run_ms, lag_ms)
+    return True
+
+
+def _worker(server_id: str) -> None:
+    while True:
+        with _cond:
+            while not _stopping:
+                due = _due.get(server_id)
+                now = time.monotonic()
+                if due is not None and due <= now:
+                    break
+                _cond.wait(None if due is None else due - now)
+            if _stopping:
+                return
+            del _due[server_id]
+        try:
+            ok = _sync_once(server_id)
+        except Exception:  # noqa: BLE001
+            logger.exception("xray sync %s: прогон упал", server_id)
+            ok = False
+        if not ok:
+            state = db_xray_sync_get(server_id) or {}
+            failures = max(1, int(state.get("failures") or 1))
+            _schedule(server_id, _RETRY_DELAYS_S[min(failures, len(_RETRY_DELAYS_S)) - 1])
+
+
+def _sweep() -> None:
+    while True:
+        try:
+            for state in db_xray_sync_dirty():
+                with _cond:
+                    scheduled = state["server_id"] in _due
+                if not scheduled:
+                    _schedule(state["server_id"], 0 if not state["failures"] else _RETRY_DELAYS_S[0])
+        except Exception:  # noqa: BLE001
+            logger.exception("xray sync: проверка грязных нод упала")
+        with _cond:
+            if not _stopping:
+                _cond.wait(_RECHECK_INTERVAL_S)
+            if _stopping:
+                return
+
+
+def xray_sync_running() -> bool:
+    with _cond:
+        return _sweeper is not None
+
+
+def xray_sync_start() -> None:
+    """Запускает планировщик в этом процессе (идемпотентно); грязные ноды из
+    БД (не досинхронизированные до падения) подхватываются сразу."""
+    global _sweeper, _stopping
+    with _cond:
+        if _sweeper is not None:
+            return
+        _stopping = False
+        _sweeper = threading.Thread(target=_sweep, name="xray-sync-sweep", daemon=True)
+        _sweeper.start()
+    logger.info("xray sync: планировщик запущен (debounce %.1f с)", _DEBOUNCE_S)
+
+
+def xray_sync_stop(timeout: float = 10.0) -> None:
+    """Останавливает планировщик (текущий прогон доработает; флаги остаются в БД)."""
+    global _stopping, _workers, _sweeper
+    with _cond:
+        threads = list(_workers.values()) + ([_sweeper] if _sweeper else [])
+        _stopping = True
+        _cond.notify_all()
+    for t in threads:
+        t.join(timeout)
+    with _cond:
+        _workers, _sweeper = {}, None
+        _due.clear()
+        _stopping = False
+
+
+def xray_sync_stats() -> Dict:
+    """Метрики процесса (запросы, слитые запросы, прогоны, время прогона и
+    задержка до sync) + состояние нод из БД."""
+    stats = dict(_stats)
+    ok = stats["succeeded"]
+    stats["avg_run_ms"] = stats["total_run_ms"] / ok if ok else 0.0
+    stats["avg_lag_ms"] = stats["total_lag_ms"] / ok if ok else 0.0
+    nodes = {
+        s["server_id"]: {
+            "dirty": s["requested_gen"] > s["synced_gen"],
+            "pending": s["requested_gen"] - s["synced_gen"],
+            "failures": s["failures"],
+            "last_error": s["last_error"],
+            "synced_at": s["synced_at"],
+        }
+        for s in db_xray_sync_states()
+    }
+    return {"running": xray_sync_running(), "debounce_s": _DEBOUNCE_S, **stats, "nodes": nodes}
@@ -42,7 +42,7 @@ from sync_xray_users import SERVERS, _ssh_read_file, CONFIG_PATH  # noqa: E402
 from sync_eu1_vless import RELAY_PRESERVE  # noqa: E402  релей-креды (yc/yc2→eu1), не фрод
 from peers_sync_check import get_awg_dump  # noqa: E402
 from bot.database import _conn, _ensure_init  # noqa: E402
-from bot.storage import get_all_peers  # noqa: E402
+from bot.storage import get_all_peers, get_peers_by_server  # noqa: E402
 
 EU1_CONFIG = "/usr/local/etc/xray/config.json"
 TID_EMAIL_RE = re.compile(r"tid_(\d+)@kronos")
@@ -60,7 +60,7 @@ def _tids(where: str) -> Set[int]:
 def active_tids() -> Set[int]:
     # Тот же фильтр, что enforce_expired / sync_xray_users (grace 12h).
     return _tids("AND active=1 AND (expires_at IS NULL "
-                 "OR datetime(expires_at) > datetime('now','-12 hours'))")
+                 "OR expires_epoch > CAST(strftime('%s', 'now', '-12 hours') AS INTEGER))")
 
 
 def read_config(server_id: str) -> dict:
@@ -116,9 +116,9 @@ def audit_awg(active: Set[int]) -> Dict:
     except Exception as e:  # noqa: BLE001
         return {"error": str(e)[:160]}
     try:
-        peers = [p for p in get_all_peers() if p.server_id == "eu1" and p.active]
+        peers = get_peers_by_server("eu1", active_only=True)
     except Exception as e:  # noqa: BLE001
-        return {"error": f"get_all_peers: {str(e)[:120]}", "runtime": len(awg_pubkeys)}
+        return {"error": f"get_peers_by_server: {str(e)[:120]}", "runtime": len(awg_pubkeys)}
     pk2tid = {(p.public_key or "").strip(): p.telegram_id for p in peers if p.public_key}
     res = {"runtime": len(awg_pubkeys), "peers_table": len(peers),
            "tracked": 0, "expired": 0, "legacy_live": 0, "unused": 0, "legacy_list": []}
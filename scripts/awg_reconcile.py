@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Сверка runtime AmneziaWG (eu1) с БД и исправление дрейфа (bot/awg_reconcile.py).
+
+Default mode — DRY-RUN: только отчёт о дрейфе и план. Реальное применение —
+флагом `--apply`. Один SSH на dump всех шардов + (при --apply и непустом
+плане) один SSH на пакет изменений — дёшево, можно ставить в cron раз в минуту.
+
+Отчёт:
+  - человекочитаемый (по умолчанию) или JSON (`--json`, для мониторинга);
+  - add/remove с причиной (missing / allowed_ips / misplaced / revoked / expired);
+  - unknown — peer'ы вне peers и пула (legacy/owner) — НЕ трогаются;
+  - deferred — не влезло в лимиты прогона, доедет на следующем.
+
+Код возврата: 0 — дрейфа нет (или всё применено), 1 — дрейф остался
+(dry-run, deferred, ошибки шардов), 2 — сверка не выполнена.
+
+Запуск:
+    /opt/vpnservice/venv/bin/python scripts/awg_reconcile.py
+    /opt/vpnservice/venv/bin/python scripts/awg_reconcile.py --apply --json
+    # cron: * * * * * cd /opt/vpnservice && venv/bin/python scripts/awg_reconcile.py --apply --json >> logs/awg_reconcile.jsonl
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import pathlib
+import sys
+from datetime import datetime, timezone
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+
+def _print_report(report: dict) -> None:
+    mode = "DRY RUN" if report["dry_run"] else "APPLY"
+    print(f"=== AWG reconcile ({report['node']}, {mode}) — {report['ms']} мс ===")
+    for shard, n in sorted(report["runtime"].items()):
+        print(f"  шард {shard:<10} runtime={n:<5} desired={report['desired'].get(shard, 0):<5} "
+              f"unknown={report['unknown'].get(shard, 0)}")
+    if report["failed_shards"]:
+        print(f"  [!] dump не получен: {', '.join(report['failed_shards'])} — шарды пропущены")
+    for item in report["unknown_shard"]:
+        print(f"  [!] шард {item['shard']!r} не в конфиге: tid={item['telegram_id']} pk={item['public_key'][:20]}...")
+    print(f"\nadd ({len(report['add'])}):")
+    for a in report["add"]:
+        print(f"    + {a['shard']:<8} {a['reason']:<12} tid={a['telegram_id']} ip={a['wg_ip']} pk={a['public_key'][:20]}...")
+    print(f"remove ({len(report['remove'])}):")
+    for r in report["remove"]:
+        print(f"    - {r['shard']:<8} {r['reason']:<12} tid={r['telegram_id']} pk={r['public_key'][:20]}...")
+    if report["removes_blocked"]:
+        print(f"\n[!] удаления заблокированы (слишком много за прогон): {', '.join(report['removes_blocked'])}")
+    deferred = report["deferred"]
+    if deferred["add"] or deferred["remove"]:
+        print(f"\nотложено до следующего прогона: add={deferred['add']} remove={deferred['remove']}")
+    if report["dry_run"]:
+        print("\n⚠ Это DRY RUN. Ничего не было изменено. Для применения: --apply")
+    else:
+        applied = report["applied"]
+        print(f"\nприменено: add={applied['add']} remove={applied['remove']}"
+              + (f", ошибки шардов: {', '.join(report['apply_failed_shards'])}"
+                 if report["apply_failed_shards"] else ""))
+
+
+def main() -> int:
+    from bot.awg_reconcile import DEFAULT_MAX_ADDS, DEFAULT_MAX_REMOVES, reconcile_awg
+
+    parser = argparse.ArgumentParser(description="Сверка runtime AmneziaWG с БД")
+    parser.add_argument("--apply", action="store_true", help="Применить план (default — dry-run)")
+    parser.add_argument("--json", action="store_true", help="Отчёт одной JSON-строкой")
+    parser.add_argument("--max-adds", type=int, default=DEFAULT_MAX_ADDS,
+                        help=f"Лимит добавлений за прогон (default {DEFAULT_MAX_ADDS})")
+    parser.add_argument("--max-removes", type=int, default=DEFAULT_MAX_REMOVES,
+                        help=f"Лимит удалений за прогон (default {DEFAULT_MAX_REMOVES})")
+    args = parser.parse_args()
+
+    try:
+        report = reconcile_awg(apply=args.apply, max_adds=args.max_adds, max_removes=args.max_removes)
+    except Exception as e:  # noqa: BLE001
+        if args.json:
+            print(json.dumps({"ts": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                              "error": str(e)[:300]}, ensure_ascii=False))
+        else:
+            print(f"[FAIL] сверка не выполнена: {e}", file=sys.stderr)
+        return 2
+
+    report["ts"] = datetime.now(timezone.utc).isoformat(timespec="seconds")
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False))
+    else:
+        _print_report(report)
+
+    drift_left = (
+        report["failed_shards"] or report["apply_failed_shards"] or report["removes_blocked"]
+        or (report["dry_run"] and (report["add"] or report["remove"]))
+        or report["deferred"]["add"] or report["deferred"]["remove"]
+    )
+    return 1 if drift_left else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,591 @@
+#!/usr/bin/env python3
+"""
+Бенчмарки слоя bot/database.py на ВРЕМЕННОЙ БД (прод не трогает).
+
+Секции:
+  pool       — латентность одного db_* хелпера: connect+PRAGMA на каждый вызов
+               (_POOL_ENABLED=False, старое поведение) против пула соединений.
+  accumulate — db_accumulate_traffic на синтетических 10k peer'ах: старый
+               SELECT+INSERT/UPDATE на peer против executemany-UPSERT. Считает
+               обращения Python→SQLite и сверяет итоговые таблицы.
+  bulk_extend — db_bulk_extend_active на 20k юзерах: цикл UPDATE на юзера
+               против одного UPDATE; время под write-lock и сверка результата.
+  write_queue — латентность hit'а /sub при конкурирующем writer'е: синхронная
+               запись против write-behind очереди; метрики очереди.
+  peers      — storage.find_peer_by_telegram_id и выборка по серверу на 50k
+               peer'ах: get_all_peers() + фильтр в Python против WHERE по
+               индексам; сверка выбранных слотов.
+  read_cache — набор чтений /api/stats (get_all_peers + get_all_users +
+               db_get_all_users) на 50k слотах / 20k юзерах: без кеша, промах,
+               hit; hit после записи в «чужую» таблицу.
+  ip_alloc   — выдача IP нового peer'а в /16 с 50k слотами: get_all_peers() +
+               линейный проход net.hosts() против аллокатора в SQLite.
+  sub        — путь /sub/<token> (без Flask) на 5k юзерах под нагрузкой
+               500 req/s: каждый hit заново (env + UUID + base64) против кеша
+               подписок с ETag/304 (bot/sub_cache.py); p50/p99 и сверка тел.
+
+Запуск:
+    venv/bin/python scripts/bench_db.py            # все секции
+    venv/bin/python scripts/bench_db.py pool       # одна секция
+"""
+from __future__ import annotations
+
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+try:
+    sys.stdout.reconfigure(encoding="utf-8")
+except Exception:
+    pass
+
+
+def _fresh_db(prefix: str):
+    """Переключает bot.database на пустую временную БД и инициализирует схему."""
+    import bot.database as db
+
+    tmp = Path(tempfile.mkdtemp(prefix=prefix))
+    db.db_pool_close_all()
+    db.DATA_DIR = tmp
+    db.DB_PATH = tmp / "vpn.db"
+    db.USERS_JSON_PATH = tmp / "users.json"
+    db.PEERS_JSON_PATH = tmp / "peers.json"
+    db._db_initialized = False
+    db.init_db()
+    return db
+
+
+def _per_call_us(fn, n: int) -> float:
+    t0 = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - t0) / n * 1e6
+
+
+def bench_pool(n: int = 2000) -> None:
+    db = _fresh_db("bench_pool_")
+    for tid in range(1, 101):
+        db.db_upsert_user({"telegram_id": tid, "username": f"u{tid}"})
+
+    print(f"pool: {n} вызовов db_find_user_by_telegram_id / db_is_access_active")
+    results = {}
+    for enabled in (False, True):
+        db._POOL_ENABLED = enabled
+        db.db_pool_close_all()
+        read_us = _per_call_us(lambda: db.db_find_user_by_telegram_id(42), n)
+        mixed_us = _per_call_us(lambda: (db.db_is_access_active(42),
+                                         db.db_update_vless_requested_at(42)), n // 2)
+        results[enabled] = (read_us, mixed_us)
+        label = "pool    " if enabled else "no-pool "
+        print(f"  {label} read {read_us:8.1f} µs/call   read+write {mixed_us:8.1f} µs/pair")
+    db._POOL_ENABLED = True
+    (r0, m0), (r1, m1) = results[False], results[True]
+    print(f"  ускорение: read ×{r0 / r1:.1f}, read+write ×{m0 / m1:.1f}")
+    print(f"  {db.db_pool_stats()}")
+
+
+class _CountingConnection(sqlite3.Connection):
+    """sqlite3.Connection, считающий вызовы execute*/executemany из Python."""
+
+    calls = 0
+
+    def execute(self, *a, **kw):
+        _CountingConnection.calls += 1
+        return super().execute(*a, **kw)
+
+    def executemany(self, *a, **kw):
+        _CountingConnection.calls += 1
+        return super().executemany(*a, **kw)
+
+
+def _legacy_accumulate_traffic(db, samples) -> None:
+    """Реализация db_accumulate_traffic до UPSERT (для сравнения)."""
+    with db._conn() as con:
+        for s in samples:
+            pk = (s.get("public_key") or "").strip()
+            if not pk:
+                continue
+            rx = int(s.get("rx") or 0)
+            tx = int(s.get("tx") or 0)
+            tid = s.get("telegram_id")
+            row = con.execute(
+                "SELECT lifetime_rx, lifetime_tx, last_rx, last_tx "
+                "FROM traffic_accounting WHERE public_key = ?", (pk,),
+            ).fetchone()
+            if row is None:
+                con.execute(
+                    "INSERT INTO traffic_accounting (public_key, telegram_id, lifetime_rx, "
+                    "lifetime_tx, last_rx, last_tx, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, datetime('now'))",
+                    (pk, tid, rx, tx, rx, tx),
+                )
+                continue
+            d_rx = rx - row["last_rx"] if rx >= row["last_rx"] else rx
+            d_tx = tx - row["last_tx"] if tx >= row["last_tx"] else tx
+            con.execute(
+                "UPDATE traffic_accounting SET lifetime_rx = lifetime_rx + ?, "
+                "lifetime_tx = lifetime_tx + ?, last_rx = ?, last_tx = ?, "
+                "telegram_id = COALESCE(?, telegram_id), updated_at = datetime('now') "
+                "WHERE public_key = ?",
+                (d_rx, d_tx, rx, tx, tid, pk),
+            )
+
+
+def _traffic_rounds(n_peers: int):
+    """3 прогона счётчиков: рост, рост, сброс у каждого 7-го peer'а."""
+    rounds = []
+    for r in range(3):
+        batch = []
+        for i in range(n_peers):
+            rx = (i + 1) * 1000 * (r + 1)
+            tx = (i + 1) * 10 * (r + 1)
+            if r == 2 and i % 7 == 0:
+                rx, tx = 5, 1  # рестарт интерфейса → счётчики с нуля
+            batch.append({"public_key": f"PK{i:06d}", "telegram_id": i % 900 + 1, "rx": rx, "tx": tx})
+        rounds.append(batch)
+    return rounds
+
+
+def bench_accumulate(n_peers: int = 10000) -> None:
+    real_connect = sqlite3.connect
+    sqlite3.connect = lambda *a, **kw: real_connect(*a, factory=_CountingConnection, **kw)
+    try:
+        print("accumulate: db_accumulate_traffic, 3 прогона × peers")
+        tables = {}
+        for impl in ("legacy", "upsert"):
+            for n in (n_peers // 10, n_peers):
+                db = _fresh_db(f"bench_acc_{impl}_")
+                rounds = _traffic_rounds(n)
+                _CountingConnection.calls = 0
+                t0 = time.perf_counter()
+                for batch in rounds:
+                    if impl == "legacy":
+                        _legacy_accumulate_traffic(db, batch)
+                    else:
+                        db.db_accumulate_traffic(batch)
+                ms = (time.perf_counter() - t0) * 1000 / len(rounds)
+                calls = _CountingConnection.calls / len(rounds)
+                print(f"  {impl:7s} peers={n:6d}  {ms:8.1f} ms/прогон  "
+                      f"{calls:8.0f} обращений к SQLite/прогон")
+                with db._conn() as con:
+                    tables[(impl, n)] = con.execute(
+                        "SELECT public_key, telegram_id, lifetime_rx, lifetime_tx, last_rx, last_tx "
+                        "FROM traffic_accounting ORDER BY public_key"
+                    ).fetchall()
+        same = all(
+            [tuple(r) for r in tables[("legacy", n)]] == [tuple(r) for r in tables[("upsert", n)]]
+            for n in (n_peers // 10, n_peers)
+        )
+        print(f"  {'✅' if same else '❌'} итоговые lifetime/last совпадают с legacy (включая сбросы)")
+    finally:
+        sqlite3.connect = real_connect
+
+
+def _legacy_bulk_extend_active(db, days: int) -> int:
+    """Реализация db_bulk_extend_active до set-based UPDATE (для сравнения)."""
+    delta = timedelta(days=int(days))
+    affected = 0
+    with db._conn() as con:
+        rows = con.execute(
+            f"SELECT telegram_id, expires_at FROM users "
+            f"WHERE telegram_id IS NOT NULL AND active = 1 AND {db._SEG_ACTIVE}"
+        ).fetchall()
+        for r in rows:
+            try:
+                new_exp = (datetime.fromisoformat(r["expires_at"]) + delta).isoformat()
+            except (ValueError, TypeError):
+                continue
+            con.execute(
+                "UPDATE users SET expires_at = ?, "
+                "notif_7d_sent = 0, notif_3d_sent = 0, notif_0d_sent = 0 "
+                "WHERE telegram_id = ?",
+                (new_exp, r["telegram_id"]),
+            )
+            affected += 1
+    return affected
+
+
+def _seed_expiring_users(db, n_users: int, now: datetime) -> None:
+    """n_users юзеров: 2/3 с активным доступом в разных форматах expires_at,
+    остальные истёкшие / NULL / active=0 / мусор."""
+    rows = []
+    for tid in range(1, n_users + 1):
+        k = tid % 9
+        if k in (0, 1, 2):
+            exp = (now + timedelta(days=tid % 40 + 1, microseconds=tid)).isoformat()
+        elif k in (3, 4):
+            exp = (now + timedelta(hours=tid % 500 + 1)).strftime("%Y-%m-%d %H:%M:%S")
+        elif k == 5:
+            exp = (now + timedelta(days=3)).isoformat() + "+03:00"
+        elif k == 6:
+            exp = (now - timedelta(days=tid % 30 + 1)).isoformat()
+        elif k == 7:
+            exp = None
+        else:
+            exp = "скоро"
+        rows.append((tid, f"u{tid}", 0 if tid % 50 == 0 else 1, exp, tid % 2))
+    with db._conn() as con:
+        con.executemany(
+            "INSERT INTO users (telegram_id, username, active, expires_at, notif_7d_sent) "
+            "VALUES (?, ?, ?, ?, ?)", rows,
+        )
+
+
+def bench_bulk_extend(n_users: int = 20000) -> None:
+    print(f"bulk_extend: db_bulk_extend_active(+3 дня) на {n_users} юзерах")
+    tables = {}
+    now = datetime.utcnow()
+    for impl in ("legacy", "set-based"):
+        db = _fresh_db(f"bench_bulk_{impl}_")
+        _seed_expiring_users(db, n_users, now)
+        t0 = time.perf_counter()
+        n = _legacy_bulk_extend_active(db, 3) if impl == "legacy" else db.db_bulk_extend_active(3)
+        ms = (time.perf_counter() - t0) * 1000
+        print(f"  {impl:9s} {ms:8.1f} ms под write-lock   затронуто {n}")
+        with db._conn() as con:
+            tables[impl] = (n, [tuple(r) for r in con.execute(
+                "SELECT telegram_id, expires_at, expires_epoch, notif_7d_sent FROM users "
+                "ORDER BY telegram_id"
+            ).fetchall()])
+    same = tables["legacy"] == tables["set-based"]
+    print(f"  {'✅' if same else '❌'} счётчик и итоговые expires_at/expires_epoch/флаги совпадают с legacy")
+
+
+def bench_write_queue(n: int = 300, hold_ms: int = 150) -> None:
+    """Латентность /sub-записи (db_update_vless_requested_at), пока «cron» в
+    соседнем соединении держит write-lock по hold_ms с паузами."""
+    import threading
+
+    db = _fresh_db("bench_wq_")
+    for tid in range(1, 101):
+        db.db_upsert_user({"telegram_id": tid, "username": f"u{tid}"})
+    print(f"write_queue: {n} hit'ов /sub, параллельный writer держит lock по {hold_ms} мс")
+    for queued in (False, True):
+        stop = threading.Event()
+
+        def long_writer():
+            con = sqlite3.connect(str(db.DB_PATH), timeout=30)
+            while not stop.is_set():
+                con.execute("BEGIN IMMEDIATE")
+                con.execute("UPDATE users SET username = username WHERE telegram_id = 1")
+                time.sleep(hold_ms / 1000)
+                con.commit()
+                time.sleep(hold_ms / 3000)
+            con.close()
+
+        if queued:
+            db.db_write_queue_start()
+        writer = threading.Thread(target=long_writer)
+        writer.start()
+        lat = []
+        for i in range(n):
+            t0 = time.perf_counter()
+            db.db_update_vless_requested_at(i % 100 + 1)
+            lat.append((time.perf_counter() - t0) * 1000)
+            time.sleep(0.002)
+        stop.set()
+        writer.join()
+        if queued:
+            db.db_write_queue_stop()
+        lat.sort()
+        label = "queue  " if queued else "sync   "
+        print(f"  {label} p50 {lat[n // 2]:7.2f} ms   p99 {lat[int(n * 0.99)]:7.2f} ms   max {lat[-1]:7.2f} ms")
+    st = db.db_write_queue_stats()
+    print(f"  очередь: enqueued={st['enqueued']} coalesced={st['coalesced']} written={st['written']} "
+          f"flushes={st['flushes']} flush avg {st['avg_flush_ms']:.1f} ms / max {st['max_flush_ms']:.1f} ms")
+
+def _legacy_peers_by_telegram_id(telegram_id, server_id=None):
+    """storage.get_peers_by_telegram_id до индексных выборок (для сравнения)."""
+    from bot import storage
+    mine = [p for p in storage._build_all_peers() if p.telegram_id == int(telegram_id)]
+    if server_id is not None:
+        sid = storage.normalize_peer_server_id(server_id)
+        mine = [p for p in mine if p.server_id == sid]
+    return mine
+
+
+def bench_peers(n_peers: int = 50000, n_lookups: int = 200) -> None:
+    from bot import storage
+
+    db = _fresh_db("bench_peers_")
+    servers = ("eu1", "main", "rus1", "yc")
+    platforms = ("pc", "ios", "android")
+    rows = []
+    for i in range(n_peers):
+        tid = i // 3 + 1
+        rows.append((tid, servers[i % 4], f"dev{i}", platforms[i % 3],
+                     f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}", f"PK{i:06d}", int(i % 11 != 0)))
+    with db._conn() as con:
+        con.executemany(
+            "INSERT INTO peers (telegram_id, server_id, device_id, os, wg_ip, public_key, active) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)", rows,
+        )
+        con.execute("ANALYZE")
+    tids = [1 + (k * 7919) % (n_peers // 3) for k in range(n_lookups)]
+    queries = [(tid, sid) for tid in tids for sid in (None, "eu1", "main")]
+    print(f"peers: {n_peers} слотов, {len(queries)} find_peer_by_telegram_id")
+    real = storage.get_peers_by_telegram_id
+    picked = {}
+    for impl in ("legacy", "indexed"):
+        storage.get_peers_by_telegram_id = _legacy_peers_by_telegram_id if impl == "legacy" else real
+        try:
+            n = len(queries) if impl == "indexed" else min(len(queries), 30)
+            t0 = time.perf_counter()
+            picked[impl] = [storage.find_peer_by_telegram_id(tid, server_id=sid) for tid, sid in queries[:n]]
+            us = (time.perf_counter() - t0) * 1e6 / n
+        finally:
+            storage.get_peers_by_telegram_id = real
+        print(f"  {impl:7s} {us:10.1f} µs/вызов  (n={n})")
+    same = picked["legacy"] == picked["indexed"][:len(picked["legacy"])]
+    print(f"  {'✅' if same else '❌'} выбранные слоты совпадают с legacy")
+
+    t0 = time.perf_counter()
+    legacy = [p for p in storage._build_all_peers() if p.server_id == "eu1" and p.active]
+    t1 = time.perf_counter()
+    indexed = storage.get_peers_by_server("eu1", active_only=True)
+    t2 = time.perf_counter()
+    print(f"  active eu1: get_all_peers+фильтр {(t1 - t0) * 1000:7.1f} ms   "
+          f"get_peers_by_server {(t2 - t1) * 1000:7.1f} ms   ({len(indexed)} слотов)")
+    rus1 = storage.get_peers_by_server("rus1")
+    same = (sorted(legacy, key=lambda p: p.public_key) == sorted(indexed, key=lambda p: p.public_key)
+            and len(rus1) == sum(1 for p in storage._build_all_peers() if p.server_id == "rus1"))
+    print(f"  {'✅' if same else '❌'} выборки по серверу совпадают (main → rus1)")
+
+
+def bench_read_cache(n_peers: int = 50000, n_users: int = 20000, rounds: int = 20) -> None:
+    from bot import storage
+
+    db = _fresh_db("bench_rc_")
+    with db._conn() as con:
+        con.executemany(
+            "INSERT INTO users (telegram_id, username) VALUES (?, ?)",
+            [(tid, f"u{tid}") for tid in range(1, n_users + 1)],
+        )
+        con.executemany(
+            "INSERT INTO peers (telegram_id, server_id, device_id, os, wg_ip, public_key) "
+            "VALUES (?, 'eu1', ?, 'pc', ?, ?)",
+            [(i % n_users + 1, f"dev{i}", f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}", f"PK{i:06d}")
+             for i in range(n_peers)],
+        )
+
+    def stats_reads():
+        return storage.get_all_peers(), storage.get_all_users(), db.db_get_all_users()
+
+    print(f"read_cache: get_all_peers + get_all_users + db_get_all_users, "
+          f"{n_peers} слотов / {n_users} юзеров")
+    db._READ_CACHE_ENABLED = False
+    t0 = time.perf_counter()
+    baseline = stats_reads()
+    print(f"  без кеша  {(time.perf_counter() - t0) * 1000:9.1f} ms")
+    db._READ_CACHE_ENABLED = True
+    t0 = time.perf_counter()
+    stats_reads()
+    print(f"  промах    {(time.perf_counter() - t0) * 1000:9.1f} ms")
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        cached = stats_reads()
+    print(f"  hit       {(time.perf_counter() - t0) * 1000 / rounds:9.3f} ms")
+    db.db_update_vless_requested_at(1)
+    t0 = time.perf_counter()
+    stats_reads()
+    print(f"  users изменена: {(time.perf_counter() - t0) * 1000:7.1f} ms (peers из кеша)")
+    same = all(list(a) == list(b) for a, b in zip(baseline, cached))
+    print(f"  {'✅' if same else '❌'} результат совпадает с чтением без кеша")
+    st = db.db_read_cache_stats()
+    print(f"  кеш: hits={st['hits']} misses={st['misses']} checks={st['checks']} "
+          f"refreshes={st['refreshes']}")
+
+
+def _legacy_allocate_ip_amnezia_eu(network_cidr: str) -> str:
+    """Выдача IP AmneziaWG (eu1) до аллокатора в SQLite (для сравнения)."""
+    import ipaddress
+    from bot import storage
+
+    net = ipaddress.ip_network(network_cidr, strict=False)
+    used = {net.network_address, net.broadcast_address, net.network_address + 1}
+    for peer in storage._build_all_peers():
+        if peer.server_id != "eu1":
+            continue
+        try:
+            used.add(ipaddress.ip_interface(peer.wg_ip).ip)
+        except ValueError:
+            continue
+    for host in net.hosts():
+        if host not in used:
+            return f"{host}/{net.prefixlen}"
+    raise RuntimeError("пул исчерпан")
+
+
+def bench_ip_alloc(n_peers: int = 50000, n_new: int = 200) -> None:
+    import bot.wireguard_peers as wg
+
+    db = _fresh_db("bench_ip_")
+    with db._conn() as con:
+        con.executemany(
+            "INSERT INTO peers (telegram_id, server_id, device_id, os, wg_ip, public_key) "
+            "VALUES (?, 'eu1', ?, 'pc', ?, ?)",
+            [(i + 1, f"dev{i}", f"10.1.{(i + 2) >> 8}.{(i + 2) & 255}/16", f"PK{i:06d}")
+             for i in range(n_peers)],
+        )
+    print(f"ip_alloc: выдача IP в 10.1.0.0/16 при {n_peers} слотах")
+    t0 = time.perf_counter()
+    legacy = [_legacy_allocate_ip_amnezia_eu("10.1.0.0/16") for _ in range(3)]
+    print(f"  legacy    {(time.perf_counter() - t0) * 1000 / 3:9.1f} ms/выдача")
+    t0 = time.perf_counter()
+    env = {"AMNEZIAWG_EU1_NETWORK_CIDR": "10.1.0.0/16"}
+    first = wg._allocate_awg_slot(10 ** 6, env)[1]
+    print(f"  засев     {(time.perf_counter() - t0) * 1000:9.1f} ms (один раз на подсеть)")
+    t0 = time.perf_counter()
+    for k in range(n_new):
+        wg._allocate_awg_slot(10 ** 6 + k + 1, env)
+    print(f"  allocator {(time.perf_counter() - t0) * 1000 / n_new:9.3f} ms/выдача")
+    same = legacy[0] == first
+    print(f"  {'✅' if same else '❌'} первый выданный адрес совпадает с legacy ({first})")
+
+
+_SUB_SERVERS = (("vless_eu1_share_url", "eu1"), ("vless_cdn_tls_share_url", "main"))
+
+
+def _sub_links(db, cfg, tid: int) -> str:
+    """Тело подписки как web/app._build_subscription_links (персонализация
+    UUID: get + get_or_create на сервер) + base64."""
+    import base64
+    import urllib.parse
+
+    out = []
+    for attr, server_id in _SUB_SERVERS:
+        u = getattr(cfg, attr)
+        db.db_get_per_user_vless_uuid(tid, server_id)
+        uuid = db.db_get_or_create_vless_uuid(tid, server_id)
+        head, rest = u.split("@", 1)
+        base, frag = f"vless://{uuid}@{rest}".rsplit("#", 1)
+        out.append(base + "#" + urllib.parse.quote(urllib.parse.unquote(frag), safe=""))
+    return base64.b64encode("\n".join(out).encode("utf-8")).decode("ascii")
+
+
+def _legacy_sub_hit(db, config, env: str, token: str, _inm):
+    """/sub до кеша: access — отдельный запрос, env разбирается на каждый hit."""
+    user = db.db_find_user_by_sub_token(token)
+    tid = int(user["telegram_id"])
+    db.db_is_access_active(tid)
+    db.db_update_vless_requested_at(tid)
+    return 200, _sub_links(db, config.load_config(env), tid), None
+
+
+def _cached_sub_hit(db, config, env: str, token: str, inm):
+    from bot.sub_cache import etag_matches, sub_render_cached, sub_stamp
+
+    user = db.db_find_user_by_sub_token(token)
+    tid = int(user["telegram_id"])
+    db.db_is_access_active_row(user)
+    db.db_update_vless_requested_at(tid)
+    body, _userinfo, etag = sub_render_cached(
+        token, sub_stamp(user, config.config_version(env)),
+        lambda: (_sub_links(db, config.load_config_cached(env), tid), None, True),
+    )
+    if etag_matches(inm, etag):
+        return 304, "", etag
+    return 200, body, etag
+
+
+def bench_sub(n_users: int = 5000, rate: int = 500, seconds: float = 4.0, threads: int = 8) -> None:
+    import random
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+
+    import bot.config as config
+    import bot.sub_cache as sc
+
+    db = _fresh_db("bench_sub_")
+    env = str(db.DATA_DIR / "env_vars.txt")
+    Path(env).write_text(
+        "BOT_TOKEN=t\nADMIN_ID=1\n"
+        "VLESS_EU1_SHARE_URL=vless://00000000-0000-0000-0000-000000000000@1.2.3.4:443"
+        "?security=reality&sni=ebay.com&fp=chrome&type=tcp&flow=xtls-rprx-vision#%F0%9F%87%A9%F0%9F%87%AA\n"
+        "VLESS_CDN_TLS_SHARE_URL=vless://00000000-0000-0000-0000-000000000000@5.6.7.8:443"
+        "?security=reality&sni=deepl.com&fp=chrome&type=tcp#%F0%9F%87%B7%F0%9F%87%BA\n"
+        + "".join(f"FILLER_{i}=value-{i}\n" for i in range(60))
+    )
+    exp = (datetime.utcnow() + timedelta(days=30)).isoformat(timespec="seconds")
+    with db._conn() as con:
+        con.executemany("INSERT INTO users (telegram_id, active, expires_at) VALUES (?, 1, ?)",
+                        [(tid, exp) for tid in range(1, n_users + 1)])
+    tokens = [db.db_ensure_sub_token(tid) for tid in range(1, n_users + 1)]
+    cfg = config.load_config(env)
+    for tid in range(1, n_users + 1):  # UUID уже выданы — steady state
+        _sub_links(db, cfg, tid)
+    db.db_write_queue_start()
+
+    print(f"sub: /sub/<token> на {n_users} юзерах, {rate} req/s × {seconds:.0f} с, {threads} потоков")
+    bodies = {}
+    for impl, hit in (("legacy", _legacy_sub_hit), ("cache", _cached_sub_hit)):
+        sc.sub_cache_clear()
+        client_etags: dict = {}
+        for tok in tokens:  # каждый клиент уже раз забрал подписку (прогрев, как в проде)
+            _s, body, client_etags[tok] = hit(db, config, env, tok, None)
+            bodies.setdefault(impl, {})[tok] = body
+        rnd = random.Random(7)
+        lat: list = []
+        codes = {200: 0, 304: 0}
+        lock = threading.Lock()
+
+        def one(tok: str, due: float) -> None:
+            code, _body, _etag = hit(db, config, env, tok, client_etags.get(tok))
+            ms = (time.perf_counter() - due) * 1000   # от «прихода» запроса, с очередью
+            with lock:
+                lat.append(ms)
+                codes[code] += 1
+
+        n = int(rate * seconds)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            for i in range(n):
+                due = start + i / rate
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                pool.submit(one, rnd.choice(tokens), due)
+        took = time.perf_counter() - start
+        lat.sort()
+        print(f"  {impl:7s} {n / took:6.0f} req/s   p50 {lat[len(lat) // 2]:7.2f} ms   "
+              f"p99 {lat[int(len(lat) * 0.99)]:7.2f} ms   max {lat[-1]:7.2f} ms   "
+              f"200={codes[200]} 304={codes[304]}")
+    db.db_write_queue_stop()
+    st = sc.sub_cache_stats()
+    print(f"  кеш: hits={st['hits']} misses={st['misses']} not_modified={st['not_modified']}")
+    same = bodies["legacy"] == bodies["cache"]
+    print(f"  {'✅' if same else '❌'} тела подписок совпадают с legacy")
+
+
+SECTIONS = {
+    "pool": bench_pool,
+    "accumulate": bench_accumulate,
+    "bulk_extend": bench_bulk_extend,
+    "write_queue": bench_write_queue,
+    "peers": bench_peers,
+    "read_cache": bench_read_cache,
+    "ip_alloc": bench_ip_alloc,
+    "sub": bench_sub,
+}
+
+
+def main(argv) -> int:
+    names = argv[1:] or list(SECTIONS)
+    for name in names:
+        fn = SECTIONS.get(name)
+        if fn is None:
+            print(f"неизвестная секция: {name} (есть: {', '.join(SECTIONS)})")
+            return 2
+        fn()
+        print()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main(sys.argv))
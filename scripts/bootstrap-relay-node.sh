@@ -113,7 +113,7 @@ cat > "$TMP" <<JSON
     { "type": "field", "outboundTag": "eu1", "network": "tcp,udp" }
   ] },
   "stats": {},
-  "api": { "tag": "api", "services": ["StatsService"] },
+  "api": { "tag": "api", "services": ["StatsService", "HandlerService"] },
   "policy": { "system": { "statsInboundUplink": true, "statsInboundDownlink": true },
     "levels": { "0": { "statsUserUplink": true, "statsUserDownlink": true } } }
 }
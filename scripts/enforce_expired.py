@@ -10,6 +10,7 @@ Default mode — DRY-RUN: ничего не меняет, только пока
 2. Действия при отзыве:
    - AmneziaWG peer: `awg set awg0 peer <pk> remove` + `amnezia-save-conf.sh`
      (peer-credentials в peers.json остаются с active=false для последующего восстановления)
+     (одним пакетом на все peer'ы прогона — AwgPeerBatch: save-conf раз на шард)
    - `db_clear_sub_token(tid)` — VLESS subscription URL отдаст пустоту, клиент HAPP/Streisand отвалится за ~12 ч
    - Уведомление юзеру в TG
 3. При восстановлении (`db_extend_subscription` после оплаты) — auto-recreate с теми же pubkey/ip:
@@ -51,7 +52,7 @@ def find_revoke_candidates() -> List[Dict]:
     """
     # Ленивый импорт — чтобы dry-run без production-зависимостей не падал
     from bot.database import _conn, _ensure_init
-    from bot.storage import get_all_peers
+    from bot.storage import get_peers_by_server
 
     _ensure_init()
 
@@ -63,16 +64,14 @@ def find_revoke_candidates() -> List[Dict]:
             FROM users
             WHERE telegram_id IS NOT NULL
               AND expires_at IS NOT NULL
-              AND datetime(expires_at) < datetime('now', '-{GRACE_PERIOD_HOURS} hours')
-            ORDER BY expires_at
+              AND expires_epoch < CAST(strftime('%s', 'now', '-{GRACE_PERIOD_HOURS} hours') AS INTEGER)
+            ORDER BY expires_epoch
             """
         ).fetchall()
 
     # Index peers by telegram_id — только active eu1
     peers_by_uid: Dict[int, List] = {}
-    for peer in get_all_peers():
-        if peer.server_id != "eu1" or not peer.active:
-            continue
+    for peer in get_peers_by_server("eu1", active_only=True):
         peers_by_uid.setdefault(peer.telegram_id, []).append(peer)
 
     candidates: List[Dict] = []
@@ -94,6 +93,8 @@ def find_revoke_candidates() -> List[Dict]:
                     "platform": p.platform,
                     "wg_ip": p.wg_ip,
                     "public_key": p.public_key,
+                    "shard": p.shard,
+                    "device_id": p.device_id,
                 }
                 for p in user_peers
             ],
@@ -109,7 +110,7 @@ def find_data_cap_candidates() -> List[Dict]:
     ИЛИ sub_token (есть что отзывать). Тот же soft-revoke, что по сроку, + закрытие гейта.
     """
     from bot.database import _conn, _ensure_init, db_get_user_total_bytes
-    from bot.storage import get_all_peers
+    from bot.storage import get_peers_by_server
     from bot.tariffs import TRIAL_DATA_LIMIT_BYTES
 
     _ensure_init()
@@ -123,14 +124,12 @@ def find_data_cap_candidates() -> List[Dict]:
               AND plan = 'trial'
               AND trial_data_baseline IS NOT NULL
               AND expires_at IS NOT NULL
-              AND datetime(expires_at) > datetime('now')
+              AND expires_epoch > CAST(strftime('%s', 'now') AS INTEGER)
             """
         ).fetchall()
 
     peers_by_uid: Dict[int, List] = {}
-    for peer in get_all_peers():
-        if peer.server_id != "eu1" or not peer.active:
-            continue
+    for peer in get_peers_by_server("eu1", active_only=True):
         peers_by_uid.setdefault(peer.telegram_id, []).append(peer)
 
     candidates: List[Dict] = []
@@ -153,7 +152,8 @@ def find_data_cap_candidates() -> List[Dict]:
             "sub_token": r["sub_token"],
             "used_bytes": used,
             "peers": [
-                {"platform": p.platform, "wg_ip": p.wg_ip, "public_key": p.public_key}
+                {"platform": p.platform, "wg_ip": p.wg_ip, "public_key": p.public_key,
+                 "shard": p.shard, "device_id": p.device_id}
                 for p in user_peers
             ],
         })
@@ -176,7 +176,7 @@ def find_data_warning_candidates() -> List[Dict]:
               AND trial_data_baseline IS NOT NULL
               AND COALESCE(trial_data_warned, 0) = 0
               AND expires_at IS NOT NULL
-              AND datetime(expires_at) > datetime('now')
+              AND expires_epoch > CAST(strftime('%s', 'now') AS INTEGER)
             """
         ).fetchall()
     out: List[Dict] = []
@@ -332,13 +332,18 @@ def _apply_revocations(candidates: List[Dict], reason: str = "time") -> int:
     последующего auto-restore при оплате.
 
     Действия:
-      1. Для каждого peer: revoke_amneziawg_peer_soft + upsert_peer(active=False)
+      1. Все peer'ы всех кандидатов убираются из runtime одним пакетом
+         (AwgPeerBatch: один SSH, save-conf раз на шард); peer'ы применённых
+         шардов → upsert_peer(active=False). Peer, который не попал в пакет
+         (например, шард убран из конфига), не мешает остальным.
       2. db_clear_sub_token(tid) — VLESS subscription URL отдаст пустую
       3. TG-уведомление юзеру (best-effort, не падаем если не дошло)
+    Шаги 2–3 (и гейт data-cap) — только если ВСЕ peer'ы юзера отозваны: иначе
+    доступ у него остался, а следующий прогон повторит отзыв.
     """
     from bot.database import db_clear_sub_token, db_find_user_by_telegram_id, _conn
     from bot.storage import Peer, upsert_peer
-    from bot.wireguard_peers import revoke_amneziawg_peer_soft
+    from bot.wireguard_peers import AwgPeerBatch
     from bot.config import load_config
     import json
     import urllib.request
@@ -365,6 +370,24 @@ def _apply_revocations(candidates: List[Dict], reason: str = "time") -> int:
             "твой существующий конфиг снова заработает."
         )
 
+    # 1a. Один пакет remove на все peer'ы всех кандидатов (раньше — SSH и
+    #     save-conf на каждый peer; в дни массового истечения — десятки вызовов).
+    batch_error: Optional[str] = None
+    batch = None
+    not_queued: Dict[str, str] = {}  # pubkey → почему не попал в пакет
+    try:
+        batch = AwgPeerBatch()
+        for c in candidates:
+            for p in c["peers"]:
+                try:
+                    batch.remove(p["public_key"], p.get("shard"))
+                except Exception as e:
+                    not_queued[p["public_key"]] = str(e)
+        batch.apply()
+    except Exception as e:
+        batch_error = str(e)
+        print(f"[FAIL] batch revoke — {e}\n")
+
     revoked_count = 0
     failed_count = 0
     for i, c in enumerate(candidates, 1):
@@ -372,14 +395,20 @@ def _apply_revocations(candidates: List[Dict], reason: str = "time") -> int:
         user_label = _fmt_user(c["username"], tid)
         print(f"[{i}/{len(candidates)}] {user_label} (tid={tid})")
 
-        # 1. Удалить каждый peer из runtime + пометить active=False в peers.json
+        # 1b. peers.json: active=False (credentials сохраняются) — для peer'ов,
+        #     чей шард применился
+        user_failed = 0
         for p in c["peers"]:
             pk = p["public_key"]
             wg_ip = p["wg_ip"]
             platform = p["platform"]
             try:
-                revoke_amneziawg_peer_soft(pk)
-                # peers.json: active=False (credentials сохраняются)
+                if batch_error is not None:
+                    raise RuntimeError(batch_error)
+                if pk in not_queued:
+                    raise RuntimeError(not_queued[pk])
+                if not batch.applied(p.get("shard")):
+                    raise RuntimeError(f"шард {p.get('shard') or 'по умолчанию'} не применён")
                 upsert_peer(Peer(
                     telegram_id=tid,
                     wg_ip=wg_ip,
@@ -387,12 +416,20 @@ def _apply_revocations(candidates: List[Dict], reason: str = "time") -> int:
                     server_id="eu1",
                     active=False,
                     platform=platform,
+                    device_id=p.get("device_id"),
+                    shard=p.get("shard"),
                 ))
                 print(f"    [OK] revoked peer pk={pk[:20]}... ip={wg_ip} platform={platform}")
                 revoked_count += 1
             except Exception as e:
                 print(f"    [FAIL] revoke peer pk={pk[:20]}... — {e}")
                 failed_count += 1
+                user_failed += 1
+
+        if user_failed:
+            print(f"    [SKIP] {user_failed} peer(ов) не отозвано — sub_token, гейт и "
+                  f"уведомление не трогаем (повтор в следующий прогон)\n")
+            continue
 
         # 2. Очистка sub_token (VLESS подписки отвалятся через ~12 ч авто-refresh)
         if c.get("sub_token"):
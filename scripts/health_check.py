@@ -216,11 +216,13 @@ def check_docker_container(name: str) -> CheckResult:
 def check_awg_peer_count(prev_count: Optional[int]) -> tuple[CheckResult, Optional[int]]:
     name = "awg_peer_count"
     try:
-        r = _run([DOCKER, "exec", "amnezia-awg2", "awg", "show", "awg0", "dump"])
-        if r.returncode != 0:
-            return CheckResult(name, "FAIL", f"awg show failed: {r.stderr.strip()[:200]}"), None
-        lines = r.stdout.strip().split("\n")
-        count = max(0, len(lines) - 1)  # минус server-line
+        from bot.awg_shards import awg_dump_all
+
+        dump, failed = awg_dump_all(docker=DOCKER)
+        if failed:
+            return CheckResult(name, "FAIL", f"awg show failed: шарды {', '.join(failed)}"), None
+        lines = dump.strip().split("\n")
+        count = max(0, len(lines) - 1)  # минус server-line (одна на все шарды)
         if prev_count and count < prev_count * (1 - AWG_PEER_DROP_THRESHOLD_PCT / 100):
             return CheckResult(
                 name,
@@ -243,19 +245,20 @@ def check_peers_consistency() -> CheckResult:
     """
     name = "peers_json_vs_awg"
     try:
-        from bot.storage import get_all_peers
+        from bot.awg_shards import awg_dump_all
+        from bot.storage import get_peers_by_server
 
         json_active = {
             p.public_key.strip()
-            for p in get_all_peers()
-            if p.server_id == "eu1" and p.active and p.public_key
+            for p in get_peers_by_server("eu1", active_only=True)
+            if p.public_key
         }
 
-        r = _run([DOCKER, "exec", "amnezia-awg2", "awg", "show", "awg0", "dump"])
-        if r.returncode != 0:
-            return CheckResult(name, "FAIL", f"awg show failed: {r.stderr.strip()[:200]}")
+        dump, failed = awg_dump_all(docker=DOCKER)
+        if failed:
+            return CheckResult(name, "FAIL", f"awg show failed: шарды {', '.join(failed)}")
         awg_keys = set()
-        for line in r.stdout.strip().split("\n")[1:]:
+        for line in dump.strip().split("\n")[1:]:
             parts = line.split("\t")
             if parts:
                 awg_keys.add(parts[0].strip())
@@ -396,11 +399,11 @@ def check_vless_config_consistency() -> CheckResult:
                 "SELECT "
                 "  SUM(CASE WHEN vless_uuid_main IS NOT NULL "
                 "           AND (expires_at IS NULL "
-                "                OR datetime(expires_at) > datetime('now', '-12 hours')) "
+                "                OR expires_epoch > CAST(strftime('%s', 'now', '-12 hours') AS INTEGER)) "
                 "      THEN 1 ELSE 0 END) AS db_main, "
                 "  SUM(CASE WHEN vless_uuid_yc IS NOT NULL "
                 "           AND (expires_at IS NULL "
-                "                OR datetime(expires_at) > datetime('now', '-12 hours')) "
+                "                OR expires_epoch > CAST(strftime('%s', 'now', '-12 hours') AS INTEGER)) "
                 "      THEN 1 ELSE 0 END) AS db_yc "
                 "FROM users "
                 "WHERE telegram_id IS NOT NULL AND active = 1"
@@ -686,6 +689,20 @@ SYSTEMD_SERVICES = ["vpn-bot.service", "vpn-web.service", "nginx.service", "xray
 DOCKER_CONTAINERS = ["amnezia-awg2", "mtproxy-faketls"]
 
 
+def _docker_containers() -> List[str]:
+    """DOCKER_CONTAINERS + контейнеры AWG-шардов из AMNEZIAWG_EU1_SHARDS."""
+    containers = list(DOCKER_CONTAINERS)
+    try:
+        from bot.awg_shards import get_awg_shards
+
+        for shard in get_awg_shards():
+            if shard.container not in containers:
+                containers.append(shard.container)
+    except Exception as e:  # noqa: BLE001
+        logger.warning("AWG-шарды не прочитаны: %s", e)
+    return containers
+
+
 def run_all_checks(state: Dict) -> tuple[List[CheckResult], Dict]:
     """Возвращает (results, new_state_extras)."""
     prev_peer_count = (state.get("awg_peer_count") or {}).get("count")
@@ -696,7 +713,7 @@ def run_all_checks(state: Dict) -> tuple[List[CheckResult], Dict]:
     # --- Локальные (Fornex) ---
     for svc in SYSTEMD_SERVICES:
         results.append(check_systemd_service(svc))
-    for ctn in DOCKER_CONTAINERS:
+    for ctn in _docker_containers():
         results.append(check_docker_container(ctn))
 
     awg_res, awg_count = check_awg_peer_count(prev_peer_count)
@@ -120,13 +120,12 @@ def record(entries: List[Tuple[int, str, str]]) -> int:
     if not entries:
         return 0
     with _conn() as con:
-        for tid, ip, srv in entries:
-            con.execute(
-                "INSERT INTO ip_usage (telegram_id, ip, server_id) VALUES (?, ?, ?) "
-                "ON CONFLICT(telegram_id, ip) DO UPDATE SET "
-                "  last_seen = datetime('now'), hits = hits + 1, server_id = excluded.server_id",
-                (tid, ip, srv),
-            )
+        con.executemany(
+            "INSERT INTO ip_usage (telegram_id, ip, server_id) VALUES (?, ?, ?) "
+            "ON CONFLICT(telegram_id, ip) DO UPDATE SET "
+            "  last_seen = datetime('now'), hits = hits + 1, server_id = excluded.server_id",
+            entries,
+        )
         con.execute(
             f"DELETE FROM ip_usage WHERE last_seen < datetime('now', '-{RETENTION_HOURS} hours')"
         )
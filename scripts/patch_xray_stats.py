@@ -9,7 +9,8 @@
 Что делает (всё идемпотентно — повторный запуск не сломает):
   1. Бэкап `{path}.bak.{timestamp}` (с PSK-сертификатом config, поэтому
      сохраняем все исходные данные).
-  2. Добавляет блоки `stats: {}`, `api`, `policy` если их нет.
+  2. Добавляет блоки `stats: {}`, `api`, `policy` если их нет; в api.services —
+     HandlerService (живые adu/rmu для sync_xray_users / sync_eu1_vless).
   3. Проставляет тег `vless-{network}` (vless-ws / vless-xhttp / vless-reality)
      каждому vless-inbound у которого нет своего tag — нужен для per-inbound
      stats. Если у inbound уже есть tag — не трогает.
@@ -47,7 +48,8 @@ API_INBOUND = {
 }
 API_OUTBOUND = {"protocol": "freedom", "tag": "api"}
 STATS_BLOCK = {}
-API_BLOCK = {"tag": "api", "services": ["StatsService"]}
+# HandlerService — живое добавление/снятие юзеров (`xray api adu/rmu`, bot/xray_api.py)
+API_BLOCK = {"tag": "api", "services": ["StatsService", "HandlerService"]}
 POLICY_BLOCK = {
     "system": {
         "statsInboundUplink": True,
@@ -75,6 +77,9 @@ def patch_config(cfg: Dict[str, Any]) -> List[str]:
     elif cfg["api"].get("tag") != "api" or "StatsService" not in (cfg["api"].get("services") or []):
         # Не перезаписываем чужой api блок, но логируем что не тронули.
         changes.append(f"api block present but unexpected, left as-is: {cfg['api']}")
+    elif "HandlerService" not in cfg["api"]["services"]:
+        cfg["api"]["services"].append("HandlerService")
+        changes.append("added api.services HandlerService (live adu/rmu)")
 
     if "policy" not in cfg:
         cfg["policy"] = POLICY_BLOCK
@@ -5,7 +5,8 @@
 Сравнивает три источника:
   1. БД (vpn.db) — `users` + связанные peer-ключи (если есть).
   2. peers.json — legacy storage, индексирован по telegram_id.
-  3. `docker exec amnezia-awg2 awg show awg0 dump` — реальное состояние AWG.
+  3. `docker exec <container> awg show <iface> dump` по всем AWG-шардам
+     (AMNEZIAWG_EU1_SHARDS, bot/awg_shards.py) — реальное состояние AWG.
 
 Вывод:
   - Сводка по каждому источнику.
@@ -19,7 +20,6 @@ Read-only — ничего не меняет.
 """
 from __future__ import annotations
 
-import subprocess
 import sys
 from pathlib import Path
 from typing import Dict, List, Set, Tuple
@@ -28,34 +28,25 @@ from typing import Dict, List, Set, Tuple
 ROOT = Path(__file__).resolve().parent.parent
 sys.path.insert(0, str(ROOT))
 
-from bot.storage import get_all_peers  # noqa: E402
-from bot.database import db_get_all_users  # noqa: E402
-
-
-AWG_CONTAINER = "amnezia-awg2"
-AWG_INTERFACE = "awg0"
+from bot.awg_shards import awg_dump_all  # noqa: E402
+from bot.storage import get_peers_by_server  # noqa: E402
+from bot.database import db_get_all_users, db_warm_pool_list  # noqa: E402
 
 
 def get_awg_dump() -> Tuple[Set[str], Dict[str, dict]]:
     """
-    Запускает `docker exec <container> awg show <iface> dump`.
+    Запускает `docker exec <container> awg show <iface> dump` для каждого шарда.
 
     Returns:
         (set of public_keys, dict public_key → {endpoint, last_handshake, rx, tx, allowed_ips})
     """
-    try:
-        result = subprocess.run(
-            ["docker", "exec", AWG_CONTAINER, "awg", "show", AWG_INTERFACE, "dump"],
-            capture_output=True,
-            text=True,
-            timeout=10,
-            check=True,
-        )
-    except (subprocess.CalledProcessError, subprocess.TimeoutExpired, FileNotFoundError) as e:
-        print(f"[!] Не удалось получить awg dump: {e}", file=sys.stderr)
+    dump, failed = awg_dump_all(timeout=10)
+    if failed:
+        print(f"[!] Не удалось получить awg dump шардов: {', '.join(failed)}", file=sys.stderr)
+    if not dump:
         return set(), {}
 
-    lines = result.stdout.strip().split("\n")
+    lines = dump.strip().split("\n")
     # Первая строка — server info, остальные — peers.
     # Формат peer-строки: <pubkey>\t<psk>\t<endpoint>\t<allowed-ips>\t<last-hs>\t<rx>\t<tx>\t<keepalive>
     pubkeys: Set[str] = set()
@@ -85,7 +76,7 @@ def main() -> int:
     print("=" * 70)
 
     # 1. peers.json — legacy storage
-    json_peers = [p for p in get_all_peers() if p.server_id == "eu1"]
+    json_peers = get_peers_by_server("eu1")
     json_active = [p for p in json_peers if p.active]
     json_pubkeys: Set[str] = {(p.public_key or "").strip() for p in json_active if p.public_key}
     json_pubkeys.discard("")
@@ -124,7 +115,11 @@ def main() -> int:
     # Legacy/admin/owner peer-ы создавались до перехода на peers.json и тоже
     # отсутствуют в нём, но активно работают. Удаление таких peer-ов рвёт
     # рабочее подключение.
-    not_in_json = awg_pubkeys - json_pubkeys
+    # Тёплый пул (bot/awg_warm_pool.py): peer'ы ещё без владельца — не orphan.
+    pool_pubkeys: Set[str] = {r["public_key"] for r in db_warm_pool_list("eu1")}
+    print(f"\n[warm pool] готовых peer-ов: {len(pool_pubkeys)}  |  из них нет в awg show: "
+          f"{len(pool_pubkeys - awg_pubkeys)}")
+    not_in_json = awg_pubkeys - json_pubkeys - pool_pubkeys
     live_outside_json: List[str] = []
     unused_outside_json: List[str] = []
     for pk in not_in_json:
@@ -25,6 +25,11 @@ eu1-shared (9 на vless-tcp) — статус не доказан, не тро
   --no-shared:       только per-user (после грейса старые/shared удаляются).
   --dry-run:         показать, не применять.
 
+Применение: разница clients[] каждого inbound — вживую через HandlerService
+(`xray api rmu/adu`, bot/xray_api.py), без рестарта (соединения не рвутся);
+config.json — checkpoint (validate, без рестарта). Нужна смена policy или
+API не справился — прежний путь: backup → validate → замена → restart.
+
 Отдельный скрипт (НЕ sync_xray_users) — чтобы не рисковать рабочим main/yc sync.
 Источник истины тот же фильтр active (grace 12h), что enforce_expired / sync_xray_users.
 
@@ -43,6 +48,14 @@ from pathlib import Path
 ROOT = Path(__file__).resolve().parent.parent
 sys.path.insert(0, str(ROOT))
 
+from bot.xray_api import (  # noqa: E402
+    XrayApiError,
+    apply_client_changes,
+    local_runner,
+    plan_client_changes,
+    write_config_checkpoint,
+)
+
 CONFIG = "/usr/local/etc/xray/config.json"
 DB_COLUMN = "vless_uuid_eu1"
 # tag → flow. ОТКАТ 2026-06-06: xHTTP-миграция оказалась впустую (проблема не транспорт,
@@ -70,7 +83,7 @@ def fetch_active_users() -> list[dict]:
             f"SELECT telegram_id, {DB_COLUMN} AS uuid FROM users "
             f"WHERE telegram_id IS NOT NULL AND active=1 AND {DB_COLUMN} IS NOT NULL "
             f"  AND (expires_at IS NULL "
-            f"       OR datetime(expires_at) > datetime('now','-12 hours'))"
+            f"       OR expires_epoch > CAST(strftime('%s', 'now', '-12 hours') AS INTEGER))"
         ).fetchall()
     return [{"tid": int(r["telegram_id"]), "uuid": r["uuid"]} for r in rows]
 
@@ -133,6 +146,7 @@ def main() -> int:
 
     cfg = json.loads(Path(CONFIG).read_text(encoding="utf-8"))
     changes = []
+    live_plans = []   # (tag, protocol, adds, removes); None — живой путь невозможен
     for ib in cfg.get("inbounds", []):
         tag = ib.get("tag")
         if ib.get("protocol") != "vless" or tag not in INBOUNDS:
@@ -141,14 +155,23 @@ def main() -> int:
         new = build_clients(users, INBOUNDS[tag], existing, include_shared)
         per_user = sum(1 for c in new if "@kronos" in (c.get("email", "") or ""))
         changes.append((tag, len(existing), len(new), per_user))
+        if live_plans is not None:
+            try:
+                live_plans.append((tag, ib["protocol"], *plan_client_changes(existing, new)))
+            except XrayApiError as e:
+                print(f"  Live API для {tag} невозможен: {e}")
+                live_plans = None
         if not args.dry_run:
             ib.setdefault("settings", {})["clients"] = new
 
     # policy.levels.0.statsUser* — per-user телеметрия (idempotent)
     pol = cfg.setdefault("policy", {}).setdefault("levels", {}).setdefault("0", {})
+    policy_changed = not (pol.get("statsUserUplink") and pol.get("statsUserDownlink"))
     if not args.dry_run:
         pol["statsUserUplink"] = True
         pol["statsUserDownlink"] = True
+    if policy_changed:
+        live_plans = None  # policy применяется только рестартом
 
     print("\nInbound (tag: existing → new, из них per-user):")
     for tag, old, new, pu in changes:
@@ -156,11 +179,38 @@ def main() -> int:
     if not changes:
         print("  ⚠ ни один из inbound не найден — проверь теги!")
         return 1
+    if live_plans is not None:
+        for tag, _proto, adds, removes in live_plans:
+            print(f"  live {tag:<12}: +{len(adds)} −{len(removes)}")
+    no_change = live_plans is not None and not any(adds or removes for _t, _p, adds, removes in live_plans)
 
     if args.dry_run:
         print("\n[DRY RUN] Ничего не записано, xray не трогали.")
         return 0
 
+    if no_change:
+        print("\n✓ Нет изменений — config не трогаем, Xray не рестартим.")
+        return 0
+
+    # Живой путь: HandlerService без рестарта, затем checkpoint config.json.
+    if live_plans is not None:
+        run = local_runner()
+        try:
+            for tag, proto, adds, removes in live_plans:
+                apply_client_changes(run, tag, proto, adds, removes)
+        except XrayApiError as e:
+            print(f"\n⚠ Live API: {e} — fallback на config + restart")
+        else:
+            print("\n✓ live: изменения применены через HandlerService, Xray не рестартим")
+            try:
+                write_config_checkpoint(run, CONFIG, json.dumps(cfg, indent=2, ensure_ascii=False))
+                print("✓ config.json checkpoint (validate OK, без рестарта)")
+            except XrayApiError as e:
+                # runtime уже применён; файл догонит следующий sync (fallback через рестарт)
+                print(f"⚠ {e}")
+            print("✓ eu1 synced")
+            return 0
+
     # backup → tmp → validate → atomic replace → restart → smoke
     ts = int(time.time())
     backup = f"{CONFIG}.bak.eu1sync.{ts}"
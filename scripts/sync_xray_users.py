@@ -2,8 +2,13 @@
 """
 Синхронизация Xray-конфига на удалённых серверах с БД per-user VLESS UUIDs.
 
-Подход — НЕ runtime API (`xray api adu/rmu` молча fail'ится на наших версиях),
-а прямая правка config.json + xray run -test (validate) + systemctl restart.
+Подход — разница clients[] применяется вживую через HandlerService
+(`xray api rmu/adu`, bot/xray_api.py) без рестарта, config.json пишется как
+checkpoint (validate, без рестарта). Раньше `adu/rmu` молча fail'ились: в
+api.services был только StatsService (scripts/patch_xray_stats.py добавляет
+HandlerService). Если живой путь невозможен (policy, клиент без email) или API
+ответил не так — прежний путь: правка config.json + xray run -test (validate)
++ systemctl restart.
 
 Source of truth — БД (users.vless_uuid_main, users.vless_uuid_yc).
 config.json для нужного inbound полностью перезаписывается списком clients[]
@@ -29,6 +34,15 @@ broadcast+48h).
     # Удалить общие share-UUIDs (после broadcast+48h)
     python3 scripts/sync_xray_users.py --all --no-shared
 
+    # Все серверы: сначала канарейка (sync + проверка xray), потом остальные
+    python3 scripts/sync_xray_users.py --all --canary main
+
+Несколько серверов синкаются параллельно (--jobs, по умолчанию 4): время
+прогона ≈ самый медленный сервер, а не сумма. Лог каждого сервера копится
+и печатается одним блоком по завершении; код выхода — 0, только если все
+серверы OK. --canary: сначала один сервер и проверка (xray active, :443);
+не прошёл — остальные не трогаются.
+
 Email-маркер для per-user телеметрии: tid_<telegram_id>@kronos.
 """
 from __future__ import annotations
@@ -38,11 +52,22 @@ import json
 import pathlib
 import subprocess
 import sys
+import threading
 import time
-from typing import Dict, List, Optional
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, List, Optional, Tuple
 
 sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
 
+from bot.xray_api import (  # noqa: E402
+    XrayApiError,
+    apply_client_changes,
+    plan_client_changes,
+    ssh_runner,
+    write_config_checkpoint,
+)
+
 # ── Конфигурация серверов ──
 # server_id → (ssh_args, inbound_tag_to_sync, flow, shared_uuid)
 # eu1 пока НЕ трогаем — vless-ws (CDN канал), отдельная задача.
@@ -65,6 +90,9 @@ SERVERS = {
 }
 
 CONFIG_PATH = "/usr/local/etc/xray/config.json"
+DEFAULT_JOBS = 4  # серверов одновременно (каждый — свои SSH-сессии)
+
+Log = Callable[[str], None]
 
 
 def _ssh_run(ssh_args: List[str], remote_cmd: str, timeout: int = 30) -> subprocess.CompletedProcess:
@@ -106,7 +134,8 @@ def fetch_db_users_for_server(server_id: str) -> List[Dict]:
       - telegram_id IS NOT NULL
       - UUID для сервера IS NOT NULL
       - expires_at IS NULL (grandfather) ИЛИ
-        datetime(expires_at) > datetime('now', '-12 hours') (активный или в grace)
+        expires_epoch > now − 12h (активный или в grace; expires_epoch —
+        индексированная unix-копия expires_at)
 
     Юзеры с истёкшей подпиской > 12h автоматически исключаются → при следующем
     sync их UUID пропадёт из Xray clients[] → старая ссылка перестанет работать.
@@ -123,7 +152,7 @@ def fetch_db_users_for_server(server_id: str) -> List[Dict]:
             f"SELECT telegram_id, {col} AS uuid FROM users "
             f"WHERE telegram_id IS NOT NULL AND active = 1 AND {col} IS NOT NULL "
             f"  AND (expires_at IS NULL "
-            f"       OR datetime(expires_at) > datetime('now', '-12 hours'))"
+            f"       OR expires_epoch > CAST(strftime('%s', 'now', '-12 hours') AS INTEGER))"
         ).fetchall()
     return [{"telegram_id": int(r["telegram_id"]), "uuid": r["uuid"]} for r in rows]
 
@@ -160,14 +189,17 @@ def build_clients(server_id: str, db_users: List[Dict], include_shared: bool) ->
     return clients
 
 
-def sync_one_server(server_id: str, include_shared: bool, dry_run: bool) -> bool:
+def sync_one_server(server_id: str, include_shared: bool, dry_run: bool, log: Log = print) -> bool:
     """
-    Синхронизирует один сервер. Возвращает True если успех.
+    Синхронизирует один сервер. Возвращает True если успех. Вывод — через
+    log (в параллельном режиме копится и печатается блоком сервера).
 
     Шаги:
     1. SSH read config.json
     2. Найти VLESS inbound с нужным tag
     3. Заменить clients[] на свежий список из БД (+ shared если flag)
+    3b. Разница clients[] вживую (HandlerService rmu/adu) + checkpoint
+        config.json без рестарта; не вышло — шаги 4–7
     4. Bashup на сервере + перезаписать config.json (через base64)
     5. xray run -test -c config.json — validate
     6. Если validate OK — systemctl restart xray
@@ -178,16 +210,16 @@ def sync_one_server(server_id: str, include_shared: bool, dry_run: bool) -> bool
     inbound_tag = cfg["inbound_tag"]
     sudo = cfg.get("sudo", "")
 
-    print(f"\n=== Sync server '{server_id}' (inbound tag '{inbound_tag}') ===")
-    print(f"  include_shared: {include_shared}, dry_run: {dry_run}, sudo: {'yes' if sudo else 'no'}")
+    log(f"\n=== Sync server '{server_id}' (inbound tag '{inbound_tag}') ===")
+    log(f"  include_shared: {include_shared}, dry_run: {dry_run}, sudo: {'yes' if sudo else 'no'}")
 
     db_users = fetch_db_users_for_server(server_id)
-    print(f"  Users from DB with per-user UUID: {len(db_users)}")
+    log(f"  Users from DB with per-user UUID: {len(db_users)}")
     if db_users:
-        print(f"    sample: tid={db_users[0]['telegram_id']}, uuid={db_users[0]['uuid'][:8]}...")
+        log(f"    sample: tid={db_users[0]['telegram_id']}, uuid={db_users[0]['uuid'][:8]}...")
 
     # 1. Прочитать удалённый config
-    print(f"  Fetching {CONFIG_PATH} from {server_id}...")
+    log(f"  Fetching {CONFIG_PATH} from {server_id}...")
     config_text = _ssh_read_file(ssh, CONFIG_PATH, sudo=sudo)
     config = json.loads(config_text)
 
@@ -203,11 +235,11 @@ def sync_one_server(server_id: str, include_shared: bool, dry_run: bool) -> bool
 
     old_clients = (inbounds[target_idx].get("settings") or {}).get("clients") or []
     old_clients_count = len(old_clients)
-    print(f"  Current clients[] count in {inbound_tag}: {old_clients_count}")
+    log(f"  Current clients[] count in {inbound_tag}: {old_clients_count}")
 
     # 3. Заменить clients
     new_clients = build_clients(server_id, db_users, include_shared)
-    print(f"  New clients[] count: {len(new_clients)} ({len(db_users)} per-user + {1 if include_shared else 0} shared)")
+    log(f"  New clients[] count: {len(new_clients)} ({len(db_users)} per-user + {1 if include_shared else 0} shared)")
 
     if "settings" not in inbounds[target_idx]:
         inbounds[target_idx]["settings"] = {}
@@ -233,7 +265,7 @@ def sync_one_server(server_id: str, include_shared: bool, dry_run: bool) -> bool
         level0["statsUserDownlink"] = True
         policy_changed = True
     if policy_changed:
-        print(f"  Added policy.levels.0.statsUser{{Uplink,Downlink}} = true (per-user telemetry)")
+        log(f"  Added policy.levels.0.statsUser{{Uplink,Downlink}} = true (per-user telemetry)")
 
     # Guard «нет изменений → не рестартим Xray»: clients[] поддерживается этим же
     # скриптом, поэтому сравниваем по содержимому (order-independent). Нужно для
@@ -245,98 +277,191 @@ def sync_one_server(server_id: str, include_shared: bool, dry_run: bool) -> bool
 
     new_config_text = json.dumps(config, indent=2, ensure_ascii=False)
 
+    live_plan = None
+    if not no_change and not policy_changed:
+        try:
+            live_plan = plan_client_changes(old_clients, new_clients)
+        except XrayApiError as e:
+            log(f"  Live API невозможен: {e}")
+
     if dry_run:
-        print(f"\n  [DRY RUN] no_change={no_change}"
+        if live_plan is not None:
+            log(f"\n  [DRY RUN] live: +{len(live_plan[0])} −{len(live_plan[1])} через HandlerService, без рестарта")
+        log(f"\n  [DRY RUN] no_change={no_change}"
               + ("  (изменений нет → реальный прогон пропустил бы рестарт)" if no_change
                  else "  (есть изменения → реальный прогон обновил бы config + рестарт)"))
-        print("  [DRY RUN] Resulting clients[] preview:")
+        log("  [DRY RUN] Resulting clients[] preview:")
         for c in new_clients[:5]:
-            print(f"    {c}")
+            log(f"    {c}")
         if len(new_clients) > 5:
-            print(f"    ... и ещё {len(new_clients) - 5}")
-        print("\n  [DRY RUN] Не записываем, не рестартим.")
+            log(f"    ... и ещё {len(new_clients) - 5}")
+        log("\n  [DRY RUN] Не записываем, не рестартим.")
         return True
 
     # Guard: ничего не изменилось — не трогаем config и НЕ рестартим Xray.
     if no_change:
-        print("  ✓ Нет изменений (clients/policy) — config не трогаем, Xray не рестартим.")
+        log("  ✓ Нет изменений (clients/policy) — config не трогаем, Xray не рестартим.")
         return True
 
+    # 3b. Живой путь: без рестарта, существующие соединения не рвутся.
+    if live_plan is not None:
+        run = ssh_runner(ssh)
+        adds, removes = live_plan
+        protocol = inbounds[target_idx].get("protocol") or "vless"
+        try:
+            apply_client_changes(run, inbound_tag, protocol, adds, removes)
+        except XrayApiError as e:
+            log(f"  ⚠ Live API: {e} — fallback на config + restart")
+        else:
+            log(f"  ✓ Live: +{len(adds)} −{len(removes)} через HandlerService, Xray не рестартим")
+            try:
+                write_config_checkpoint(run, CONFIG_PATH, new_config_text, sudo=sudo)
+                log("  ✓ config.json checkpoint (validate OK, без рестарта)")
+            except XrayApiError as e:
+                # runtime уже применён; файл догонит следующий sync (fallback через рестарт)
+                log(f"  ⚠ {e}")
+            log(f"  ✓ {server_id} synced successfully")
+            return True
+
     # 4. Backup + write
     ts = int(time.time())
     backup_path = f"{CONFIG_PATH}.bak.sync.{ts}"
-    print(f"  Backup → {backup_path}")
+    log(f"  Backup → {backup_path}")
     r = _ssh_run(ssh, f"{sudo}cp {CONFIG_PATH} {backup_path}")
     if r.returncode != 0:
         raise RuntimeError(f"backup failed: {r.stderr}")
 
-    print("  Writing new config.json (tmp)...")
+    log("  Writing new config.json (tmp)...")
     # Tmp файл в /tmp (любой user может писать), потом sudo mv в /usr/local/etc
     tmp_path = f"/tmp/xray-sync.{ts}.json"
     _ssh_write_file(ssh, tmp_path, new_config_text, sudo="")  # /tmp не нужен sudo
 
     # 5. Validate
-    print("  Validating with `xray run -test`...")
+    log("  Validating with `xray run -test`...")
     r = _ssh_run(ssh, f"{sudo}xray run -test -format=json -c {tmp_path}", timeout=20)
     if r.returncode != 0:
-        print(f"  ✗ VALIDATE FAIL (rc={r.returncode})")
-        print(f"  stderr: {r.stderr.strip()[:500]}")
-        print(f"  Tmp config оставлен: {tmp_path}")
-        print(f"  Backup исходного: {backup_path}")
+        log(f"  ✗ VALIDATE FAIL (rc={r.returncode})")
+        log(f"  stderr: {r.stderr.strip()[:500]}")
+        log(f"  Tmp config оставлен: {tmp_path}")
+        log(f"  Backup исходного: {backup_path}")
         return False
-    print("  ✓ Validate OK")
+    log("  ✓ Validate OK")
 
     # 6. Atomic replace + restart
-    print("  Replacing config.json + restart xray...")
+    log("  Replacing config.json + restart xray...")
     r = _ssh_run(ssh, f"{sudo}mv {tmp_path} {CONFIG_PATH} && {sudo}systemctl restart xray")
     if r.returncode != 0:
-        print(f"  ✗ Replace/restart failed: {r.stderr}")
+        log(f"  ✗ Replace/restart failed: {r.stderr}")
         return False
     time.sleep(3)
 
     # 7. Smoke-test
     r = _ssh_run(ssh, "systemctl is-active xray && ss -Htnl 'sport = :443' | head -1")
     if r.returncode != 0 or "active" not in r.stdout:
-        print(f"  ✗ POST-RESTART CHECK FAILED:")
-        print(f"  stdout: {r.stdout[:500]}")
-        print(f"  stderr: {r.stderr[:300]}")
+        log(f"  ✗ POST-RESTART CHECK FAILED:")
+        log(f"  stdout: {r.stdout[:500]}")
+        log(f"  stderr: {r.stderr[:300]}")
         rollback_user = "root" if not sudo else ""
-        print(f"  ⚠ ROLLBACK: ssh {server_id} '{sudo}cp {backup_path} {CONFIG_PATH} && {sudo}systemctl restart xray'")
+        log(f"  ⚠ ROLLBACK: ssh {server_id} '{sudo}cp {backup_path} {CONFIG_PATH} && {sudo}systemctl restart xray'")
         return False
-    print(f"  ✓ xray active, :443 listening")
-    print(f"  ✓ {server_id} synced successfully")
+    log(f"  ✓ xray active, :443 listening")
+    log(f"  ✓ {server_id} synced successfully")
     return True
 
 
-def main() -> int:
+def verify_server(server_id: str, log: Log = print) -> bool:
+    """Проверка после sync (канарейка): xray active и :443 слушается."""
+    r = _ssh_run(SERVERS[server_id]["ssh"], "systemctl is-active xray && ss -Htnl 'sport = :443' | head -1")
+    ok = r.returncode == 0 and "active" in r.stdout and ":443" in r.stdout
+    log(f"  {'✓' if ok else '✗'} verify {server_id}: {r.stdout.strip()[:200] or r.stderr.strip()[:200]}")
+    return ok
+
+
+def _run_node(server_id: str, include_shared: bool, dry_run: bool, buffered: bool) -> Tuple[bool, float, List[str]]:
+    """sync_one_server с перехватом исключений. buffered — лог копится в
+    список (параллельный режим), иначе печатается сразу."""
+    lines: List[str] = []
+    log = lines.append if buffered else print
+    t0 = time.monotonic()
+    try:
+        ok = sync_one_server(server_id, include_shared=include_shared, dry_run=dry_run, log=log)
+    except Exception as e:
+        log(f"\n  ✗ EXCEPTION on {server_id}: {e}")
+        log(traceback.format_exc().rstrip())
+        ok = False
+    return ok, time.monotonic() - t0, lines
+
+
+def sync_servers(
+    targets: List[str],
+    include_shared: bool,
+    dry_run: bool,
+    jobs: int = DEFAULT_JOBS,
+    canary: Optional[str] = None,
+) -> Dict[str, Optional[bool]]:
+    """
+    Синкает targets: canary (если задан) — первым и с verify_server, затем
+    остальные пулом из jobs потоков. Возвращает {server: True/False/None},
+    None — не запускался (канарейка не прошла).
+    """
+    results: Dict[str, Optional[bool]] = {}
+    durations: Dict[str, float] = {}
+    rest = list(targets)
+    if canary:
+        print(f"\n### Канарейка: {canary}")
+        ok, durations[canary], _ = _run_node(canary, include_shared, dry_run, buffered=False)
+        if ok and not dry_run:
+            ok = verify_server(canary)
+        results[canary] = ok
+        rest.remove(canary)
+        if not ok:
+            print(f"\n⛔ Канарейка {canary} не прошла — остальные ({', '.join(rest) or '—'}) не трогаем")
+            results.update({srv: None for srv in rest})
+            rest = []
+
+    jobs = max(1, min(jobs, len(rest) or 1))
+    print_lock = threading.Lock()
+    with ThreadPoolExecutor(max_workers=jobs, thread_name_prefix="xray-sync") as pool:
+        futures = {pool.submit(_run_node, srv, include_shared, dry_run, jobs > 1): srv for srv in rest}
+        for fut in as_completed(futures):
+            srv = futures[fut]
+            ok, durations[srv], lines = fut.result()
+            results[srv] = ok
+            with print_lock:
+                for line in lines:
+                    print(line)
+
+    print(f"\n{'=' * 60}")
+    for srv in targets:
+        status = {True: "OK", False: "FAIL", None: "SKIPPED"}[results[srv]]
+        took = f"  {durations[srv]:.1f}s" if srv in durations else ""
+        print(f"  {srv:<8} {status}{took}")
+    return results
+
+
+def main(argv: Optional[List[str]] = None) -> int:
     parser = argparse.ArgumentParser(description="Sync per-user VLESS UUIDs to Xray config.json on main/yc")
     g = parser.add_mutually_exclusive_group(required=True)
-    g.add_argument("--server", choices=["main"], help="Sync only this server")
+    g.add_argument("--server", choices=sorted(SERVERS), help="Sync only this server")
     g.add_argument("--all", action="store_true", help="Sync all servers (main; yc/yc2 убраны 06-28)")
     parser.add_argument("--no-shared", action="store_true",
                         help="Don't include legacy shared UUID (use AFTER broadcast+48h, etap 7)")
     parser.add_argument("--dry-run", action="store_true",
                         help="Show what would be written, don't apply")
-    args = parser.parse_args()
-
-    targets = ["main"] if args.all else [args.server]  # yc/yc2 убраны 06-28 (снос YC)
+    parser.add_argument("--jobs", type=int, default=DEFAULT_JOBS,
+                        help=f"Сколько серверов синкать одновременно (default {DEFAULT_JOBS}; 1 — по очереди)")
+    parser.add_argument("--canary", choices=sorted(SERVERS),
+                        help="Сначала этот сервер + проверка; не прошёл — остальные не трогаем")
+    args = parser.parse_args(argv)
+
+    targets = list(SERVERS) if args.all else [args.server]  # yc/yc2 убраны 06-28 (снос YC)
+    if args.canary and args.canary not in targets:
+        parser.error(f"--canary {args.canary} не входит в синкаемые серверы")
     include_shared = not args.no_shared
 
-    ok_count = 0
-    fail_count = 0
-    for srv in targets:
-        try:
-            if sync_one_server(srv, include_shared=include_shared, dry_run=args.dry_run):
-                ok_count += 1
-            else:
-                fail_count += 1
-        except Exception as e:
-            print(f"\n  ✗ EXCEPTION on {srv}: {e}")
-            import traceback
-            traceback.print_exc()
-            fail_count += 1
-
-    print(f"\n{'=' * 60}")
+    results = sync_servers(targets, include_shared, args.dry_run, jobs=args.jobs, canary=args.canary)
+    ok_count = sum(1 for ok in results.values() if ok)
+    fail_count = len(results) - ok_count
     print(f"Итого: {ok_count} OK, {fail_count} FAIL")
     return 0 if fail_count == 0 else 1
 
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""
+Тест пакетных изменений runtime AmneziaWG (AwgPeerBatch в bot/wireguard_peers.py)
+на ВРЕМЕННОЙ БД, без SSH (execute_server_command подменён внутри теста и
+эмулирует маркеры шардов).
+
+Проверяет:
+  1. N remove/restore по двум шардам — один SSH, по одному `awg set` и
+     save-conf на шард, peer-клаузы в одном вызове.
+  2. Повтор операции над ключом — побеждает последняя; пустой пакет — без SSH.
+  3. Ошибка шарда: остальные применены, failed_shards / applied().
+  4. Больше _AWG_BATCH_CHUNK peer'ов — несколько `awg set`, save-conf один.
+  5. restore_user_revoked_peers — все peer'ы юзера одним SSH.
+  6. enforce_expired._apply_revocations — один SSH на прогон, active=False
+     только для peer'ов применённых шардов; peer с неизвестным шардом не
+     мешает остальным; sub_token не чистится, если peer не отозван.
+
+Запуск:  venv/bin/python scripts/test_awg_batch.py
+"""
+from __future__ import annotations
+
+import contextlib
+import io
+import re
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+try:
+    sys.stdout.reconfigure(encoding="utf-8")
+except Exception:
+    pass
+
+_FAILED = 0
+
+
+def check(name: str, cond: bool) -> None:
+    global _FAILED
+    print(f"  {'✅' if cond else '❌'} {name}")
+    if not cond:
+        _FAILED += 1
+
+
+def main() -> int:
+    tmp = Path(tempfile.mkdtemp(prefix="awg_batch_test_"))
+    import bot.database as db
+    db.DATA_DIR = tmp
+    db.DB_PATH = tmp / "vpn.db"
+    db.USERS_JSON_PATH = tmp / "users.json"
+    db.PEERS_JSON_PATH = tmp / "peers.json"
+    db._db_initialized = False
+    db.init_db()
+    import bot.storage as storage
+    storage.PEERS_FILE = tmp / "peers.json"
+    import bot.wireguard_peers as wg
+    import bot.awg_shards as awg_shards
+
+    env = {
+        "AMNEZIAWG_EU1_ADD_CLIENT_SCRIPT": "/opt/add.sh",
+        "AMNEZIAWG_EU1_REMOVE_CLIENT_SCRIPT": "/opt/remove.sh",
+        "AMNEZIAWG_EU1_SHARDS": "a=amnezia-awg2:awg0:10.50.0.0/24, b=amnezia-awg3:awg1:10.60.0.0/24:48101",
+    }
+    commands: list = []
+    broken: set = set()
+
+    def fake_execute(server_id, cmd, timeout=30):
+        commands.append(cmd)
+        if "/opt/add.sh" in cmd:
+            ip = cmd.rsplit(" ", 1)[1]
+            return f"PUBKEY=PK-{ip}\n[Interface]\nAddress = {ip}/32\n", ""
+        out = []
+        for line in cmd.splitlines():
+            m = re.search(r"AWG_BATCH:OK:([\w.-]+)", line)
+            if m:
+                ok = m.group(1) not in broken
+                out.append(f"AWG_BATCH:{'OK' if ok else 'FAIL'}:{m.group(1)}")
+        return "".join(f"{l}\n" for l in out), "awg: error" if broken else ""
+
+    wg._load_env = lambda: env
+    wg._get_server_config = lambda server_id, env: {"ssh_host": "eu1.test", "endpoint_host": "1.2.3.4"}
+    wg.execute_server_command = fake_execute
+    awg_shards._load_env = lambda: env
+
+    print("1. Один SSH на пакет")
+    batch = wg.AwgPeerBatch()
+    for i in range(5):
+        batch.remove(f"PKa{i}", "a")
+    for i in range(3):
+        batch.restore(f"PKb{i}", f"10.60.0.{10 + i}/24", "b")
+    batch.remove("PK-legacy")
+    check("в пакете 9 операций", len(batch) == 9)
+    failed = batch.apply()
+    check("один SSH", len(commands) == 1 and failed == [])
+    cmd = commands[0]
+    check("по одному awg set на шард",
+          cmd.count("docker exec amnezia-awg2 awg set awg0 ") == 1
+          and cmd.count("docker exec amnezia-awg3 awg set awg1 ") == 1)
+    check("save-conf по разу на шард",
+          cmd.count("/opt/amnezia-save-conf.sh") == 2
+          and "AWG_NETWORK_CIDR=10.60.0.0/24 ENDPOINT_PORT=48101 /opt/amnezia-save-conf.sh" in cmd)
+    check("remove без шарда → первый", "peer PK-legacy remove" in cmd.splitlines()[0])
+    check("restore: psk + /32",
+          "peer PKb1 preshared-key /opt/amnezia/awg/wireguard_psk.key allowed-ips 10.60.0.11/32" in cmd)
+    check("пакет очищен", len(batch) == 0)
+
+    print("\n2. Последняя операция побеждает")
+    commands.clear()
+    check("пустой пакет — без SSH", wg.AwgPeerBatch().apply() == [] and commands == [])
+    batch = wg.AwgPeerBatch()
+    batch.restore("PKx", "10.50.0.7", "a")
+    batch.remove("PKx", "a")
+    batch.apply()
+    check("restore → remove = remove", "peer PKx remove" in commands[0] and "allowed-ips" not in commands[0])
+    try:
+        batch.restore("PKy", "", "a")
+        check("restore без IP → WireGuardError", False)
+    except wg.WireGuardError:
+        check("restore без IP → WireGuardError", True)
+
+    print("\n3. Ошибка шарда")
+    commands.clear()
+    broken.add("b")
+    batch = wg.AwgPeerBatch()
+    batch.remove("PK1", "a")
+    batch.remove("PK2", "b")
+    failed = batch.apply()
+    check(f"не применён только b ({failed})", failed == ["b"] and batch.failed_shards == ["b"])
+    check("applied(): a — да, b — нет", batch.applied("a") and batch.applied(None) and not batch.applied("b"))
+    try:
+        wg.restore_amneziawg_peer_runtime("PK2", "10.60.0.5", "b")
+        check("одиночный restore в сломанный шард → WireGuardError", False)
+    except wg.WireGuardError:
+        check("одиночный restore в сломанный шард → WireGuardError", True)
+    broken.clear()
+
+    print("\n4. Большой пакет")
+    commands.clear()
+    batch = wg.AwgPeerBatch()
+    n = wg._AWG_BATCH_CHUNK * 2 + 1
+    for i in range(n):
+        batch.remove(f"PKbig{i}", "a")
+    batch.apply()
+    check(f"{n} peer'ов → 3 awg set, save-conf один, SSH один",
+          len(commands) == 1 and commands[0].count("awg set awg0") == 3
+          and commands[0].count("/opt/amnezia-save-conf.sh") == 1)
+
+    print("\n5. restore_user_revoked_peers")
+    peers = []
+    for platform in ("pc", "ios", "android"):
+        dev = db.db_add_device(700, platform, platform)
+        peers.append(wg.create_amneziawg_peer_and_config_for_user(700, platform=platform, device_id=dev)[0])
+    for p in peers:
+        storage.upsert_peer(storage.Peer(telegram_id=700, wg_ip=p.wg_ip, public_key=p.public_key, server_id="eu1",
+                                         active=False, platform=p.platform, device_id=p.device_id, shard=p.shard))
+    commands.clear()
+    restored = wg.restore_user_revoked_peers(700)
+    rows = db.db_get_peers_by_telegram_id(700)
+    check(f"3 peer'а одним SSH ({len(commands)})", len(restored) == 3 and len(commands) == 1)
+    check("все active, устройства те же",
+          all(r["active"] for r in rows) and {r["device_id"] for r in rows} == {p.device_id for p in peers})
+    commands.clear()
+    check("повтор — ничего, без SSH", wg.restore_user_revoked_peers(700) == [] and commands == [])
+
+    print("\n6. enforce_expired._apply_revocations")
+    sys.path.insert(0, str(ROOT / "scripts"))
+    import enforce_expired
+    import bot.config
+    bot.config.load_config = lambda: None  # без BOT_TOKEN: уведомления не шлются
+    candidates = []
+    for tid in (801, 802, 803, 804):
+        p, _ = wg.create_amneziawg_peer_and_config_for_user(tid, platform="pc")
+        candidates.append({
+            "telegram_id": tid, "username": None, "expires_at": "", "sub_token": None,
+            "peers": [{"platform": p.platform, "wg_ip": p.wg_ip, "public_key": p.public_key,
+                       "shard": p.shard, "device_id": p.device_id}],
+        })
+    # последний юзер — во втором шарде, который «сломан»
+    db.db_upsert_peer({**db.db_get_peers_by_telegram_id(803)[0], "shard": "b"})
+    candidates[2]["peers"][0]["shard"] = "b"
+    # а этот — в шарде, убранном из конфига: remove() бросает, остальные идут
+    db.db_upsert_peer({**db.db_get_peers_by_telegram_id(804)[0], "shard": "gone"})
+    candidates[3]["peers"][0]["shard"] = "gone"
+    candidates[0]["sub_token"] = candidates[2]["sub_token"] = "tok"
+    broken.add("b")
+    commands.clear()
+    with contextlib.redirect_stdout(io.StringIO()) as out:
+        enforce_expired._apply_revocations(candidates)
+    broken.clear()
+    check(f"один SSH на прогон ({len(commands)})", len(commands) == 1)
+    active = {t: db.db_get_peers_by_telegram_id(t)[0]["active"] for t in (801, 802, 803, 804)}
+    check(f"active=False только в применённом шарде ({active})",
+          not active[801] and not active[802] and active[803] and active[804])
+    check("итог: revoked=2, failed=2", "revoked=2 peer(ов), failed=2" in out.getvalue())
+    check("sub_token чистится только у отозванного юзера",
+          out.getvalue().count("sub_token cleared") == 1 and out.getvalue().count("[SKIP]") == 2)
+
+    print()
+    if _FAILED:
+        print(f"❌ ПРОВАЛЕНО проверок: {_FAILED}")
+        return 1
+    print("✅ Все проверки пройдены")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+Тест сверки runtime AmneziaWG с БД (bot/awg_reconcile.py) на ВРЕМЕННОЙ БД,
+без SSH: execute_server_command подменён эмулятором eu1 (dump шардов и
+пакетный `awg set` меняют словарь runtime).
+
+Проверяет:
+  1. Dry-run: один SSH (dump), план с причинами, runtime не меняется.
+  2. Desired state: active + доступ (grace 12 ч), revoked/expired, пул;
+     чужие peer'ы (нет в peers и пуле) не трогаются.
+  3. Apply: один SSH на пакет; повторный прогон — дрейфа нет, только dump.
+  4. Лимиты прогона: лишнее — deferred, доезжает следующим прогоном.
+  5. Guard: план снимает слишком большую долю шарда — удаления блокируются.
+  6. Шард без dump пропускается; peer в чужом шарде переносится.
+
+Запуск:  venv/bin/python scripts/test_awg_reconcile.py
+"""
+from __future__ import annotations
+
+import re
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+try:
+    sys.stdout.reconfigure(encoding="utf-8")
+except Exception:
+    pass
+
+_FAILED = 0
+
+
+def check(name: str, cond: bool) -> None:
+    global _FAILED
+    print(f"  {'✅' if cond else '❌'} {name}")
+    if not cond:
+        _FAILED += 1
+
+
+def main() -> int:
+    tmp = Path(tempfile.mkdtemp(prefix="awg_reconcile_test_"))
+    import bot.database as db
+    db.DATA_DIR = tmp
+    db.DB_PATH = tmp / "vpn.db"
+    db.USERS_JSON_PATH = tmp / "users.json"
+    db.PEERS_JSON_PATH = tmp / "peers.json"
+    db._db_initialized = False
+    db.init_db()
+    import bot.storage as storage
+    storage.PEERS_FILE = tmp / "peers.json"
+    import bot.wireguard_peers as wg
+    import bot.awg_shards as awg_shards
+    import bot.awg_reconcile as rec
+
+    env = {
+        "AMNEZIAWG_EU1_ADD_CLIENT_SCRIPT": "/opt/add.sh",
+        "AMNEZIAWG_EU1_SHARDS": "a=amnezia-awg2:awg0:10.50.0.0/24, b=amnezia-awg3:awg1:10.60.0.0/24",
+    }
+    by_container = {"amnezia-awg2": "a", "amnezia-awg3": "b"}
+    runtime = {"a": {}, "b": {}}
+    down: set = set()
+    commands: list = []
+
+    def fake_execute(server_id, cmd, timeout=30):
+        commands.append(cmd)
+        out = []
+        if "awg show" in cmd:
+            for line in cmd.splitlines():
+                shard = by_container[re.search(r"docker exec (\S+) awg show", line).group(1)]
+                out.append(f"AWG_DUMP:{shard}")
+                if shard in down:
+                    out.append("AWG_DUMP:FAIL")
+                    continue
+                out.append("PRIV\tPUB-iface\t51820\toff")
+                for pk, ips in runtime[shard].items():
+                    out.append(f"{pk}\t(none)\t(none)\t{ips}\t0\t0\t0\toff")
+            return "".join(f"{l}\n" for l in out), ""
+        for line in cmd.splitlines():
+            shard = by_container[re.search(r"docker exec (\S+) awg set", line).group(1)]
+            for pk, op, ips in re.findall(r"peer (\S+) (remove|preshared-key \S+ allowed-ips (\S+))", line):
+                if op == "remove":
+                    runtime[shard].pop(pk, None)
+                else:
+                    runtime[shard][pk] = ips
+            out.append(f"AWG_BATCH:OK:{shard}")
+        return "".join(f"{l}\n" for l in out), ""
+
+    wg._load_env = lambda: env
+    wg._get_server_config = lambda server_id, env: {"ssh_host": "eu1.test", "endpoint_host": "1.2.3.4"}
+    wg.execute_server_command = fake_execute
+    awg_shards._load_env = lambda: env
+
+    def user(tid: int, expires: str) -> None:
+        with db._conn() as con:
+            con.execute("INSERT INTO users (telegram_id, expires_at) VALUES (?, datetime('now', ?))",
+                        (tid, expires))
+
+    def slot(tid: int, ip: str, active: bool = True, shard: str = "a") -> str:
+        pk = f"PK{tid}"
+        storage.upsert_peer(storage.Peer(telegram_id=tid, wg_ip=ip, public_key=pk, server_id="eu1",
+                                         active=active, platform="pc", shard=shard))
+        return pk
+
+    user(1, "+30 days"); ok = slot(1, "10.50.0.2/24")
+    user(2, "+30 days"); missing = slot(2, "10.50.0.3/24")
+    user(3, "+30 days"); revoked = slot(3, "10.50.0.4/24", active=False)
+    user(4, "-2 days"); expired = slot(4, "10.50.0.5/24")
+    user(5, "-1 hours"); grace = slot(5, "10.50.0.6/24")
+    user(6, "+30 days"); wrong_ip = slot(6, "10.60.0.7/24", shard="b")
+    legacy = slot(7, "10.50.0.8/24")           # юзера нет в users — не отзываем
+    with db._conn() as con:
+        con.execute("UPDATE peers SET shard = NULL WHERE telegram_id = 7")  # NULL → первый шард
+    db.db_warm_pool_add("eu1", "a", "10.50.0.20", "PKpool1", "cfg")
+    db.db_warm_pool_add("eu1", "b", "10.60.0.21", "PKpool2", "cfg")
+    runtime["a"].update({ok: "10.50.0.2/32", revoked: "10.50.0.4/32", expired: "10.50.0.5/32",
+                         grace: "10.50.0.6/32", legacy: "10.50.0.8/32", "PKpool1": "10.50.0.20/32",
+                         "OWNER": "10.50.0.250/32"})
+    runtime["b"].update({wrong_ip: "10.60.0.99/32"})
+
+    print("1. Dry-run")
+    before = {s: dict(p) for s, p in runtime.items()}
+    report = rec.reconcile_awg()
+    adds = {a["public_key"]: a["reason"] for a in report["add"]}
+    removes = {r["public_key"]: r["reason"] for r in report["remove"]}
+    check("один SSH (dump), runtime не изменён", len(commands) == 1 and runtime == before)
+    check(f"add: {adds}", adds == {missing: "missing", wrong_ip: "allowed_ips", "PKpool2": "missing"})
+    check(f"remove: {removes}", removes == {revoked: "revoked", expired: "expired"})
+
+    print("\n2. Desired state")
+    check("grace 12 ч и юзер без users — остаются", grace not in removes and legacy not in removes)
+    check("чужой peer (OWNER) — unknown, не трогаем",
+          report["unknown"] == {"a": 1} and "OWNER" not in removes)
+    check(f"desired по шардам ({report['desired']})", report["desired"] == {"a": 5, "b": 2})
+
+    print("\n3. Apply")
+    commands.clear()
+    report = rec.reconcile_awg(apply=True)
+    check("dump + один пакет", len(commands) == 2)
+    check(f"применено {report['applied']}", report["applied"] == {"add": 3, "remove": 2})
+    check("runtime сошёлся",
+          missing in runtime["a"] and revoked not in runtime["a"] and expired not in runtime["a"]
+          and runtime["b"][wrong_ip] == "10.60.0.7/32" and "PKpool2" in runtime["b"]
+          and "OWNER" in runtime["a"])
+    check("БД не тронута", db.db_get_peers_by_telegram_id(4)[0]["active"] == 1)
+    commands.clear()
+    report = rec.reconcile_awg(apply=True)
+    check("повтор — дрейфа нет, только dump", not report["add"] and not report["remove"] and len(commands) == 1)
+
+    print("\n4. Лимиты")
+    for tid in range(10, 14):
+        user(tid, "+30 days")
+        slot(tid, f"10.50.0.{tid + 100}/24")
+    report = rec.reconcile_awg(apply=True, max_adds=3)
+    check(f"3 добавлено, 1 отложен ({report['deferred']})",
+          report["applied"]["add"] == 3 and report["deferred"] == {"add": 1, "remove": 0})
+    report = rec.reconcile_awg(apply=True, max_adds=3)
+    check("следующий прогон доделал", report["applied"]["add"] == 1 and report["deferred"]["add"] == 0)
+
+    print("\n5. Guard на массовое удаление")
+    with db._conn() as con:
+        con.execute("UPDATE peers SET active = 0 WHERE server_id = 'eu1'")
+    in_a = set(runtime["a"])
+    report = rec.reconcile_awg(apply=True)
+    check(f"удаления в a заблокированы ({report['removes_blocked']}), в b (1 peer) — нет",
+          report["removes_blocked"] == ["a"] and set(runtime["a"]) == in_a
+          and report["applied"]["remove"] == 1 and wrong_ip not in runtime["b"])
+    with db._conn() as con:
+        con.execute("UPDATE peers SET active = 1 WHERE telegram_id <> 3")
+
+    print("\n6. Шард без dump, перенос шарда")
+    down.add("b")
+    runtime["b"].pop("PKpool2")
+    report = rec.reconcile_awg(apply=True)
+    check("шард b пропущен", report["failed_shards"] == ["b"] and "PKpool2" not in runtime["b"])
+    down.clear()
+    runtime["b"]["PKpool2"] = "10.60.0.21/32"
+    with db._conn() as con:
+        con.execute("UPDATE peers SET shard = 'b' WHERE telegram_id = 2")
+    report = rec.reconcile_awg(apply=True)
+    check("peer перенесён в свой шард",
+          runtime["b"].get(missing) == "10.50.0.3/32" and missing not in runtime["a"]
+          and {r["reason"] for r in report["remove"]} == {"misplaced"})
+
+    print()
+    if _FAILED:
+        print(f"❌ ПРОВАЛЕНО проверок: {_FAILED}")
+        return 1
+    print("✅ Все проверки пройдены")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
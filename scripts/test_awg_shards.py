@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+Тест шардирования AmneziaWG на eu1 (bot/awg_shards.py + выдача в
+bot/wireguard_peers.py) на ВРЕМЕННОЙ БД, без SSH (execute_server_command
+подменён внутри теста).
+
+Проверяет:
+  1. Разбор AMNEZIAWG_EU1_SHARDS; fallback на старые AMNEZIAWG_EU1_* ; ошибки.
+  2. Заполнение по порядку: маленький шард /29 (5 адресов) заполнен →
+     следующий peer уходит во второй шард; шард записан в peers.shard.
+  3. Команды add/remove/restore адресуют контейнер и интерфейс шарда peer'а.
+  4. upsert без shard не затирает записанный шард (restore/enforce).
+  5. Пулы в подсети шире /24.
+  6. Ошибка до add-скрипта — AwgNotProvisionedError (повтор безопасен);
+     после — обычная WireGuardError, аренда IP не отдаётся.
+
+Запуск:  venv/bin/python scripts/test_awg_shards.py
+"""
+from __future__ import annotations
+
+import re
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+try:
+    sys.stdout.reconfigure(encoding="utf-8")
+except Exception:
+    pass
+
+_FAILED = 0
+
+
+def check(name: str, cond: bool) -> None:
+    global _FAILED
+    print(f"  {'✅' if cond else '❌'} {name}")
+    if not cond:
+        _FAILED += 1
+
+
+def main() -> int:
+    tmp = Path(tempfile.mkdtemp(prefix="awg_shards_test_"))
+    import bot.database as db
+    db.DATA_DIR = tmp
+    db.DB_PATH = tmp / "vpn.db"
+    db.USERS_JSON_PATH = tmp / "users.json"
+    db.PEERS_JSON_PATH = tmp / "peers.json"
+    db._db_initialized = False
+    db.init_db()
+    import bot.storage as storage
+    storage.PEERS_FILE = tmp / "peers.json"
+    import bot.wireguard_peers as wg
+    from bot.awg_shards import get_awg_shards, resolve_shard
+
+    print("1. Конфиг шардов")
+    env = {
+        "AMNEZIAWG_EU1_ADD_CLIENT_SCRIPT": "/opt/add.sh",
+        "AMNEZIAWG_EU1_REMOVE_CLIENT_SCRIPT": "/opt/remove.sh",
+        "AMNEZIAWG_EU1_SHARDS": "a=amnezia-awg2:awg0:10.50.0.0/29, b=amnezia-awg3:awg1:10.60.0.0/22:48101",
+    }
+    shards = get_awg_shards(env)
+    check(f"два шарда по порядку ({[s.name for s in shards]})",
+          [s.name for s in shards] == ["a", "b"] and shards[1].interface == "awg1"
+          and shards[1].endpoint_port == "48101" and shards[0].endpoint_port == "")
+    legacy = get_awg_shards({"AMNEZIAWG_EU1_INTERFACE": "wg0", "AMNEZIAWG_EU1_NETWORK_CIDR": "10.1.0.0/24"})
+    check("без AMNEZIAWG_EU1_SHARDS — один шард из старых переменных",
+          len(legacy) == 1 and legacy[0].interface == "wg0" and legacy[0].container == "amnezia-awg2")
+    check("NULL-шард → первый", resolve_shard(None, env).name == "a")
+    for bad in ("a=c:i", "a=c:i:10.0.0.0/24,a=d:i:10.1.0.0/24"):
+        try:
+            get_awg_shards({"AMNEZIAWG_EU1_SHARDS": bad})
+            check(f"ошибка конфига {bad!r}", False)
+        except ValueError:
+            check(f"ошибка конфига {bad!r}", True)
+
+    commands: list = []
+    broken_script = {"on": False}
+
+    def fake_execute(server_id, cmd, timeout=30):
+        commands.append(cmd)
+        if "/opt/add.sh" in cmd and broken_script["on"]:
+            return "PUBKEY=ERROR\n", "awg: interface not found"
+        if "/opt/add.sh" in cmd:
+            ip = cmd.rsplit(" ", 1)[1]
+            return f"PUBKEY=PK-{ip}\n[Interface]\nAddress = {ip}/32\n", ""
+        if "AWG_BATCH:OK:" in cmd:  # пакет AwgPeerBatch: каждый шард отчитывается маркером
+            return "".join(f"AWG_BATCH:OK:{m}\n" for m in re.findall(r"AWG_BATCH:OK:([\w.-]+)", cmd)), ""
+        return "", ""
+
+    wg._load_env = lambda: env
+    wg._get_server_config = lambda server_id, env: {"ssh_host": "eu1.test", "endpoint_host": "1.2.3.4"}
+    wg.execute_server_command = fake_execute
+    import bot.awg_shards as awg_shards
+    awg_shards._load_env = lambda: env
+
+    print("\n2. Заполнение по порядку")
+    created = []
+    for tid in range(1, 8):
+        peer, _conf = wg.create_amneziawg_peer_and_config_for_user(tid, platform="pc")
+        created.append(peer)
+    first = [p for p in created if p.shard == "a"]
+    second = [p for p in created if p.shard == "b"]
+    check(f"/29 вмещает 5 peers ({[p.wg_ip for p in first]})",
+          len(first) == 5 and all(p.wg_ip.startswith("10.50.0.") for p in first))
+    check(f"6-й и 7-й — во втором шарде ({[p.wg_ip for p in second]})",
+          [p.wg_ip for p in second] == ["10.60.0.2/22", "10.60.0.3/22"])
+    row = db.db_get_peers_by_telegram_id(6)[0]
+    check(f"peers.shard записан ({row['shard']})", row["shard"] == "b")
+    check("add-скрипт второго шарда получил его контейнер/интерфейс/порт",
+          "AWG_DOCKER_CONTAINER=amnezia-awg3 AWG_INTERFACE=awg1" in commands[5]
+          and "ENDPOINT_PORT=48101" in commands[5])
+
+    print("\n3. Runtime-операции по шарду peer'а")
+    commands.clear()
+    peer6 = storage.find_peer_by_telegram_id(6, server_id="eu1")
+    wg.revoke_amneziawg_peer_soft(peer6.public_key, peer6.shard)
+    check("revoke → remove-скрипт в amnezia-awg3", commands and "amnezia-awg3" in commands[-1])
+    wg.restore_amneziawg_peer_runtime(peer6.public_key, peer6.wg_ip, peer6.shard)
+    check("restore → docker exec amnezia-awg3 awg set awg1 + save-conf шарда",
+          "docker exec amnezia-awg3 awg set awg1" in commands[-1]
+          and "AWG_NETWORK_CIDR=10.60.0.0/22 ENDPOINT_PORT=48101 /opt/amnezia-save-conf.sh" in commands[-1])
+    wg._remove_amneziawg_peer("PK-legacy")
+    check("без шарда → первый (amnezia-awg2)", "amnezia-awg2" in commands[-1])
+
+    print("\n4. upsert без shard")
+    storage.upsert_peer(storage.Peer(telegram_id=6, wg_ip=peer6.wg_ip, public_key=peer6.public_key,
+                                     server_id="eu1", active=False, platform="pc"))
+    row = db.db_get_peers_by_telegram_id(6)[0]
+    check("soft-revoke (Peer без shard) сохранил шард", row["shard"] == "b" and not row["active"])
+    restored = wg.restore_user_revoked_peers(6)
+    row = db.db_get_peers_by_telegram_id(6)[0]
+    check("restore_user_revoked_peers: active, шард тот же",
+          len(restored) == 1 and row["active"] and row["shard"] == "b")
+    commands.clear()
+    peer, _ = wg.regenerate_amneziawg_peer_and_config_for_user(7, platform="pc")
+    check(f"регенерация: тот же IP и шард ({peer.wg_ip}, {peer.shard})",
+          peer.wg_ip == "10.60.0.3/22" and peer.shard == "b" and "amnezia-awg3" in commands[0])
+
+    print("\n5. Пулы шире /24")
+    ip = wg._allocate_ip_in_pool("10.70.0.0/22", "eu1", 300, 1000, 99)
+    check(f"пул 300–1000 в /22 → 10.70.1.44 ({ip})", ip == "10.70.1.44/32")
+    try:
+        wg._allocate_ip_in_pool("10.80.0.0/25", "eu1", 8, 100, 99)
+        check("/25 → WireGuardError", False)
+    except wg.WireGuardError:
+        check("/25 → WireGuardError", True)
+
+    print("\n6. Ошибки выдачи")
+    full_env = dict(env, AMNEZIAWG_EU1_SHARDS="a=amnezia-awg2:awg0:10.50.0.0/29")
+    wg._load_env = lambda: full_env
+    commands.clear()
+    try:
+        wg.create_amneziawg_peer_and_config_for_user(50, platform="pc")
+        check("шарды заполнены → AwgNotProvisionedError", False)
+    except wg.AwgNotProvisionedError:
+        check("шарды заполнены → AwgNotProvisionedError, скрипт не вызывался", not commands)
+    wg._load_env = lambda: env
+    broken_script["on"] = True
+    try:
+        wg.create_amneziawg_peer_and_config_for_user(51, platform="pc")
+        check("скрипт упал → WireGuardError", False)
+    except wg.AwgNotProvisionedError:
+        check("скрипт упал → не AwgNotProvisionedError", False)
+    except wg.WireGuardError:
+        check("скрипт упал → WireGuardError (без повтора)", True)
+    broken_script["on"] = False
+    with db._conn() as con:
+        leased = con.execute("SELECT host FROM ip_leases WHERE telegram_id = 51").fetchall()
+    check(f"аренда IP после вызова скрипта не отдана ({[r[0] for r in leased]})", len(leased) == 1)
+
+    print("\n7. Шард убран из конфига")
+    try:
+        resolve_shard("gone", env)
+        check("неизвестный шард → WireGuardError", False)
+    except wg.WireGuardError:
+        check("неизвестный шард → WireGuardError", True)
+    did = db.db_add_device(60, "laptop", os="pc")
+    wg.create_amneziawg_peer_and_config_for_user(60, platform="pc", device_id=did)
+    with db._conn() as con:
+        con.execute("UPDATE peers SET shard = 'gone' WHERE telegram_id = 60")
+    try:
+        wg.regenerate_amneziawg_peer_and_config_for_user(60, platform="pc", device_id=did)
+        check("регенерация слота с убранным шардом → WireGuardError", False)
+    except wg.WireGuardError:
+        check("регенерация слота с убранным шардом → WireGuardError", True)
+    wg.delete_amneziawg_device(60, did)
+    check("удаление устройства с убранным шардом прошло",
+          not [r for r in db.db_get_peers_by_telegram_id(60) if r.get("device_id") == did])
+
+    print()
+    if _FAILED:
+        print(f"❌ ПРОВАЛЕНО проверок: {_FAILED}")
+        return 1
+    print("✅ Все проверки пройдены")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
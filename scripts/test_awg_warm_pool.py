@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+Тест тёплого пула AmneziaWG (bot/awg_warm_pool.py + claim в
+bot/wireguard_peers.py / bot/storage.py) на ВРЕМЕННОЙ БД, без SSH
+(execute_server_command подменён внутри теста).
+
+Проверяет:
+  1. Пополнение до цели: add-скрипт по разу на peer, IP арендован за пулом.
+  2. Выдача нового слота из пула — без SSH; слот в peers с шардом пула,
+     аренда IP перешла на юзера; android_safe применяется к конфигу пула.
+  3. После выдачи пул пополняется обратно до цели.
+  4. Пул пуст — обычный путь через скрипт, без лишних устройств.
+  5. Адреса пула не выдаются повторно и не подбираются как «забытые».
+  6. Ошибка скрипта: IP возвращается, пополнение останавливается.
+  7. Peer'ы шарда, убранного из конфига, вычищаются из пула (аренды отданы).
+  8. Параллельные выдачи из пула — без дублей.
+
+Запуск:  venv/bin/python scripts/test_awg_warm_pool.py
+"""
+from __future__ import annotations
+
+import sys
+import tempfile
+import threading
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+try:
+    sys.stdout.reconfigure(encoding="utf-8")
+except Exception:
+    pass
+
+_FAILED = 0
+
+
+def check(name: str, cond: bool) -> None:
+    global _FAILED
+    print(f"  {'✅' if cond else '❌'} {name}")
+    if not cond:
+        _FAILED += 1
+
+
+def main() -> int:
+    tmp = Path(tempfile.mkdtemp(prefix="awg_warm_pool_test_"))
+    import bot.database as db
+    db.DATA_DIR = tmp
+    db.DB_PATH = tmp / "vpn.db"
+    db.USERS_JSON_PATH = tmp / "users.json"
+    db.PEERS_JSON_PATH = tmp / "peers.json"
+    db._db_initialized = False
+    db.init_db()
+    import bot.storage as storage
+    storage.PEERS_FILE = tmp / "peers.json"
+    import bot.wireguard_peers as wg
+    import bot.awg_shards as awg_shards
+    import bot.awg_warm_pool as pool
+
+    env = {
+        "AMNEZIAWG_EU1_ADD_CLIENT_SCRIPT": "/opt/add.sh",
+        "AMNEZIAWG_EU1_REMOVE_CLIENT_SCRIPT": "/opt/remove.sh",
+        "AMNEZIAWG_EU1_SHARDS": "a=amnezia-awg2:awg0:10.50.0.0/24",
+        "AMNEZIAWG_EU1_WARM_POOL": "3",
+    }
+    commands: list = []
+    fail = {"add": False}
+
+    def fake_execute(server_id, cmd, timeout=30):
+        commands.append(cmd)
+        if "/opt/add.sh" in cmd:
+            if fail["add"]:
+                return "PUBKEY=ERROR\n", "awg: error"
+            ip = cmd.rsplit(" ", 1)[1]
+            return f"PUBKEY=PK-{ip}\n[Interface]\nAddress = {ip}/32\nDNS = 1.1.1.1, 1.0.0.1\n", ""
+        return "", ""
+
+    wg._load_env = lambda: env
+    wg._get_server_config = lambda server_id, env: {"ssh_host": "eu1.test", "endpoint_host": "1.2.3.4"}
+    wg.execute_server_command = fake_execute
+    awg_shards._load_env = lambda: env
+    space = "eu1:10.50.0.0/24"
+
+    def lease_owner(host: str):
+        with db._conn() as con:
+            r = con.execute("SELECT telegram_id FROM ip_leases WHERE space = ? AND host = ?",
+                            (space, host)).fetchone()
+        return r[0] if r else None
+
+    print("1. Пополнение")
+    added = pool.fill_warm_pool()
+    depth = db.db_warm_pool_depth("eu1")
+    check(f"создано 3, в пуле {depth}", added == 3 and depth == {"a": 3})
+    check("add-скрипт — по разу на peer", sum("/opt/add.sh" in c for c in commands) == 3)
+    rows = db.db_warm_pool_list("eu1")
+    check("IP пула арендованы за WARM_POOL_TELEGRAM_ID",
+          all(lease_owner(r["host"]) == db.WARM_POOL_TELEGRAM_ID for r in rows))
+    check("повторное пополнение при полном пуле — ничего", pool.fill_warm_pool() == 0)
+
+    print("\n2. Выдача из пула")
+    commands.clear()
+    oldest = rows[0]
+    peer, cfg = wg.create_amneziawg_peer_and_config_for_user(101, platform="pc")
+    check("без SSH", commands == [])
+    check(f"peer из пула ({peer.wg_ip}, {peer.public_key})",
+          peer.wg_ip == oldest["wg_ip"] and peer.public_key == oldest["public_key"] and peer.shard == "a")
+    row = db.db_get_peers_by_telegram_id(101)[0]
+    check("слот в peers (шард, устройство)", row["wg_ip"] == peer.wg_ip and row["shard"] == "a" and row["device_id"])
+    check("аренда IP перешла на юзера", lease_owner(oldest["host"]) == 101)
+    check("строка ушла из пула", db.db_warm_pool_depth("eu1") == {"a": 2})
+    check("устройство одно", len(db.db_list_devices(101)) == 1)
+    dev = db.db_add_device(102, "Телефон", "android")
+    peer2, cfg2 = wg.create_amneziawg_peer_and_config_for_user(102, android_safe=True, platform="android",
+                                                               device_id=dev)
+    check("явный device_id сохранён", peer2.device_id == dev and db.db_get_peers_by_telegram_id(102)[0]["device_id"] == dev)
+    check("android_safe — один DNS", "DNS = 1.1.1.1\n" in cfg2 + "\n" and "1.0.0.1" not in cfg2)
+
+    print("\n3. Пополнение после выдачи")
+    commands.clear()
+    check("дозаполнено 2", pool.fill_warm_pool() == 2 and db.db_warm_pool_depth("eu1") == {"a": 3})
+
+    print("\n4. Пул пуст")
+    for tid in (201, 202, 203):
+        wg.create_amneziawg_peer_and_config_for_user(tid, platform="pc")
+    check("пул выбран", db.db_warm_pool_depth("eu1") == {})
+    commands.clear()
+    peer, _ = wg.create_amneziawg_peer_and_config_for_user(204, platform="pc")
+    check("промах — через add-скрипт", len(commands) == 1 and "/opt/add.sh" in commands[0])
+    check("устройство одно", len(db.db_list_devices(204)) == 1)
+    ips = [r["wg_ip"] for t in (101, 102, 201, 202, 203, 204) for r in db.db_get_peers_by_telegram_id(t)]
+    check(f"все адреса разные ({len(set(ips))} из {len(ips)})", len(set(ips)) == len(ips))
+
+    print("\n5. Аренды пула")
+    pool.fill_warm_pool()
+    with db._conn() as con:
+        con.execute("UPDATE ip_leases SET leased_at = datetime('now', '-1 day')")
+        reclaimed = db._ip_reclaim_stale(con, space)
+    check(f"подбор забытых аренд не трогает пул (подобрано {reclaimed})",
+          reclaimed == 0 and all(lease_owner(r["host"]) == 0 for r in db.db_warm_pool_list("eu1")))
+    pool_hosts = {r["host"] for r in db.db_warm_pool_list("eu1")}
+    ip = wg._allocate_awg_slot(301, env)[1].split("/")[0]
+    check(f"обычная выдача не берёт адрес пула ({ip})", ip not in pool_hosts)
+    db.db_ip_release(301, ip)
+
+    print("\n6. Ошибка скрипта")
+    peer, _ = wg.create_amneziawg_peer_and_config_for_user(401, platform="pc")
+    fail["add"] = True
+    errors = pool._stats["fill_errors"]
+    leases_before = db.db_ip_pool_stats(space)
+    check("пополнение остановилось", pool.fill_warm_pool() == 0 and pool._stats["fill_errors"] == errors + 1)
+    check("IP вернулся в пул", db.db_ip_pool_stats(space)["hosts"]["free"] == leases_before["hosts"]["free"])
+    fail["add"] = False
+
+    print("\n7. Шард убран из конфига")
+    pool.fill_warm_pool()
+    env["AMNEZIAWG_EU1_SHARDS"] = "b=amnezia-awg3:awg0:10.60.0.0/24"
+    commands.clear()
+    hosts = [r["host"] for r in db.db_warm_pool_list("eu1")]
+    pruned = pool.prune_warm_pool()
+    check(f"вычищено {pruned}", pruned == 3 and db.db_warm_pool_depth("eu1") == {})
+    check("без SSH (контейнер выведенного шарда неизвестен)", commands == [])
+    check("аренды отданы", all(lease_owner(h) is None for h in hosts))
+
+    print("\n8. Параллельные выдачи")
+    pool.fill_warm_pool(target=6)
+    got: list = []
+    errors_: list = []
+
+    def claim(tid: int) -> None:
+        try:
+            got.append(wg.create_amneziawg_peer_and_config_for_user(tid, platform="pc")[0].wg_ip)
+        except Exception as exc:  # noqa: BLE001
+            errors_.append(exc)
+
+    commands.clear()
+    threads = [threading.Thread(target=claim, args=(500 + i,)) for i in range(6)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    check(f"6 выдач, без ошибок ({errors_})", len(got) == 6 and not errors_)
+    check("все из пула, без SSH, адреса разные", commands == [] and len(set(got)) == 6)
+
+    stats = pool.warm_pool_stats()
+    check(f"метрики: claimed={stats['claimed']} depth={stats['depth']} target={stats['target']}",
+          stats["claimed"] == 12 and stats["depth"] == 0 and stats["target"] == 3 and stats["filled"] >= 14)
+
+    print()
+    if _FAILED:
+        print(f"❌ ПРОВАЛЕНО проверок: {_FAILED}")
+        return 1
+    print("✅ Все проверки пройдены")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -40,15 +40,10 @@ def get_peer_for_tid(tid: int):
 
 
 def awg_show_has_peer(pubkey: str) -> bool:
-    """Проверяет что pubkey есть в runtime AWG."""
-    import subprocess
-    r = subprocess.run(
-        ["docker", "exec", "amnezia-awg2", "awg", "show", "awg0", "dump"],
-        capture_output=True, text=True, timeout=10,
-    )
-    if r.returncode != 0:
-        return False
-    return pubkey.strip() in r.stdout
+    """Проверяет что pubkey есть в runtime AWG (любого шарда)."""
+    from bot.awg_shards import awg_dump_all
+    dump, _failed = awg_dump_all(timeout=10)
+    return pubkey.strip() in dump
 
 
 def cleanup_test_peer(pubkey: str | None):
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Тест нормализованного срока доступа users.expires_epoch на ВРЕМЕННОЙ БД.
+
+Проверяет:
+  1. Триггеры держат expires_epoch в синхроне со смешанными форматами
+     expires_at (isoformat с 'T'/микросекундами, datetime('now'), +03:00, мусор).
+  2. db_extend_subscription / сырой UPDATE (как в main.py) обновляют epoch.
+  3. Backfill: БД, где колонка уже есть, но epoch устарел, — миграция доливает.
+  4. Сегменты/счётчики на epoch совпадают со старым datetime(expires_at).
+  5. EXPLAIN QUERY PLAN: активные юзеры берутся по idx_users_expires_epoch.
+
+Запуск:  venv/bin/python scripts/test_expires_epoch.py
+"""
+from __future__ import annotations
+
+import calendar
+import sys
+import tempfile
+from datetime import datetime, timedelta
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+try:
+    sys.stdout.reconfigure(encoding="utf-8")
+except Exception:
+    pass
+
+_FAILED = 0
+
+
+def check(name: str, cond: bool) -> None:
+    global _FAILED
+    print(f"  {'✅' if cond else '❌'} {name}")
+    if not cond:
+        _FAILED += 1
+
+
+def main() -> int:
+    tmp = Path(tempfile.mkdtemp(prefix="expires_epoch_test_"))
+    import bot.database as db
+    db.DATA_DIR = tmp
+    db.DB_PATH = tmp / "vpn.db"
+    db.USERS_JSON_PATH = tmp / "users.json"
+    db.PEERS_JSON_PATH = tmp / "peers.json"
+    db._db_initialized = False
+    db.init_db()
+
+    now = datetime.utcnow().replace(microsecond=0)
+    formats = {
+        101: (now + timedelta(days=3, microseconds=123456)).isoformat(),   # 'T' + µs
+        102: (now - timedelta(hours=2)).strftime("%Y-%m-%d %H:%M:%S"),     # datetime('now')-стиль
+        103: (now + timedelta(hours=5)).isoformat() + "+03:00",            # с зоной → UTC now+2h
+        104: (now - timedelta(days=1)).isoformat(),                        # истёк вчера
+        105: "не дата",
+        106: None,                                                         # placeholder
+    }
+    for tid, exp in formats.items():
+        db.db_upsert_user({"telegram_id": tid, "username": f"u{tid}"})
+        with db._conn() as con:
+            con.execute("UPDATE users SET expires_at = ? WHERE telegram_id = ?", (exp, tid))
+
+    def epoch(tid: int):
+        with db._conn() as con:
+            return con.execute(
+                "SELECT expires_epoch FROM users WHERE telegram_id = ?", (tid,)
+            ).fetchone()[0]
+
+    print("1. Триггеры и форматы")
+    check("'T' + микросекунды", epoch(101) == calendar.timegm((now + timedelta(days=3)).timetuple()))
+    with db._conn() as con:
+        same = con.execute(
+            "SELECT COUNT(*) FROM users WHERE expires_at IS NOT NULL "
+            "AND expires_epoch IS NOT CAST(strftime('%s', expires_at) AS INTEGER)"
+        ).fetchone()[0]
+    check("epoch = strftime('%s', expires_at) у всех строк", same == 0)
+    check("+03:00 приведён к UTC", epoch(103) == epoch(102) + 4 * 3600)
+    check("мусор и NULL → NULL", epoch(105) is None and epoch(106) is None)
+
+    print("\n2. Писатели")
+    new_exp = db.db_extend_subscription(104, 30)
+    check("db_extend_subscription пересчитал epoch",
+          epoch(104) == calendar.timegm(datetime.fromisoformat(new_exp).timetuple()))
+    with db._conn() as con:
+        con.execute(
+            "UPDATE users SET expires_at = datetime('now'), subscription_status = 'expired' "
+            "WHERE telegram_id = ? AND expires_at IS NULL", (106,),
+        )
+        now_epoch = con.execute("SELECT CAST(strftime('%s', 'now') AS INTEGER)").fetchone()[0]
+    check("сырой UPDATE expires_at = datetime('now') (main.py) → epoch", abs(epoch(106) - now_epoch) <= 2)
+
+    print("\n3. Backfill")
+    with db._conn() as con:
+        con.execute("DROP TRIGGER trg_users_expires_epoch_upd")
+        con.execute("UPDATE users SET expires_at = '2030-01-01 00:00:00' WHERE telegram_id = 101")
+        stale = epoch(101)
+    db._migrate_add_expires_epoch_column()
+    check("устаревший epoch долит миграцией", stale != epoch(101) and epoch(101) == 1893456000)
+    with db._conn() as con:
+        con.execute("UPDATE users SET expires_at = '2031-01-01 00:00:00' WHERE telegram_id = 101")
+    check("триггер пересоздан", epoch(101) == 1924992000)
+
+    print("\n4. Семантика запросов")
+    with db._conn() as con:
+        legacy = {r[0] for r in con.execute(
+            "SELECT telegram_id FROM users WHERE telegram_id > 0 AND active = 1 "
+            "AND expires_at IS NOT NULL AND datetime(expires_at) > datetime('now')"
+        ).fetchall()}
+    active = {u["telegram_id"] for u in db.db_users_by_segment("active")}
+    check(f"segment active == datetime()-фильтр ({sorted(active)})", active == legacy)
+    check("db_count_active_users совпадает", db.db_count_active_users() == len(legacy))
+    inactive = {u["telegram_id"] for u in db.db_users_by_segment("inactive")}
+    check("active ⊔ inactive = все", active | inactive == set(formats) and not active & inactive)
+
+    print("\n5. План запроса")
+    with db._conn() as con:
+        plan = " | ".join(r[3] for r in con.execute(
+            f"EXPLAIN QUERY PLAN SELECT telegram_id FROM users WHERE {db._SEG_ACTIVE}"
+        ).fetchall())
+    check(f"range scan по индексу ({plan})", "idx_users_expires_epoch" in plan)
+
+    print()
+    if _FAILED:
+        print(f"❌ ПРОВАЛЕНО проверок: {_FAILED}")
+        return 1
+    print("✅ Все проверки пройдены")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
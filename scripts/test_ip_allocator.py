@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Тест IP-аллокатора (db_ip_allocate + обёртки bot/wireguard_peers.py) на
+ВРЕМЕННОЙ БД.
+
+Проверяет:
+  1. Засев из существующих peers: выдаётся наименьший свободный адрес.
+  2. Пулы VPN+GPT (8–254 без 20–50) и Unified (20–50) делят пространство
+     подсети с обычным пулом — один адрес не выдаётся дважды.
+  3. Освобождение: удаление слота (db_delete_peer / db_delete_device) и смена
+     wg_ip возвращают адрес; soft-revoke (active=0) — нет; db_ip_release после
+     сбоя выдачи.
+  4. Слот, вставленный мимо аллокатора, «усыновляется», а не выдаётся повторно.
+  5. Исчерпание пула и подбор забытых аренд.
+  6. Параллельная выдача из 8 потоков — без дублей.
+  7. Число запросов на выдачу не растёт с числом peers.
+
+Запуск:  venv/bin/python scripts/test_ip_allocator.py
+"""
+from __future__ import annotations
+
+import sys
+import tempfile
+import threading
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+try:
+    sys.stdout.reconfigure(encoding="utf-8")
+except Exception:
+    pass
+
+_FAILED = 0
+
+
+def check(name: str, cond: bool) -> None:
+    global _FAILED
+    print(f"  {'✅' if cond else '❌'} {name}")
+    if not cond:
+        _FAILED += 1
+
+
+def main() -> int:
+    tmp = Path(tempfile.mkdtemp(prefix="ip_alloc_test_"))
+    import bot.database as db
+    db.DATA_DIR = tmp
+    db.DB_PATH = tmp / "vpn.db"
+    db.USERS_JSON_PATH = tmp / "users.json"
+    db.PEERS_JSON_PATH = tmp / "peers.json"
+    db._db_initialized = False
+    db.init_db()
+    import bot.wireguard_peers as wg
+
+    def add_peer(tid: int, ip: str, device: str, server_id: str = "eu1") -> None:
+        db.db_upsert_peer({"telegram_id": tid, "server_id": server_id, "device_id": device,
+                           "os": "pc", "wg_ip": ip, "public_key": f"PK-{device}", "active": True})
+
+    awg_env = {"AMNEZIAWG_EU1_NETWORK_CIDR": "10.1.0.0/24"}  # один шард, как без AMNEZIAWG_EU1_SHARDS
+    awg = lambda tid: wg._allocate_awg_slot(tid, awg_env)[1]  # noqa: E731
+
+    print("1. Засев из peers")
+    for n, ip in enumerate(("10.1.0.2/32", "10.1.0.3/32", "10.1.0.5/32")):
+        add_peer(100 + n, ip, f"seed{n}")
+    add_peer(200, "10.0.0.4/24", "rus", server_id="main")  # другая нода — не мешает
+    first = awg(1)
+    check(f"первая выдача — дырка .4 ({first})", first == "10.1.0.4/24")
+    add_peer(1, first, "d1")
+    second = awg(2)
+    check(f"дальше — курсор .6 ({second})", second == "10.1.0.6/24")
+    add_peer(2, second, "d2")
+    main_ip = wg._allocate_ip("10.0.0.0/24", "rus1", 3)
+    check(f"main: .1 сервер, .2 client1, .4 занят → .3 ({main_ip})", main_ip == "10.0.0.3/24")
+
+    print("\n2. Пулы в одной подсети")
+    uni = wg._allocate_ip_unified_pool("10.1.0.0/24", "eu1", 4)
+    gpt = wg._allocate_ip_in_pool("10.1.0.0/24", "eu1", 8, 254, 5,
+                                  exclude_octet_start=20, exclude_octet_end=50)
+    check(f"unified .20, gpt .8 ({uni}, {gpt})", uni == "10.1.0.20/32" and gpt == "10.1.0.8/32")
+    add_peer(4, uni, "d4")
+    add_peer(5, gpt, "d5")
+    hosts = [awg(10 + i) for i in range(3)]
+    check(f"обычный пул обходит .8 ({hosts})", hosts == ["10.1.0.7/24", "10.1.0.9/24", "10.1.0.10/24"])
+    for i, ip in enumerate(hosts):
+        add_peer(10 + i, ip, f"h{i}")
+    uni2 = wg._allocate_ip_unified_pool("10.1.0.0/24", "eu1", 6)
+    check(f"unified не берёт занятое ({uni2})", uni2 == "10.1.0.21/32")
+    add_peer(6, uni2, "d6")
+
+    print("\n3. Освобождение")
+    db.db_upsert_peer({"telegram_id": 1, "server_id": "eu1", "device_id": "d1", "os": "pc",
+                       "wg_ip": "10.1.0.4/24", "public_key": "PK-d1", "active": False})
+    check("soft-revoke держит адрес", awg(20) == "10.1.0.11/24")
+    db.db_ip_release(20, "10.1.0.11/24")
+    check("db_ip_release вернул несохранённую аренду", awg(21) == "10.1.0.11/24")
+    add_peer(21, "10.1.0.11/24", "d21")
+    db.db_delete_peer(1, "eu1", "d1")
+    check("db_delete_peer освободил .4", awg(22) == "10.1.0.4/24")
+    add_peer(22, "10.1.0.4/24", "d22")
+    db.db_delete_device("h0")
+    check("db_delete_device освободил .7", awg(23) == "10.1.0.7/24")
+    add_peer(23, "10.1.0.7/24", "d23")
+    db.db_delete_peer(4, "eu1", "d4")
+    check("адрес unified-пула вернулся в unified", wg._allocate_ip_unified_pool("10.1.0.0/24", "eu1", 24) == "10.1.0.20/32")
+    add_peer(24, "10.1.0.20/32", "d24")
+    add_peer(2, "10.1.0.30/32", "d2")  # upsert того же слота с новым IP
+    check("смена wg_ip освободила .6", awg(25) == "10.1.0.6/24")
+    add_peer(25, "10.1.0.6/24", "d25")
+    db.db_ip_release(22, "10.1.0.4")
+    check("db_ip_release не трогает адрес живого слота", awg(26) != "10.1.0.4/24")
+
+    print("\n4. Слот мимо аллокатора")
+    stats = db.db_ip_pool_stats("eu1:10.1.0.0/24")["hosts"]
+    nxt = f"10.1.0.{stats['next_ip']}/32"
+    with db._conn() as con:
+        con.execute(
+            "INSERT INTO peers (telegram_id, server_id, device_id, os, wg_ip, public_key) "
+            "VALUES (999, 'eu2', 'manual', 'pc', ?, 'PK-manual')", (nxt,),
+        )
+    got = awg(27)
+    check(f"{nxt} усыновлён, выдан следующий ({got})", got.split("/")[0] != nxt.split("/")[0])
+
+    print("\n5. Исчерпание")
+    small = [wg._allocate_ip("10.9.0.0/29", "yc", 30 + i) for i in range(5)]
+    check(f"/29: 5 адресов .2–.6 ({small})", small[0] == "10.9.0.2/29" and small[-1] == "10.9.0.6/29")
+    try:
+        wg._allocate_ip("10.9.0.0/29", "yc", 40)
+        check("6-й → WireGuardError", False)
+    except wg.WireGuardError:
+        check("6-й → WireGuardError", True)
+    with db._conn() as con:
+        con.execute("UPDATE ip_leases SET leased_at = datetime('now', '-1 hour') WHERE host = '10.9.0.3'")
+    check("забытая аренда подобрана", wg._allocate_ip("10.9.0.0/29", "yc", 41) == "10.9.0.3/29")
+
+    print("\n6. Параллельная выдача")
+    got: list = []
+    errors: list = []
+
+    def worker(k: int) -> None:
+        try:
+            for i in range(25):
+                got.append(wg._allocate_ip("10.20.0.0/16", "yc", 1000 + k * 100 + i))
+        except Exception as e:  # noqa: BLE001
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(k,)) for k in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    check(f"200 выдач без ошибок и дублей ({len(got)}, уникальных {len(set(got))}, ошибок {len(errors)})",
+          len(got) == 200 and len(set(got)) == 200 and not errors)
+
+    print("\n7. Стоимость выдачи")
+    counts = []
+    for extra in (0, 2000):
+        with db._conn() as con:
+            con.executemany(
+                "INSERT INTO peers (telegram_id, server_id, device_id, os, wg_ip, public_key) "
+                "VALUES (?, 'eu1', ?, 'pc', ?, ?)",
+                [(5000 + i, f"bulk{i}", f"10.3.{i >> 8}.{i & 255}/32", f"PKb{i}") for i in range(extra)],
+            )
+        awg(50)  # засев пространства (если ещё нет) — один раз
+        traced: list = []
+        with db._conn() as con:
+            con.set_trace_callback(traced.append)
+            try:
+                awg(51 + extra)
+            finally:
+                con.set_trace_callback(None)
+        counts.append(len(traced))
+    check(f"запросов на выдачу при +0 и +2000 peers одинаково ({counts})", counts[0] == counts[1])
+
+    print()
+    if _FAILED:
+        print(f"❌ ПРОВАЛЕНО проверок: {_FAILED}")
+        return 1
+    print("✅ Все проверки пройдены")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
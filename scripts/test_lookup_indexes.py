@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Регрессионный тест планов запросов для горячих point-lookup'ов (ВРЕМЕННАЯ БД).
+
+Вызывает реальные db_* хелперы, перехватывает их SQL (trace_callback, с
+подставленными параметрами) и прогоняет каждый SELECT/UPDATE/DELETE через
+EXPLAIN QUERY PLAN. Ни один шаг плана не должен быть SCAN (полный проход
+таблицы или индекса) — только SEARCH по индексу.
+
+Дополнительно: init_db на актуальной БД пересоздаёт снесённый индекс.
+
+Запуск:  venv/bin/python scripts/test_lookup_indexes.py
+"""
+from __future__ import annotations
+
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+try:
+    sys.stdout.reconfigure(encoding="utf-8")
+except Exception:
+    pass
+
+_FAILED = 0
+
+
+def check(name: str, cond: bool) -> None:
+    global _FAILED
+    print(f"  {'✅' if cond else '❌'} {name}")
+    if not cond:
+        _FAILED += 1
+
+
+def main() -> int:
+    tmp = Path(tempfile.mkdtemp(prefix="lookup_idx_test_"))
+    import bot.database as db
+    db.DATA_DIR = tmp
+    db.DB_PATH = tmp / "vpn.db"
+    db.USERS_JSON_PATH = tmp / "users.json"
+    db.PEERS_JSON_PATH = tmp / "peers.json"
+    db._db_initialized = False
+    db.init_db()
+
+    # Немного данных + ANALYZE, чтобы планировщик не считал таблицы пустыми.
+    for tid in range(1, 201):
+        db.db_upsert_user({"telegram_id": tid, "username": f"u{tid}"})
+        db.db_ensure_sub_token(tid)
+        db.db_ensure_referral_code(tid)
+        db.db_record_payment("yookassa", 199.0, telegram_id=tid, external_id=f"ext-{tid}")
+        db.db_create_otp(f"u{tid}@example.com", "123456")
+        for n, sid in enumerate(("eu1", "main")):
+            db.db_upsert_peer({"telegram_id": tid, "server_id": sid, "device_id": f"dev{n}-{tid}",
+                               "os": "pc", "wg_ip": f"10.{n}.0.{tid}", "public_key": f"PK{n}-{tid}",
+                               "active": True})
+    with db._conn() as con:
+        con.execute("ANALYZE")
+    token = db.db_ensure_sub_token(42)
+    code = db.db_ensure_referral_code(42)
+
+    calls = [
+        ("db_find_user_by_sub_token", lambda: db.db_find_user_by_sub_token(token)),
+        ("db_ensure_sub_token (новый токен)", lambda: db.db_ensure_sub_token(10_001)),
+        ("db_get_user_by_referral_code", lambda: db.db_get_user_by_referral_code(code)),
+        ("db_count_referrals", lambda: db.db_count_referrals(code)),
+        ("db_set_referred_by", lambda: db.db_set_referred_by(7, code)),
+        ("db_find_payment_by_external_id", lambda: db.db_find_payment_by_external_id("ext-42")),
+        ("db_update_payment_status", lambda: db.db_update_payment_status("ext-42", "succeeded")),
+        ("db_create_otp", lambda: db.db_create_otp("u42@example.com", "654321")),
+        ("db_verify_otp", lambda: db.db_verify_otp("u42@example.com", "654321")),
+        ("db_get_peers_by_telegram_id", lambda: db.db_get_peers_by_telegram_id(42)),
+        ("db_get_peers_by_device_id", lambda: db.db_get_peers_by_device_id("dev0-42")),
+        ("db_get_peers_by_public_key", lambda: db.db_get_peers_by_public_key("PK1-42")),
+        ("db_get_peers_by_server", lambda: db.db_get_peers_by_server(["eu1"], active_only=True)),
+    ]
+    db.db_upsert_user({"telegram_id": 10_001, "username": "fresh"})
+
+    print("1. EXPLAIN QUERY PLAN горячих lookup'ов")
+    for name, fn in calls:
+        traced: list = []
+        with db._conn() as con:
+            con.set_trace_callback(traced.append)
+            try:
+                fn()
+            finally:
+                con.set_trace_callback(None)
+            scans = []
+            for sql in traced:
+                head = sql.lstrip().split(None, 1)[0].upper()
+                if head not in ("SELECT", "UPDATE", "DELETE"):
+                    continue
+                for row in con.execute(f"EXPLAIN QUERY PLAN {sql}").fetchall():
+                    if row[3].startswith("SCAN"):
+                        scans.append(row[3])
+        check(f"{name}: без SCAN{' (' + '; '.join(scans) + ')' if scans else ''}",
+              bool(traced) and not scans)
+
+    print("\n2. Самовосстановление индексов")
+    with db._conn() as con:
+        con.execute("DROP INDEX idx_users_sub_token")
+    db._db_initialized = False
+    db.init_db()
+    with db._conn() as con:
+        names = {r[0] for r in con.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'"
+        ).fetchall()}
+    check("init_db (fast path) пересоздал idx_users_sub_token", "idx_users_sub_token" in names)
+    check("все _LOOKUP_INDEXES на месте", all(i[0] in names for i in db._LOOKUP_INDEXES))
+
+    print()
+    if _FAILED:
+        print(f"❌ ПРОВАЛЕНО проверок: {_FAILED}")
+        return 1
+    print("✅ Все проверки пройдены")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
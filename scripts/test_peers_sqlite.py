@@ -9,6 +9,7 @@ Self-contained тест консолидации peers.json → SQLite.
   2. Идемпотентность миграции (повторный прогон не плодит дубли).
   3. storage.get_all_peers() / find_peer_by_telegram_id() поверх БД.
   4. upsert_peer / delete_peer: запись в БД + dual-write зеркало peers.json.
+  5. Fast path init_db по PRAGMA user_version (актуальная БД — без миграций).
 
 Запуск (где есть python3):
     cd /opt/vpnservice && venv/bin/python scripts/test_peers_sqlite.py
@@ -129,6 +130,31 @@ def main() -> int:
     dev999 = db.db_get_device(did)
     check("device 999 = iPad/ios", dev999 is not None and dev999["name"] == "iPad" and dev999["os"] == "ios")
 
+    # ── 5. Fast path по PRAGMA user_version ──────────────────────────────────
+    print("\n5. Версия схемы (PRAGMA user_version)")
+    with db._conn() as con:
+        ver = con.execute("PRAGMA user_version").fetchone()[0]
+    check(f"после init_db user_version = {db._SCHEMA_VERSION}", ver == db._SCHEMA_VERSION)
+
+    ran = []
+    orig_run = db._run_migrations
+    db._run_migrations = lambda v: ran.append(v)
+    try:
+        db._db_initialized = False
+        db.init_db()
+        check("актуальная БД: повторный init_db не гоняет миграции", ran == [])
+        with db._conn() as con:
+            con.execute("PRAGMA user_version = 3")
+        db.init_db()
+        check("отставшая БД: миграции с user_version=3", ran == [3])
+    finally:
+        db._run_migrations = orig_run
+    db.init_db()
+    with db._conn() as con:
+        ver = con.execute("PRAGMA user_version").fetchone()[0]
+    check("дозапуск с v3 поднял версию и не сломал peers",
+          ver == db._SCHEMA_VERSION and len(db.db_get_all_peers()) == 6)
+
     print()
     if _FAILED:
         print(f"❌ ПРОВАЛЕНО проверок: {_FAILED}")
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""
+Тест очереди выдачи конфигов (bot/provision_queue.py + db_job_* в
+bot/database.py) на ВРЕМЕННОЙ БД, с тестовыми видами задач вместо SSH.
+
+Проверяет:
+  1. Без воркеров (PROVISION_QUEUE=0) задача выполняется сразу, listener
+     получает результат, после доставки конфиг стирается из БД.
+  2. Идемпотентность: повтор idem_key незавершённой задачи не создаёт и не
+     выполняет её снова; после done/failed ключ свободен.
+  3. С воркерами submit возвращается сразу; на ноде одновременно не больше
+     workers_per_node задач.
+  4. Лимит на ноду общий для процессов: чужие running-задачи занимают слоты.
+  5. Повторы с задержкой; после max_attempts — failed, listener вызван один раз.
+  6. Воркеры берут только задачи своего owner.
+  7. Зависшая running-задача возвращается в очередь и доделывается; без
+     попыток — failed, listener вызван, ключ освобождён.
+  8. Без listener'а результат отдаётся опросом один раз (take_job_result).
+  9. Неидемпотентный вид (retry_only): одна попытка, повтор — только ошибок
+     «до побочных эффектов»; зависшая — failed; awg_* так и зарегистрированы.
+
+Запуск:  venv/bin/python scripts/test_provision_queue.py
+"""
+from __future__ import annotations
+
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+try:
+    sys.stdout.reconfigure(encoding="utf-8")
+except Exception:
+    pass
+
+_FAILED = 0
+
+
+def check(name: str, cond: bool) -> None:
+    global _FAILED
+    print(f"  {'✅' if cond else '❌'} {name}")
+    if not cond:
+        _FAILED += 1
+
+
+def wait_for(pred, timeout: float = 5.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if pred():
+            return True
+        time.sleep(0.02)
+    return pred()
+
+
+def main() -> int:
+    tmp = Path(tempfile.mkdtemp(prefix="provision_queue_test_"))
+    import bot.database as db
+    db.DATA_DIR = tmp
+    db.DB_PATH = tmp / "vpn.db"
+    db.USERS_JSON_PATH = tmp / "users.json"
+    db.PEERS_JSON_PATH = tmp / "peers.json"
+    db._db_initialized = False
+    db.init_db()
+    import bot.provision_queue as pq
+    _INLINE = pq._INLINE_OWNER
+    pq._RETRY_DELAYS_S = (0, 0, 0)
+    pq._POLL_INTERVAL_S = 0.02
+
+    calls: dict = {}
+    delivered: list = []
+    lock = threading.Lock()
+    state = {"running": 0, "max_running": 0}
+
+    def run_ok(params):
+        with lock:
+            calls[params["n"]] = calls.get(params["n"], 0) + 1
+        return {"config": f"cfg-{params['n']}"}
+
+    def run_slow(params):
+        with lock:
+            state["running"] += 1
+            state["max_running"] = max(state["max_running"], state["running"])
+        time.sleep(0.15)
+        with lock:
+            state["running"] -= 1
+        return run_ok(params)
+
+    def run_flaky(params):
+        with lock:
+            calls[params["n"]] = calls.get(params["n"], 0) + 1
+            n = calls[params["n"]]
+        if n <= params["fail_times"]:
+            raise RuntimeError(f"ssh упал ({n})")
+        return {"config": "ok"}
+
+    def listener(job):
+        with lock:
+            delivered.append((job["id"], job["status"], job["result"], job["error"]))
+        return True
+
+    for kind, runner in (("t_ok", run_ok), ("t_slow", run_slow), ("t_flaky", run_flaky)):
+        pq.register_job_kind(kind, runner)
+        pq.set_job_listener(kind, listener)
+
+    print("1. Без воркеров — синхронно")
+    job_id, created = pq.submit_job("t_ok", "eu1", 1, {"n": "a"}, idem_key="k-a")
+    job = db.db_job_get(job_id)
+    check("создана и выполнена сразу", created and job["status"] == "done" and calls.get("a") == 1)
+    check("listener получил конфиг", delivered and delivered[-1][:3] == (job_id, "done", {"config": "cfg-a"}))
+    check("после доставки конфиг стёрт", job["result"] is None and job["delivered_at"])
+    pq.register_job_kind("t_ok", run_flaky)
+    job_id, _ = pq.submit_job("t_ok", "eu1", 1, {"n": "g", "fail_times": 9})
+    pq.register_job_kind("t_ok", run_ok)
+    job = db.db_job_get(job_id)
+    check("ошибка без воркеров — одна попытка, failed", job["status"] == "failed" and job["attempts"] == 1)
+
+    print("\n2. Идемпотентность")
+    busy, _ = db.db_job_submit("t_ok", "eu1", "web", 2, {"n": "b"}, idem_key="k-b")
+    db.db_job_claim("web", "eu1", ["t_ok"], 2, job_id=busy)
+    again_id, created = pq.submit_job("t_ok", "eu1", 2, {"n": "b"}, idem_key="k-b")
+    check("idem_key задачи в работе → та же задача, не создана", not created and again_id == busy)
+    check("runner не вызван", "b" not in calls)
+    db.db_job_complete(busy, {"config": "x"})
+    again_id, created = pq.submit_job("t_ok", "eu1", 1, {"n": "a"}, idem_key="k-a")
+    check("после done ключ свободен → новая задача", created and calls.get("a") == 2)
+    failing, _ = db.db_job_submit("t_ok", "eu1", "web", 3, {}, idem_key="k-f", max_attempts=1)
+    db.db_job_claim("web", "eu1", ["t_ok"], 2, job_id=failing)
+    db.db_job_fail(failing, "x", 0)
+    check("после failed ключ свободен", db.db_job_submit("t_ok", "eu1", "web", 3, {}, idem_key="k-f")[1])
+
+    print("\n3. Воркеры: submit не ждёт, лимит на ноду")
+    pq.provision_queue_start("bot", nodes=("eu1",), workers_per_node=2)
+    check("очередь запущена", pq.provision_queue_running())
+    t0 = time.perf_counter()
+    ids = [pq.submit_job("t_slow", "eu1", 10 + i, {"n": f"s{i}"})[0] for i in range(6)]
+    submit_ms = (time.perf_counter() - t0) * 1000
+    check(f"6 submit за {submit_ms:.0f} мс (задача — 150 мс)", submit_ms < 150)
+    ok = wait_for(lambda: all(db.db_job_get(i)["status"] == "done" for i in ids))
+    check("все 6 выполнены", ok)
+    check(f"одновременно на ноде ≤ 2 (max={state['max_running']})", 1 < state["max_running"] <= 2)
+    again_id, created = pq.submit_job("t_slow", "eu1", 10, {"n": "s0"}, idem_key=None)
+    check("без idem_key — новая задача", created and again_id not in ids)
+    wait_for(lambda: db.db_job_get(again_id)["status"] == "done")
+
+    print("\n4. Лимит общий для процессов")
+    other = [db.db_job_submit("t_ok", "eu1", "web", 20 + i, {"n": f"o{i}"})[0] for i in range(2)]
+    for i in other:
+        db.db_job_claim("web", "eu1", ["t_ok"], 2, job_id=i)
+    mine, _ = pq.submit_job("t_ok", "eu1", 30, {"n": "m"})
+    time.sleep(0.3)
+    check("2 running в другом процессе → своя ждёт", db.db_job_get(mine)["status"] == "queued")
+    for i in other:
+        db.db_job_complete(i, {"config": "x"})
+    check("слоты освободились → выполнена", wait_for(lambda: db.db_job_get(mine)["status"] == "done"))
+
+    print("\n5. Повторы")
+    delivered.clear()
+    flaky, _ = pq.submit_job("t_flaky", "eu1", 40, {"n": "fl", "fail_times": 2})
+    check("2 ошибки, 3-я попытка успешна",
+          wait_for(lambda: db.db_job_get(flaky)["status"] == "done") and db.db_job_get(flaky)["attempts"] == 3)
+    dead, _ = pq.submit_job("t_flaky", "eu1", 41, {"n": "dd", "fail_times": 99})
+    check("после max_attempts — failed", wait_for(lambda: db.db_job_get(dead)["status"] == "failed"))
+    job = db.db_job_get(dead)
+    check(f"попыток {job['attempts']}, ошибка сохранена", job["attempts"] == 3 and "ssh упал" in job["error"])
+    fails = [d for d in delivered if d[0] == dead]
+    check("listener вызван один раз, со status=failed", len(fails) == 1 and fails[0][1] == "failed")
+
+    print("\n6. Только свой owner")
+    foreign, _ = db.db_job_submit("t_ok", "eu1", "web", 50, {"n": "w"})
+    time.sleep(0.3)
+    check("задачу web воркеры bot не берут", db.db_job_get(foreign)["status"] == "queued")
+
+    print("\n7. Зависшая задача")
+    pq.provision_queue_stop()
+    check("очередь остановлена", not pq.provision_queue_running())
+    stale, _ = db.db_job_submit("t_ok", "eu1", "bot", 60, {"n": "st"})
+    db.db_job_claim("bot", "eu1", ["t_ok"], 2, job_id=stale)
+    with db._conn() as con:
+        con.execute("UPDATE provision_jobs SET started_at = datetime('now', '-1 hour') WHERE id = ?", (stale,))
+    dead_stale, _ = db.db_job_submit("t_ok", "eu1", _INLINE, 61, {"n": "ds"}, idem_key="k-ds", max_attempts=1)
+    db.db_job_claim(_INLINE, "eu1", ["t_ok"], 9, job_id=dead_stale)
+    with db._conn() as con:
+        con.execute("UPDATE provision_jobs SET started_at = datetime('now', '-1 hour') WHERE id IN (?, ?)",
+                    (stale, dead_stale))
+    delivered.clear()
+    pq._sweep_stale()
+    check("задача с попытками — снова queued", db.db_job_get(stale)["status"] == "queued")
+    job = db.db_job_get(dead_stale)
+    check("inline без попыток — failed, ключ освобождён", job["status"] == "failed" and job["idem_key"] is None)
+    check("listener получил failed", [d[:2] for d in delivered] == [(dead_stale, "failed")])
+    check("повторный sweep ничего не трогает", db.db_job_requeue_stale(300) == (0, []))
+    pq.provision_queue_start("bot", nodes=("eu1",), workers_per_node=2)
+    check("после рестарта доделана", wait_for(lambda: db.db_job_get(stale)["status"] == "done"))
+
+    print("\n8. Результат опросом")
+    pq._listeners.pop("t_ok")
+    polled, _ = pq.submit_job("t_ok", "eu1", 70, {"n": "p"})
+    wait_for(lambda: db.db_job_get(polled)["status"] == "done")
+    first = pq.take_job_result(polled)
+    second = pq.take_job_result(polled)
+    check("первый опрос — конфиг", first["result"] == {"config": "cfg-p"})
+    check("второй — уже стёрт", second["result"] is None and second["delivered_at"])
+
+    print("\n9. Неидемпотентные задачи")
+    class NotStarted(Exception):
+        pass
+
+    def run_once(params):
+        with lock:
+            calls[params["n"]] = calls.get(params["n"], 0) + 1
+            n = calls[params["n"]]
+        if n <= params.get("early", 0):
+            raise NotStarted("до скрипта")
+        if params.get("late"):
+            raise RuntimeError("после скрипта")
+        return {"config": "once"}
+
+    pq.register_job_kind("t_once", run_once, retry_only=(NotStarted,))
+    pq.set_job_listener("t_once", listener)
+    early, _ = pq.submit_job("t_once", "eu1", 80, {"n": "e", "early": 2})
+    check("ошибки до скрипта — повторены, 3-я попытка успешна",
+          wait_for(lambda: db.db_job_get(early)["status"] == "done") and calls["e"] == 3)
+    check("max_attempts=1 в БД", db.db_job_get(early)["max_attempts"] == 1)
+    late, _ = pq.submit_job("t_once", "eu1", 81, {"n": "l", "late": True})
+    check("ошибка после скрипта — без повтора",
+          wait_for(lambda: db.db_job_get(late)["status"] == "failed") and calls["l"] == 1)
+    never, _ = pq.submit_job("t_once", "eu1", 82, {"n": "x", "early": 99})
+    check("до скрипта, но попытки кончились — failed",
+          wait_for(lambda: db.db_job_get(never)["status"] == "failed") and calls["x"] == 3)
+    hung, _ = db.db_job_submit("t_once", "eu1", "web", 83, {"n": "h"}, max_attempts=1)
+    db.db_job_claim("web", "eu1", ["t_once"], 9, job_id=hung)
+    with db._conn() as con:
+        con.execute("UPDATE provision_jobs SET started_at = datetime('now', '-1 hour') WHERE id = ?", (hung,))
+    pq._sweep_stale()
+    check("зависшая — failed, не в очередь", db.db_job_get(hung)["status"] == "failed")
+    from bot.wireguard_peers import AwgNotProvisionedError
+    check("awg_create/awg_regen: retry_only=AwgNotProvisionedError",
+          all(pq._retry_only.get(k) == (AwgNotProvisionedError,) for k in ("awg_create", "awg_regen")))
+
+    stats = pq.provision_queue_stats()
+    check(f"метрики: executed={stats['executed']}, retried={stats['retried']}, failed={stats['failed']}",
+          stats["running"] and stats["retried"] >= 4 and stats["failed"] >= 1 and "eu1" in stats["jobs"])
+    pq.provision_queue_stop()
+
+    print()
+    if _FAILED:
+        print(f"❌ ПРОВАЛЕНО проверок: {_FAILED}")
+        return 1
+    print("✅ Все проверки пройдены")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
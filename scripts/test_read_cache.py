@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Тест read cache (db_read_cached) поверх users/peers на ВРЕМЕННОЙ БД.
+
+Проверяет:
+  1. Повторный get_all_peers/get_all_users/db_get_all_users — hit без SELECT
+     по таблицам; наружу отдаются копии списков.
+  2. Запись через db_upsert_peer → промах и свежие данные.
+  3. Запись из «чужого процесса» (отдельное sqlite3-соединение, сырой SQL)
+     тоже инвалидирует — через data_version + триггеры table_versions.
+  4. Запись в users не сбрасывает кеш peers (и наоборот).
+  5. Внутри собственной незакоммиченной транзакции кеш обходится.
+  6. Счётчики hits/misses/bypassed и разбивка по ключам.
+
+Запуск:  venv/bin/python scripts/test_read_cache.py
+"""
+from __future__ import annotations
+
+import sqlite3
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+try:
+    sys.stdout.reconfigure(encoding="utf-8")
+except Exception:
+    pass
+
+_FAILED = 0
+
+
+def check(name: str, cond: bool) -> None:
+    global _FAILED
+    print(f"  {'✅' if cond else '❌'} {name}")
+    if not cond:
+        _FAILED += 1
+
+
+def main() -> int:
+    tmp = Path(tempfile.mkdtemp(prefix="read_cache_test_"))
+    import bot.database as db
+    db.DATA_DIR = tmp
+    db.DB_PATH = tmp / "vpn.db"
+    db.USERS_JSON_PATH = tmp / "users.json"
+    db.PEERS_JSON_PATH = tmp / "peers.json"
+    db._db_initialized = False
+    db.init_db()
+    from bot import storage
+
+    for tid in range(1, 21):
+        db.db_upsert_user({"telegram_id": tid, "username": f"u{tid}"})
+        db.db_upsert_peer({"telegram_id": tid, "server_id": "eu1", "device_id": f"dev{tid}",
+                           "os": "pc", "wg_ip": f"10.8.0.{tid}", "public_key": f"PK{tid}",
+                           "active": True})
+
+    def traced_selects(fn):
+        traced: list = []
+        with db._conn() as con:
+            con.set_trace_callback(traced.append)
+            try:
+                fn()
+            finally:
+                con.set_trace_callback(None)
+        return [q for q in traced if q.lstrip().upper().startswith("SELECT")]
+
+    def key_stats(key: str):
+        return db.db_read_cache_stats()["keys"].get(key, {"hits": 0, "misses": 0})
+
+    print("1. Повторное чтение")
+    first = storage.get_all_peers()
+    storage.get_all_users()
+    db.db_get_all_users()
+    selects = traced_selects(lambda: (storage.get_all_peers(), storage.get_all_users(),
+                                      db.db_get_all_users()))
+    check(f"повтор без SELECT по users/peers ({selects})", not selects)
+    check("storage.peers: 1 промах, 1 hit",
+          key_stats("storage.peers") == {"hits": 1, "misses": 1})
+    again = storage.get_all_peers()
+    again.clear()
+    check("наружу — копия списка", len(storage.get_all_peers()) == 20 and first is not again)
+
+    print("\n2. Запись через db_upsert_peer")
+    db.db_upsert_peer({"telegram_id": 21, "server_id": "eu1", "device_id": "dev21", "os": "ios",
+                       "wg_ip": "10.8.0.21", "public_key": "PK21", "active": True})
+    misses = key_stats("storage.peers")["misses"]
+    peers = storage.get_all_peers()
+    check("новый слот виден", any(p.public_key == "PK21" for p in peers) and len(peers) == 21)
+    check("это был промах", key_stats("storage.peers")["misses"] == misses + 1)
+
+    print("\n3. Запись из другого соединения")
+    other = sqlite3.connect(str(db.DB_PATH))
+    other.execute("UPDATE peers SET active = 0 WHERE public_key = 'PK5'")
+    other.commit()
+    check("деактивация видна", not next(p for p in storage.get_all_peers() if p.public_key == "PK5").active)
+    other.execute("DELETE FROM users WHERE telegram_id = 20")
+    other.commit()
+    check("удаление юзера видно в обоих кешах users",
+          len(storage.get_all_users()) == 19 and len(db.db_get_all_users()) == 19)
+    other.close()
+
+    print("\n4. Гранулярность по таблицам")
+    storage.get_all_peers()
+    hits = key_stats("storage.peers")["hits"]
+    db.db_update_vless_requested_at(1)
+    db.db_accumulate_traffic([{"public_key": "PK1", "telegram_id": 1, "rx": 10, "tx": 1}])
+    storage.get_all_peers()
+    check("запись в users/traffic не сбросила peers", key_stats("storage.peers")["hits"] == hits + 1)
+    users_misses = key_stats("storage.users")["misses"]
+    storage.get_all_users()
+    check("а users перечитан", key_stats("storage.users")["misses"] == users_misses + 1)
+
+    print("\n5. Своя транзакция")
+    bypassed = db.db_read_cache_stats()["bypassed"]
+    with db._conn() as con:
+        con.execute("UPDATE peers SET active = 0 WHERE public_key = 'PK7'")
+        inside = next(p for p in storage.get_all_peers() if p.public_key == "PK7")
+    check("незакоммиченная запись видна внутри транзакции", not inside.active)
+    check("кеш обойдён", db.db_read_cache_stats()["bypassed"] == bypassed + 1)
+    check("после commit — тоже", not next(p for p in storage.get_all_peers() if p.public_key == "PK7").active)
+
+    print("\n6. Счётчики")
+    st = db.db_read_cache_stats()
+    check(f"hits/misses/entries ({st['hits']}/{st['misses']}/{st['entries']})",
+          st["hits"] > 0 and st["misses"] > 0 and st["entries"] == 3)
+    db.db_read_cache_clear()
+    check("clear сбросил записи", db.db_read_cache_stats()["entries"] == 0)
+
+    print()
+    if _FAILED:
+        print(f"❌ ПРОВАЛЕНО проверок: {_FAILED}")
+        return 1
+    print("✅ Все проверки пройдены")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Тест выбора сервера db_pick_server / db_server_load на ВРЕМЕННОЙ БД.
+
+Проверяет:
+  1. VLESS: нагрузка считается по per-user UUID сервера (а не один общий
+     счётчик на все), AWG — по preferred_server_id; active=0 не считается.
+  2. Утилизация: сервер с меньшим числом юзеров, но активных (last_seen /
+     трафик в traffic_rollup за сутки), проигрывает «спящему».
+  3. Capacity: нагрузка нормируется на ёмкость сервера.
+  4. Вся нагрузка — фиксированное число запросов, не зависящее от числа серверов.
+
+Запуск:  venv/bin/python scripts/test_server_pick.py
+"""
+from __future__ import annotations
+
+import sys
+import tempfile
+from datetime import datetime, timedelta
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+try:
+    sys.stdout.reconfigure(encoding="utf-8")
+except Exception:
+    pass
+
+_FAILED = 0
+
+
+def check(name: str, cond: bool) -> None:
+    global _FAILED
+    print(f"  {'✅' if cond else '❌'} {name}")
+    if not cond:
+        _FAILED += 1
+
+
+def main() -> int:
+    tmp = Path(tempfile.mkdtemp(prefix="server_pick_test_"))
+    import bot.database as db
+    db.DATA_DIR = tmp
+    db.DB_PATH = tmp / "vpn.db"
+    db.USERS_JSON_PATH = tmp / "users.json"
+    db.PEERS_JSON_PATH = tmp / "peers.json"
+    db._db_initialized = False
+    db.init_db()
+
+    db.db_upsert_server("eu1", "EU1", "vless", 100, active=False)
+    db.db_upsert_server("eu1-awg", "EU1 AWG", "awg", 100, active=False)
+    db.db_upsert_server("main", "Main", "vless", 100)
+    db.db_upsert_server("yc", "YC", "vless", 100)
+    db.db_upsert_server("awg1", "AWG 1", "awg", 100)
+    db.db_upsert_server("awg2", "AWG 2", "awg", 100)
+
+    # main: 10 юзеров (все спят), yc: 6 юзеров (5 активных за сутки), +2 active=0 на yc
+    for tid in range(1, 19):
+        db.db_upsert_user({"telegram_id": tid, "username": f"u{tid}", "active": tid <= 16,
+                           "preferred_server_id": "awg1" if tid <= 10 else "awg2"})
+        db.db_get_or_create_vless_uuid(tid, "main" if tid <= 10 else "yc")
+
+    print("1. Счётчики юзеров")
+    load = db.db_server_load("vless")
+    check(f"vless per-server: main=10, yc=6 ({load})",
+          load["main"]["users"] == 10 and load["yc"]["users"] == 6)
+    check("неактивный сервер eu1 не в выдаче", "eu1" not in load)
+    awg = db.db_server_load("awg")
+    check(f"awg по preferred_server_id: awg1=10, awg2=6 ({awg})",
+          awg["awg1"]["users"] == 10 and awg["awg2"]["users"] == 6)
+    check("без активности выбирается менее заселённый yc", db.db_pick_server("vless") == "yc")
+
+    print("\n2. Утилизация")
+    db.db_accumulate_vless_user_traffic(
+        "yc", [{"telegram_id": tid, "rx": 10_000, "tx": 1_000} for tid in range(11, 16)]
+    )
+    load = db.db_server_load("vless")
+    check(f"yc active=5 по last_seen ({load['yc']})", load["yc"]["active"] == 5)
+    check("активный yc (6+2×5=16) тяжелее спящего main (10) → main",
+          db.db_pick_server("vless") == "main")
+
+    hour = (datetime.utcnow() - timedelta(hours=2)).strftime("%Y-%m-%d %H:00:00")
+    with db._conn() as con:
+        for tid in range(11, 16):
+            con.execute(
+                "INSERT INTO peers (telegram_id, server_id, device_id, wg_ip, public_key) "
+                "VALUES (?, 'awg2', ?, ?, ?)", (tid, f"dev{tid}", f"10.9.0.{tid}", f"PK{tid}"),
+            )
+            con.execute(
+                "INSERT INTO traffic_rollup (resolution, bucket, public_key, telegram_id, rx, tx, samples) "
+                "VALUES ('h', ?, ?, ?, 5000, 500, 12)", (hour, f"PK{tid}", tid),
+            )
+    awg = db.db_server_load("awg")
+    check(f"awg2 active=5 по traffic_rollup ({awg['awg2']})", awg["awg2"]["active"] == 5)
+    check("awg: активный awg2 уступает спящему awg1", db.db_pick_server("awg") == "awg1")
+
+    print("\n3. Capacity")
+    db.db_upsert_server("main", "Main", "vless", 20)
+    check("main с capacity 20 (10/20=0.5) тяжелее yc (16/100) → yc", db.db_pick_server("vless") == "yc")
+
+    print("\n4. Число запросов")
+    counts = []
+    for extra in (0, 5):
+        for i in range(extra):
+            db.db_upsert_server(f"x{i}", f"X{i}", "vless", 100)
+        traced: list = []
+        with db._conn() as con:
+            con.set_trace_callback(traced.append)
+            try:
+                db.db_pick_server("vless")
+            finally:
+                con.set_trace_callback(None)
+        counts.append(sum(1 for q in traced if q.lstrip().upper().startswith("SELECT")))
+    check(f"SELECT'ов при 2 и 7 серверах одинаково ({counts})", counts[0] == counts[1])
+
+    print()
+    if _FAILED:
+        print(f"❌ ПРОВАЛЕНО проверок: {_FAILED}")
+        return 1
+    print("✅ Все проверки пройдены")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
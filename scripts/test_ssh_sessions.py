@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+Тест постоянных SSH-сессий (bot/ssh_sessions.py) без сети: в PATH
+подкладывается фейковый `ssh`, который эмулирует ControlMaster (сокет —
+файл-маркер) и выполняет команду локально через bash.
+
+Проверяет:
+  1. Серия команд — один handshake, дальше каналы через master.
+  2. stdin/stdout/код возврата проходят как у обычного ssh.
+  3. Умерший master (код 255) → переподключение; повтор команды — только
+     с retry=True.
+  4. Лимит параллельных команд на хост.
+  5. SSH_MULTIPLEX=0 — по коннекту на команду, без ControlMaster.
+  6. execute_server_command идёт через сессию.
+  7. Каталог сокетов чужой / открытый → multiplexing выключен.
+
+Запуск:  venv/bin/python scripts/test_ssh_sessions.py
+"""
+from __future__ import annotations
+
+import os
+import stat
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+try:
+    sys.stdout.reconfigure(encoding="utf-8")
+except Exception:
+    pass
+
+_FAILED = 0
+
+# Фейковый ssh: лог в $FAKE_SSH_LOG (connect/mux/direct/exit), «смерть» master'а —
+# файл $FAKE_SSH_DROP (следующая команда через master → 255).
+_FAKE_SSH = r'''#!/usr/bin/env python3
+import os, subprocess, sys
+args = sys.argv[1:]
+opts, rest = {}, []
+i = 0
+while i < len(args):
+    a = args[i]
+    if a in ("-o", "-i", "-O"):
+        if a == "-o":
+            k, v = args[i + 1].split("=", 1)
+            opts[k] = v
+        elif a == "-O":
+            opts["_op"] = args[i + 1]
+        i += 2
+        continue
+    rest.append(a)
+    i += 1
+target, cmd = rest[0], " ".join(rest[1:])
+log = open(os.environ["FAKE_SSH_LOG"], "a")
+sock = opts.get("ControlPath", "").replace("%C", target)
+if opts.get("_op") == "exit":
+    if sock and os.path.exists(sock):
+        os.remove(sock)
+    log.write("exit\n")
+    sys.exit(0)
+master = opts.get("ControlMaster")
+if master == "auto" and not os.path.exists(sock):
+    open(sock, "w").close()
+    log.write("connect\n")
+elif master and os.path.exists(sock):
+    drop = os.environ["FAKE_SSH_DROP"]
+    if os.path.exists(drop):
+        os.remove(drop)
+        log.write("dead\n")
+        sys.stderr.write("mux_client_request_session: read from master failed\n")
+        sys.exit(255)
+    log.write("mux\n")
+else:
+    log.write("direct\n")
+log.close()
+sys.exit(subprocess.run(["bash", "-c", cmd]).returncode)
+'''
+
+
+def check(name: str, cond: bool) -> None:
+    global _FAILED
+    print(f"  {'✅' if cond else '❌'} {name}")
+    if not cond:
+        _FAILED += 1
+
+
+def main() -> int:
+    tmp = Path(tempfile.mkdtemp(prefix="ssh_sessions_test_"))
+    fake = tmp / "bin" / "ssh"
+    fake.parent.mkdir()
+    fake.write_text(_FAKE_SSH)
+    fake.chmod(fake.stat().st_mode | stat.S_IXUSR)
+    log = tmp / "ssh.log"
+    os.environ["PATH"] = f"{fake.parent}{os.pathsep}{os.environ['PATH']}"
+    os.environ["FAKE_SSH_LOG"] = str(log)
+    os.environ["FAKE_SSH_DROP"] = str(tmp / "drop")
+
+    import bot.ssh_sessions as ssh
+    ssh._CONTROL_DIR = tmp / "ctl"
+    ssh._settings = {"multiplex": True, "max_sessions": 2}
+
+    def events() -> list:
+        out = log.read_text().split() if log.exists() else []
+        log.write_text("")
+        return out
+
+    print("1. Серия команд")
+    for _ in range(5):
+        ssh.run_ssh("node1", "true", user="root")
+    ev = events()
+    st = ssh.ssh_session_stats()["root@node1"]
+    check(f"1 connect + 5 через master ({ev})", ev == ["connect"] + ["mux"] * 5)
+    check(f"handshake/команды раздельно ({st['handshakes']}/{st['commands']})",
+          st["handshakes"] == 1 and st["commands"] == 5 and st["command_ms_avg"] > 0)
+
+    print("\n2. stdin/stdout/код возврата")
+    r = ssh.run_ssh("node1", "bash", user="root", input="echo hello; exit 3\n")
+    check(f"stdout и код ({r.stdout.strip()!r}, {r.returncode})", r.stdout.strip() == "hello" and r.returncode == 3)
+    try:
+        ssh.run_ssh("node1", "false", user="root", check=True)
+        check("check=True → CalledProcessError", False)
+    except ssh.subprocess.CalledProcessError:
+        check("check=True → CalledProcessError", True)
+    events()
+
+    print("\n3. Умерший master")
+    (tmp / "drop").touch()
+    r = ssh.run_ssh("node1", "echo ok", user="root", retry=True)
+    ev = events()
+    check(f"retry=True: 255 → exit + connect + повтор ({ev})",
+          ev == ["dead", "exit", "connect", "mux"] and r.stdout.strip() == "ok")
+    check("reconnects=1", ssh.ssh_session_stats()["root@node1"]["reconnects"] == 1)
+    (tmp / "drop").touch()
+    r = ssh.run_ssh("node1", "echo ok", user="root")
+    ev = events()
+    check(f"без retry: 255 → exit, команда не повторена ({ev})", ev == ["dead", "exit"] and r.returncode == 255)
+    ssh.run_ssh("node1", "true", user="root")
+    check("следующая команда поднимает master заново", events() == ["connect", "mux"])
+
+    print("\n4. Лимит на хост")
+    t0 = time.perf_counter()
+    threads = [threading.Thread(target=ssh.run_ssh, args=("node2", "sleep 0.3")) for _ in range(6)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - t0
+    st = ssh.ssh_session_stats()["node2"]
+    check(f"6 команд по 0.3 с при лимите 2 — ≥0.9 с ({elapsed:.2f} с), ждали {st['waited']}",
+          elapsed >= 0.9 and st["waited"] >= 1 and st["in_flight"] == 0)
+    events()
+
+    print("\n5. SSH_MULTIPLEX=0")
+    ssh._settings = {"multiplex": False, "max_sessions": 2}
+    for _ in range(3):
+        ssh.run_ssh("node3", "true")
+    check("по коннекту на команду", events() == ["direct"] * 3)
+    ssh._settings = {"multiplex": True, "max_sessions": 2}
+
+    print("\n6. execute_server_command")
+    import bot.wireguard_peers as wg
+    wg._load_env = lambda: {}
+    wg._get_server_config = lambda server_id, env: {"ssh_host": "eu1.test", "ssh_user": "root"}
+    out, _err = wg.execute_server_command("eu1", "echo $((2 + 2))")
+    out2, _err = wg.execute_server_command("eu1", "echo again")
+    check(f"вывод ({out.strip()}, {out2.strip()}) через одну сессию ({events()})",
+          out.strip() == "4" and out2.strip() == "again"
+          and ssh.ssh_session_stats()["root@eu1.test"]["handshakes"] == 1)
+
+    print("\n7. Каталог сокетов")
+    ssh._CONTROL_DIR.chmod(0o755)
+    ssh.run_ssh("node4", "true")
+    check("права 755 → без ControlMaster", events() == ["direct"] and not ssh._control_dir_ok())
+    ssh._CONTROL_DIR.chmod(0o700)
+    check("0700 и наш → снова ok", ssh._control_dir_ok())
+    ssh._CONTROL_DIR = tmp / "link"
+    ssh._CONTROL_DIR.symlink_to(tmp / "ctl")
+    check("symlink → не ok", not ssh._control_dir_ok())
+    ssh._CONTROL_DIR = tmp / ("x" * 80)
+    check("длинный путь → не ok", not ssh._control_dir_ok())
+
+    print()
+    if _FAILED:
+        print(f"❌ ПРОВАЛЕНО проверок: {_FAILED}")
+        return 1
+    print("✅ Все проверки пройдены")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+Тест кеша подписок /sub/<token> (bot/sub_cache.py) и load_config_cached
+(bot/config.py) на ВРЕМЕННОЙ БД, без Flask: render — счётчик вызовов.
+
+Проверяет:
+  1. Повторный hit — из кеша, без render; ETag strong и стабилен.
+  2. Инвалидация штампом: новый UUID, продление, отзыв, смена env.
+  3. Срок истёк без записи в БД — штамп меняется сам.
+  4. If-None-Match: точное, список, W/, *, чужой ETag.
+  5. LRU: не больше _MAX_ENTRIES токенов.
+  6. load_config_cached перечитывает env только после правки файла.
+  7. Неполная отрисовка (общая ссылка вместо per-user) — без кеша и ETag.
+
+Запуск:  venv/bin/python scripts/test_sub_cache.py
+"""
+from __future__ import annotations
+
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+try:
+    sys.stdout.reconfigure(encoding="utf-8")
+except Exception:
+    pass
+
+_FAILED = 0
+
+
+def check(name: str, cond: bool) -> None:
+    global _FAILED
+    print(f"  {'✅' if cond else '❌'} {name}")
+    if not cond:
+        _FAILED += 1
+
+
+def main() -> int:
+    tmp = Path(tempfile.mkdtemp(prefix="sub_cache_test_"))
+    import bot.database as db
+    db.DATA_DIR = tmp
+    db.DB_PATH = tmp / "vpn.db"
+    db.USERS_JSON_PATH = tmp / "users.json"
+    db.PEERS_JSON_PATH = tmp / "peers.json"
+    db._db_initialized = False
+    db.init_db()
+    import bot.config as config
+    import bot.sub_cache as sc
+
+    env = tmp / "env_vars.txt"
+    env.write_text("BOT_TOKEN=t\nADMIN_ID=1\nVLESS_EU1_SHARE_URL=vless://shared@1.2.3.4:443#eu1\n")
+    renders: list = []
+    broken: set = set()
+
+    def hit(token: str, if_none_match: str | None = None):
+        """Путь api_subscription без Flask: (status, body, etag)."""
+        user = db.db_find_user_by_sub_token(token)
+
+        def render():
+            cfg = config.load_config_cached(str(env))
+            renders.append(token)
+            if token in broken:   # как _personalize_vless_url при ошибке БД
+                return cfg.vless_eu1_share_url, user.get("expires_at"), False
+            uuid = db.db_get_or_create_vless_uuid(int(user["telegram_id"]), "eu1")
+            return cfg.vless_eu1_share_url.replace("shared", uuid), user.get("expires_at"), True
+
+        body, _userinfo, etag = sc.sub_render_cached(
+            token, sc.sub_stamp(user, config.config_version(str(env))), render)
+        if etag and sc.etag_matches(if_none_match, etag):
+            return 304, "", etag
+        return 200, body, etag
+
+    def user(tid: int, expires: str | None) -> str:
+        with db._conn() as con:
+            con.execute("INSERT INTO users (telegram_id, active, expires_at) VALUES (?, 1, ?)", (tid, expires))
+        return db.db_ensure_sub_token(tid)
+
+    future = (datetime.utcnow() + timedelta(days=30)).isoformat(timespec="seconds")
+    tok = user(1, future)
+
+    print("1. Кеш")
+    status, body, etag = hit(tok)
+    status, body, etag = hit(tok)   # первый hit создал UUID → штамп сдвинулся
+    renders.clear()
+    status2, body2, etag2 = hit(tok)
+    check("повторный hit без render", not renders and (status2, body2, etag2) == (200, body, etag))
+    check(f"ETag strong ({etag})", etag.startswith('"') and not etag.startswith("W/") and len(etag) == 34)
+    status, _, _ = hit(tok, etag)
+    check("If-None-Match совпал → 304 без render", status == 304 and not renders)
+
+    print("\n2. Инвалидация")
+    uuid_before = db.db_get_per_user_vless_uuid(1, "eu1")
+    db.db_clear_per_user_vless_uuid(1, "eu1")
+    status, body3, etag3 = hit(tok, etag)
+    check("UUID сброшен → перерисовка, новый ETag, 200",
+          renders == [tok] and status == 200 and etag3 != etag and uuid_before not in body3)
+    renders.clear()
+    hit(tok)  # штамп с новым UUID
+    renders.clear()
+    db.db_extend_subscription(1, days=30)
+    hit(tok)
+    check("продление → перерисовка", renders == [tok])
+    renders.clear()
+    with db._conn() as con:
+        con.execute("UPDATE users SET active = 0 WHERE telegram_id = 1")
+    user_row = db.db_find_user_by_sub_token(tok)
+    check("active=0 → другой штамп",
+          sc.sub_stamp(user_row, config.config_version(str(env)))
+          != sc.sub_stamp({**user_row, "active": 1}, config.config_version(str(env))))
+    with db._conn() as con:
+        con.execute("UPDATE users SET active = 1 WHERE telegram_id = 1")
+    _, _, etag4 = hit(tok)
+    renders.clear()
+    st = env.stat()
+    env.write_text(env.read_text().replace("1.2.3.4", "5.6.7.8"))   # тот же размер
+    os.utime(env, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    status, body5, etag5 = hit(tok, etag4)
+    check("правка env → перерисовка с новым адресом", renders == [tok] and "5.6.7.8" in body5 and status == 200)
+    renders.clear()
+    hit(tok)
+    check("UUID/env/срок без изменений — из кеша", not renders)
+    unrelated = user(2, None)
+    hit(unrelated)
+    renders.clear()
+    hit(tok)
+    check("запись чужого юзера кеш не трогает", not renders)
+
+    print("\n3. Срок истёк")
+    soon = (datetime.utcnow() + timedelta(seconds=1)).isoformat(timespec="seconds")
+    with db._conn() as con:
+        con.execute("UPDATE users SET expires_at = ? WHERE telegram_id = 1", (soon,))
+    row = db.db_find_user_by_sub_token(tok)
+    before = sc.sub_stamp(row, (0, 0))
+    time.sleep(1.2)
+    check("штамп сменился без записи в БД",
+          sc.sub_stamp(row, (0, 0)) != before and not db.db_is_access_active_row(row))
+
+    print("\n4. If-None-Match")
+    e = '"abc"'
+    check("точное", sc.etag_matches('"abc"', e))
+    check("список", sc.etag_matches('"x", "abc"', e))
+    check("W/ (слабое сравнение)", sc.etag_matches('W/"abc"', e))
+    check("*", sc.etag_matches("*", e))
+    check("чужой / пустой — нет", not sc.etag_matches('"abd"', e) and not sc.etag_matches(None, e))
+
+    print("\n5. LRU")
+    sc.sub_cache_clear()
+    sc._MAX_ENTRIES = 3
+    for i in range(5):
+        sc.sub_render_cached(f"t{i}", (i,), lambda: ("b", None, True))
+    stats = sc.sub_cache_stats()
+    check(f"entries={stats['entries']}, evicted={stats['evicted']}", stats["entries"] == 3 and stats["evicted"] == 2)
+    renders.clear()
+    sc.sub_render_cached("t4", (4,), lambda: renders.append(1) or ("b", None, True))
+    sc.sub_render_cached("t0", (0,), lambda: renders.append(1) or ("b", None, True))
+    check("свежий — в кеше, вытесненный — перерисован", renders == [1])
+
+    print("\n6. load_config_cached")
+    a = config.load_config_cached(str(env))
+    b = config.load_config_cached(str(env))
+    check("без правки — тот же объект", a is b)
+    st = env.stat()
+    env.write_text(env.read_text() + "ONBOARDING_ENABLED=1\n")
+    os.utime(env, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    c = config.load_config_cached(str(env))
+    check("после правки — перечитан", c is not a and c.onboarding_enabled)
+    check("нет файла → версия (0, 0)", config.config_version(str(tmp / "missing.txt")) == (0, 0))
+
+    print("\n7. Неполная отрисовка")
+    sc._MAX_ENTRIES = 50000
+    sc.sub_cache_clear()
+    tok3 = user(3, future)
+    broken.add(tok3)
+    renders.clear()
+    status, body, etag = hit(tok3)
+    check("общая ссылка отдана без ETag", status == 200 and "shared" in body and etag is None)
+    hit(tok3, '"x"')
+    check("следующий hit снова рисует (не из кеша)", renders == [tok3, tok3])
+    check(f"degraded={sc.sub_cache_stats()['degraded']}", sc.sub_cache_stats()["degraded"] == 2)
+    broken.discard(tok3)
+    status, body, etag = hit(tok3)
+    status, body, etag = hit(tok3)   # UUID создан → штамп сдвинулся
+    renders.clear()
+    check("починилось → per-user ссылка, ETag, кеш",
+          "shared" not in body and etag and hit(tok3, etag)[0] == 304 and not renders)
+
+    print()
+    if _FAILED:
+        print(f"❌ ПРОВАЛЕНО проверок: {_FAILED}")
+        return 1
+    print("✅ Все проверки пройдены")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
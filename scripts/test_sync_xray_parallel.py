@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Тест параллельного sync нескольких серверов (scripts/sync_xray_users.py,
+sync_servers / main), без SSH: sync_one_server и verify_server подменены
+фейками с задержкой, SERVERS — три фейковых сервера.
+
+Проверяет:
+  1. Три сервера параллельно: время ≈ самый медленный, а не сумма; exit 0.
+  2. Логи серверов не перемешаны — каждый блок целиком.
+  3. Сбой/исключение на одном сервере: остальные синкаются, exit 1.
+  4. --jobs 1 — по очереди.
+  5. Канарейка: первой и одна; не прошла (sync или verify) — остальные не трогаются.
+
+Запуск:  venv/bin/python scripts/test_sync_xray_parallel.py
+"""
+from __future__ import annotations
+
+import contextlib
+import io
+import sys
+import threading
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "scripts"))
+
+try:
+    sys.stdout.reconfigure(encoding="utf-8")
+except Exception:
+    pass
+
+_FAILED = 0
+
+
+def check(name: str, cond: bool) -> None:
+    global _FAILED
+    print(f"  {'✅' if cond else '❌'} {name}")
+    if not cond:
+        _FAILED += 1
+
+
+def main() -> int:
+    import sync_xray_users as sx
+
+    sx.SERVERS = {name: {**sx.SERVERS["main"], "ssh": ["ssh", f"root@{name}"]} for name in ("main", "n2", "n3")}
+    delays = {"main": 0.3, "n2": 0.4, "n3": 0.2}
+    fail: dict = {}
+    bad_verify: set = set()
+    calls: list = []
+    lock = threading.Lock()
+
+    def fake_sync(server_id, include_shared, dry_run, log=print):
+        with lock:
+            calls.append(server_id)
+        for step in range(3):
+            log(f"  {server_id} step {step}")
+            time.sleep(delays[server_id] / 3)
+        if fail.get(server_id) == "raise":
+            raise RuntimeError(f"ssh {server_id}: timeout")
+        return fail.get(server_id) != "false"
+
+    sx.sync_one_server = fake_sync
+    sx.verify_server = lambda server_id, log=print: server_id not in bad_verify
+
+    def run(argv):
+        calls.clear()
+        out = io.StringIO()
+        t0 = time.monotonic()
+        with contextlib.redirect_stdout(out):
+            rc = sx.main(argv)
+        return rc, time.monotonic() - t0, out.getvalue()
+
+    print("1. Параллельно")
+    rc, took, out = run(["--all"])
+    check(f"exit 0, все три ({sorted(calls)})", rc == 0 and sorted(calls) == ["main", "n2", "n3"])
+    check(f"время {took:.2f}s ≈ самый медленный (0.4s), не сумма (0.9s)", took < 0.7)
+
+    print("\n2. Логи не перемешаны")
+    lines = [l.split()[0] for l in out.splitlines() if " step " in l]
+    blocks = [srv for i, srv in enumerate(lines) if i == 0 or lines[i - 1] != srv]
+    check(f"каждый сервер — один блок ({blocks})", sorted(blocks) == ["main", "n2", "n3"])
+    check("итог по серверам", all(f"{srv:<8} OK" in out for srv in ("main", "n2", "n3")))
+
+    print("\n3. Сбой одного сервера")
+    fail.update({"n2": "false", "n3": "raise"})
+    rc, _, out = run(["--all"])
+    check("exit 1, main всё равно синкнут", rc == 1 and "main     OK" in out)
+    check("n2 FAIL, n3 — исключение с traceback в своём блоке",
+          "n2       FAIL" in out and "EXCEPTION on n3: ssh n3: timeout" in out and "Traceback" in out)
+    fail.clear()
+
+    print("\n4. --jobs 1")
+    rc, took, out = run(["--all", "--jobs", "1"])
+    check(f"по очереди ({took:.2f}s ≥ 0.85s)", rc == 0 and took >= 0.85)
+
+    print("\n5. Канарейка")
+    rc, _, out = run(["--all", "--canary", "n3"])
+    check(f"канарейка первой ({calls}), затем остальные, exit 0",
+          rc == 0 and calls[0] == "n3" and sorted(calls[1:]) == ["main", "n2"])
+    fail["n3"] = "false"
+    rc, _, out = run(["--all", "--canary", "n3"])
+    check("sync канарейки не прошёл — остальные не трогаются",
+          rc == 1 and calls == ["n3"] and "main     SKIPPED" in out)
+    fail.clear()
+    bad_verify.add("n3")
+    rc, _, out = run(["--all", "--canary", "n3"])
+    check("verify канарейки не прошёл — тоже стоп", rc == 1 and calls == ["n3"])
+    rc, _, _ = run(["--all", "--canary", "n3", "--dry-run"])
+    check("dry-run: verify не нужен", rc == 0 and len(calls) == 3)
+    try:
+        with contextlib.redirect_stderr(io.StringIO()):
+            run(["--server", "main", "--canary", "n2"])
+        check("--canary вне синкаемых → ошибка", False)
+    except SystemExit as e:
+        check("--canary вне синкаемых → ошибка", e.code == 2)
+
+    print()
+    if _FAILED:
+        print(f"❌ ПРОВАЛЕНО проверок: {_FAILED}")
+        return 1
+    print("✅ Все проверки пройдены")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
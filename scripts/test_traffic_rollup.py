@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Тест свёртки истории трафика traffic_snapshots → часы → сутки на ВРЕМЕННОЙ БД.
+
+Симулирует cron traffic_accounting.py: 5 суток 5-мин снимков для 3 peer'ов
+(у одного — сброс счётчиков посреди часа, у другого — пропуск в дампе),
+после каждого снимка db_rollup_traffic(now=ts). Проверяет:
+  1. Сырые снимки вычищены до _TRAFFIC_RAW_KEEP_DAYS, история — в 'h'/'d'.
+  2. Окна, выровненные по часам/суткам, и свежие окна (в пределах raw) дают
+     ТОЧНО ту же reset-aware дельту, что и полный сырой ряд.
+  3. План окна берёт самое грубое разрешение (сутки) там, где можно.
+  4. by='user' агрегирует peer'ы юзера.
+  5. Повторный db_rollup_traffic — no-op (водяные знаки).
+
+Запуск:  venv/bin/python scripts/test_traffic_rollup.py
+"""
+from __future__ import annotations
+
+import sys
+import tempfile
+from datetime import datetime, timedelta
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+try:
+    sys.stdout.reconfigure(encoding="utf-8")
+except Exception:
+    pass
+
+_FAILED = 0
+FMT = "%Y-%m-%d %H:%M:%S"
+
+
+def check(name: str, cond: bool) -> None:
+    global _FAILED
+    print(f"  {'✅' if cond else '❌'} {name}")
+    if not cond:
+        _FAILED += 1
+
+
+def main() -> int:
+    tmp = Path(tempfile.mkdtemp(prefix="rollup_test_"))
+    import bot.database as db
+    db.DATA_DIR = tmp
+    db.DB_PATH = tmp / "vpn.db"
+    db.USERS_JSON_PATH = tmp / "users.json"
+    db.PEERS_JSON_PATH = tmp / "peers.json"
+    db._db_initialized = False
+    db.init_db()
+
+    # Синтетический ряд: PKA (tid 1) ровный, PKB (tid 1) со сбросом,
+    # PKC (tid 2) пропадает из дампа на 2 часа.
+    t0 = datetime(2026, 3, 1, 0, 2, 30)
+    steps = 5 * 288
+    counters = {"PKA": [0, 0], "PKB": [0, 0], "PKC": [0, 0]}
+    tids = {"PKA": 1, "PKB": 1, "PKC": 2}
+    truth = []  # (ts, pk, d_rx, d_tx) — приращение, отнесённое к снимку
+    last_seen = {}
+    for i in range(steps):
+        ts = t0 + timedelta(minutes=5 * i)
+        rows = []
+        for k, pk in enumerate(("PKA", "PKB", "PKC")):
+            if pk == "PKC" and 400 <= i < 424:
+                continue  # peer'а нет в dump
+            inc_rx, inc_tx = 1000 * (k + 1) + i % 13, 100 * (k + 1)
+            if pk == "PKB" and i in (500, 901):
+                counters[pk] = [inc_rx, inc_tx]  # рестарт → счётчик с нуля
+            else:
+                counters[pk][0] += inc_rx
+                counters[pk][1] += inc_tx
+            rx, tx = counters[pk]
+            prev = last_seen.get(pk)
+            if prev is not None:
+                d_rx = rx - prev[0] if rx >= prev[0] else rx
+                d_tx = tx - prev[1] if tx >= prev[1] else tx
+                truth.append((ts, pk, d_rx, d_tx))
+            last_seen[pk] = (rx, tx)
+            rows.append((ts.strftime(FMT), pk, tids[pk], rx, tx))
+        with db._conn() as con:
+            con.executemany("INSERT INTO traffic_snapshots VALUES (?, ?, ?, ?, ?)", rows)
+        db.db_rollup_traffic(now=ts)
+    now = t0 + timedelta(minutes=5 * (steps - 1))
+
+    def expected(lo: datetime, hi: datetime, pk: str = None) -> int:
+        return sum(d_rx + d_tx for ts, p, d_rx, d_tx in truth
+                   if lo <= ts < hi and (pk is None or p == pk))
+
+    def got(lo: datetime, hi: datetime, by: str = "peer"):
+        return db.db_query_traffic_window(lo.strftime(FMT), hi.strftime(FMT), by=by, now=now)
+
+    print("1. Retention и уровни")
+    with db._conn() as con:
+        oldest_raw = con.execute("SELECT MIN(ts) FROM traffic_snapshots").fetchone()[0]
+        n_h = con.execute("SELECT COUNT(*) FROM traffic_rollup WHERE resolution='h'").fetchone()[0]
+        n_d = con.execute("SELECT COUNT(*) FROM traffic_rollup WHERE resolution='d'").fetchone()[0]
+    check("сырые снимки старше 3 суток удалены",
+          oldest_raw >= (now - timedelta(days=db._TRAFFIC_RAW_KEEP_DAYS)).strftime(FMT))
+    check(f"часовые бакеты есть ({n_h}), дневные есть ({n_d})", n_h > 0 and n_d > 0)
+
+    print("\n2. Точность окон")
+    cases = [
+        ("все 5 суток (от начала ряда)", t0, now + timedelta(seconds=1)),
+        ("сутки 2 целиком", datetime(2026, 3, 2), datetime(2026, 3, 3)),
+        ("часы 02.03 17:00 – 03.03 03:00 (сброс PKB внутри)", datetime(2026, 3, 2, 17), datetime(2026, 3, 3, 3)),
+        ("свежее невыровненное окно 1ч 17м", now - timedelta(minutes=77), now + timedelta(seconds=1)),
+        ("свежее окно через границу суток", datetime(2026, 3, 4, 21, 7), datetime(2026, 3, 5, 2, 41)),
+    ]
+    for name, lo, hi in cases:
+        total = sum(r["delta_total"] for r in got(lo, hi))
+        exp = expected(lo, hi)
+        check(f"{name}: {total} == {exp}", total == exp)
+    pkb = next(r for r in got(t0, now + timedelta(seconds=1)) if r["public_key"] == "PKB")
+    check("сбросы PKB учтены по каждому шагу", pkb["delta_total"] == expected(t0, now + timedelta(seconds=1), "PKB"))
+
+    print("\n3. План окна")
+    plan = db.db_traffic_window_plan(t0.strftime(FMT), now.strftime(FMT), now=now)
+    kinds = [p[0] for p in plan]
+    check(f"длинное окно: сутки в середине, мелкие уровни по краям ({kinds})",
+          "d" in kinds and kinds[-1] == "raw")
+    short = db.db_traffic_window_plan((now - timedelta(minutes=30)).strftime(FMT), now.strftime(FMT), now=now)
+    check("окно 30 мин — только raw", [p[0] for p in short] == ["raw"])
+
+    print("\n4. Per-user")
+    users = got(t0, now + timedelta(seconds=1), by="user")
+    u1 = next(u for u in users if u["telegram_id"] == 1)
+    check("tid 1 = PKA + PKB (2 peer'а)",
+          u1["peers"] == 2 and u1["delta_total"] == expected(t0, now + timedelta(seconds=1), "PKA")
+          + expected(t0, now + timedelta(seconds=1), "PKB"))
+
+    print("\n5. Идемпотентность")
+    before = got(t0, now + timedelta(seconds=1))
+    again = db.db_rollup_traffic(now=now)
+    check("повторная свёртка ничего не добавила",
+          again == {"h": 0, "d": 0} and got(t0, now + timedelta(seconds=1)) == before)
+
+    print()
+    if _FAILED:
+        print(f"❌ ПРОВАЛЕНО проверок: {_FAILED}")
+        return 1
+    print("✅ Все проверки пройдены")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+Тест сборщика VLESS-трафика на дельтах (scripts/vless_summary_accounting.py,
+statsquery -reset → db_add_vless_traffic_deltas) на ВРЕМЕННОЙ БД, без xray
+и SSH: statsquery эмулируется счётчиками в памяти, -reset их обнуляет.
+
+Проверяет:
+  1. Один statsquery -reset на сервер за опрос (main — через run_ssh).
+  2. Дельты копятся в lifetime; per-user — и для eu1; нулевые не пишутся.
+  3. Совместимость: reset-aware накопитель (--snapshot) поверх дельт считает верно.
+  4. Сервер не ответил — ничего не пишется, счётчики не теряются.
+  5. Ошибка БД — дельты в spool, следующий опрос их досылает.
+  6. Переход --snapshot → -reset: первый опрос не считает трафик дважды.
+
+Запуск:  venv/bin/python scripts/test_vless_deltas.py
+"""
+from __future__ import annotations
+
+import json
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "scripts"))
+
+try:
+    sys.stdout.reconfigure(encoding="utf-8")
+except Exception:
+    pass
+
+_FAILED = 0
+
+
+def check(name: str, cond: bool) -> None:
+    global _FAILED
+    print(f"  {'✅' if cond else '❌'} {name}")
+    if not cond:
+        _FAILED += 1
+
+
+def main() -> int:
+    tmp = Path(tempfile.mkdtemp(prefix="vless_deltas_test_"))
+    import bot.database as db
+    db.DATA_DIR = tmp
+    db.DB_PATH = tmp / "vpn.db"
+    db.USERS_JSON_PATH = tmp / "users.json"
+    db.PEERS_JSON_PATH = tmp / "peers.json"
+    db._db_initialized = False
+    db.init_db()
+    import vless_summary_accounting as vsa
+
+    counters = {"eu1": {}, "main": {}}
+    calls: list = []
+    down: set = set()
+
+    def statsquery(server: str, args: list) -> subprocess.CompletedProcess:
+        calls.append((server, args))
+        if server in down:
+            return subprocess.CompletedProcess([], 1, "", "failed to dial")
+        pattern = next((a.split("=", 1)[1] for a in args if a.startswith("-pattern=")), "")
+        stat = [{"name": n, "value": v} if v else {"name": n}
+                for n, v in counters[server].items() if pattern in n]
+        if "-reset" in args:
+            for n in counters[server]:
+                counters[server][n] = 0
+        return subprocess.CompletedProcess([], 0, json.dumps({"stat": stat}), "")
+
+    vsa.subprocess.run = lambda cmd, **kw: statsquery("eu1", cmd[3:])
+    vsa.run_ssh = lambda host, cmd, **kw: statsquery(
+        "main", [a.strip("'") for a in cmd.split()[3:]])
+
+    def traffic(server: str, kind: str, name: str, rx: int, tx: int) -> None:
+        c = counters[server]
+        c[f"{kind}>>>{name}>>>traffic>>>uplink"] = c.get(f"{kind}>>>{name}>>>traffic>>>uplink", 0) + rx
+        c[f"{kind}>>>{name}>>>traffic>>>downlink"] = c.get(f"{kind}>>>{name}>>>traffic>>>downlink", 0) + tx
+
+    def lifetime():
+        with db._conn() as con:
+            srv = {(r[0], r[1]): (r[2], r[3]) for r in con.execute(
+                "SELECT server_id, inbound_tag, lifetime_rx, lifetime_tx FROM vless_server_traffic")}
+            usr = {(r[0], r[1]): (r[2], r[3]) for r in con.execute(
+                "SELECT telegram_id, server_id, lifetime_rx, lifetime_tx FROM vless_user_traffic")}
+        return srv, usr
+
+    traffic("eu1", "inbound", "vless-tcp", 1000, 5000)
+    traffic("eu1", "inbound", "api", 7, 7)
+    traffic("eu1", "user", "tid_1@kronos", 600, 3000)
+    traffic("eu1", "user", "tid_2@kronos", 0, 0)
+    traffic("eu1", "user", "shared-legacy", 400, 2000)
+    traffic("main", "inbound", "vless-tcp", 200, 800)
+    traffic("main", "user", "tid_1@kronos", 200, 800)
+
+    print("1. Один вызов на сервер")
+    result = vsa.poll_once()
+    check(f"вызовов: {len(calls)}, все с -reset", len(calls) == 2 and all("-reset" in a for _, a in calls))
+    check("без -pattern (все счётчики разом)", not any(x.startswith("-pattern") for _, a in calls for x in a))
+    check(f"итог опроса {result}", result == {"eu1": (6000, 1), "main": (1000, 1)})
+
+    print("\n2. Дельты копятся")
+    traffic("eu1", "inbound", "vless-tcp", 10, 50)
+    traffic("eu1", "user", "tid_1@kronos", 10, 50)
+    vsa.poll_once()
+    srv, usr = lifetime()
+    check(f"eu1 inbound {srv.get(('eu1', 'vless-tcp'))}", srv.get(("eu1", "vless-tcp")) == (1010, 5050))
+    check("api-inbound и юзеры без tid не пишутся",
+          ("eu1", "api") not in srv and all(isinstance(k[0], int) for k in usr))
+    check(f"per-user eu1 {usr.get((1, 'eu1'))}, main {usr.get((1, 'main'))}",
+          usr.get((1, "eu1")) == (610, 3050) and usr.get((1, "main")) == (200, 800))
+    check("нулевой юзер не записан", (2, "eu1") not in usr)
+    calls.clear()
+    vsa.poll_once()
+    check("без трафика — lifetime не меняется", lifetime() == (srv, usr) and len(calls) == 2)
+
+    print("\n3. Совместимость со --snapshot")
+    traffic("main", "inbound", "vless-tcp", 30, 70)
+    traffic("main", "user", "tid_1@kronos", 30, 70)
+    vsa.snapshot_once()
+    srv, usr = lifetime()
+    check(f"reset-aware поверх дельт: {srv[('main', 'vless-tcp')]}, {usr[(1, 'main')]}",
+          srv[("main", "vless-tcp")] == (230, 870) and usr[(1, "main")] == (230, 870))
+    for n in counters["main"]:
+        counters["main"][n] = 0   # как будто между режимами был -reset
+
+    print("\n4. Сервер не ответил")
+    down.add("main")
+    traffic("main", "user", "tid_1@kronos", 5, 5)
+    result = vsa.poll_once()
+    check("main=None, eu1 опрошен", result["main"] is None and result["eu1"] == (0, 0))
+    down.clear()
+    vsa.poll_once()
+    check("счётчики не потерялись — доехали следующим опросом", lifetime()[1][(1, "main")] == (235, 875))
+
+    print("\n5. Ошибка БД → spool")
+    real = vsa.db_add_vless_traffic_deltas
+
+    def broken(*a, **kw):
+        raise db.sqlite3.OperationalError("database is locked")
+
+    vsa.db_add_vless_traffic_deltas = broken
+    traffic("eu1", "user", "tid_3@kronos", 100, 900)
+    vsa.poll_once()
+    spool = tmp / vsa.SPOOL_NAME
+    check("дельты в spool", spool.exists() and '"telegram_id": 3' in spool.read_text())
+    vsa.db_add_vless_traffic_deltas = real
+    vsa.poll_once()
+    check("следующий опрос дослал, spool пуст",
+          lifetime()[1].get((3, "eu1")) == (100, 900) and not spool.exists()
+          and not spool.with_suffix(".replay").exists())
+
+    print("\n6. Переход со снимков на -reset")
+    gb = 1024 ** 3
+    traffic("main", "user", "tid_9@kronos", 2 * gb, 8 * gb)
+    vsa.snapshot_once()
+    check("снимок: 10 ГБ", db.db_get_user_total_bytes(9) == 10 * gb)
+    traffic("main", "user", "tid_9@kronos", 0, 1 * gb)   # счётчик Xray: 11 ГБ с запуска
+    vsa.poll_once()
+    check(f"первый -reset: {db.db_get_user_total_bytes(9) / gb:.0f} ГБ (не 21)",
+          db.db_get_user_total_bytes(9) == 11 * gb)
+    traffic("main", "user", "tid_9@kronos", 0, 2 * gb)
+    vsa.poll_once()
+    check("дальше дельты целиком: 13 ГБ", db.db_get_user_total_bytes(9) == 13 * gb)
+    traffic("main", "user", "tid_10@kronos", 0, 5 * gb)
+    vsa.snapshot_once()
+    counters["main"]["user>>>tid_10@kronos>>>traffic>>>downlink"] = 1 * gb   # Xray перезапущен
+    vsa.poll_once()
+    check("счётчик меньше снимка (рестарт Xray) → + значение целиком",
+          db.db_get_user_total_bytes(10) == 6 * gb)
+
+    print()
+    if _FAILED:
+        print(f"❌ ПРОВАЛЕНО проверок: {_FAILED}")
+        return 1
+    print("✅ Все проверки пройдены")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
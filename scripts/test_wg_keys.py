@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Тест генерации ключей WireGuard в процессе (bot/wg_keys.py).
+
+Проверяет:
+  1. Векторы RFC 7748 (раздел 6.1): публичные ключи Алисы и Боба.
+  2. Чистый Python и `cryptography` (если установлен) дают одно и то же.
+  3. Приватный ключ — с clamping, как у `wg genkey`; пачка — без повторов.
+  4. Сверка с `wg pubkey` (если wireguard-tools есть на хосте; иначе пропуск).
+  5. Скорость: ключ в процессе против пары процессов wg.
+
+Запуск:  venv/bin/python scripts/test_wg_keys.py
+"""
+from __future__ import annotations
+
+import base64
+import shutil
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+try:
+    sys.stdout.reconfigure(encoding="utf-8")
+except Exception:
+    pass
+
+_FAILED = 0
+
+# RFC 7748, 6.1
+_ALICE_PRIV = "77076d0a7318a57d3c16c17251b26645df4c2f87ebc0992ab177fba51db92c2a"
+_ALICE_PUB = "8520f0098930a754748b7ddcb43ef75a0dbf3a0d26381af4eba4a98eaa9b4e6a"
+_BOB_PRIV = "5dab087e624a8a4b79e17f8b83800ee66f3bb1292618b6fd1c2f8b27ff88e0eb"
+_BOB_PUB = "de9edb7d7b7dc1b4d35b61c2ece435373f8343c85b78674dadfc7e146f882b4f"
+
+
+def check(name: str, cond: bool) -> None:
+    global _FAILED
+    print(f"  {'✅' if cond else '❌'} {name}")
+    if not cond:
+        _FAILED += 1
+
+
+def _b64(hex_str: str) -> str:
+    return base64.b64encode(bytes.fromhex(hex_str)).decode()
+
+
+def main() -> int:
+    from bot import wg_keys
+
+    print("1. Векторы RFC 7748")
+    for who, priv, pub in (("Алиса", _ALICE_PRIV, _ALICE_PUB), ("Боб", _BOB_PRIV, _BOB_PUB)):
+        check(f"{who}: public_key_from_private", wg_keys.public_key_from_private(_b64(priv)) == _b64(pub))
+        check(f"{who}: чистый Python", wg_keys._x25519_base_py(bytes.fromhex(priv)).hex() == pub)
+    try:
+        wg_keys.public_key_from_private(base64.b64encode(b"x" * 31).decode())
+        check("31 байт → ValueError", False)
+    except ValueError:
+        check("31 байт → ValueError", True)
+
+    print("\n2. cryptography vs чистый Python")
+    pairs = wg_keys.generate_keypairs(50)
+    same = all(
+        wg_keys._x25519_base_py(base64.b64decode(priv)) == base64.b64decode(pub) for priv, pub in pairs
+    )
+    backend = "cryptography" if wg_keys.X25519PrivateKey is not None else "чистый Python"
+    check(f"50 пар совпадают (бэкенд: {backend})", same)
+
+    print("\n3. Формат и пачка")
+    raw = [base64.b64decode(priv) for priv, _ in pairs]
+    check("32 байта, clamping как у wg genkey",
+          all(len(r) == 32 and r[0] & 7 == 0 and r[31] & 128 == 0 and r[31] & 64 for r in raw))
+    check("пачка без повторов", len({priv for priv, _ in pairs}) == 50 and len({pub for _, pub in pairs}) == 50)
+
+    print("\n4. Сверка с wg pubkey")
+    wg_bin = shutil.which("wg")
+    if wg_bin is None:
+        print("  ⏭  wireguard-tools не установлен — пропуск")
+    else:
+        mismatched = 0
+        for priv, pub in pairs[:20]:
+            out = subprocess.run([wg_bin, "pubkey"], input=f"{priv}\n", capture_output=True,
+                                 text=True, check=True).stdout.strip()
+            mismatched += out != pub
+        check(f"20 ключей совпали с wg pubkey (расхождений {mismatched})", mismatched == 0)
+        genkey = subprocess.check_output([wg_bin, "genkey"], text=True).strip()
+        wg_pub = subprocess.run([wg_bin, "pubkey"], input=f"{genkey}\n", capture_output=True,
+                                text=True, check=True).stdout.strip()
+        check("ключ от wg genkey → тот же pubkey", wg_keys.public_key_from_private(genkey) == wg_pub)
+
+    print("\n5. Скорость")
+    n = 200
+    t0 = time.perf_counter()
+    wg_keys.generate_keypairs(n)
+    in_proc_ms = (time.perf_counter() - t0) * 1000 / n
+    t0 = time.perf_counter()
+    for _ in range(n):
+        wg_keys._x25519_base_py(b"\x01" * 32)
+    py_ms = (time.perf_counter() - t0) * 1000 / n
+    print(f"  в процессе: {in_proc_ms:.3f} мс/ключ ({backend}); чистый Python: {py_ms:.3f} мс/ключ")
+    if wg_bin is not None:
+        t0 = time.perf_counter()
+        for _ in range(20):
+            priv = subprocess.check_output([wg_bin, "genkey"], text=True).strip()
+            subprocess.run([wg_bin, "pubkey"], input=f"{priv}\n", capture_output=True, text=True, check=True)
+        print(f"  wg genkey + wg pubkey: {(time.perf_counter() - t0) * 1000 / 20:.3f} мс/ключ")
+    check("чистый Python < 10 мс на ключ", py_ms < 10)
+
+    print()
+    if _FAILED:
+        print(f"❌ ПРОВАЛЕНО проверок: {_FAILED}")
+        return 1
+    print("✅ Все проверки пройдены")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
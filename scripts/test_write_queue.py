@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+Тест write-behind очереди bot/database.py на ВРЕМЕННОЙ БД.
+
+Проверяет:
+  1. Очередь выключена → db_update_vless_requested_at пишет синхронно.
+  2. Включена → записи копятся, одинаковый ключ сливается (coalescing),
+     время фиксируется на момент hit'а; flush пишет одной транзакцией.
+  3. Фоновый поток сбрасывает очередь сам за ~_WQ_FLUSH_INTERVAL_S.
+  4. Ошибка flush → пачка возвращается в очередь, более свежая запись
+     того же ключа не затирается старой.
+  5. db_write_queue_stop дописывает остаток, дальше — снова синхронно.
+
+Запуск:  venv/bin/python scripts/test_write_queue.py
+"""
+from __future__ import annotations
+
+import sqlite3
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+try:
+    sys.stdout.reconfigure(encoding="utf-8")
+except Exception:
+    pass
+
+_FAILED = 0
+
+
+def check(name: str, cond: bool) -> None:
+    global _FAILED
+    print(f"  {'✅' if cond else '❌'} {name}")
+    if not cond:
+        _FAILED += 1
+
+
+def main() -> int:
+    tmp = Path(tempfile.mkdtemp(prefix="write_queue_test_"))
+    import bot.database as db
+    db.DATA_DIR = tmp
+    db.DB_PATH = tmp / "vpn.db"
+    db.USERS_JSON_PATH = tmp / "users.json"
+    db.PEERS_JSON_PATH = tmp / "peers.json"
+    db._db_initialized = False
+    db.init_db()
+    for tid in range(1, 11):
+        db.db_upsert_user({"telegram_id": tid, "username": f"u{tid}"})
+
+    def seen(tid: int):
+        with db._conn() as con:
+            return con.execute(
+                "SELECT vless_requested_at FROM users WHERE telegram_id = ?", (tid,)
+            ).fetchone()[0]
+
+    print("1. Очередь выключена")
+    db.db_update_vless_requested_at(1)
+    check("запись видна сразу", seen(1) is not None)
+    check("stats: не запущена, пусто", not db.db_write_queue_stats()["running"])
+
+    print("\n2. Coalescing")
+    db._WQ_FLUSH_INTERVAL_S = 60.0  # фоновый поток не мешает ручной проверке
+    db.db_write_queue_start()
+    before = seen(2)
+    for _ in range(10):
+        for tid in range(2, 11):
+            db.db_update_vless_requested_at(tid)
+    db.db_update_proxy_requested_at(2)
+    st = db.db_write_queue_stats()
+    check(f"91 запись → depth 10, coalesced 81 ({st['depth']}, {st['coalesced']})",
+          st["depth"] == 10 and st["coalesced"] == 81 and st["enqueued"] == 91)
+    check("до flush в БД ничего нет", seen(2) == before)
+    n = db.db_write_queue_flush()
+    st = db.db_write_queue_stats()
+    check(f"flush записал 10 за одну транзакцию ({n}, flushes={st['flushes']})",
+          n == 10 and st["flushes"] == 1 and st["depth"] == 0)
+    check("после flush значения на месте", all(seen(t) is not None for t in range(2, 11)))
+    check(f"латентность flush замерена ({st['last_flush_ms']:.2f} мс)", st["last_flush_ms"] > 0)
+
+    print("\n3. Фоновый flush")
+    db.db_write_queue_stop()
+    db._WQ_FLUSH_INTERVAL_S = 0.05
+    db.db_write_queue_start()
+    with db._conn() as con:
+        con.execute("UPDATE users SET vless_requested_at = NULL WHERE telegram_id = 3")
+    db.db_update_vless_requested_at(3)
+    deadline = time.monotonic() + 2.0
+    while seen(3) is None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    check("поток сбросил запись сам", seen(3) is not None)
+
+    print("\n4. Ошибка flush")
+    db.db_write_queue_stop()
+    db._WQ_FLUSH_INTERVAL_S = 60.0
+    db.db_write_queue_start()
+    real_conn = db._conn
+
+    @contextmanager
+    def broken_conn():
+        # пока пачка «в полёте» — конкурентный hit кладёт свежее значение для tid 5
+        db._write_behind(("vless_requested_at", 5),
+                         "UPDATE users SET vless_requested_at = ? WHERE telegram_id = ?",
+                         ("2030-01-01 00:00:00", 5))
+        raise sqlite3.OperationalError("database is locked")
+        yield  # pragma: no cover
+
+    with db._conn() as con:
+        con.execute("UPDATE users SET vless_requested_at = NULL WHERE telegram_id IN (4, 5)")
+    db.db_update_vless_requested_at(4)
+    db._write_behind(("vless_requested_at", 5),
+                     "UPDATE users SET vless_requested_at = ? WHERE telegram_id = ?",
+                     ("2000-01-01 00:00:00", 5))
+    db._conn = broken_conn
+    try:
+        n = db.db_write_queue_flush()
+    finally:
+        db._conn = real_conn
+    st = db.db_write_queue_stats()
+    check(f"flush вернул 0, errors=1, записи в очереди ({st['depth']})",
+          n == 0 and st["errors"] >= 1 and st["depth"] == 2)
+    db.db_write_queue_flush()
+    check("после восстановления дописано, свежее значение tid 5 не затёрто",
+          seen(4) is not None and seen(5) == "2030-01-01 00:00:00")
+
+    print("\n5. Остановка")
+    db.db_update_vless_requested_at(6)
+    db.db_write_queue_stop()
+    st = db.db_write_queue_stats()
+    check("stop дописал остаток", st["depth"] == 0 and not st["running"])
+    with db._conn() as con:
+        con.execute("UPDATE users SET vless_requested_at = NULL WHERE telegram_id = 7")
+    db.db_update_vless_requested_at(7)
+    check("после stop — снова синхронно", seen(7) is not None)
+
+    print()
+    if _FAILED:
+        print(f"❌ ПРОВАЛЕНО проверок: {_FAILED}")
+        return 1
+    print("✅ Все проверки пройдены")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+Тест живого управления юзерами Xray (bot/xray_api.py + sync_xray_users),
+без SSH и без xray: команды перехватываются фейковым runner'ом, который
+эмулирует `xray api adu/rmu` над clients[] в памяти.
+
+Проверяет:
+  1. plan_client_changes: добавленные/снятые/изменённые; клиент без email → XrayApiError.
+  2. adu/rmu: команды, разбор ответа, несовпадение числа юзеров → XrayApiError.
+  3. sync_one_server: изменения вживую, checkpoint config.json, БЕЗ restart.
+  4. Нет изменений — ни API, ни записи.
+  5. API не справился — fallback на config + restart.
+  6. patch_xray_stats добавляет HandlerService в api.services.
+
+Запуск:  venv/bin/python scripts/test_xray_api.py
+"""
+from __future__ import annotations
+
+import base64
+import json
+import re
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "scripts"))
+
+try:
+    sys.stdout.reconfigure(encoding="utf-8")
+except Exception:
+    pass
+
+_FAILED = 0
+
+
+def check(name: str, cond: bool) -> None:
+    global _FAILED
+    print(f"  {'✅' if cond else '❌'} {name}")
+    if not cond:
+        _FAILED += 1
+
+
+def _done(stdout: str = "", rc: int = 0, stderr: str = "") -> subprocess.CompletedProcess:
+    return subprocess.CompletedProcess([], rc, stdout, stderr)
+
+
+class FakeXray:
+    """clients[] одного inbound'а в «runtime» + журнал команд."""
+
+    def __init__(self, clients):
+        self.runtime = {c.get("email") or c["id"]: c for c in clients}
+        self.commands: list = []
+        self.broken = False
+        self.config_text = None
+
+    def run(self, cmd: str) -> subprocess.CompletedProcess:
+        self.commands.append(cmd)
+        if self.broken and "xray api" in cmd:
+            return _done(rc=1, stderr="rpc error: Unavailable")
+        if "xray api rmu" in cmd:
+            emails = cmd.split("-tag=", 1)[1].split()[1:]
+            n = sum(1 for e in emails if self.runtime.pop(e, None) is not None)
+            return _done(f"Removed {n} user(s) in total.\n")
+        if "xray api adu" in cmd:
+            payload = json.loads(base64.b64decode(re.search(r"echo (\S+) \| base64", cmd).group(1)))
+            n = 0
+            for c in payload["inbounds"][0]["settings"]["clients"]:
+                if c["email"] not in self.runtime:
+                    self.runtime[c["email"]] = c
+                    n += 1
+            return _done(f"Added {n} user(s) in total.\n")
+        if "xray-checkpoint" in cmd:
+            self.config_text = base64.b64decode(re.search(r"echo (\S+) \| base64", cmd).group(1)).decode()
+            return _done()
+        return _done()
+
+
+def main() -> int:
+    from bot.xray_api import (
+        XrayApiError, apply_client_changes, plan_client_changes, xray_add_users, xray_remove_users,
+    )
+
+    a = {"id": "uuid-a", "email": "tid_1@kronos", "flow": "xtls-rprx-vision"}
+    b = {"id": "uuid-b", "email": "tid_2@kronos", "flow": "xtls-rprx-vision"}
+    c = {"id": "uuid-c", "email": "tid_3@kronos", "flow": "xtls-rprx-vision"}
+    b2 = {**b, "id": "uuid-b2"}
+    shared = {"id": "uuid-shared", "flow": "xtls-rprx-vision"}
+
+    print("1. План изменений")
+    adds, removes = plan_client_changes([a, b, shared], [a, b2, c, shared])
+    check(f"+{[x['email'] for x in adds]} −{removes}",
+          [x["id"] for x in adds] == ["uuid-b2", "uuid-c"] and removes == ["tid_2@kronos"])
+    check("без изменений — пусто", plan_client_changes([a, shared], [shared, a]) == ([], []))
+    for old, new, what in (([a, shared], [a], "снятие shared"), ([a], [a, shared], "добавление shared")):
+        try:
+            plan_client_changes(old, new)
+            check(f"{what} (без email) → XrayApiError", False)
+        except XrayApiError:
+            check(f"{what} (без email) → XrayApiError", True)
+
+    print("\n2. adu / rmu")
+    fake = FakeXray([a, b])
+    check("rmu снял 1", xray_remove_users(fake.run, "vless-tcp", ["tid_2@kronos"]) == 1)
+    check("rmu: --server и -tag", "--server=127.0.0.1:10085 -tag=vless-tcp tid_2@kronos" in fake.commands[-1])
+    check("adu добавил 1", xray_add_users(fake.run, "vless-tcp", "vless", [c]) == 1 and "tid_3@kronos" in fake.runtime)
+    try:
+        xray_add_users(fake.run, "vless-tcp", "vless", [c])
+        check("adu уже существующего (0 из 1) → XrayApiError", False)
+    except XrayApiError:
+        check("adu уже существующего (0 из 1) → XrayApiError", True)
+    fake.broken = True
+    try:
+        apply_client_changes(fake.run, "vless-tcp", "vless", [], ["tid_1@kronos"])
+        check("API недоступен → XrayApiError", False)
+    except XrayApiError:
+        check("API недоступен → XrayApiError", True)
+
+    print("\n3. sync_one_server: вживую, без рестарта")
+    import sync_xray_users as sx
+
+    config = {
+        "policy": {"levels": {"0": {"statsUserUplink": True, "statsUserDownlink": True}}},
+        "inbounds": [{"tag": "vless-tcp", "protocol": "vless",
+                      "settings": {"clients": [a, b, {"id": sx.SERVERS["main"]["shared_uuid"],
+                                                       "flow": "xtls-rprx-vision"}],
+                                   "decryption": "none"}}],
+    }
+    fake = FakeXray(config["inbounds"][0]["settings"]["clients"])
+    legacy_cmds: list = []
+
+    def ssh_run(ssh_args, remote_cmd, timeout=30):
+        legacy_cmds.append(remote_cmd)
+        return _done()
+
+    sx.fetch_db_users_for_server = lambda sid: [{"telegram_id": 1, "uuid": "uuid-a"},
+                                               {"telegram_id": 3, "uuid": "uuid-c"}]
+    sx._ssh_read_file = lambda ssh, path, sudo="": json.dumps(config)
+    sx._ssh_run = ssh_run
+    sx._ssh_write_file = lambda *a_, **kw: legacy_cmds.append("write")
+    sx.ssh_runner = lambda ssh: fake.run
+    sx.time.sleep = lambda s: None
+
+    ok = sx.sync_one_server("main", include_shared=True, dry_run=False)
+    check("успех", ok)
+    check("в runtime: tid_1, tid_3, shared; tid_2 снят",
+          set(fake.runtime) == {"tid_1@kronos", "tid_3@kronos", sx.SERVERS["main"]["shared_uuid"]})
+    check("restart не вызывался", not any("restart" in cmd for cmd in legacy_cmds + fake.commands))
+    written = json.loads(fake.config_text or "{}")
+    emails = [cl.get("email") for cl in written.get("inbounds", [{}])[0].get("settings", {}).get("clients", [])]
+    check(f"checkpoint config.json записан ({emails})", emails == ["tid_1@kronos", "tid_3@kronos", None])
+
+    print("\n4. Нет изменений")
+    config = written
+    fake.commands.clear()
+    legacy_cmds.clear()
+    check("ни API, ни записи", sx.sync_one_server("main", True, False) and not fake.commands and not legacy_cmds)
+
+    print("\n5. Fallback")
+    sx.fetch_db_users_for_server = lambda sid: [{"telegram_id": 1, "uuid": "uuid-a"}]
+    fake.broken = True
+    legacy_cmds.clear()
+    sx.sync_one_server("main", True, False)
+    check("API не ответил → config + restart", any("systemctl restart xray" in cmd for cmd in legacy_cmds))
+
+    print("\n6. patch_xray_stats")
+    import patch_xray_stats as px
+    cfg = {"api": {"tag": "api", "services": ["StatsService"]}}
+    changes = px.patch_config(cfg)
+    check("HandlerService добавлен в существующий api-блок",
+          cfg["api"]["services"] == ["StatsService", "HandlerService"] and any("HandlerService" in ch for ch in changes))
+    cfg = {}
+    px.patch_config(cfg)
+    check("новый api-блок — со StatsService и HandlerService",
+          set(cfg["api"]["services"]) == {"StatsService", "HandlerService"})
+
+    print()
+    if _FAILED:
+        print(f"❌ ПРОВАЛЕНО проверок: {_FAILED}")
+        return 1
+    print("✅ Все проверки пройдены")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""
+Тест планировщика sync Xray (bot/xray_sync.py) на ВРЕМЕННОЙ БД, без
+subprocess: sync ноды подменён фейковым runner'ом (set_sync_runner).
+
+Проверяет:
+  1. Волна из 50 запросов — один прогон; coalesced = 49, нода чистая.
+  2. Запросы во время прогона — ровно один догоняющий прогон.
+  3. На ноду один прогон одновременно; разные ноды — параллельно.
+  4. Ошибка прогона: флаг остаётся, last_error; повтор доводит до sync.
+  5. Флаг переживает «падение»: грязная нода в БД подхватывается при старте.
+  6. Метрики: время прогона, задержка до sync, состояние нод.
+
+Запуск:  venv/bin/python scripts/test_xray_sync.py
+"""
+from __future__ import annotations
+
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+try:
+    sys.stdout.reconfigure(encoding="utf-8")
+except Exception:
+    pass
+
+_FAILED = 0
+
+
+def check(name: str, cond: bool) -> None:
+    global _FAILED
+    print(f"  {'✅' if cond else '❌'} {name}")
+    if not cond:
+        _FAILED += 1
+
+
+def wait_for(cond, timeout: float = 5.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if cond():
+            return True
+        time.sleep(0.02)
+    return cond()
+
+
+def main() -> int:
+    tmp = Path(tempfile.mkdtemp(prefix="xray_sync_test_"))
+    import bot.database as db
+    db.DATA_DIR = tmp
+    db.DB_PATH = tmp / "vpn.db"
+    db.USERS_JSON_PATH = tmp / "users.json"
+    db.PEERS_JSON_PATH = tmp / "peers.json"
+    db._db_initialized = False
+    db.init_db()
+    import bot.xray_sync as xs
+
+    xs._DEBOUNCE_S = 0.3
+    xs._RETRY_DELAYS_S = (0.2,)
+    lock = threading.Lock()
+    runs: list = []
+    in_flight: dict = {}
+    max_in_flight: dict = {}
+    overlap = {"nodes": 0}
+    fail = set()
+    run_time = {"s": 0.05}
+    gate = threading.Event()
+    gate.set()
+
+    def runner(server_id: str) -> None:
+        with lock:
+            in_flight[server_id] = in_flight.get(server_id, 0) + 1
+            max_in_flight[server_id] = max(max_in_flight.get(server_id, 0), in_flight[server_id])
+            overlap["nodes"] = max(overlap["nodes"], sum(1 for n in in_flight.values() if n))
+        try:
+            gate.wait(5)
+            time.sleep(run_time["s"])
+            if server_id in fail:
+                raise RuntimeError("ssh: connection refused")
+            runs.append(server_id)
+        finally:
+            with lock:
+                in_flight[server_id] -= 1
+
+    xs.set_sync_runner(runner)
+
+    def clean(server_id: str) -> bool:
+        s = db.db_xray_sync_get(server_id)
+        return bool(s) and s["requested_gen"] == s["synced_gen"]
+
+    print("1. Волна запросов")
+    xs._DEBOUNCE_S = 1.5   # окно с запасом: 50 конкурирующих записей в SQLite
+    threads = [threading.Thread(target=xs.request_xray_sync, args=("main",)) for _ in range(50)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    check("планировщик запущен первым запросом", xs.xray_sync_running())
+    check("до конца окна debounce прогона нет", not runs)
+    check("один прогон на 50 запросов", wait_for(lambda: clean("main")) and runs == ["main"])
+    check(f"coalesced = {xs._stats['coalesced']}", xs._stats["coalesced"] == 49 and xs._stats["requested"] == 50)
+    xs._DEBOUNCE_S = 0.3
+
+    print("\n2. Запросы во время прогона")
+    runs.clear()
+    gate.clear()
+    xs.request_xray_sync("main")
+    wait_for(lambda: in_flight.get("main"))
+    for _ in range(5):
+        xs.request_xray_sync("main")
+    check("нода грязная, пока идёт прогон", not clean("main"))
+    gate.set()
+    check("догоняющий прогон один", wait_for(lambda: clean("main") and len(runs) == 2) and runs == ["main", "main"])
+    time.sleep(xs._DEBOUNCE_S * 2)
+    check("лишних прогонов нет", len(runs) == 2)
+
+    print("\n3. Один прогон на ноду")
+    runs.clear()
+    run_time["s"] = 0.3
+    for i in range(20):
+        xs.request_xray_sync("main" if i % 2 else "eu1")
+        time.sleep(0.03)
+    check("обе ноды синхронизированы", wait_for(lambda: clean("main") and clean("eu1")))
+    check(f"на ноду ≤ 1 одновременно ({max_in_flight})", max(max_in_flight.values()) == 1)
+    check("разные ноды шли параллельно", overlap["nodes"] == 2)
+    # другой процесс (здесь — поток) держит лок ноды и успевает синхронизировать
+    runs.clear()
+    db.db_xray_sync_request("eu1")
+    done = []
+    holder = threading.Thread(target=lambda: done.append(xs._sync_once("eu1")))
+    holder.start()
+    wait_for(lambda: in_flight.get("eu1"))
+    second = xs._sync_once("eu1")
+    holder.join()
+    check("дождавшийся лока не гоняет sync повторно",
+          second and done == [True] and runs == ["eu1"] and xs._stats["skipped"] == 1)
+    run_time["s"] = 0.05
+
+    print("\n4. Ошибка прогона")
+    runs.clear()
+    fail.add("eu1")
+    xs.request_xray_sync("eu1")
+    wait_for(lambda: (db.db_xray_sync_get("eu1") or {}).get("failures", 0) >= 1)
+    state = db.db_xray_sync_get("eu1")
+    check(f"нода грязная, last_error={state['last_error']!r}",
+          not clean("eu1") and "connection refused" in (state["last_error"] or ""))
+    fail.clear()
+    check("повтор довёл до sync", wait_for(lambda: clean("eu1")) and runs == ["eu1"])
+    check("счётчик неудач сброшен", db.db_xray_sync_get("eu1")["failures"] == 0 and xs._stats["failed"] >= 1)
+
+    print("\n5. Флаг переживает падение")
+    xs.xray_sync_stop()
+    runs.clear()
+    db.db_xray_sync_request("main")
+    db.db_xray_sync_request("main")
+    check("без планировщика нода остаётся грязной", not clean("main") and not runs)
+    xs.xray_sync_start()
+    check("после старта — подхвачена и синхронизирована одним прогоном",
+          wait_for(lambda: clean("main")) and runs == ["main"])
+
+    print("\n6. Метрики")
+    stats = xs.xray_sync_stats()
+    check(f"avg_run_ms={stats['avg_run_ms']:.0f}, max_lag_ms={stats['max_lag_ms']:.0f}",
+          stats["avg_run_ms"] > 0 and stats["max_lag_ms"] >= xs._DEBOUNCE_S * 1000 * 0.9)
+    check(f"ноды: {sorted(stats['nodes'])}",
+          set(stats["nodes"]) == {"main", "eu1"} and not any(n["dirty"] for n in stats["nodes"].values()))
+    check("eu1 / main — свои скрипты",
+          xs.sync_command("eu1")[-1].endswith("sync_eu1_vless.py")
+          and xs.sync_command("main")[-3:][1:] == ["--server", "main"])
+    xs.xray_sync_stop()
+
+    print()
+    if _FAILED:
+        print(f"❌ ПРОВАЛЕНО проверок: {_FAILED}")
+        return 1
+    print("✅ Все проверки пройдены")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
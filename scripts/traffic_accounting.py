@@ -3,7 +3,7 @@
 Периодический сэмплер трафика AmneziaWG → накопительный учёт в SQLite.
 
 Запускается по cron (каждые 5 минут). Читает текущие счётчики rx/tx из
-`awg show awg0 dump` и копит lifetime-трафик в таблице traffic_accounting
+`awg show <iface> dump` всех AWG-шардов eu1 (bot/awg_shards.py) и копит lifetime-трафик в таблице traffic_accounting
 (reset-aware, см. bot.database.db_accumulate_traffic).
 
 Зачем cron, если /api/traffic тоже накапливает: панель смотрят нерегулярно,
@@ -12,27 +12,26 @@
 """
 
 import pathlib
-import subprocess
 import sys
 
 sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
 
-from bot.storage import get_all_peers
+from bot.awg_shards import awg_dump_all
+from bot.storage import get_peers_by_server
 from bot.database import db_accumulate_traffic, db_record_traffic_snapshot, init_db
 
 
 def _awg_dump() -> str:
-    """awg живёт внутри Docker-контейнера amnezia-awg2."""
+    """awg живёт внутри Docker-контейнеров шардов; шард без ответа пропускаем —
+    его счётчики докопятся следующим прогоном (учёт reset-aware)."""
     try:
-        out = subprocess.run(
-            ["docker", "exec", "amnezia-awg2", "awg", "show", "awg0", "dump"],
-            capture_output=True, text=True, timeout=15,
-        )
-        if out.returncode == 0:
-            return out.stdout
-    except Exception:
-        pass
-    return ""
+        dump, failed = awg_dump_all(timeout=15)
+    except Exception as e:  # noqa: BLE001
+        print(f"traffic_accounting: awg dump failed: {e}", flush=True)
+        return ""
+    if failed:
+        print(f"traffic_accounting: no dump from shards {', '.join(failed)}", flush=True)
+    return dump
 
 
 def main() -> int:
@@ -57,9 +56,7 @@ def main() -> int:
 
     samples = []
     total_bytes_this_run = 0
-    for peer in get_all_peers():
-        if peer.server_id != "eu1" or not peer.active:
-            continue
+    for peer in get_peers_by_server("eu1", active_only=True):
         pk = (peer.public_key or "").strip()
         if pk in transfer:
             rx, tx = transfer[pk]
@@ -2,8 +2,9 @@
 """
 Диагностика трафика AmneziaWG за временное окно: кто качал, сколько.
 
-Источник: таблица traffic_snapshots (заполняется traffic_accounting.py каждые 5 мин,
-хранится 14 дней). См. db_record_traffic_snapshot / db_query_traffic_delta.
+Источник: traffic_snapshots (сырые 5-мин снимки traffic_accounting.py, ~3 дня) +
+traffic_rollup (часовые ~90 дней / дневные ~3 года бакеты). Окно читается в самом
+грубом разрешении, которое его покрывает. См. db_query_traffic_window.
 
 Использование:
     # Окно "вчера 20-21 МСК" (= 17-18 UTC)
@@ -18,7 +19,8 @@
 Время — UTC (как пишется в БД). МСК = UTC+3.
 
 Вывод: top-15 пользователей по приросту трафика за окно + сводка за окно
-(общий объём, средняя скорость, пиковая по 5-минутному интервалу).
+(общий объём, средняя скорость, пиковая по 5-минутному интервалу — пока
+сырые снимки окна ещё не вычищены).
 """
 from __future__ import annotations
 
@@ -30,7 +32,9 @@ from datetime import datetime, timedelta, timezone
 
 sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
 
-from bot.database import db_query_traffic_delta, _conn, _ensure_init  # type: ignore
+from bot.database import (  # type: ignore
+    db_query_traffic_window, db_traffic_window_plan, _conn, _ensure_init,
+)
 
 
 def _parse_last(spec: str) -> tuple[str, str]:
@@ -124,10 +128,13 @@ def main() -> int:
 
     print(f"Window: {start_ts} .. {end_ts} (UTC)")
 
-    results = db_query_traffic_delta(start_ts, end_ts)
+    plan = db_traffic_window_plan(start_ts, end_ts)
+    print("Resolution: " + ", ".join(f"{res} [{lo} .. {hi})" for res, lo, hi in plan))
+
+    results = db_query_traffic_window(start_ts, end_ts)
 
     if not results:
-        print("\nNo snapshots in window. (Может быть окно вне 14-дневного retention,")
+        print("\nNo traffic in window. (Окно старше retention дневных бакетов")
         print("или traffic_accounting cron не запускался.)")
         return 0
 
@@ -1,68 +1,88 @@
 #!/usr/bin/env python3
 """
-Периодический сэмплер VLESS-трафика → накопительный учёт в SQLite.
+Сборщик VLESS-трафика → накопительный учёт в SQLite.
 
-Запускается по cron каждые 5 минут на Fornex. Для каждого сервера (eu1
-локально, main и yc через SSH) вызывает `xray api statsquery` и забирает:
+Для каждого сервера (eu1 локально, main через постоянную SSH-сессию
+bot/ssh_sessions) ОДИН вызов `xray api statsquery -reset` за опрос: Xray
+отдаёт все счётчики и обнуляет их, т.е. каждый опрос — чистые дельты с
+прошлого. Из них:
   1. inbound>>>vless-*>>>traffic>>>uplink/downlink → vless_server_traffic
      (per-server aggregate — для шапки админки)
   2. user>>>tid_X@kronos>>>traffic>>>uplink/downlink → vless_user_traffic
-     (per-user — для статуса юзеров в админке, доступно с 2026-06-03
-     после Этапа 7 — добавили policy.levels.0.statsUser* + per-user UUIDs)
+     (per-user — для статуса юзеров в админке; с per-user UUID на eu1
+     (sync_eu1_vless.py) — теперь и для eu1, не только main)
+Дельты сервера прибавляются к lifetime одной транзакцией
+(db_add_vless_traffic_deltas). Первый -reset после --snapshot отдаёт весь
+счётчик с запуска Xray — он сверяется с last_rx/last_tx снимка, чтобы
+уже учтённое не прибавилось дважды. Нулевые счётчики не пишутся.
 
-Накопление reset-aware (при рестарте Xray счётчики обнуляются, БД продолжает
-копить lifetime).
+Раньше: два statsquery без -reset на сервер (inbound и user) + reset-aware
+дифф со снимком в БД. Режим остался как --snapshot (откат).
 
-eu1 пока без per-user телеметрии — там общие UUIDs ещё (отдельная задача).
-Per-user пишется только для main/yc.
+Дельты между -reset и записью в БД нигде больше не хранятся, поэтому при
+ошибке БД они дописываются в data/vless_deltas_spool.jsonl и досылаются
+следующим опросом. Потеряются только дельты опроса, ответ которого не
+дошёл (SSH оборвался после -reset), — не больше одного интервала.
+
+⚠ -reset и --snapshot одновременно НЕ запускать (и никакой другой читатель
+счётчиков Xray): каждый видит только часть трафика / считает дважды.
+
+Запуск:
+    venv/bin/python scripts/vless_summary_accounting.py            # один опрос (cron */5)
+    venv/bin/python scripts/vless_summary_accounting.py --loop 30  # демон, опрос раз в 30 с
+    venv/bin/python scripts/vless_summary_accounting.py --snapshot # старый режим (без -reset)
 """
 
+import argparse
 import json
 import pathlib
 import re
 import subprocess
 import sys
+import time
 from typing import Dict, List, Optional, Tuple
 
 sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
 
-from bot.database import (
+from bot import database  # noqa: E402
+from bot.database import (  # noqa: E402
     db_accumulate_vless_server_traffic,
     db_accumulate_vless_user_traffic,
+    db_add_vless_traffic_deltas,
     init_db,
 )
+from bot.ssh_sessions import run_ssh  # noqa: E402
 
 # Email-маркер per-user UUID: tid_<telegram_id>@kronos
 _USER_EMAIL_RE = re.compile(r"^tid_(\d+)@kronos$")
 
-# Команды SSH для удалённых серверов — те же опции что в health_check.py.
-SSH_OPTS = [
-    "-o", "ConnectTimeout=5",
-    "-o", "BatchMode=yes",
-    "-o", "StrictHostKeyChecking=accept-new",
-    "-o", "ServerAliveInterval=3",
-    "-o", "ServerAliveCountMax=1",
-]
-REMOTE_SSH: Dict[str, List[str]] = {
-    "main": ["ssh", "-i", "/root/.ssh/id_ed25519_main"] + SSH_OPTS + ["root@81.200.146.32"],
+# Удалённые серверы — через run_ssh (ControlMaster: при опросе раз в 30 с
+# handshake не повторяется, команда идёт каналом живого коннекта).
+REMOTE_SSH: Dict[str, Dict[str, str]] = {
+    "main": {"host": "81.200.146.32", "user": "root", "key_path": "/root/.ssh/id_ed25519_main"},
     # yc убран 2026-06-28 (снос YC)
 }
+SERVERS = ["eu1", "main"]  # eu1 — локально
 
-# Какие серверы пинговать (eu1 — локально, через docker/локальный xray).
 XRAY_API_ADDR = "127.0.0.1:10085"
+SPOOL_NAME = "vless_deltas_spool.jsonl"
 
 
-def _query_xray_stats(server: str, pattern: str) -> Optional[Dict]:
+def _query_xray_stats(server: str, pattern: str = "", reset: bool = False) -> Optional[Dict]:
     """
-    Универсальный wrapper для `xray api statsquery -pattern=...`.
-    Возвращает parsed JSON `{"stat": [...]}` или None при ошибке.
+    Универсальный wrapper для `xray api statsquery [-pattern=...] [-reset]`.
+    Пустой pattern — все счётчики. Возвращает parsed JSON `{"stat": [...]}`
+    или None при ошибке.
     """
+    args = [f"--server={XRAY_API_ADDR}"]
+    if pattern:
+        args.append(f"-pattern={pattern}")
+    if reset:
+        args.append("-reset")
     try:
         if server == "eu1":
             r = subprocess.run(
-                ["xray", "api", "statsquery",
-                 f"--server={XRAY_API_ADDR}",
-                 f"-pattern={pattern}"],
+                ["xray", "api", "statsquery"] + args,
                 capture_output=True, text=True, timeout=15,
             )
         else:
@@ -70,15 +90,10 @@ def _query_xray_stats(server: str, pattern: str) -> Optional[Dict]:
             if not ssh:
                 print(f"vless_summary: unknown server {server}", flush=True)
                 return None
-            # SSH: pattern в одинарных кавычках чтобы `>>>` не интерпретировался shell
-            remote_cmd = (
-                f"xray api statsquery --server={XRAY_API_ADDR} "
-                f"'-pattern={pattern}'"
-            )
-            r = subprocess.run(
-                ssh + [remote_cmd],
-                capture_output=True, text=True, timeout=15,
-            )
+            # SSH: аргументы в одинарных кавычках чтобы `>>>` не интерпретировался shell
+            remote_cmd = "xray api statsquery " + " ".join(f"'{a}'" for a in args)
+            r = run_ssh(ssh["host"], remote_cmd, user=ssh["user"], key_path=ssh["key_path"],
+                        timeout=15, connect_timeout=5)
     except subprocess.TimeoutExpired:
         print(f"vless_summary: timeout querying {server} pattern={pattern!r}", flush=True)
         return None
@@ -91,110 +106,168 @@ def _query_xray_stats(server: str, pattern: str) -> Optional[Dict]:
         return None
 
     try:
-        return json.loads(r.stdout)
+        return json.loads(r.stdout or "{}")
     except json.JSONDecodeError as e:
         print(f"vless_summary: {server} JSON parse error: {e}", flush=True)
         return None
 
 
-def _query_inbound_samples(server: str) -> Optional[List[Dict]]:
-    """Per-inbound (server-aggregate) samples — для vless_server_traffic."""
-    data = _query_xray_stats(server, "inbound>>>vless")
-    if data is None:
-        return None
-    by_tag: Dict[str, Dict[str, int]] = {}
-    for stat in data.get("stat") or []:
-        name = stat.get("name") or ""
-        value = int(stat.get("value") or 0)
-        parts = name.split(">>>")
-        if len(parts) != 4 or parts[0] != "inbound" or parts[2] != "traffic":
+def _parse_traffic(stats: List[Dict], kind: str) -> Dict[str, Dict[str, int]]:
+    """`<kind>>>><name>>>>traffic>>>uplink|downlink` → {name: {"rx", "tx"}}."""
+    out: Dict[str, Dict[str, int]] = {}
+    for stat in stats:
+        parts = (stat.get("name") or "").split(">>>")
+        if len(parts) != 4 or parts[0] != kind or parts[2] != "traffic":
             continue
-        tag = parts[1]
-        direction = parts[3]
-        bucket = by_tag.setdefault(tag, {"rx": 0, "tx": 0})
-        if direction == "uplink":
-            bucket["rx"] = value
-        elif direction == "downlink":
-            bucket["tx"] = value
+        bucket = out.setdefault(parts[1], {"rx": 0, "tx": 0})
+        if parts[3] == "uplink":
+            bucket["rx"] = int(stat.get("value") or 0)
+        elif parts[3] == "downlink":
+            bucket["tx"] = int(stat.get("value") or 0)
+    return out
+
+
+def _inbound_samples(stats: List[Dict]) -> List[Dict]:
     return [
         {"inbound_tag": tag, "rx": v["rx"], "tx": v["tx"]}
-        for tag, v in by_tag.items()
+        for tag, v in _parse_traffic(stats, "inbound").items()
+        if tag.startswith("vless")
     ]
 
 
-def _query_user_samples(server: str) -> Optional[List[Dict]]:
-    """
-    Per-user samples для main/yc — vless_user_traffic.
-    Парсит email-маркеры `tid_<telegram_id>@kronos`.
-    Возвращает [{"telegram_id": int, "rx": int, "tx": int}, ...].
-    """
-    data = _query_xray_stats(server, "user>>>")
+def _user_samples(stats: List[Dict]) -> List[Dict]:
+    """Парсит email-маркеры `tid_<telegram_id>@kronos` → [{"telegram_id", "rx", "tx"}]."""
+    out = []
+    for email, v in _parse_traffic(stats, "user").items():
+        m = _USER_EMAIL_RE.match(email)
+        if m:
+            out.append({"telegram_id": int(m.group(1)), "rx": v["rx"], "tx": v["tx"]})
+    return out
+
+
+def collect_deltas(server: str) -> Optional[Tuple[List[Dict], List[Dict]]]:
+    """Один statsquery -reset: (inbound-дельты, per-user дельты), нулевые
+    отброшены. None — сервер не ответил (счётчики не сброшены)."""
+    data = _query_xray_stats(server, reset=True)
     if data is None:
         return None
-    by_tid: Dict[int, Dict[str, int]] = {}
-    for stat in data.get("stat") or []:
-        name = stat.get("name") or ""
-        value = int(stat.get("value") or 0)
-        # name: user>>>tid_<X>@kronos>>>traffic>>>uplink|downlink
-        parts = name.split(">>>")
-        if len(parts) != 4 or parts[0] != "user" or parts[2] != "traffic":
+    stats = data.get("stat") or []
+    return (
+        [s for s in _inbound_samples(stats) if s["rx"] or s["tx"]],
+        [s for s in _user_samples(stats) if s["rx"] or s["tx"]],
+    )
+
+
+def _spool_path() -> pathlib.Path:
+    return pathlib.Path(database.DATA_DIR) / SPOOL_NAME
+
+
+def _store_deltas(server: str, inbound: List[Dict], users: List[Dict]) -> bool:
+    """Дельты в БД; не вышло — в spool (досылаются следующим опросом)."""
+    try:
+        db_add_vless_traffic_deltas(server, inbound, users)
+        return True
+    except Exception as e:  # noqa: BLE001
+        print(f"vless_summary: {server} запись в БД не удалась ({e}) — дельты в spool", flush=True)
+        path = _spool_path()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"server": server, "inbound": inbound, "users": users}) + "\n")
+        return False
+
+
+def replay_spool() -> int:
+    """Досылает дельты, не записанные прошлыми опросами. Возвращает число записанных."""
+    path = _spool_path()
+    pending = path.with_suffix(".replay")   # остался — прошлый replay прервался
+    if not path.exists() and not pending.exists():
+        return 0
+    lines = pending.read_text(encoding="utf-8").splitlines() if pending.exists() else []
+    if path.exists():
+        lines += path.read_text(encoding="utf-8").splitlines()
+        pending.write_text("\n".join(lines) + "\n", encoding="utf-8")
+        path.unlink()
+    done = 0
+    for line in lines:
+        if not line.strip():
             continue
-        m = _USER_EMAIL_RE.match(parts[1])
-        if not m:
+        try:
+            entry = json.loads(line)
+        except json.JSONDecodeError:
+            print(f"vless_summary: битая строка spool пропущена: {line[:100]!r}", flush=True)
             continue
-        tid = int(m.group(1))
-        direction = parts[3]
-        bucket = by_tid.setdefault(tid, {"rx": 0, "tx": 0})
-        if direction == "uplink":
-            bucket["rx"] = value
-        elif direction == "downlink":
-            bucket["tx"] = value
-    return [
-        {"telegram_id": tid, "rx": v["rx"], "tx": v["tx"]}
-        for tid, v in by_tid.items()
-    ]
+        if _store_deltas(entry["server"], entry["inbound"], entry["users"]):
+            done += 1
+    pending.unlink()
+    return done
 
 
-def main() -> int:
-    init_db()
-    servers_processed = 0
-    total_rx_tx_this_run = 0
-    total_user_samples = 0
+def poll_once(servers: List[str] = SERVERS) -> Dict[str, Optional[Tuple[int, int]]]:
+    """Один опрос всех серверов: {server: (байт за интервал, юзеров с трафиком)},
+    None — сервер не ответил."""
+    replayed = replay_spool()
+    if replayed:
+        print(f"vless_summary: из spool дослано {replayed}", flush=True)
+    out: Dict[str, Optional[Tuple[int, int]]] = {}
+    for server in servers:
+        deltas = collect_deltas(server)
+        if deltas is None:
+            out[server] = None
+            continue
+        inbound, users = deltas
+        if inbound or users:
+            _store_deltas(server, inbound, users)
+        out[server] = (sum(s["rx"] + s["tx"] for s in inbound), len(users))
+    return out
 
-    for server in ["eu1", "main"]:  # yc убран 2026-06-28 (снос YC)
-        # 1. Per-inbound aggregate (для шапки админки — vless_server_traffic)
-        inbound_samples = _query_inbound_samples(server)
-        if inbound_samples is None:
+
+def snapshot_once() -> int:
+    """Старый режим: снимки без -reset + reset-aware дифф в БД (только main per-user)."""
+    servers_processed = 0
+    for server in SERVERS:
+        data = _query_xray_stats(server, "inbound>>>vless")
+        if data is None:
             continue
         servers_processed += 1
+        inbound_samples = _inbound_samples(data.get("stat") or [])
         db_accumulate_vless_server_traffic(server, inbound_samples)
-        per_server = sum(s["rx"] + s["tx"] for s in inbound_samples)
-        total_rx_tx_this_run += per_server
-        tags_summary = ", ".join(
-            f"{s['inbound_tag']}={(s['rx']+s['tx'])/1024**2:.1f}MB"
-            for s in inbound_samples if (s["rx"] + s["tx"]) > 0
-        ) or "all-zero"
-
-        # 2. Per-user (для статуса VLESS-юзеров — vless_user_traffic).
-        # Только main (eu1 пока на общих UUIDs, телеметрия = inbound-aggregate; yc убран 06-28).
-        user_count = 0
         if server == "main":
-            user_samples = _query_user_samples(server)
+            users = _query_xray_stats(server, "user>>>")
+            user_samples = _user_samples((users or {}).get("stat") or [])
             if user_samples:
                 db_accumulate_vless_user_traffic(server, user_samples)
-                user_count = sum(1 for s in user_samples if (s["rx"] + s["tx"]) > 0)
-                total_user_samples += user_count
+    print(f"vless_summary: snapshot — {servers_processed}/{len(SERVERS)} servers", flush=True)
+    return 0
 
-        suffix = f", per-user={user_count} active" if server == "main" else ""
-        print(f"vless_summary[{server}]: {tags_summary}{suffix}", flush=True)
 
-    print(
-        f"vless_summary: done — {servers_processed}/2 servers, "
-        f"total rx+tx={total_rx_tx_this_run / 1024**2:.1f} MB, "
-        f"per-user samples with traffic={total_user_samples}",
-        flush=True,
-    )
-    return 0
+def _report(result: Dict[str, Optional[Tuple[int, int]]]) -> None:
+    parts = []
+    for server, r in result.items():
+        parts.append(f"{server}=нет ответа" if r is None else f"{server}={r[0] / 1024**2:.1f}MB/{r[1]} users")
+    print(f"vless_summary: {', '.join(parts)}", flush=True)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="VLESS-трафик (xray statsquery -reset) → SQLite")
+    ap.add_argument("--loop", type=float, default=0,
+                    help="Опрашивать раз в N секунд (демон); 0 — один опрос (cron)")
+    ap.add_argument("--snapshot", action="store_true",
+                    help="Старый режим: без -reset, дифф со снимком в БД")
+    args = ap.parse_args(argv)
+    init_db()
+    if args.snapshot:
+        return snapshot_once()
+    if args.loop <= 0:
+        result = poll_once()
+        _report(result)
+        return 0 if any(r is not None for r in result.values()) else 1
+    try:
+        while True:
+            t0 = time.monotonic()
+            _report(poll_once())
+            time.sleep(max(0.0, args.loop - (time.monotonic() - t0)))
+    except KeyboardInterrupt:
+        return 0
 
 
 if __name__ == "__main__":
@@ -27,6 +27,8 @@ import io
 import json
 import logging
 import pathlib
+import re
+import secrets
 import shlex
 import socket
 import subprocess
@@ -34,8 +36,8 @@ import threading
 import time
 import urllib.parse
 import urllib.request
-from datetime import datetime
-from typing import Dict, List, Optional
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
 
 from flask import Flask, Response, jsonify, redirect, render_template, render_template_string, request, session, url_for
 from werkzeug.security import generate_password_hash, check_password_hash
@@ -45,14 +47,20 @@ from werkzeug.middleware.proxy_fix import ProxyFix
 import sys
 sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
 
-from bot.config import get_effective_mtproto_proxy_link, load_config, _parse_env_file
+from bot.awg_shards import awg_dump_all
+from bot.config import (
+    config_version,
+    get_effective_mtproto_proxy_link,
+    load_config,
+    load_config_cached,
+    _parse_env_file,
+)
 from bot.storage import Peer, User, get_all_peers, get_all_users, find_user
 from bot import tariffs
 from bot.formatting import format_subscription_status
 from bot.database import (
     db_list_devices,
     db_get_device,
-    db_add_device,
     db_delete_device,
     db_rename_device,
     db_count_devices,
@@ -68,6 +76,7 @@ from bot.database import (
     db_get_effective_telegram_id,
     db_get_trial_data_status,
     db_get_all_users,
+    db_read_cache_stats,
     db_count_subscription_split,
     db_accumulate_traffic,
     db_get_lifetime_by_user,
@@ -82,6 +91,7 @@ from bot.database import (
     db_ensure_sub_token,
     db_find_user_by_sub_token,
     db_is_access_active,
+    db_is_access_active_row,
     db_find_user_by_telegram_id,
     db_ensure_signup_trial,
     db_record_payment,
@@ -100,9 +110,24 @@ from bot.database import (
     db_get_per_user_vless_uuid,
     db_get_vless_user_last_seen,
     db_get_vless_user_lifetime,
+    db_query_traffic_window,
+    db_traffic_window_plan,
     init_db,
+    db_write_queue_start,
+    TRAFFIC_WINDOW_MAX_DAYS,
 )
 from bot.email_otp import generate_otp, send_otp_email
+from bot.awg_warm_pool import warm_pool_stats
+from bot.provision_queue import (
+    provision_queue_start,
+    provision_queue_stats,
+    set_job_listener,
+    submit_job,
+    take_job_result,
+)
+from bot.ssh_sessions import ssh_session_stats
+from bot.sub_cache import etag_matches, sub_cache_stats, sub_render_cached, sub_stamp
+from bot.xray_sync import request_xray_sync, xray_sync_start, xray_sync_stats
 from bot.wireguard_peers import (
     WireGuardError,
     create_amneziawg_peer_and_config_for_user,
@@ -130,6 +155,11 @@ try:
     ADMIN_ID = config.admin_id
     # Инициализируем SQLite DB (включая миграцию users.json)
     init_db(whitelist_seed=config.telegram_id_whitelist or [])
+    if config.db_write_queue:
+        db_write_queue_start()
+    if config.provision_queue:
+        provision_queue_start("web", workers_per_node=config.provision_workers_per_node)
+    xray_sync_start()
 except Exception as e:
     logger.error(f"Ошибка загрузки конфига/БД: {e}")
     ADMIN_ID = None
@@ -440,17 +470,15 @@ def _parse_wg_dump_full(stdout: str) -> Dict[str, Dict]:
 
 
 def _get_awg_dump_eu1() -> str:
-    """awg живёт внутри Docker-контейнера amnezia-awg2."""
+    """awg живёт внутри Docker-контейнеров шардов (amnezia-awg2, ...) — dump всех шардов."""
     try:
-        out = subprocess.run(
-            ["docker", "exec", "amnezia-awg2", "awg", "show", "awg0", "dump"],
-            capture_output=True, text=True, timeout=10,
-        )
-        if out.returncode == 0 and out.stdout.strip():
-            return out.stdout
-    except (FileNotFoundError, subprocess.TimeoutExpired, Exception):
-        pass
-    return ""
+        dump, failed = awg_dump_all(timeout=10)
+    except Exception:  # noqa: BLE001 — битый AMNEZIAWG_EU1_SHARDS не роняет панель
+        logger.exception("awg dump eu1")
+        return ""
+    if failed:
+        logger.warning("awg dump eu1: нет ответа от шардов %s", ", ".join(failed))
+    return dump
 
 
 def _get_wg_transfer_for_server(server_id: str) -> Dict[str, tuple]:
@@ -705,8 +733,40 @@ def api_traffic():
 
     Сортировка: активные (свежий handshake) → тихие с peer-ом → онбординг →
     без конфига → истёкшие. Внутри группы — по активности desc.
+
+    ?window=24h|7d|30d|... — дополнительно `window_bytes` per юзер: AWG-трафик
+    за окно из истории (traffic_rollup, самое грубое подходящее разрешение).
     """
     try:
+        window_map: Dict[int, int] = {}
+        window_info: Optional[Dict] = None
+        window_spec = (request.args.get("window") or "").strip()
+        if window_spec:
+            m = re.fullmatch(r"(\d{1,6})([hd])", window_spec)
+            if not m:
+                return jsonify({"error": "window: формат 24h / 7d"}), 400
+            n = int(m.group(1))
+            # Дальше дневных rollup'ов истории нет; огромное n ещё и переполнит timedelta.
+            max_n = TRAFFIC_WINDOW_MAX_DAYS * (24 if m.group(2) == "h" else 1)
+            if not 1 <= n <= max_n:
+                return jsonify({"error": f"window: от 1h до {TRAFFIC_WINDOW_MAX_DAYS}d"}), 400
+            span = timedelta(hours=n) if m.group(2) == "h" else timedelta(days=n)
+            end_dt = datetime.now(timezone.utc).replace(tzinfo=None)
+            start_ts = (end_dt - span).strftime("%Y-%m-%d %H:%M:%S")
+            end_ts = end_dt.strftime("%Y-%m-%d %H:%M:%S")
+            try:
+                for r in db_query_traffic_window(start_ts, end_ts, by="user"):
+                    if r["telegram_id"] is not None:
+                        window_map[int(r["telegram_id"])] = r["delta_total"]
+                window_info = {
+                    "spec": window_spec,
+                    "start": start_ts,
+                    "end": end_ts,
+                    "resolutions": [res for res, _lo, _hi in db_traffic_window_plan(start_ts, end_ts)],
+                }
+            except Exception as e:
+                logger.warning("Traffic window query failed: %s", e)
+
         peers = get_all_peers()
         dump_stdout = _get_awg_dump_eu1()
         full_data = _parse_wg_dump_full(dump_stdout) if dump_stdout else {}
@@ -858,6 +918,7 @@ def api_traffic():
                 "rx_bytes": rx,
                 "tx_bytes": tx,
                 "total_bytes": total_bytes,
+                "window_bytes": window_map.get(uid, 0) if window_info else None,
                 "vless_total_bytes": vless_total_bytes,
                 "vless_last_seen": vless_seen,  # ISO timestamp (real per-user connect)
                 "last_handshake": last_hs,
@@ -901,6 +962,7 @@ def api_traffic():
 
         resp = jsonify({
             "users": users_list,
+            "window": window_info,
             "last_update": datetime.now().isoformat(),
         })
         resp.headers["Cache-Control"] = "no-store, no-cache, must-revalidate"
@@ -1064,6 +1126,12 @@ def api_stats():
             "vless_by_server": vless_by_server,
             "vless_total_bytes": vless_total_bytes,
             "by_server": by_server,
+            "read_cache": {k: v for k, v in db_read_cache_stats().items() if k != "keys"},
+            "ssh_sessions": ssh_session_stats(),
+            "provision_queue": provision_queue_stats(),
+            "awg_warm_pool": warm_pool_stats(),
+            "xray_sync": xray_sync_stats(),
+            "sub_cache": sub_cache_stats(),
             "last_update": datetime.now().isoformat(),
         })
     except Exception as e:
@@ -1268,8 +1336,8 @@ def api_recovery_awg_config_by_email():
 # Лимит устройств — per-user по тарифу (db_get_device_limit; грандфазер/триал = 5).
 
 
-def _awg_config_payload(peer, cfg: str, os_: str, name: str = "", device_id: str = "") -> dict:
-    resp = {"ok": True, "filename": f"awg_{peer.server_id}.conf", "config": cfg, "os": os_}
+def _awg_config_payload(server_id: str, cfg: str, os_: str, name: str = "", device_id: str = "") -> dict:
+    resp = {"ok": True, "filename": f"awg_{server_id}.conf", "config": cfg, "os": os_}
     if name:
         resp["name"] = name
     if device_id:
@@ -1321,20 +1389,72 @@ def api_recovery_device_add():
         if db_count_devices(telegram_id) >= cap:
             return jsonify({"error": f"Достигнут лимит {cap} устройств по тарифу."}), 409
         name = db_device_autoname(telegram_id, os_)
-        device_id = db_add_device(telegram_id, name, os_)
-        try:
-            peer, cfg = create_amneziawg_peer_and_config_for_user(
-                telegram_id, android_safe=(os_ == "android"), server_id="eu1", platform=os_, device_id=device_id)
-        except WireGuardError as exc:
-            db_delete_device(device_id)  # откат записи устройства
-            logger.exception("device-add %s os=%s: %s", telegram_id, os_, exc)
-            return jsonify({"error": "Не удалось создать конфиг устройства."}), 500
-        return jsonify(_awg_config_payload(peer, cfg, os_, name, device_id))
+        # Повтор запроса с тем же request_id (ретрай клиента, двойной тап), пока
+        # задача идёт, → та же задача; запись устройства создаёт она сама.
+        request_id = str(body.get("request_id") or "").strip()[:64]
+        params = {
+            "telegram_id": telegram_id, "platform": os_, "android_safe": os_ == "android",
+            "device_id": secrets.token_hex(4), "device_name": name, "create_device": True,
+            "reply": "device_add",
+        }
+        job_id, _created = submit_job(
+            "awg_create", "eu1", telegram_id, params,
+            idem_key=f"web:device-add:{telegram_id}:{request_id}" if request_id else None,
+        )
+        return _provision_job_response(job_id, telegram_id)
     except Exception as e:
         logger.exception("Ошибка api/recovery/device-add: %s", e)
         return jsonify({"error": str(e)}), 500
 
 
+def _on_provision_job(job: dict) -> bool:
+    """ЛК забирает конфиг опросом (/api/recovery/job); здесь — только откат
+    записи устройства, если peer так и не создан."""
+    p = job["params"]
+    if job["status"] == "failed" and p.get("reply") == "device_add" and p.get("device_id"):
+        db_delete_device(p["device_id"])
+    return False
+
+
+set_job_listener("awg_create", _on_provision_job)
+
+
+def _provision_job_response(job_id: int, telegram_id: int):
+    """Ответ по задаче выдачи: 202 {pending} пока выполняется, конфиг — когда готова."""
+    job = take_job_result(job_id)
+    if job is None or job["telegram_id"] != telegram_id:
+        return jsonify({"error": "Задача не найдена."}), 404
+    if job["status"] in ("queued", "running"):
+        return jsonify({"ok": True, "pending": True, "job_id": job_id}), 202
+    if job["status"] == "failed":
+        logger.warning("provision job %s для %s: %s", job_id, telegram_id, job["error"])
+        return jsonify({"error": "Не удалось создать конфиг устройства."}), 500
+    r = job["result"]
+    if r is None:
+        return jsonify({"error": "Конфиг уже выдан — обнови устройство, чтобы получить новый."}), 410
+    return jsonify(_awg_config_payload(r["server_id"], r["config"], r["os"] or job["params"].get("platform", "pc"),
+                                       job["params"].get("device_name") or "", r["device_id"] or ""))
+
+
+@app.route("/api/recovery/job", methods=["POST"])
+def api_recovery_job():
+    """Статус задачи выдачи (device-add вернул 202). Тело: {token, job_id}."""
+    try:
+        body = request.get_json() or {}
+        auth, err = _verify_email_session(body)
+        if err:
+            return err
+        _u, telegram_id = auth
+        try:
+            job_id = int(body.get("job_id"))
+        except (TypeError, ValueError):
+            return jsonify({"error": "job_id required"}), 400
+        return _provision_job_response(job_id, telegram_id)
+    except Exception as e:
+        logger.exception("Ошибка api/recovery/job: %s", e)
+        return jsonify({"error": str(e)}), 500
+
+
 @app.route("/api/recovery/device-regen", methods=["POST"])
 def api_recovery_device_regen():
     """Обновить конфиг устройства. Тело: {token, device_id}."""
@@ -1353,7 +1473,7 @@ def api_recovery_device_regen():
         os_ = dev["os"]
         peer, cfg = regenerate_amneziawg_peer_and_config_for_user(
             telegram_id, android_safe=(os_ == "android"), server_id="eu1", device_id=device_id)
-        return jsonify(_awg_config_payload(peer, cfg, os_, dev["name"], device_id))
+        return jsonify(_awg_config_payload(peer.server_id, cfg, os_, dev["name"], device_id))
     except WireGuardError as exc:
         return jsonify({"error": str(exc)}), 400
     except Exception as e:
@@ -1995,29 +2115,16 @@ def _replace_uuid_in_vless_url(url: str, new_uuid: str) -> str:
 def _sync_xray_after_new_uuid(server_id: str) -> None:
     """
     Фоновая синхронизация Xray config после создания нового per-user UUID.
-    Запускается в отдельном subprocess чтобы не блокировать HTTP-ответ.
-    Юзер сразу получает ссылку; Xray-config обновится за ~5-10 сек.
+    Не блокирует HTTP-ответ: нода помечается грязной, планировщик
+    (bot/xray_sync.py) через несколько секунд делает ОДИН sync на все
+    накопившиеся UUID. Юзер сразу получает ссылку; Xray обновится за ~5-15 сек.
 
-    Если sync упадёт — юзер сможет подключиться только после следующего
-    sync (cron / повторный sync_xray_users.py вручную).
+    Если sync упадёт — флаг остаётся в БД, планировщик повторит сам.
     """
     try:
-        import subprocess as _sp
-        scripts_dir = pathlib.Path(__file__).resolve().parent.parent / "scripts"
-        # eu1 — отдельный скрипт (локальный, 3 inbound, grace); main/yc — sync_xray_users.
-        if server_id == "eu1":
-            cmd = [sys.executable, str(scripts_dir / "sync_eu1_vless.py")]
-        else:
-            cmd = [sys.executable, str(scripts_dir / "sync_xray_users.py"), "--server", server_id]
-        # Используем Popen — non-blocking, родительский процесс не ждёт
-        _sp.Popen(
-            cmd,
-            stdout=_sp.DEVNULL, stderr=_sp.DEVNULL,
-            start_new_session=True,
-        )
-        logger.info("Spawned async vless sync for server %s", server_id)
+        request_xray_sync(server_id)
     except Exception as e:
-        logger.warning("Failed to spawn sync_xray_users for %s: %s", server_id, e)
+        logger.warning("Failed to schedule xray sync for %s: %s", server_id, e)
 
 
 # Маппинг VLESS-сервера → ENV-атрибут (для генерации ссылок)
@@ -2028,39 +2135,43 @@ _VLESS_SERVER_TO_ATTR = {
 }
 
 
-def _personalize_vless_url(template_url: str, server_id: str, telegram_id: int) -> str:
+def _personalize_vless_url(template_url: str, server_id: str, telegram_id: int) -> Tuple[str, bool]:
     """
     Берёт env-template (общий vless://OLD_UUID@...) и подставляет per-user UUID
     для конкретного юзера. Если UUID ещё не создан в БД — создаёт + триггерит
     async sync Xray (≈10 сек до готовности на сервере).
 
-    Если что-то пошло не так — возвращает оригинальный template (graceful
-    degradation: юзер получит общую ссылку, продолжит работать как раньше).
+    Возвращает (url, подставлен ли per-user UUID). Если что-то пошло не так —
+    оригинальный template и False (graceful degradation: юзер получит общую
+    ссылку, продолжит работать как раньше; такой ответ не кешируется).
     """
     if not template_url or not telegram_id:
-        return template_url
+        return template_url, False
     try:
         existing = db_get_per_user_vless_uuid(telegram_id, server_id)
         per_user_uuid = db_get_or_create_vless_uuid(telegram_id, server_id)
         if not per_user_uuid:
-            return template_url
+            return template_url, False
         if not existing:
             # Только что создан → нужна синхронизация Xray
             _sync_xray_after_new_uuid(server_id)
-        return _replace_uuid_in_vless_url(template_url, per_user_uuid)
+        return _replace_uuid_in_vless_url(template_url, per_user_uuid), True
     except Exception as e:
         logger.warning("personalize_vless_url failed for tid=%s server=%s: %s",
                        telegram_id, server_id, e)
-        return template_url
+        return template_url, False
 
 
-def _build_subscription_links(telegram_id: Optional[int] = None) -> List[str]:
+def _build_subscription_links(
+    telegram_id: Optional[int] = None, cfg=None, fallbacks: Optional[List[str]] = None,
+) -> List[str]:
     """
     Список vless:// для subscription. Если telegram_id передан — подставляем
     per-user UUID для каждого сервера (миграция 2026-06-01). Если None
-    (legacy путь) — возвращаем общие share-ссылки из env.
+    (legacy путь) — возвращаем общие share-ссылки из env. fallbacks — сюда
+    дописываются server_id, где per-user UUID не подставился (общая ссылка).
     """
-    cfg = load_config()
+    cfg = cfg or load_config()
     out: List[str] = []
     seen = set()
     # (env_attr, default_label, server_id для per-user UUID)
@@ -2080,7 +2191,9 @@ def _build_subscription_links(telegram_id: Optional[int] = None) -> List[str]:
         seen.add(u)
         # Подстановка per-user UUID
         if telegram_id:
-            u = _personalize_vless_url(u, server_id, telegram_id)
+            u, personalized = _personalize_vless_url(u, server_id, telegram_id)
+            if not personalized and fallbacks is not None:
+                fallbacks.append(server_id)
         if "#" in u:
             base, frag = u.rsplit("#", 1)
             current = urllib.parse.unquote(frag)
@@ -2101,13 +2214,12 @@ def api_subscription(token):
     подписка → все устройства отваливаются. Сейчас все grandfathered → отдаётся всем.
     """
     try:
-        import base64 as _b64
         user = db_find_user_by_sub_token(token)
         if not user or not user.get("active"):
             return Response("", mimetype="text/plain", status=404)
 
         tid = user.get("telegram_id")
-        if tid and not db_is_access_active(int(tid)):
+        if tid and not db_is_access_active_row(user):
             # enforcement: нет доступа → пустая подписка (нет серверов)
             return Response("", mimetype="text/plain")
 
@@ -2115,30 +2227,58 @@ def api_subscription(token):
         # есть VPN-клиент с настроенной подпиской (HAPP/Streisand/...) который
         # автоматически проверяет URL каждые ~12 ч (Profile-Update-Interval).
         # Это ЛУЧШИЙ proof-of-life сигнал: клиент жив → юзер пользуется.
+        # Пишется и на 304 (write-behind, в БД не ходит).
         if tid:
             try:
                 db_update_vless_requested_at(int(tid))
             except Exception:
                 logger.warning("vless_requested_at update failed for sub tid=%s", tid)
 
-        links = _build_subscription_links(telegram_id=int(tid) if tid else None)
-        body = _b64.b64encode("\n".join(links).encode("utf-8")).decode("ascii")
-        resp = Response(body, mimetype="text/plain; charset=utf-8")
+        # Тело — из кеша (bot/sub_cache.py), пока не сменились UUID/срок/env.
+        # Неполная отрисовка (общая ссылка вместо per-user) — без кеша и ETag.
+        body, userinfo, etag = sub_render_cached(
+            token, sub_stamp(user, config_version()), lambda: _render_subscription(user),
+        )
+        if etag and etag_matches(request.headers.get("If-None-Match"), etag):
+            resp = Response(status=304)
+        else:
+            resp = Response(body, mimetype="text/plain; charset=utf-8")
         resp.headers["Profile-Update-Interval"] = "12"
-        resp.headers["Cache-Control"] = "no-store"
-        exp = user.get("expires_at")
-        if exp:
-            try:
-                ts = int(datetime.fromisoformat(exp).timestamp())
-                resp.headers["Subscription-Userinfo"] = f"upload=0; download=0; total=0; expire={ts}"
-            except (ValueError, TypeError):
-                pass
+        if etag:
+            resp.headers["ETag"] = etag
+            # no-cache (не no-store): клиент хранит ответ, но каждый раз сверяет ETag.
+            resp.headers["Cache-Control"] = "private, no-cache"
+        else:
+            resp.headers["Cache-Control"] = "private, no-store"
+        if userinfo:
+            resp.headers["Subscription-Userinfo"] = userinfo
         return resp
     except Exception as e:
         logger.exception("api/subscription: %s", e)
         return Response("", mimetype="text/plain", status=500)
 
 
+def _render_subscription(user: Dict) -> tuple:
+    """(base64-тело, Subscription-Userinfo, полная ли) подписки юзера — то, что
+    кешируется. Неполная — где-то вместо per-user UUID общая ссылка."""
+    import base64 as _b64
+    tid = user.get("telegram_id")
+    fallbacks: List[str] = []
+    links = _build_subscription_links(
+        telegram_id=int(tid) if tid else None, cfg=load_config_cached(), fallbacks=fallbacks,
+    )
+    body = _b64.b64encode("\n".join(links).encode("utf-8")).decode("ascii")
+    userinfo = None
+    exp = user.get("expires_at")
+    if exp:
+        try:
+            ts = int(datetime.fromisoformat(exp).timestamp())
+            userinfo = f"upload=0; download=0; total=0; expire={ts}"
+        except (ValueError, TypeError):
+            pass
+    return body, userinfo, not fallbacks
+
+
 # ════════════════════ §8 · AUTH API: OTP / пароль / tg-webapp ════════════════════
 @app.route("/api/auth/send-otp", methods=["POST"])
 def api_auth_send_otp():
@@ -1211,15 +1211,35 @@ document.addEventListener('DOMContentLoaded', () => {
     deviceResult.appendChild(e);
   }
 
+  // device-add при PROVISION_QUEUE отвечает 202 {pending, job_id} — конфиг
+  // создаётся в фоне; опрашиваем /api/recovery/job, пока задача не завершится.
+  async function _waitProvisionJob(r, d) {
+    const deadline = Date.now() + 180000;
+    while (r.status === 202 && d.pending && Date.now() < deadline) {
+      await new Promise((res) => setTimeout(res, 1500));
+      r = await fetch('/api/recovery/job', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ token: sessionToken, job_id: d.job_id }),
+      });
+      d = await r.json().catch(() => ({}));
+    }
+    if (r.status === 202) return { r: { ok: false, statusText: 'Превышено время ожидания' }, d: {} };
+    return { r, d };
+  }
+
   async function addDevice(os) {
     _showDeviceResult('📲 Новое устройство', 'Создаём конфиг…');
     try {
-      const r = await fetch('/api/recovery/device-add', {
+      // request_id — ключ идемпотентности: ретрай того же запроса не создаст второе устройство.
+      const requestId = Date.now().toString(36) + Math.random().toString(36).slice(2, 10);
+      let r = await fetch('/api/recovery/device-add', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ token: sessionToken, os }),
+        body: JSON.stringify({ token: sessionToken, os, request_id: requestId }),
       });
-      const d = await r.json().catch(() => ({}));
+      let d = await r.json().catch(() => ({}));
+      ({ r, d } = await _waitProvisionJob(r, d));
       if (!r.ok) { _deviceResultError(d.error || r.statusText); haptic('error'); return; }
       haptic('success');
       deviceResult.innerHTML = '';